@@ -39,6 +39,8 @@ from rest_framework.authtoken.serializers import AuthTokenSerializer
 from catmaid.error import ClientError
 from catmaid.forms import RegisterForm
 from catmaid.control.common import get_request_list
+from catmaid.control.permissioncache import (get_permission_cache,
+        get_permission_cache_key)
 from catmaid.models import Project, UserRole, ClassInstance, \
         ClassInstanceClassInstance
 from ..tokens import account_activation_token
@@ -214,20 +216,31 @@ def requires_user_role(roles):
 
     def decorated_with_requires_user_role(f):
         def inner_decorator(request, roles=roles, *args, **kwargs):
-            p = Project.objects.get(pk=kwargs['project_id'])
             u = request.user
-
-            has_role = check_user_role(u, p, roles)
             is_token_authenticated = getattr(request, '_is_token_authenticated', False)
 
-            # If a request is authenticated through an API token permissions are
-            # required, endpoints that require write/annotate permissions also
-            # need to have the TokenAnnotate permission. This is enforced also
-            # for admin accounts.
-            if is_token_authenticated and not contains_read_roles(roles) and \
-                    settings.REQUIRE_EXTRA_TOKEN_PERMISSIONS:
-                has_role = 'can_annotate_with_token' in get_user_perms(u, p) or \
-                        'can_annotate_with_token' in get_group_perms(u, p)
+            # Recent results of the same check are reused, if enabled.
+            cache = get_permission_cache()
+            cache_key = get_permission_cache_key(u, kwargs['project_id'],
+                    roles, is_token_authenticated) if cache else None
+            has_role = cache.get(cache_key) if cache and cache_key else None
+
+            if has_role is None:
+                generation = cache.generation if cache else None
+                p = Project.objects.get(pk=kwargs['project_id'])
+                has_role = check_user_role(u, p, roles)
+
+                # If a request is authenticated through an API token permissions are
+                # required, endpoints that require write/annotate permissions also
+                # need to have the TokenAnnotate permission. This is enforced also
+                # for admin accounts.
+                if is_token_authenticated and not contains_read_roles(roles) and \
+                        settings.REQUIRE_EXTRA_TOKEN_PERMISSIONS:
+                    has_role = 'can_annotate_with_token' in get_user_perms(u, p) or \
+                            'can_annotate_with_token' in get_group_perms(u, p)
+
+                if cache and cache_key:
+                    cache.put(cache_key, has_role, generation)
 
             if has_role:
                 # The user can execute the function.
@@ -252,24 +265,34 @@ def requires_user_role_for_any_project(roles):
         def inner_decorator(request, roles=roles, *args, **kwargs):
             u = request.user
 
-            # Check for admin privs in all cases.
-            role_codesnames = set()
-            role_codesnames.add('can_administer')
+            cache = get_permission_cache()
+            cache_key = get_permission_cache_key(u, None, roles) if cache else None
+            has_role = cache.get(cache_key) if cache and cache_key else None
+
+            if has_role is None:
+                generation = cache.generation if cache else None
+
+                # Check for admin privs in all cases.
+                role_codesnames = set()
+                role_codesnames.add('can_administer')
 
-            if isinstance(roles, str):
-                roles = [roles]
-            for role in roles:
-                if role == UserRole.Annotate:
-                    role_codesnames.add('can_annotate')
-                elif role == UserRole.Browse:
-                    role_codesnames.add('can_browse')
+                if isinstance(roles, str):
+                    roles = [roles]
+                for role in roles:
+                    if role == UserRole.Annotate:
+                        role_codesnames.add('can_annotate')
+                    elif role == UserRole.Browse:
+                        role_codesnames.add('can_browse')
 
-            has_role = get_objects_and_perms_for_user(u,
-                                                      role_codesnames,
-                                                      Project,
-                                                      any_perm=True)
+                has_role = len(get_objects_and_perms_for_user(u,
+                                                              role_codesnames,
+                                                              Project,
+                                                              any_perm=True)) > 0
 
-            if len(has_role):
+                if cache and cache_key:
+                    cache.put(cache_key, has_role, generation)
+
+            if has_role:
                 # The user can execute the function.
                 return f(request, *args, **kwargs)
             else:
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import io
+import logging
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, vstack
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from catmaid.control.common import get_relation_to_id_map, Echo
+from catmaid.control.link import UNDIRECTED_LINK_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+    logger.info("CATMAID was unable to load the pyarrow library, which is an "
+          "optional dependency. Arrow IPC exports of connectivity matrices "
+          "are therefore disabled. To enable, install pyarrow.")
+
+# The number of dirty skeletons updated in one transaction by default.
+SKELETON_CONNECTIVITY_BATCH_SIZE = 1000
+
+# The number of row skeletons of a connectivity matrix that are queried
+# together. Streamed exports are written one such block at a time.
+CONNECTIVITY_MATRIX_BLOCK_SIZE = 500
+
+CONNECTIVITY_MATRIX_FORMATS = ('csv', 'npz', 'arrow')
+
+# Pairs of links on the same connector that are represented in the summary
+# table. Pairs of different relations are stored once, with the lower relation
+# ID as source. Pairs with the same relation are only meaningful for undirected
+# relations, where they are stored in both directions.
+summarized_link_pair_filter = '''
+    t1.id <> t2.id
+    AND (t1.relation_id < t2.relation_id
+      OR (t1.relation_id = t2.relation_id
+        AND t1.relation_id = ANY(%(undirected_rel_ids)s::bigint[])))
+'''
+
+
+def get_undirected_relation_ids(project_id, cursor=None) -> List[int]:
+    relations = get_relation_to_id_map(project_id, UNDIRECTED_LINK_TYPES, cursor)
+    return list(relations.values())
+
+
+def is_summarized(project_id, skeleton_ids, cursor=None) -> bool:
+    """Whether connectivity between the passed in skeletons can be read from the
+    summary table, i.e. the summary is enabled and none of the skeletons has
+    been changed since it was last updated.
+    """
+    if not getattr(settings, 'SKELETON_CONNECTIVITY_SUMMARY', False):
+        return False
+
+    if not cursor:
+        cursor = connection.cursor()
+
+    cursor.execute("""
+        SELECT EXISTS (
+            SELECT 1
+            FROM catmaid_skeleton_connectivity_dirty d
+            WHERE d.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        )
+    """, {
+        'skeleton_ids': list(skeleton_ids),
+    })
+    return not cursor.fetchone()[0]
+
+
+def get_summarized_links(project_id, source_skeleton_ids, target_skeleton_ids,
+        source_rel_id, target_rel_id, cursor=None) -> Optional[List[Tuple]]:
+    """Return a list of (source skeleton ID, target skeleton ID, confidence,
+    link count) tuples for all links of a source skeleton with the source
+    relation to a connector, which is linked to a target skeleton with the
+    target relation. The confidence is the minimum of both links. If the
+    summary table can't be used for these skeletons and relations, None is
+    returned and the links have to be read from treenode_connector.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    if source_rel_id == target_rel_id and \
+            source_rel_id not in get_undirected_relation_ids(project_id, cursor):
+        return None
+
+    source_skeleton_ids = list(source_skeleton_ids)
+    target_skeleton_ids = list(target_skeleton_ids)
+    if not is_summarized(project_id, set(source_skeleton_ids + target_skeleton_ids),
+            cursor):
+        return None
+
+    # Pairs of different relations are only stored in one direction.
+    swap = source_rel_id > target_rel_id
+    if swap:
+        source_rel_id, target_rel_id = target_rel_id, source_rel_id
+        source_skeleton_ids, target_skeleton_ids = target_skeleton_ids, source_skeleton_ids
+
+    cursor.execute("""
+        SELECT sc.source_skeleton_id, sc.target_skeleton_id, sc.confidence,
+            sc.n_links
+        FROM catmaid_skeleton_connectivity sc
+        WHERE sc.source_skeleton_id = ANY(%(source_skeleton_ids)s::bigint[])
+          AND sc.target_skeleton_id = ANY(%(target_skeleton_ids)s::bigint[])
+          AND sc.source_relation_id = %(source_rel_id)s
+          AND sc.target_relation_id = %(target_rel_id)s
+    """, {
+        'source_skeleton_ids': source_skeleton_ids,
+        'target_skeleton_ids': target_skeleton_ids,
+        'source_rel_id': source_rel_id,
+        'target_rel_id': target_rel_id,
+    })
+
+    if swap:
+        return [(r[1], r[0], r[2], r[3]) for r in cursor.fetchall()]
+    return cursor.fetchall()
+
+
+def get_summarized_partners(project_id, skeleton_ids, partner_skeleton_ids,
+        relation_id, cursor=None) -> Optional[Set[Tuple[int, int]]]:
+    """Return a set of (skeleton ID, partner skeleton ID) tuples for all
+    skeletons that are linked with the passed in relation to a connector, which
+    in turn is linked to a partner skeleton with a different relation or the
+    same relation, if it is undirected. If the summary table can't be used for
+    these skeletons, None is returned.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    skeleton_ids = list(skeleton_ids)
+    partner_skeleton_ids = list(partner_skeleton_ids)
+    if not is_summarized(project_id, set(skeleton_ids + partner_skeleton_ids),
+            cursor):
+        return None
+
+    cursor.execute("""
+        SELECT sc.source_skeleton_id, sc.target_skeleton_id
+        FROM catmaid_skeleton_connectivity sc
+        WHERE sc.source_skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+          AND sc.target_skeleton_id = ANY(%(partner_skeleton_ids)s::bigint[])
+          AND sc.source_relation_id = %(relation_id)s
+        UNION
+        SELECT sc.target_skeleton_id, sc.source_skeleton_id
+        FROM catmaid_skeleton_connectivity sc
+        WHERE sc.target_skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+          AND sc.source_skeleton_id = ANY(%(partner_skeleton_ids)s::bigint[])
+          AND sc.target_relation_id = %(relation_id)s
+    """, {
+        'skeleton_ids': skeleton_ids,
+        'partner_skeleton_ids': partner_skeleton_ids,
+        'relation_id': relation_id,
+    })
+
+    return set(cursor.fetchall())
+
+
+def update_skeleton_connectivity(project_id, skeleton_ids, cursor=None) -> None:
+    """Recompute all summary entries that involve the passed in skeletons from
+    treenode_connector.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    params = {
+        'project_id': project_id,
+        'skeleton_ids': list(skeleton_ids),
+        'undirected_rel_ids': get_undirected_relation_ids(project_id, cursor),
+    }
+
+    cursor.execute("""
+        DELETE FROM catmaid_skeleton_connectivity
+        WHERE source_skeleton_id = ANY(%(skeleton_ids)s::bigint[]);
+
+        DELETE FROM catmaid_skeleton_connectivity
+        WHERE target_skeleton_id = ANY(%(skeleton_ids)s::bigint[]);
+    """, params)
+
+    # Entries with a partner skeleton that is updated concurrently by another
+    # worker are computed by both. Since both compute the absolute link count,
+    # the later one can simply replace the existing value.
+    cursor.execute(f"""
+        INSERT INTO catmaid_skeleton_connectivity (project_id,
+            source_skeleton_id, target_skeleton_id, source_relation_id,
+            target_relation_id, confidence, n_links)
+        SELECT %(project_id)s, t1.skeleton_id, t2.skeleton_id, t1.relation_id,
+            t2.relation_id, LEAST(t1.confidence, t2.confidence), COUNT(*)
+        FROM (
+            SELECT DISTINCT tc.connector_id
+            FROM treenode_connector tc
+            WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ) c
+        JOIN treenode_connector t1
+            ON t1.connector_id = c.connector_id
+        JOIN treenode_connector t2
+            ON t2.connector_id = c.connector_id
+        WHERE (t1.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            OR t2.skeleton_id = ANY(%(skeleton_ids)s::bigint[]))
+          AND {summarized_link_pair_filter}
+        GROUP BY t1.skeleton_id, t2.skeleton_id, t1.relation_id,
+            t2.relation_id, LEAST(t1.confidence, t2.confidence)
+        ON CONFLICT (source_skeleton_id, target_skeleton_id,
+            source_relation_id, target_relation_id, confidence)
+        DO UPDATE SET n_links = EXCLUDED.n_links
+    """, params)
+
+
+def update_dirty_skeleton_connectivity(project_ids=None,
+        batch_size=SKELETON_CONNECTIVITY_BATCH_SIZE, cursor=None) -> int:
+    """Claim, recompute and remove one batch of dirty skeletons. Each batch is
+    claimed using SELECT ... FOR UPDATE SKIP LOCKED, so that multiple workers
+    can process the queue in parallel. Skeletons that are changed while a batch
+    is processed, are marked dirty again once the batch is committed. Returns
+    the number of processed skeletons.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    with transaction.atomic():
+        cursor.execute(f"""
+            SELECT skeleton_id, project_id
+            FROM catmaid_skeleton_connectivity_dirty
+            {'WHERE project_id = ANY(%(project_ids)s::integer[])' if project_ids else ''}
+            ORDER BY invalidation_time
+            LIMIT %(batch_size)s
+            FOR UPDATE SKIP LOCKED
+        """, {
+            'project_ids': project_ids,
+            'batch_size': batch_size,
+        })
+        dirty_skeletons = cursor.fetchall()
+        if not dirty_skeletons:
+            return 0
+
+        project_skeletons:Dict[int, List] = {}
+        for skeleton_id, project_id in dirty_skeletons:
+            project_skeletons.setdefault(project_id, []).append(skeleton_id)
+
+        for project_id, skeleton_ids in project_skeletons.items():
+            update_skeleton_connectivity(project_id, skeleton_ids, cursor)
+
+        cursor.execute("""
+            DELETE FROM catmaid_skeleton_connectivity_dirty
+            WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        """, {
+            'skeleton_ids': [s[0] for s in dirty_skeletons],
+        })
+
+    return len(dirty_skeletons)
+
+
+def check_skeleton_connectivity(project_id, skeleton_ids=None,
+        cursor=None) -> List[Tuple]:
+    """Compare the summary entries of all skeletons in a project, or of the
+    passed in skeletons only, with the links in treenode_connector. Dirty
+    skeletons are ignored. Returns a list of (source skeleton ID, target
+    skeleton ID, source relation ID, target relation ID, confidence, summary
+    count, actual count) tuples for each mismatch.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    if skeleton_ids is None:
+        link_filter = 't1.project_id = %(project_id)s'
+        summary_filter = 'sc.project_id = %(project_id)s'
+    else:
+        link_filter = '''
+            (t1.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            OR t2.skeleton_id = ANY(%(skeleton_ids)s::bigint[]))
+        '''
+        summary_filter = '''
+            (sc.source_skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            OR sc.target_skeleton_id = ANY(%(skeleton_ids)s::bigint[]))
+        '''
+
+    cursor.execute(f"""
+        WITH actual AS (
+            SELECT t1.skeleton_id AS source_skeleton_id,
+                t2.skeleton_id AS target_skeleton_id,
+                t1.relation_id AS source_relation_id,
+                t2.relation_id AS target_relation_id,
+                LEAST(t1.confidence, t2.confidence) AS confidence,
+                COUNT(*) AS n_links
+            FROM treenode_connector t1
+            JOIN treenode_connector t2
+                ON t2.connector_id = t1.connector_id
+            WHERE {link_filter}
+              AND {summarized_link_pair_filter}
+            GROUP BY 1, 2, 3, 4, 5
+        ), summary AS (
+            SELECT sc.source_skeleton_id, sc.target_skeleton_id,
+                sc.source_relation_id, sc.target_relation_id, sc.confidence,
+                sc.n_links
+            FROM catmaid_skeleton_connectivity sc
+            WHERE {summary_filter}
+        )
+        SELECT source_skeleton_id, target_skeleton_id, source_relation_id,
+            target_relation_id, confidence, COALESCE(s.n_links, 0),
+            COALESCE(a.n_links, 0)
+        FROM summary s
+        FULL OUTER JOIN actual a
+            USING (source_skeleton_id, target_skeleton_id, source_relation_id,
+                target_relation_id, confidence)
+        WHERE s.n_links IS DISTINCT FROM a.n_links
+          AND NOT EXISTS (
+            SELECT 1 FROM catmaid_skeleton_connectivity_dirty d
+            WHERE d.skeleton_id IN (source_skeleton_id, target_skeleton_id))
+        ORDER BY 1, 2, 3, 4, 5
+    """, {
+        'project_id': project_id,
+        'skeleton_ids': list(skeleton_ids) if skeleton_ids is not None else None,
+        'undirected_rel_ids': get_undirected_relation_ids(project_id, cursor),
+    })
+
+    return cursor.fetchall()
+
+
+def mark_skeleton_connectivity_dirty(project_id, skeleton_ids=None,
+        cursor=None) -> int:
+    """Mark the passed in skeletons, or all skeletons of a project that are
+    linked or have summary entries, as dirty. They are read from treenode_connector until they are updated again.
+    Returns the number of marked skeletons.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    if skeleton_ids is None:
+        cursor.execute("""
+            INSERT INTO catmaid_skeleton_connectivity_dirty (skeleton_id, project_id)
+            SELECT skeleton_id, project_id
+            FROM treenode_connector
+            WHERE project_id = %(project_id)s
+            UNION
+            SELECT source_skeleton_id, project_id
+            FROM catmaid_skeleton_connectivity
+            WHERE project_id = %(project_id)s
+            UNION
+            SELECT target_skeleton_id, project_id
+            FROM catmaid_skeleton_connectivity
+            WHERE project_id = %(project_id)s
+            ON CONFLICT (skeleton_id)
+            DO UPDATE SET invalidation_time = EXCLUDED.invalidation_time
+        """, {
+            'project_id': project_id,
+        })
+    else:
+        cursor.execute("""
+            INSERT INTO catmaid_skeleton_connectivity_dirty (skeleton_id, project_id)
+            SELECT DISTINCT skeleton.id, %(project_id)s
+            FROM UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+            ON CONFLICT (skeleton_id)
+            DO UPDATE SET invalidation_time = EXCLUDED.invalidation_time
+        """, {
+            'project_id': project_id,
+            'skeleton_ids': list(skeleton_ids),
+        })
+
+    return cursor.rowcount
+
+
+def get_synapse_counts(project_id, row_skeleton_ids, col_skeleton_ids,
+        pre_rel_id, post_rel_id, cursor=None) -> List[Tuple[int, int, int]]:
+    """Return a list of (row skeleton ID, column skeleton ID, synapse count)
+    tuples for all pairs of row and column skeletons that are connected by at
+    least one synapse. Counts are read from the skeleton connectivity summary
+    if possible and are aggregated in the database otherwise.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    links = get_summarized_links(project_id, row_skeleton_ids,
+            col_skeleton_ids, pre_rel_id, post_rel_id, cursor)
+    if links is not None:
+        counts:Dict[Tuple[int, int], int] = {}
+        for source, target, _, n_links in links:
+            key = (source, target)
+            counts[key] = counts.get(key, 0) + n_links
+        return [(k[0], k[1], v) for k, v in counts.items()]
+
+    cursor.execute("""
+        SELECT t1.skeleton_id, t2.skeleton_id, COUNT(*)
+        FROM treenode_connector t1
+        JOIN treenode_connector t2
+            ON t2.connector_id = t1.connector_id
+        WHERE t1.skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
+          AND t2.skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
+          AND t1.relation_id = %(pre_rel_id)s
+          AND t2.relation_id = %(post_rel_id)s
+        GROUP BY t1.skeleton_id, t2.skeleton_id
+    """, {
+        'row_skeleton_ids': list(row_skeleton_ids),
+        'col_skeleton_ids': list(col_skeleton_ids),
+        'pre_rel_id': pre_rel_id,
+        'post_rel_id': post_rel_id,
+    })
+    return cursor.fetchall()
+
+
+def iter_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids,
+        block_size=CONNECTIVITY_MATRIX_BLOCK_SIZE,
+        cursor=None) -> Iterator[Tuple[int, csr_matrix]]:
+    """Yield the synapse count matrix of the passed in row and column
+    skeletons as (row offset, CSR matrix) tuples of at most `block_size` rows.
+    Rows and columns follow the order of the passed in skeleton IDs, which can
+    contain duplicates.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'), cursor)
+    pre_rel_id, post_rel_id = relations['presynaptic_to'], relations['postsynaptic_to']
+
+    rows = np.asarray(row_skeleton_ids, dtype=np.int64)
+    col_ids, col_index = np.unique(np.asarray(col_skeleton_ids, dtype=np.int64),
+            return_inverse=True)
+
+    for offset in range(0, len(rows), block_size):
+        row_ids, row_index = np.unique(rows[offset:offset + block_size],
+                return_inverse=True)
+        counts = np.array(get_synapse_counts(project_id, row_ids.tolist(),
+                col_ids.tolist(), pre_rel_id, post_rel_id, cursor),
+                dtype=np.int64).reshape(-1, 3)
+        block = coo_matrix((counts[:, 2], (np.searchsorted(row_ids, counts[:, 0]),
+                np.searchsorted(col_ids, counts[:, 1]))),
+                shape=(len(row_ids), len(col_ids))).tocsr()
+        yield offset, block[row_index][:, col_index]
+
+
+def get_sparse_connectivity_matrix(project_id, row_skeleton_ids,
+        col_skeleton_ids, cursor=None) -> csr_matrix:
+    """Return the synapse count matrix of the passed in row and column
+    skeletons as CSR matrix.
+    """
+    blocks = [b for _, b in iter_connectivity_matrix(project_id,
+            row_skeleton_ids, col_skeleton_ids, cursor=cursor)]
+    if not blocks:
+        return csr_matrix((0, len(col_skeleton_ids)), dtype=np.int64)
+    return vstack(blocks, format='csr')
+
+
+def iter_connectivity_matrix_csv(blocks, row_skeleton_ids, col_skeleton_ids,
+        names=None) -> Iterator[str]:
+    """Yield the lines of a CSV representation of a connectivity matrix, with
+    a header row of column skeletons and the row skeleton in the first column.
+    If a name mapping is provided, skeleton IDs are replaced with names.
+    """
+    if names is None:
+        names = {}
+    writer = csv.writer(Echo(), quoting=csv.QUOTE_NONNUMERIC)
+    yield writer.writerow([''] + [names.get(c, c) for c in col_skeleton_ids])
+
+    row = np.zeros(len(col_skeleton_ids), dtype=np.int64)
+    for offset, block in blocks:
+        for i in range(block.shape[0]):
+            start, end = block.indptr[i], block.indptr[i + 1]
+            row[:] = 0
+            row[block.indices[start:end]] = block.data[start:end]
+            skeleton_id = row_skeleton_ids[offset + i]
+            yield writer.writerow([names.get(skeleton_id, skeleton_id)] + row.tolist())
+
+
+def iter_connectivity_matrix_arrow(blocks, row_skeleton_ids,
+        col_skeleton_ids) -> Iterator[bytes]:
+    """Yield an Arrow IPC stream of a connectivity matrix, with one record
+    batch of (row_skeleton_id, column_skeleton_id, count) rows for each block.
+    """
+    if not pyarrow:
+        raise ValueError("Arrow export requires the pyarrow library")
+
+    schema = pyarrow.schema([
+        ('row_skeleton_id', pyarrow.int64()),
+        ('column_skeleton_id', pyarrow.int64()),
+        ('count', pyarrow.int64()),
+    ])
+    rows = np.asarray(row_skeleton_ids, dtype=np.int64)
+    cols = np.asarray(col_skeleton_ids, dtype=np.int64)
+
+    sink = io.BytesIO()
+    writer = pyarrow.RecordBatchStreamWriter(sink, schema)
+    for offset, block in blocks:
+        block = block.tocoo()
+        writer.write_batch(pyarrow.RecordBatch.from_arrays([
+            pyarrow.array(rows[offset + block.row]),
+            pyarrow.array(cols[block.col]),
+            pyarrow.array(block.data.astype(np.int64)),
+        ], schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+
+def get_connectivity_matrix_npz(matrix:csr_matrix, row_skeleton_ids,
+        col_skeleton_ids) -> bytes:
+    """Return a compressed NPZ file of a CSR connectivity matrix, which can be
+    read with scipy.sparse.load_npz(). Additionally, the arrays
+    row_skeleton_ids and column_skeleton_ids map matrix indices to skeletons.
+    """
+    buf = io.BytesIO()
+    np.savez_compressed(buf, format=matrix.format.encode('ascii'),
+            shape=matrix.shape, data=matrix.data, indices=matrix.indices,
+            indptr=matrix.indptr,
+            row_skeleton_ids=np.asarray(row_skeleton_ids, dtype=np.int64),
+            column_skeleton_ids=np.asarray(col_skeleton_ids, dtype=np.int64))
+    return buf.getvalue()
@@ -26,6 +26,7 @@ from catmaid.control.link import (create_treenode_links, LINK_TYPES,
 from catmaid.control.common import (cursor_fetch_dictionary,
         get_relation_to_id_map, get_class_to_id_map, get_request_bool,
         get_request_list)
+from catmaid.control.connectivity import get_summarized_partners
 
 
 logger = logging.getLogger(__name__)
@@ -149,6 +150,16 @@ def _many_to_many_synapses(skids1, skids2, relation_name, project_id) -> Tuple:
     relation_id = relations[relation_name]
     undirected_link_ids = [relations[link_type] for link_type in UNDIRECTED_LINK_TYPES]
 
+    # Limit both skeleton sets to skeletons that are actually connected, if the
+    # skeleton connectivity summary is up to date for them.
+    partners = get_summarized_partners(project_id, skids1, skids2, relation_id,
+            cursor)
+    if partners is not None:
+        if not partners:
+            return tuple()
+        skids1 = list(set(p[0] for p in partners))
+        skids2 = list(set(p[1] for p in partners))
+
     cursor.execute('''
     SELECT tc1.connector_id, c.location_x, c.location_y, c.location_z,
            tc1.treenode_id, tc1.skeleton_id, tc1.confidence, tc1.user_id,
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import glob
 import json
 import logging
@@ -8,8 +10,9 @@ import os
 import os.path
 from PIL import Image as PILImage, TiffImagePlugin
 import requests
+from requests.adapters import HTTPAdapter
 from time import time
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
 
 from django.conf import settings
 from django.http import HttpResponse, HttpRequest, JsonResponse
@@ -39,6 +42,8 @@ crop_output_path = os.path.join(settings.MEDIA_ROOT,
     settings.MEDIA_CROPPING_SUBDIRECTORY)
 # Whether SSL certificates should be verified
 verify_ssl = getattr(settings, 'CROPPING_VERIFY_CERTIFICATES', True)
+# The number of threads used to fetch the tiles of a cropping job
+tile_fetch_threads = getattr(settings, 'CROPPING_TILE_FETCH_THREADS', 8)
 
 
 class CropJob(object):
@@ -200,16 +205,20 @@ class ImagePart:
                     "extent should be zero!" )
 
         self.estimated_size = 0
+        self.bytes_read = 0
 
     def __str__(self):
         return (f'Image part at ({self.x_dst}, {self.y_dst}) with dimensions '
             f'({self.width}, {self.height}), Source: ({self.x_min_src}, {self.y_min_src}), '
             f'({self.x_max_src}, {self.y_min_src})')
 
-    def get_image(self):
-        # Open the image
+    def get_image(self, session=None):
+        """Fetch, decode and crop the image of this part. If a requests session
+        is passed in, it is used to reuse connections.
+        """
+        http = session if session is not None else requests
         try:
-            r = requests.get(self.path, allow_redirects=True, verify=verify_ssl, timeout=1)
+            r = http.get(self.path, allow_redirects=True, verify=verify_ssl, timeout=1)
             if not r:
                 raise ValueError(f"Could not get {self.path}")
             if r.status_code != 200:
@@ -226,14 +235,78 @@ class ImagePart:
         if self.width != src_width or self.height != src_height:
             # left upper right lower
             image = image.crop((self.x_min_src, self.y_min_src, self.x_min_src + self.width, self.y_min_src + self.height))
+        else:
+            # Decode the image right away, rather than lazily when it is
+            # pasted. This allows decoding in the fetching thread.
+            image.load()
 
         # Estimates the size in Bytes of this image part by scaling the number
         # of Bytes read with the ratio between the needed part of the image and
         # its actual size.
-        self.estimated_size = bytes_read * round(abs(float(self.width * self.height) /
+        self.bytes_read = bytes_read
+        self.estimated_size = round(bytes_read * abs(float(self.width * self.height) /
                                                      float(src_width * src_height)))
         return image
 
+
+class CropStatistics:
+    """Progress information on a cropping job.
+    """
+    def __init__(self):
+        self.start = time()
+        self.n_tiles = 0
+        self.n_bytes = 0
+        self.n_images = 0
+
+    def __str__(self):
+        duration = max(time() - self.start, 0.001)
+        return (f'{self.n_images} images were created from {self.n_tiles} '
+                f'tiles ({self.n_bytes / 1024**2:.1f} MB) in {duration:.1f} s '
+                f'({self.n_tiles / duration:.1f} tiles/s, '
+                f'{self.n_bytes / 1024**2 / duration:.1f} MB/s).')
+
+
+class TileFetcher:
+    """Fetches image parts concurrently, using a bounded pool of threads that
+    share a single HTTP session. Tasks that didn't start yet are cancelled when
+    the fetcher is closed.
+    """
+    def __init__(self, n_threads:int=None):
+        self.n_threads = max(1, n_threads or tile_fetch_threads)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.n_threads,
+                pool_maxsize=self.n_threads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.n_threads)
+        self.futures:Set[Future] = set()
+
+    def fetch(self, image_parts:List[ImagePart]) -> List[Future]:
+        """Start fetching all passed in image parts and return one future per
+        part, in the same order.
+        """
+        futures = [self.executor.submit(ip.get_image, self.session)
+                for ip in image_parts]
+        self.futures.update(futures)
+        return futures
+
+    def done(self, futures:List[Future]) -> None:
+        self.futures.difference_update(futures)
+
+    def close(self) -> None:
+        for future in self.futures:
+            future.cancel()
+        self.futures.clear()
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
 def to_x_index(x, stack, zoom_level, enforce_bounds=True) -> int:
     """ Converts a real world position to a x pixel position.
     Also, makes sure the value is in bounds.
@@ -266,22 +339,30 @@ def extract_substack(job) -> List:
     rotation requests. A list of PIL images is returned -- one for each
     slice, starting on top.
     """
+    return list(iter_substack(job))
+
+def iter_substack(job, stats:CropStatistics=None) -> Iterator:
+    """ Like extract_substack(), but PIL images are generated one after the
+    other, so that only the images of a single slice have to be kept in
+    memory. The job's bounding box is modified while the generator runs and
+    restored when it completes or is closed.
+    """
     # Treat rotation requests special
     if abs(job.rotation_cw) < 0.00001:
         # No rotation, create the sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
+        yield from iter_substack_no_rotation(job, stats)
     elif abs(job.rotation_cw - 90.0) < 0.00001:
         # 90 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation(job)
-        cropped_stack = [img.rotate(270) for img in cropped_stack]
+        for img in iter_substack_no_rotation(job, stats):
+            yield img.rotate(270)
     elif abs(job.rotation_cw - 180.0) < 0.00001:
         # 180 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation(job)
-        cropped_stack = [img.rotate(180) for img in cropped_stack]
+        for img in iter_substack_no_rotation(job, stats):
+            yield img.rotate(180)
     elif abs(job.rotation_cw - 270.0) < 0.00001:
         # 270 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation(job)
-        cropped_stack = [img.rotate(90) for img in cropped_stack]
+        for img in iter_substack_no_rotation(job, stats):
+            yield img.rotate(90)
     else:
         # Some methods do counter-clockwise rotation
         rotation_ccw = 360.0 - job.rotation_cw
@@ -309,59 +390,50 @@ def extract_substack(job) -> List:
         job.y_min = min([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
         job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
         job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
-        # Create the enlarged sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
-
-        # Next, rotate the whole result stack counterclockwise to have the
-        # actual ROI axis aligned.
-        cropped_stack = [img.rotate(rotation_ccw) for img in cropped_stack]
-
-        # Last, do a second crop to remove the not needed parts. The region
-        # to crop is defined by the relative original crop-box coordinates to
-        # to the rotated bounding box.
-        rot_bb_p1 = rotate2d(rotation_ccw,
-            [job.x_min, job.y_min], center)
-        rot_bb_p2 = rotate2d(rotation_ccw,
-            [job.x_min, job.y_max], center)
-        rot_bb_p3 = rotate2d(rotation_ccw,
-            [job.x_max, job.y_max], center)
-        rot_bb_p4 = rotate2d(rotation_ccw,
-            [job.x_max, job.y_min], center)
-        # Get bounding box minimum coordinates in world space
-        bb_x_min = min([rot_bb_p1[0], rot_bb_p2[0], rot_bb_p3[0], rot_bb_p4[0]])
-        bb_y_min = min([rot_bb_p1[1], rot_bb_p2[1], rot_bb_p3[1], rot_bb_p4[1]])
-        # Create relative final crop coordinates
-        crop_p1 = [abs(real_x_min - bb_x_min), abs(real_y_min - bb_y_min)]
-        crop_p2 = [abs(real_x_min - bb_x_min), abs(real_y_max - bb_y_min)]
-        crop_p3 = [abs(real_x_max - bb_x_min), abs(real_y_min - bb_y_min)]
-        crop_p4 = [abs(real_x_max - bb_x_min), abs(real_y_max - bb_y_min)]
-        crop_x_min = min([crop_p1[0], crop_p2[0], crop_p3[0], crop_p4[0]])
-        crop_y_min = min([crop_p1[1], crop_p2[1], crop_p3[1], crop_p4[1]])
-        crop_x_max = max([crop_p1[0], crop_p2[0], crop_p3[0], crop_p4[0]])
-        crop_y_max = max([crop_p1[1], crop_p2[1], crop_p3[1], crop_p4[1]])
-        crop_x_min_px = to_x_index(crop_x_min, job.ref_stack, job.zoom_level, False)
-        crop_y_min_px = to_y_index(crop_y_min, job.ref_stack, job.zoom_level, False)
-        crop_x_max_px = to_x_index(crop_x_max, job.ref_stack, job.zoom_level, False)
-        crop_y_max_px = to_y_index(crop_y_max, job.ref_stack, job.zoom_level, False)
-        crop_width_px = crop_x_max_px - crop_x_min_px
-        crop_height_px = crop_y_max_px - crop_y_min_px
-
-        # Crop all images (left, upper, right, lower)
-        crop_geometry = (crop_x_min_px, crop_y_min_px, crop_x_min_px + crop_width_px, crop_y_min_px + crop_height_px)
-        out_stack = []
-        for img in cropped_stack:
-            cropped = img.crop(crop_geometry)
-            out_stack.append(cropped)
-
-        cropped_stack = out_stack
-
-        # Reset the original job parameters
-        job.x_min = real_x_min
-        job.x_max = real_x_max
-        job.y_min = real_y_min
-        job.y_max = real_y_max
-
-    return cropped_stack
+
+        try:
+            # Each image of the enlarged sub-stack is rotated counterclockwise
+            # to have the actual ROI axis aligned. Then a second crop removes
+            # the not needed parts. The region to crop is defined by the
+            # relative original crop-box coordinates to to the rotated
+            # bounding box.
+            rot_bb_p1 = rotate2d(rotation_ccw,
+                [job.x_min, job.y_min], center)
+            rot_bb_p2 = rotate2d(rotation_ccw,
+                [job.x_min, job.y_max], center)
+            rot_bb_p3 = rotate2d(rotation_ccw,
+                [job.x_max, job.y_max], center)
+            rot_bb_p4 = rotate2d(rotation_ccw,
+                [job.x_max, job.y_min], center)
+            # Get bounding box minimum coordinates in world space
+            bb_x_min = min([rot_bb_p1[0], rot_bb_p2[0], rot_bb_p3[0], rot_bb_p4[0]])
+            bb_y_min = min([rot_bb_p1[1], rot_bb_p2[1], rot_bb_p3[1], rot_bb_p4[1]])
+            # Create relative final crop coordinates
+            crop_p1 = [abs(real_x_min - bb_x_min), abs(real_y_min - bb_y_min)]
+            crop_p2 = [abs(real_x_min - bb_x_min), abs(real_y_max - bb_y_min)]
+            crop_p3 = [abs(real_x_max - bb_x_min), abs(real_y_min - bb_y_min)]
+            crop_p4 = [abs(real_x_max - bb_x_min), abs(real_y_max - bb_y_min)]
+            crop_x_min = min([crop_p1[0], crop_p2[0], crop_p3[0], crop_p4[0]])
+            crop_y_min = min([crop_p1[1], crop_p2[1], crop_p3[1], crop_p4[1]])
+            crop_x_max = max([crop_p1[0], crop_p2[0], crop_p3[0], crop_p4[0]])
+            crop_y_max = max([crop_p1[1], crop_p2[1], crop_p3[1], crop_p4[1]])
+            crop_x_min_px = to_x_index(crop_x_min, job.ref_stack, job.zoom_level, False)
+            crop_y_min_px = to_y_index(crop_y_min, job.ref_stack, job.zoom_level, False)
+            crop_x_max_px = to_x_index(crop_x_max, job.ref_stack, job.zoom_level, False)
+            crop_y_max_px = to_y_index(crop_y_max, job.ref_stack, job.zoom_level, False)
+            crop_width_px = crop_x_max_px - crop_x_min_px
+            crop_height_px = crop_y_max_px - crop_y_min_px
+
+            # Crop all images (left, upper, right, lower)
+            crop_geometry = (crop_x_min_px, crop_y_min_px, crop_x_min_px + crop_width_px, crop_y_min_px + crop_height_px)
+            for img in iter_substack_no_rotation(job, stats):
+                yield img.rotate(rotation_ccw).crop(crop_geometry)
+        finally:
+            # Reset the original job parameters
+            job.x_min = real_x_min
+            job.x_max = real_x_max
+            job.y_min = real_y_min
+            job.y_max = real_y_max
 
 
 class BB:
@@ -384,7 +456,11 @@ def extract_substack_no_rotation(job) -> List:
     rotation requests. A list of PIL images is returned -- one for each
     slice, starting on top.
     """
+    return list(iter_substack_no_rotation(job))
 
+def get_stack_bounding_boxes(job) -> Dict[int, BB]:
+    """ Get a pixel space bounding box for each stack of the passed in job.
+    """
     # The actual bounding boxes used for creating the images of each stack
     # depend not only on the request, but also on the translation of the stack
     # wrt. the project. Therefore, a dictionary with bounding box information for
@@ -434,11 +510,79 @@ def extract_substack_no_rotation(job) -> List:
         bb.height = height
         s_to_bb[stack.id] = bb
 
-    # Get number of wanted slices, only the relative distance is needed and no
-    # bounds need to be enforced (otherwise we'd need to respect the translation).
+    return s_to_bb
+
+def get_n_slices(job) -> int:
+    """ Get number of wanted slices, only the relative distance is needed and
+    no bounds need to be enforced (otherwise we'd need to respect the
+    translation).
+    """
     px_z_min = to_z_index(job.z_min, job.ref_stack, job.zoom_level, False)
     px_z_max = to_z_index(job.z_max, job.ref_stack, job.zoom_level, False)
-    n_slices = px_z_max + 1 - px_z_min
+    return max(0, px_z_max + 1 - px_z_min)
+
+def get_image_parts(job, mirror, bb, nz) -> List[ImagePart]:
+    """ Get all image parts that are needed to create the image of slice nz in
+    the passed in bounding box for the passed in stack mirror.
+    """
+    stack = mirror.stack
+    # Shortcut for tile width and height
+    tile_width = mirror.tile_width
+    tile_height = mirror.tile_height
+    # Get indices for bounding tiles (0 indexed)
+    tile_x_min = int(bb.px_x_min / tile_width)
+    tile_x_max = int(bb.px_x_max / tile_width)
+    tile_y_min = int(bb.px_y_min / tile_height)
+    tile_y_max = int(bb.px_y_max / tile_height)
+    # Get the number of needed tiles for each direction
+    num_x_tiles = tile_x_max - tile_x_min + 1
+    num_y_tiles = tile_y_max - tile_y_min + 1
+    # Associate image parts with all tiles
+    image_parts = []
+    x_dst = bb.px_x_offset
+    for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
+        # The min x,y for the image part in the current tile are 0
+        # for all tiles except the first one.
+        cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
+        # The max x,y for the image part of current tile are the tile
+        # size minus one except for the last one.
+        if nx < (num_x_tiles - 1):
+            cur_px_x_max = tile_width - 1
+        else:
+            cur_px_x_max = bb.px_x_max - x * tile_width
+        # Reset y destination component
+        y_dst = bb.px_y_offset
+        for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
+            cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
+            if ny < (num_y_tiles - 1):
+                cur_px_y_max = tile_height - 1
+            else:
+                cur_px_y_max = bb.px_y_max - y * tile_height
+            # Create an image part definition
+            z = bb.px_z_min + nz
+            path = job.get_tile_path(stack, mirror, (x, y, z))
+            try:
+                part = ImagePart(path, cur_px_x_min, cur_px_x_max,
+                        cur_px_y_min, cur_px_y_max, x_dst, y_dst)
+                image_parts.append( part )
+            except Exception as e:
+                # ignore failed slices
+                logger.error(f'An error happend while creating an impagepart: {e}')
+            # Update y component of destination position
+            y_dst += cur_px_y_max - cur_px_y_min
+        # Update x component of destination position
+        x_dst += cur_px_x_max - cur_px_x_min
+
+    return image_parts
+
+def iter_substack_no_rotation(job, stats:CropStatistics=None) -> Iterator:
+    """ Like extract_substack_no_rotation(), but PIL images are generated one
+    after the other. The tiles of each image are fetched in parallel and while
+    one slice is composed, the tiles of the next slice are fetched already.
+    This limits the number of images in memory to about one slice per channel.
+    """
+    s_to_bb = get_stack_bounding_boxes(job)
+    n_slices = get_n_slices(job)
 
     # The images are generated per slice, so most of the following
     # calculations refer to 2d images.
@@ -446,92 +590,73 @@ def extract_substack_no_rotation(job) -> List:
     # Each stack to export is treated as a separate channel. The order
     # of the exported dimensions is XYCZ. This means all the channels of
     # one slice are exported, then the next slice follows, etc.
-    cropped_stack = []
+    planes = ((nz, mirror) for nz in range(n_slices) for mirror in job.stack_mirrors)
+    n_channels = len(job.stack_mirrors)
     # Accumulator for estimated result size
     estimated_total_size = 0
-    # Iterate over all slices
-    for nz in range(n_slices):
-        for mirror in job.stack_mirrors:
-            stack = mirror.stack
-            bb = s_to_bb[stack.id]
-            # Shortcut for tile width and height
-            tile_width = mirror.tile_width
-            tile_height = mirror.tile_height
-            # Get indices for bounding tiles (0 indexed)
-            tile_x_min = int(bb.px_x_min / tile_width)
-            tile_x_max = int(bb.px_x_max / tile_width)
-            tile_y_min = int(bb.px_y_min / tile_height)
-            tile_y_max = int(bb.px_y_max / tile_height)
-            # Get the number of needed tiles for each direction
-            num_x_tiles = tile_x_max - tile_x_min + 1
-            num_y_tiles = tile_y_max - tile_y_min + 1
-            # Associate image parts with all tiles
-            image_parts = []
-            x_dst = bb.px_x_offset
-            for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
-                # The min x,y for the image part in the current tile are 0
-                # for all tiles except the first one.
-                cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
-                # The max x,y for the image part of current tile are the tile
-                # size minus one except for the last one.
-                if nx < (num_x_tiles - 1):
-                    cur_px_x_max = tile_width - 1
-                else:
-                    cur_px_x_max = bb.px_x_max - x * tile_width
-                # Reset y destination component
-                y_dst = bb.px_y_offset
-                for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
-                    cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
-                    if ny < (num_y_tiles - 1):
-                        cur_px_y_max = tile_height - 1
-                    else:
-                        cur_px_y_max = bb.px_y_max - y * tile_height
-                    # Create an image part definition
-                    z = bb.px_z_min + nz
-                    path = job.get_tile_path(stack, mirror, (x, y, z))
-                    try:
-                        part = ImagePart(path, cur_px_x_min, cur_px_x_max,
-                                cur_px_y_min, cur_px_y_max, x_dst, y_dst)
-                        image_parts.append( part )
-                    except Exception as e:
-                        # ignore failed slices
-                        logger.error(f'An error happend while creating an impagepart: {e}')
-                    # Update y component of destination position
-                    y_dst += cur_px_y_max - cur_px_y_min
-                # Update x component of destination position
-                x_dst += cur_px_x_max - cur_px_x_min
-
-            # Write out the image parts and make sure the maximum allowed file
-            # size isn't exceeded.
-
-            cropped_slice = PILImage.new(mode="RGB", size=(bb.width, bb.height))
-            for ip in image_parts:
-                # Get (correctly cropped) image
-                image = ip.get_image()
-
-                # Estimate total file size and abort if this exceeds the
-                # maximum allowed file size.
-                estimated_total_size = estimated_total_size + ip.estimated_size
-                if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
-                    raise ValueError("The estimated size of the requested image "
-                                     "region is larger than the maximum allowed "
-                                     "file size: %0.2f > %s Bytes" % \
-                                     (estimated_total_size,
-                                      settings.GENERATED_FILES_MAXIMUM_SIZE))
-                # Draw the image onto result image
-                cropped_slice.paste(image, (ip.x_dst, ip.y_dst))
-                # Delete tile image - it's not needed anymore
-                del image
-
-            # Optionally, use only a single channel
-            if job.single_channel:
-                # r g b
-                cropped_slice, _, _ = cropped_slice.split()
-
-            # Add the image to the cropped stack
-            cropped_stack.append( cropped_slice )
-
-    return cropped_stack
+
+    with TileFetcher() as fetcher:
+        # Image parts and their futures of the requested planes, up to one
+        # slice ahead of the plane that is currently composed.
+        requested:deque = deque()
+
+        def next_slice():
+            nonlocal estimated_total_size
+            bb, image_parts, futures = requested.popleft()
+            cropped_slice, estimated_total_size = compose_slice(job, bb,
+                    image_parts, futures, estimated_total_size, stats)
+            fetcher.done(futures)
+            return cropped_slice
+
+        for nz, mirror in planes:
+            bb = s_to_bb[mirror.stack.id]
+            image_parts = get_image_parts(job, mirror, bb, nz)
+            requested.append((bb, image_parts, fetcher.fetch(image_parts)))
+            if len(requested) > n_channels:
+                yield next_slice()
+
+        while requested:
+            yield next_slice()
+
+def compose_slice(job, bb, image_parts, futures, estimated_total_size,
+        stats:CropStatistics=None) -> Tuple[PILImage.Image, int]:
+    """ Paste the fetched image parts into a new image of the bounding box
+    size. Returns this image along with the updated estimated total size.
+    """
+    # Write out the image parts and make sure the maximum allowed file
+    # size isn't exceeded.
+    cropped_slice = PILImage.new(mode="RGB", size=(bb.width, bb.height))
+    for ip, future in zip(image_parts, futures):
+        # Get (correctly cropped) image
+        image = future.result()
+
+        # Estimate total file size and abort if this exceeds the
+        # maximum allowed file size.
+        estimated_total_size = estimated_total_size + ip.estimated_size
+        if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+            raise ValueError("The estimated size of the requested image "
+                             "region is larger than the maximum allowed "
+                             "file size: %0.2f > %s Bytes" % \
+                             (estimated_total_size,
+                              settings.GENERATED_FILES_MAXIMUM_SIZE))
+        # Draw the image onto result image
+        cropped_slice.paste(image, (ip.x_dst, ip.y_dst))
+        # Delete tile image - it's not needed anymore
+        del image
+
+        if stats:
+            stats.n_tiles += 1
+            stats.n_bytes += ip.bytes_read
+
+    # Optionally, use only a single channel
+    if job.single_channel:
+        # r g b
+        cropped_slice, _, _ = cropped_slice.split()
+
+    if stats:
+        stats.n_images += 1
+
+    return cropped_slice, estimated_total_size
 
 def rotate2d(degrees, point, origin) -> Tuple[float, float]:
     """ A rotation function that rotates a point counter-clockwise around
@@ -547,22 +672,42 @@ def rotate2d(degrees, point, origin) -> Tuple[float, float]:
 
     return newx, newyorz
 
+def write_tiff_stack(path, images:Iterable, metadata) -> int:
+    """ Write the passed in images one after the other as pages of a new
+    multi-page TIFF file. Unlike Pillow's save_all option, this doesn't require
+    all images to be in memory at the same time. Returns the number of written
+    images.
+    """
+    n_written = 0
+    with TiffImagePlugin.AppendingTiffWriter(path, new=True) as tiff:
+        for image in images:
+            image.save(tiff, format="TIFF", compression="raw", tiffinfo=metadata)
+            tiff.newFrame()
+            n_written += 1
+    return n_written
+
 @task()
 def process_crop_job(job: CropJob, create_message=True) -> str:
     """ This method does the actual cropping. It controls the data extraction
     and the creation of the sub-stack. It can be executed as Celery task.
     """
+    stats = CropStatistics()
     try:
-        # Create the sub-stack
-        cropped_stack = extract_substack(job)
-        # Save the resulting micro_stack to a temporary location
         no_error_occured = True
         error_message = ""
         # Only produce an image if parts of stacks are within the output
-        if len(cropped_stack) > 0:
-            metadata = job.create_tiff_metadata(len(cropped_stack))
-            cropped_stack[0].save(job.output_path, compression="raw", save_all=True,
-                    append_images=cropped_stack[1:], tiffinfo=metadata)
+        n_images = get_n_slices(job) * len(job.stack_mirrors)
+        if n_images > 0:
+            # The meta data is created before the sub-stack generator changes
+            # the bounding box of the job for rotated crops.
+            metadata = job.create_tiff_metadata(n_images)
+            # Create the sub-stack and stream it to a temporary location
+            cropped_stack = iter_substack(job, stats)
+            try:
+                write_tiff_stack(job.output_path, cropped_stack, metadata)
+            finally:
+                cropped_stack.close()
+            logger.info(f'Cropping job for {job.output_path}: {stats}')
         else:
             no_error_occured = False
             error_message = "A region outside the stack has been selected. " \
@@ -588,8 +733,8 @@ def process_crop_job(job: CropJob, create_message=True) -> str:
             url = os.path.join( settings.CATMAID_URL, "crop/download/" + file_name + "/")
             msg.title = "Microstack finished"
             msg.text = "The requested microstack %s is finished. You can " \
-                    "download it from this location: <a href='%s'>%s</a>" % \
-                    (bb_text, url, url)
+                    "download it from this location: <a href='%s'>%s</a>. %s" % \
+                    (bb_text, url, url, stats)
             msg.action = url
         else:
             msg.title = "Microstack could not be created"
@@ -1,12 +1,88 @@
 # -*- coding: utf-8 -*-
 
-from typing import List
+from collections import namedtuple
+from multiprocessing import Pool
+import re
+import time
+from typing import Dict, List, Tuple
 
-from django.db import connection, transaction
+from django.db import connection, connections, transaction
 from django.core.management.base import CommandError
 
 from catmaid.models import Project
 
+
+# The default number of source IDs that are materialized in a single chunk.
+EDGE_REBUILD_CHUNK_SIZE = 100000
+
+# Shadow tables are named after the table they replace, with this suffix.
+# Indices of shadow tables use it as well until they are swapped in.
+SHADOW_SUFFIX = '_rebuild'
+
+# Describes how an edge table is materialized from a source table, whose IDs it
+# shares. The select query has to constrain rows of the source table, given by
+# its alias, with a {where} placeholder. The changed query returns the IDs of
+# all source rows whose materialization changed since transaction %(txid)s.
+# Writes to the locked tables are blocked while a shadow table is swapped in.
+EdgeTableSource = namedtuple('EdgeTableSource', ['source', 'alias', 'columns',
+        'select', 'changed', 'locked'])
+
+edge_table_sources = {
+    'treenode_edge': EdgeTableSource('treenode', 'c',
+        'id, parent_id, project_id, edge', """
+            SELECT c.id, c.parent_id, c.project_id, ST_MakeLine(
+                ST_MakePoint(c.location_x, c.location_y, c.location_z),
+                ST_MakePoint(p.location_x, p.location_y, p.location_z))
+            FROM treenode c
+            JOIN treenode p
+                ON p.id = COALESCE(c.parent_id, c.id)
+            WHERE {where}
+        """, """
+            SELECT t.id
+            FROM treenode t
+            WHERE t.txid >= %(txid)s
+            UNION
+            SELECT c.id
+            FROM treenode c
+            JOIN treenode p
+                ON p.id = c.parent_id
+            WHERE p.txid >= %(txid)s
+        """, ('treenode',)),
+    'treenode_connector_edge': EdgeTableSource('treenode_connector', 'tc',
+        'id, project_id, edge', """
+            SELECT tc.id, tc.project_id, ST_MakeLine(
+                ST_MakePoint(t.location_x, t.location_y, t.location_z),
+                ST_MakePoint(c.location_x, c.location_y, c.location_z))
+            FROM treenode_connector tc
+            JOIN treenode t
+                ON t.id = tc.treenode_id
+            JOIN connector c
+                ON c.id = tc.connector_id
+            WHERE {where}
+        """, """
+            SELECT tc.id
+            FROM treenode_connector tc
+            JOIN treenode t
+                ON t.id = tc.treenode_id
+            JOIN connector c
+                ON c.id = tc.connector_id
+            WHERE tc.txid >= %(txid)s
+                OR t.txid >= %(txid)s
+                OR c.txid >= %(txid)s
+        """, ('treenode_connector', 'treenode', 'connector')),
+    'connector_geom': EdgeTableSource('connector', 'c',
+        'id, project_id, geom', """
+            SELECT c.id, c.project_id,
+                ST_MakePoint(c.location_x, c.location_y, c.location_z)
+            FROM connector c
+            WHERE {where}
+        """, """
+            SELECT c.id
+            FROM connector c
+            WHERE c.txid >= %(txid)s
+        """, ('connector',)),
+}
+
 def rebuild_edge_tables(project_ids=None, log=None) -> None:
     """Rebuild edge tables for all passed in project IDs. If no project IDs are
     passed in, all edge tables are rebuilt.
@@ -165,6 +241,428 @@ def rebuild_edge_tables(project_ids=None, log=None) -> None:
                     '%s treenode edges, %s connector edges, %s connectors' % \
                     (num_new_tn_edges, num_new_c_edges, num_new_c_geoms))
 
+def get_project_filter(alias, project_ids) -> str:
+    return f'AND {alias}.project_id = ANY(%(project_ids)s::int[])' if project_ids else ''
+
+
+def _rebuild_edge_chunk(task) -> Tuple[str, int, int]:
+    """Materialize all rows of an edge table for a range of source IDs in a
+    single transaction and record the chunk as done. Existing rows in this
+    range are replaced, unless a shadow table is filled.
+    """
+    edge_table, target, scope, project_ids, chunk_start, chunk_end = task
+    spec = edge_table_sources[edge_table]
+    params = {
+        'min_id': chunk_start,
+        'max_id': chunk_end,
+        'project_ids': project_ids,
+    }
+    where = f'{spec.alias}.id >= %(min_id)s AND {spec.alias}.id < %(max_id)s ' + \
+            get_project_filter(spec.alias, project_ids)
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        # Changes in transactions below this horizon are visible to the
+        # following queries.
+        cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        snapshot_xmin = cursor.fetchone()[0]
+
+        if target == edge_table:
+            cursor.execute(f"""
+                DELETE FROM {target} e
+                WHERE e.id >= %(min_id)s AND e.id < %(max_id)s
+                {get_project_filter('e', project_ids)}
+            """, params)
+
+        cursor.execute(f"""
+            INSERT INTO {target} ({spec.columns})
+            {spec.select.format(where=where)}
+        """, params)
+        n_rows = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO catmaid_edge_rebuild_progress (edge_table, scope,
+                chunk_start, chunk_end, n_rows, snapshot_xmin)
+            VALUES (%(edge_table)s, %(scope)s, %(chunk_start)s, %(chunk_end)s,
+                %(n_rows)s, %(snapshot_xmin)s)
+            ON CONFLICT (edge_table, scope, chunk_start) DO UPDATE
+            SET n_rows = EXCLUDED.n_rows, snapshot_xmin = EXCLUDED.snapshot_xmin
+        """, {
+            'edge_table': target,
+            'scope': scope,
+            'chunk_start': chunk_start,
+            'chunk_end': chunk_end,
+            'n_rows': n_rows,
+            'snapshot_xmin': snapshot_xmin,
+        })
+
+    return edge_table, chunk_start, n_rows
+
+
+def create_shadow_table(cursor, edge_table) -> None:
+    """Create an empty copy of an edge table without indices or constraints
+    other than NOT NULL, but with the same storage parameters.
+    """
+    cursor.execute("""
+        SELECT reloptions FROM pg_class WHERE oid = %(table)s::regclass
+    """, {
+        'table': edge_table,
+    })
+    reloptions = cursor.fetchone()[0]
+    storage = f"WITH ({', '.join(reloptions)})" if reloptions else ''
+    cursor.execute(f"""
+        DROP TABLE IF EXISTS {edge_table}{SHADOW_SUFFIX};
+        CREATE TABLE {edge_table}{SHADOW_SUFFIX}
+            (LIKE {edge_table} INCLUDING DEFAULTS) {storage};
+    """)
+
+
+def get_table_schema(cursor, edge_table) -> Dict[str, List]:
+    """Return the definitions of all indices, constraints and triggers of a
+    table. Indices that back constraints are part of the constraints.
+    """
+    cursor.execute("""
+        SELECT c.relname, pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        JOIN pg_class c
+            ON c.oid = i.indexrelid
+        WHERE i.indrelid = %(table)s::regclass
+            AND NOT EXISTS (
+                SELECT 1 FROM pg_constraint con
+                WHERE con.conindid = i.indexrelid
+                    AND con.conrelid = i.indrelid
+            )
+    """, {
+        'table': edge_table,
+    })
+    indices = cursor.fetchall()
+
+    cursor.execute("""
+        SELECT conname, contype, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %(table)s::regclass
+    """, {
+        'table': edge_table,
+    })
+    constraints = cursor.fetchall()
+
+    cursor.execute("""
+        SELECT tgname, pg_get_triggerdef(oid)
+        FROM pg_trigger
+        WHERE tgrelid = %(table)s::regclass
+            AND NOT tgisinternal
+    """, {
+        'table': edge_table,
+    })
+    triggers = cursor.fetchall()
+
+    return {
+        'indices': indices,
+        'constraints': constraints,
+        'triggers': triggers,
+    }
+
+
+def retarget_definition(definition, edge_table) -> str:
+    """Make a definition that references an edge table reference its shadow
+    table instead.
+    """
+    return re.sub(rf'(ON|REFERENCES) (ONLY )?(\w+\.)?{edge_table}\b',
+            rf'\1 \2{edge_table}{SHADOW_SUFFIX}', definition)
+
+
+def refresh_shadow_table(cursor, edge_table, since_txid) -> int:
+    """Remove rows from a shadow table whose source rows don't exist anymore
+    and update rows whose materialization changed since <since_txid>. Returns
+    the number of updated rows.
+    """
+    spec = edge_table_sources[edge_table]
+    shadow_table = f'{edge_table}{SHADOW_SUFFIX}'
+    cursor.execute(f"""
+        DELETE FROM {shadow_table} s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {spec.source} src WHERE src.id = s.id
+        )
+    """)
+
+    cursor.execute(f"""
+        DROP TABLE IF EXISTS edge_rebuild_changed;
+        CREATE TEMPORARY TABLE edge_rebuild_changed ON COMMIT DROP AS
+        {spec.changed};
+        DELETE FROM {shadow_table} s
+        USING edge_rebuild_changed ch
+        WHERE s.id = ch.id;
+    """, {
+        'txid': since_txid,
+    })
+    where = f'{spec.alias}.id IN (SELECT id FROM edge_rebuild_changed)'
+    cursor.execute(f"""
+        INSERT INTO {shadow_table} ({spec.columns})
+        {spec.select.format(where=where)}
+    """)
+    return cursor.rowcount
+
+
+def swap_in_shadow_table(edge_table, since_txid, log) -> None:
+    """Replace an edge table with its completely filled shadow table. Indices
+    and unique constraints are created on the shadow table first. Changes that
+    happened to the source data during the rebuild are applied twice: once
+    without locks and then again while writes to the source tables are blocked
+    and the tables are swapped. Foreign keys are validated after the swap.
+    """
+    shadow_table = f'{edge_table}{SHADOW_SUFFIX}'
+    spec = edge_table_sources[edge_table]
+    cursor = connection.cursor()
+    schema = get_table_schema(cursor, edge_table)
+
+    # Indices and constraints that are backed by indices need temporary names
+    # until the original table is dropped.
+    renames = []
+    for name, definition in schema['indices']:
+        log(f'Creating index {name} on {shadow_table}')
+        definition = retarget_definition(definition, edge_table).replace(
+                f' INDEX {name} ON ', f' INDEX IF NOT EXISTS {name}{SHADOW_SUFFIX} ON ', 1)
+        cursor.execute(definition)
+        renames.append(f'ALTER INDEX {name}{SHADOW_SUFFIX} RENAME TO {name}')
+
+    cursor.execute("""
+        SELECT conname FROM pg_constraint
+        WHERE conrelid = %(table)s::regclass
+    """, {
+        'table': shadow_table,
+    })
+    existing_constraints = set(r[0] for r in cursor.fetchall())
+    foreign_keys = []
+    for name, constraint_type, definition in schema['constraints']:
+        definition = retarget_definition(definition, edge_table)
+        if constraint_type == 'f':
+            foreign_keys.append((name, definition))
+        elif constraint_type in ('p', 'u', 'x'):
+            if f'{name}{SHADOW_SUFFIX}' not in existing_constraints:
+                log(f'Creating constraint {name} on {shadow_table}')
+                cursor.execute(f"""
+                    ALTER TABLE {shadow_table}
+                    ADD CONSTRAINT {name}{SHADOW_SUFFIX} {definition}
+                """)
+            renames.append(f'ALTER TABLE {edge_table} RENAME CONSTRAINT {name}{SHADOW_SUFFIX} TO {name}')
+        elif name not in existing_constraints:
+            cursor.execute(f"""
+                ALTER TABLE {shadow_table}
+                ADD CONSTRAINT {name} {definition}
+            """)
+
+    with transaction.atomic():
+        cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        next_since_txid = cursor.fetchone()[0]
+        n_updated = refresh_shadow_table(cursor, edge_table, since_txid)
+        log(f'Updated {n_updated} rows of {shadow_table} that changed during the rebuild')
+
+    with transaction.atomic():
+        cursor.execute(f"""
+            LOCK TABLE {', '.join(spec.locked)} IN SHARE MODE;
+            LOCK TABLE {edge_table} IN ACCESS EXCLUSIVE MODE;
+        """)
+        n_updated = refresh_shadow_table(cursor, edge_table, next_since_txid)
+        log(f'Updated {n_updated} rows of {shadow_table} before the swap')
+
+        for name, definition in foreign_keys:
+            cursor.execute(f"""
+                ALTER TABLE {shadow_table}
+                ADD CONSTRAINT {name} {definition} NOT VALID
+            """)
+        for name, definition in schema['triggers']:
+            cursor.execute(retarget_definition(definition, edge_table))
+
+        cursor.execute(f"""
+            DROP TABLE {edge_table};
+            ALTER TABLE {shadow_table} RENAME TO {edge_table};
+        """)
+        for rename in renames:
+            cursor.execute(rename)
+
+    for name, _ in foreign_keys:
+        cursor.execute(f"ALTER TABLE {edge_table} VALIDATE CONSTRAINT {name}")
+
+    cursor.execute(f"ANALYZE {edge_table}")
+
+
+def rebuild_edge_tables_chunked(project_ids=None, chunk_size=EDGE_REBUILD_CHUNK_SIZE,
+        n_workers=1, resume=False, shadow=False, edge_tables=None,
+        log=None, progress_interval=10) -> Dict[str, int]:
+    """Rebuild edge tables for all passed in project IDs, or all projects if no
+    project IDs are passed in, in chunks of <chunk_size> source IDs. Each chunk
+    is committed on its own and chunks are processed by <n_workers> processes
+    in parallel.
+
+    An interrupted rebuild can be continued with <resume>, using the same
+    parameters, in which case already materialized chunks are skipped. With
+    <shadow>, every edge table is materialized into a new table that replaces
+    the existing table only at the end. This requires rebuilding all projects.
+
+    Returns the number of materialized rows per edge table.
+    """
+    if not log:
+        # Assign no-op function if no log function is passed in
+        log = lambda x: None
+
+    if chunk_size < 1:
+        raise ValueError("The chunk size has to be positive")
+
+    if shadow and project_ids:
+        raise ValueError("Shadow tables can only be used to rebuild all projects")
+
+    edge_tables = edge_tables or list(edge_table_sources.keys())
+    for edge_table in edge_tables:
+        if edge_table not in edge_table_sources:
+            raise ValueError(f"Unknown edge table: {edge_table}")
+
+    if project_ids:
+        project_ids = sorted(set(int(pid) for pid in project_ids))
+        for project_id in project_ids:
+            if not Project.objects.filter(pk=project_id).exists():
+                raise CommandError(f'Project "{project_id}" does not exist')
+        scope = 'projects:' + ','.join(map(str, project_ids))
+    else:
+        scope = 'all'
+
+    cursor = connection.cursor()
+
+    tasks:List[Tuple] = []
+    n_chunks:Dict[str, int] = {}
+    n_done:Dict[str, int] = {}
+    n_rows:Dict[str, int] = {}
+    for edge_table in edge_tables:
+        spec = edge_table_sources[edge_table]
+        target = f'{edge_table}{SHADOW_SUFFIX}' if shadow else edge_table
+
+        cursor.execute("SELECT to_regclass(%(table)s)", {'table': target})
+        target_exists = cursor.fetchone()[0] is not None
+        if not resume or not target_exists:
+            cursor.execute("""
+                DELETE FROM catmaid_edge_rebuild_progress
+                WHERE edge_table = %(edge_table)s AND scope = %(scope)s
+            """, {
+                'edge_table': target,
+                'scope': scope,
+            })
+            if shadow:
+                create_shadow_table(cursor, edge_table)
+
+        cursor.execute("""
+            SELECT chunk_start, chunk_end, n_rows
+            FROM catmaid_edge_rebuild_progress
+            WHERE edge_table = %(edge_table)s AND scope = %(scope)s
+        """, {
+            'edge_table': target,
+            'scope': scope,
+        })
+        done = cursor.fetchall()
+        if any(end - start != chunk_size for start, end, _ in done):
+            raise ValueError(f"The rebuild of {edge_table} was started with a "
+                    "different chunk size")
+        done_chunks = set(start for start, _, _ in done)
+        n_rows[edge_table] = sum(r[2] for r in done)
+
+        cursor.execute(f"""
+            SELECT min(src.id), max(src.id)
+            FROM {spec.source} src
+            WHERE TRUE {get_project_filter('src', project_ids)}
+        """, {
+            'project_ids': project_ids,
+        })
+        min_id, max_id = cursor.fetchone()
+
+        if not shadow:
+            # Remove rows outside of the range of source IDs, which aren't
+            # covered by any chunk.
+            cursor.execute(f"""
+                DELETE FROM {edge_table} e
+                WHERE (%(min_id)s::bigint IS NULL OR e.id < %(min_id)s OR e.id > %(max_id)s)
+                {get_project_filter('e', project_ids)}
+            """, {
+                'min_id': min_id,
+                'max_id': max_id,
+                'project_ids': project_ids,
+            })
+
+        if min_id is None:
+            chunk_starts:List[int] = []
+        else:
+            # Chunks are aligned to multiples of the chunk size, so that a
+            # resumed rebuild finds the same chunks.
+            first_chunk = (min_id // chunk_size) * chunk_size
+            chunk_starts = list(range(first_chunk, max_id + 1, chunk_size))
+        pending = [(edge_table, target, scope, project_ids, start, start + chunk_size)
+                for start in chunk_starts if start not in done_chunks]
+        tasks.extend(pending)
+        n_chunks[edge_table] = len(chunk_starts)
+        n_done[edge_table] = len(chunk_starts) - len(pending)
+        log(f'{edge_table}: {len(pending)} of {len(chunk_starts)} chunks to '
+                f'materialize into {target}')
+
+    start_time = time.time()
+    last_report = start_time
+    n_new_rows = 0
+
+    def report(edge_table, chunk_rows):
+        nonlocal last_report, n_new_rows
+        n_done[edge_table] += 1
+        n_rows[edge_table] += chunk_rows
+        n_new_rows += chunk_rows
+        now = time.time()
+        if now - last_report >= progress_interval:
+            last_report = now
+            rate = n_new_rows / max(now - start_time, 1e-6)
+            log(', '.join(f'{t}: {n_done[t]}/{n_chunks[t]} chunks' for t in edge_tables) +
+                    f' - {n_new_rows} rows, {rate:.0f} rows/s')
+
+    if n_workers > 1 and len(tasks) > 1:
+        # Close all database connections to not share them with the worker
+        # processes. Each worker opens its own connection.
+        connections.close_all()
+        with Pool(n_workers) as pool:
+            for edge_table, _, chunk_rows in pool.imap_unordered(_rebuild_edge_chunk, tasks):
+                report(edge_table, chunk_rows)
+    else:
+        for task in tasks:
+            edge_table, _, chunk_rows = _rebuild_edge_chunk(task)
+            report(edge_table, chunk_rows)
+
+    duration = time.time() - start_time
+    log(f'Materialized {n_new_rows} rows in {duration:.1f}s '
+            f'({n_new_rows / max(duration, 1e-6):.0f} rows/s)')
+
+    cursor = connection.cursor()
+    for edge_table in edge_tables:
+        target = f'{edge_table}{SHADOW_SUFFIX}' if shadow else edge_table
+        if shadow:
+            cursor.execute("""
+                SELECT min(snapshot_xmin)
+                FROM catmaid_edge_rebuild_progress
+                WHERE edge_table = %(edge_table)s AND scope = %(scope)s
+            """, {
+                'edge_table': target,
+                'scope': scope,
+            })
+            since_txid = cursor.fetchone()[0]
+            if since_txid is None:
+                cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+                since_txid = cursor.fetchone()[0]
+            log(f'Swapping in {target} as {edge_table}')
+            swap_in_shadow_table(edge_table, since_txid, log)
+
+        cursor.execute("""
+            DELETE FROM catmaid_edge_rebuild_progress
+            WHERE edge_table = %(edge_table)s AND scope = %(scope)s
+        """, {
+            'edge_table': target,
+            'scope': scope,
+        })
+        log(f'Created {n_rows[edge_table]} rows in {edge_table}')
+
+    return n_rows
+
+
 def rebuild_edges_selectively(skeleton_ids, connector_ids=[], log=None) -> None:
     """Rebuild edge table entries for all passed in skeleton IDs.
     """
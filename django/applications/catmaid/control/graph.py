@@ -23,8 +23,7 @@ from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, get_request_list
 from catmaid.control.link import KNOWN_LINK_PAIRS
 from catmaid.control.review import get_treenodes_to_reviews
-from catmaid.control.tree_util import simplify, find_root, reroot, partition, \
-        spanning_tree, cable_length
+from catmaid.control.tree_util import ArrayTree
 from catmaid.control.synapseclustering import tree_max_density
 
 
@@ -102,7 +101,11 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                 subdomains.append(g)
                 anchors[domain.local_max] = g
             # Define edges between domains: create a simplified graph
-            mini = simplify(graph, anchors.keys())
+            tree = ArrayTree.from_digraph(graph)
+            _, mini_edges = tree.simplify(tree.indices(list(anchors.keys())))
+            mini = nx.Graph()
+            mini.add_nodes_from(anchors.keys())
+            mini.add_edges_from(tuple(tree.node_ids[list(e)].tolist()) for e in mini_edges)
             # Replace each node by the corresponding graph, or a graph of a single node
             for node in mini.nodes:
                 g = anchors.get(node)
@@ -282,17 +285,19 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
                 continue
 
             try:
-                spanning = spanning_tree(post_arbor, edge_props['post_treenodes'])
+                tree = ArrayTree.from_digraph(post_arbor, locations)
+                spanning = tree.spanning_mask(tree.indices(edge_props['post_treenodes']))
+                spanning_nodes = tree.node_ids[spanning].tolist()
                 # for arbor in whole_arbors[circuit[post_arbor]['skeleton_id']]:
                 #     if post_arbor == arbor:
                 #         tc = arbor.treenode_synapse_counts
                 tc = post_arbor.treenode_synapse_counts
-                count = spanning.number_of_nodes()
+                count = len(spanning_nodes)
                 if count < 3:
-                    median_synapse_centrality = sum(tc[treenodeID].synapse_centrality for treenodeID in spanning.nodes) / count
+                    median_synapse_centrality = sum(tc[treenodeID].synapse_centrality for treenodeID in spanning_nodes) / count
                 else:
-                    median_synapse_centrality = sorted(tc[treenodeID].synapse_centrality for treenodeID in spanning.nodes)[count / 2]
-                cable = cable_length(spanning, locations)
+                    median_synapse_centrality = sorted(tc[treenodeID].synapse_centrality for treenodeID in spanning_nodes)[count / 2]
+                cable = tree.cable_length(spanning)
                 if -1 == median_synapse_centrality:
                     # Signal not computable
                     edge_props['risk'] = -1
@@ -443,21 +448,23 @@ def _node_centrality_by_synapse(tree, nodes:Dict, totalOutputs:int, totalInputs:
             counts.synapse_centrality = -1
         return
 
-    if len(list(tree.successors(find_root(tree)))) > 1:
+    arbor = ArrayTree.from_digraph(tree)
+    if arbor.n_children[arbor.root] > 1:
         # Reroot at the first end node found
-        tree = tree.copy()
-        endNode = next(nodeID for nodeID in nodes.keys() if not list(tree.successors(nodeID)))
-        reroot(tree, endNode)
+        n_children = arbor.n_children
+        endNode = next(nodeID for nodeID in nodes.keys() if not n_children[arbor.index(nodeID)])
+        arbor = arbor.reroot(arbor.index(endNode))
 
     # 2. Partition into sequences, sorted from small to large
-    sequences = sorted(partition(tree), key=len)
+    sequences = sorted(arbor.partition(), key=len)
+    node_ids = arbor.node_ids.tolist()
 
     # 3. Traverse all partitions counting synapses seen
     for seq in sequences:
         # Each seq runs from an end node towards the root or a branch node
         seenI = 0
         seenO = 0
-        for nodeID in seq:
+        for nodeID in (node_ids[i] for i in seq):
             counts = nodes[nodeID]
             seenI += counts.inputs + counts.seenInputs
             seenO += counts.outputs + counts.seenOutputs
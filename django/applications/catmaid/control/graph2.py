@@ -6,8 +6,6 @@ from itertools import count
 import json
 import networkx as nx
 from networkx.algorithms import weakly_connected_components
-from numpy import subtract
-from numpy.linalg import norm
 from typing import Any, DefaultDict, Dict, List, Optional, Tuple, Union
 
 from django.db import connection
@@ -19,9 +17,10 @@ from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import (get_relation_to_id_map, get_request_bool,
         get_request_list)
+from catmaid.control.connectivity import get_summarized_links
 from catmaid.control.link import KNOWN_LINK_PAIRS, UNDIRECTED_LINK_TYPES
-from catmaid.control.tree_util import simplify
-from catmaid.control.synapseclustering import tree_max_density
+from catmaid.control.tree_util import ArrayTree
+from catmaid.control.synapseclustering import array_tree_max_density
 
 
 def make_new_synapse_count_array() -> List[int]:
@@ -43,6 +42,25 @@ def basic_graph(project_id, skeleton_ids, relations=None,
     undirected_links = source_link in UNDIRECTED_LINK_TYPES and \
             target_link in UNDIRECTED_LINK_TYPES
 
+    edges:DefaultDict = defaultdict(partial(defaultdict, make_new_synapse_count_array))
+
+    # Without a connector constraint, link counts can be read from the skeleton
+    # connectivity summary, unless it is outdated for any of the skeletons.
+    if not allowed_connector_ids:
+        links = get_summarized_links(project_id, skeleton_ids, skeleton_ids,
+                source_rel_id, target_rel_id, cursor)
+        if links is not None:
+            for source, target, confidence, n_links in links:
+                if undirected_links and source >= target:
+                    continue
+                edges[source][target][confidence - 1] += n_links
+
+            return {
+                'edges': tuple((s, t, count)
+                        for s, edge in edges.items()
+                        for t, count in edge.items())
+            }
+
     # Find all links in the passed in set of skeletons. If a relation is
     # reciprocal, we need to avoid getting two result rows back for each
     # treenode-connector-treenode connection. To keep things simple, we will add
@@ -66,7 +84,6 @@ def basic_graph(project_id, skeleton_ids, relations=None,
         'allowed_c_ids': allowed_connector_ids,
     })
 
-    edges:DefaultDict = defaultdict(partial(defaultdict, make_new_synapse_count_array))
     for row in cursor.fetchall():
         edges[row[0]][row[1]][row[2] - 1] += 1
 
@@ -361,10 +378,6 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
     chunks, chunkIDs = subgraphs(digraph, skeleton_id)
 
     for i, chunkID, chunk in zip(count(start=1), chunkIDs, chunks):
-        # Populate edge properties with the weight
-        for parent, child in chunk.edges():
-            chunk[parent][child]['weight'] = norm(subtract(locations[child], locations[parent]))
-
         # Check if need to expand at all
         blob = tuple(c for c in cs if c[0] in chunk)
         if 0 == len(blob): # type: ignore
@@ -378,7 +391,11 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
             continue
 
         # Invoke Casey's magic: split by synapse domain
-        max_density = tree_max_density(chunk.to_undirected(), treenode_ids,
+        chunk_node_ids = list(chunk.nodes)
+        tree = ArrayTree(chunk_node_ids,
+                [next(chunk.predecessors(n), -1) for n in chunk_node_ids],
+                [locations[n] for n in chunk_node_ids])
+        max_density = array_tree_max_density(tree, treenode_ids,
                 connector_ids, relation_ids, [bandwidth])
         # Get first element of max_density
         domains = next(iter(max_density.values()))
@@ -395,8 +412,12 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
         # Pick one treenode from each domain to act as anchor
         anchors = {d.node_ids[0]: (i+k, d) for k, d in domains.items()}
 
-        # Create new Graph where the edges are the edges among synapse domains
-        mini = simplify(chunk, anchors.keys())
+        # Create the edges among synapse domains, the nodes are the anchors
+        # and the branch nodes between them.
+        _, mini_edges = tree.simplify(tree.indices(list(anchors.keys())))
+        mini_edges = [tuple(tree.node_ids[list(e)].tolist()) for e in mini_edges]
+        mini_node_ids = list(dict.fromkeys(list(anchors.keys()) +
+                [n for e in mini_edges for n in e]))
 
         # Many side effects:
         # * add internal edges to intraedges
@@ -404,7 +425,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
         # * custom-apply populate_connectors with the known synapses of each domain
         #   (rather than having to sift through all in cs)
         mini_nodes = {}
-        for node in mini.nodes:
+        for node in mini_node_ids:
             nblob = anchors.get(node)
             if nblob:
                 index, domain = nblob
@@ -418,7 +439,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
                 branch_nodes.append(domainID)
             mini_nodes[node] = domainID
 
-        for a1, a2 in mini.edges:
+        for a1, a2 in mini_edges:
             intraedges.append((mini_nodes[a1], mini_nodes[a2]))
 
     return nodes, branch_nodes
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import select
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+
+from catmaid.models import NodeGridCache
+
+
+logger = logging.getLogger(__name__)
+
+# Marker for cells that are known to not have any data for a particular LOD
+# range and data type. This allows to cache empty cells too.
+EMPTY_CELL = None
+
+CellKey = Tuple[int, int, int, int]
+VariantKey = Tuple[str, int, int]
+
+
+class GridCellCache(object):
+    """A size-bounded, process local LRU cache for node grid cache cells. Cells
+    are stored in their encoded form (msgpack bytes, JSON text) so that a cache
+    hit doesn't need to copy or decode more than a database hit would. Keys are
+    formed by the grid ID and the X, Y and Z index of a cell, and each cell can
+    have multiple variants, one for each data type and LOD range combination.
+
+    The cache is kept consistent with the database by listening to the
+    "catmaid.dirty-cache" Postgres notification channel on a separate database
+    connection, which is also used by the cache update worker. Every cell
+    marked dirty is dropped from the cache. As long as the listener isn't
+    connected, the cache isn't used. Entries also expire after a configurable
+    time to live.
+    """
+
+    notify_channel = "catmaid.dirty-cache"
+
+    def __init__(self, max_size, ttl=300, grid_ttl=60, max_cells_per_query=1024,
+            listen=True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.grid_ttl = grid_ttl
+        self.max_cells_per_query = max_cells_per_query
+        self.listen = listen
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # The generation is incremented with every invalidation. It allows
+        # callers to detect whether an invalidation happened while they were
+        # reading from the database.
+        self.generation = 0
+        self.entries:OrderedDict = OrderedDict()
+        self.grids:Dict[int, Tuple[float, List[Tuple]]] = dict()
+        self.lock = threading.RLock()
+        self.listening = not listen
+        self.listener:Optional[threading.Thread] = None
+        self.pid = os.getpid()
+
+    def is_available(self) -> bool:
+        """Whether the cache can be used right now. The invalidation listener
+        is started lazily, once per process (e.g. after forking).
+        """
+        if self.max_size <= 0:
+            return False
+        if self.listen:
+            pid = os.getpid()
+            if self.listener is None or self.pid != pid:
+                self.start_listener(pid)
+        return self.listening
+
+    def get_grids(self, project_id) -> Optional[List[Tuple]]:
+        """Get the cached grid list of a project or None if it isn't cached.
+        """
+        with self.lock:
+            entry = self.grids.get(project_id)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.grid_ttl:
+                del self.grids[project_id]
+                return None
+            return entry[1]
+
+    def set_grids(self, project_id, grids:List[Tuple]) -> None:
+        with self.lock:
+            self.grids[project_id] = (time.time(), grids)
+
+    def get(self, cell_key:CellKey, variant:VariantKey) -> Tuple[bool, Any]:
+        """Return a tuple of the form (hit, value) for the passed in cell and
+        variant.
+        """
+        with self.lock:
+            cell = self.entries.get(cell_key)
+            entry = cell.get(variant) if cell else None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            created, size, value = entry
+            if time.time() - created > self.ttl:
+                self._remove_variant(cell_key, variant)
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(cell_key)
+            self.hits += 1
+            return True, value
+
+    def get_many(self, cell_keys:Iterable[CellKey], variant:VariantKey) -> Optional[List[Any]]:
+        """Return the values for all passed in cells, or None if not all of
+        them are cached.
+        """
+        values = []
+        for cell_key in cell_keys:
+            hit, value = self.get(cell_key, variant)
+            if not hit:
+                return None
+            values.append(value)
+        return values
+
+    def put(self, cell_key:CellKey, variant:VariantKey, value:Any,
+            generation:int=None) -> bool:
+        """Store a value for a particular cell and variant. If a generation is
+        passed in and the cache saw invalidations since then, the value isn't
+        stored, because it might be outdated already.
+        """
+        size = get_encoded_size(value)
+        if size > self.max_size:
+            return False
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._remove_variant(cell_key, variant)
+            cell = self.entries.get(cell_key)
+            if cell is None:
+                cell = self.entries[cell_key] = dict()
+            cell[variant] = (time.time(), size, value)
+            self.entries.move_to_end(cell_key)
+            self.size += size
+            while self.size > self.max_size and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= sum(e[1] for e in evicted.values())
+            return True
+
+    def invalidate_cell(self, grid_id, x, y, z) -> None:
+        with self.lock:
+            self.generation += 1
+            cell = self.entries.pop((grid_id, x, y, z), None)
+            if cell:
+                self.size -= sum(e[1] for e in cell.values())
+
+    def invalidate_project(self, project_id) -> None:
+        """Remove the cached grid selection of a project."""
+        with self.lock:
+            self.generation += 1
+            self.grids.pop(project_id, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.grids.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'size': self.size,
+                'max_size': self.max_size,
+                'n_cells': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'generation': self.generation,
+                'listening': self.listening,
+            }
+
+    def _remove_variant(self, cell_key:CellKey, variant:VariantKey) -> None:
+        cell = self.entries.get(cell_key)
+        if cell:
+            entry = cell.pop(variant, None)
+            if entry:
+                self.size -= entry[1]
+            if not cell:
+                del self.entries[cell_key]
+
+    def handle_notification(self, payload:str) -> None:
+        try:
+            data = json.loads(payload)
+            self.invalidate_cell(data['grid_id'], data['x'], data['y'], data['z'])
+        except (ValueError, KeyError):
+            logger.warning(f'Could not parse dirty cache notification: {payload}')
+            self.clear()
+
+    def start_listener(self, pid) -> None:
+        with self.lock:
+            if self.listener is not None and self.pid == pid:
+                return
+            # Entries inherited from a parent process can't be trusted, because
+            # notifications were not received in the meantime.
+            self.pid = pid
+            self.listening = False
+            self.entries.clear()
+            self.grids.clear()
+            self.size = 0
+            self.listener = threading.Thread(target=self._listen,
+                    args=(connection.get_connection_params(),),
+                    name='catmaid-grid-cell-cache', daemon=True)
+            self.listener.start()
+
+    def _listen(self, connection_params, retry_delay=5, poll_timeout=5) -> None:
+        """Listen to dirty cell notifications on a dedicated database
+        connection. If the connection breaks, all entries are removed and the
+        cache is disabled until the connection is reestablished.
+        """
+        while True:
+            db = None
+            try:
+                db = psycopg2.connect(**connection_params)
+                db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with db.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.notify_channel}"')
+                # Changes might have happened while not listening.
+                self.clear()
+                self.listening = True
+                logger.debug('Grid cell cache is listening for dirty cells')
+                while True:
+                    if select.select([db], [], [], poll_timeout) == ([], [], []):
+                        continue
+                    db.poll()
+                    while db.notifies:
+                        notify = db.notifies.pop(0)
+                        if notify.channel == self.notify_channel:
+                            self.handle_notification(notify.payload)
+            except Exception as e:
+                self.listening = False
+                self.clear()
+                logger.warning(f'Grid cell cache listener disconnected: {e}')
+            finally:
+                if db is not None:
+                    try:
+                        db.close()
+                    except psycopg2.Error:
+                        pass
+            time.sleep(retry_delay)
+
+
+def get_encoded_size(value) -> int:
+    """Estimate the memory size of an encoded cell, which is a list of LOD
+    buckets, each one being either None or a bytes/text representation.
+    """
+    if value is EMPTY_CELL:
+        return 1
+    return 1 + sum(len(v) for v in value if v)
+
+
+_grid_cell_cache:Optional[GridCellCache] = None
+_grid_cell_cache_lock = threading.Lock()
+
+
+def get_grid_cell_cache() -> Optional[GridCellCache]:
+    """Get the grid cell cache of this process, or None if the cache is
+    disabled (NODE_GRID_CACHE_LRU_SIZE = 0) or unavailable.
+    """
+    global _grid_cell_cache
+    max_size = settings.NODE_GRID_CACHE_LRU_SIZE
+    if not max_size:
+        return None
+    if _grid_cell_cache is None:
+        with _grid_cell_cache_lock:
+            if _grid_cell_cache is None:
+                _grid_cell_cache = GridCellCache(max_size,
+                        ttl=settings.NODE_GRID_CACHE_LRU_TTL)
+    return _grid_cell_cache if _grid_cell_cache.is_available() else None
+
+
+def on_grid_change(sender, instance, **kwargs) -> None:
+    """Drop the cached grid selection of a project if one of its grids changes
+    in this process. Other processes will notice after grid_ttl seconds.
+    """
+    if _grid_cell_cache is not None:
+        _grid_cell_cache.invalidate_project(instance.project_id)
+
+
+post_save.connect(on_grid_change, sender=NodeGridCache)
+post_delete.connect(on_grid_change, sender=NodeGridCache)
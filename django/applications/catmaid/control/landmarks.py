@@ -3,16 +3,22 @@
 from collections import defaultdict
 import json
 import math
+import time
 from typing import Any, DefaultDict, Dict, List, Set, Tuple
 
 from django.db import connection
 from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
+from guardian.shortcuts import get_perms, get_users_with_perms
 
-from catmaid.control.authentication import requires_user_role, can_edit_or_fail, can_edit_all_or_fail
+from catmaid.control.authentication import (requires_user_role,
+        can_edit_or_fail, can_edit_all_or_fail, PermissionError)
 from catmaid.control.common import get_request_list, get_class_to_id_map, get_relation_to_id_map, get_request_bool
+from catmaid.control.landmarktransform import (get_landmark_transform,
+        transform_pointclouds, transform_skeletons)
 from catmaid.models import (
-    Class, ClassInstance, ClassInstanceClassInstance, Relation, Point, PointClassInstance, UserRole,
+    Class, ClassInstance, ClassInstanceClassInstance, Relation, Point, PointClassInstance,
+    PointCloud, UserRole,
 )
 from catmaid.serializers import BasicClassInstanceSerializer
 
@@ -707,6 +713,15 @@ class LandmarkGroupImport(APIView):
           paramType: form
           defaultValue: true
           required: false
+        - name: with_stats
+          description: |
+            Whether to return the imported groups as "groups" field along with
+            a "stats" field, which reports the number of created objects and
+            the import throughput.
+          type: boolean
+          paramType: form
+          defaultValue: false
+          required: false
         """
         project_id = int(project_id)
         if not project_id:
@@ -715,6 +730,7 @@ class LandmarkGroupImport(APIView):
         reuse_existing_landmarks = get_request_bool(request.data, 'reuse_existing_landmarks', False)
         create_non_existing_groups = get_request_bool(request.data, 'create_non_existing_groups', True)
         create_non_existing_landmarks = get_request_bool(request.data, 'create_non_existing_landmarks', True)
+        with_stats = get_request_bool(request.data, 'with_stats', False)
 
         # Make sure the data to import matches our expectations
         data = request.data.get('data')
@@ -738,6 +754,7 @@ class LandmarkGroupImport(APIView):
                             "does not have a valid {ci}. coordinate: {coordinate}.")
                     link[ci] = value
 
+        start_time = time.time()
         classes = get_class_to_id_map(project_id)
         relations = get_relation_to_id_map(project_id)
         landmark_class = classes['landmark']
@@ -753,9 +770,15 @@ class LandmarkGroupImport(APIView):
                 class_column=landmarkgroup_class).values_list('name', 'id'))
 
         imported_groups = []
+        n_created_groups = 0
 
         # Keep track of which landmarks have been seen and were accepted.
         seen_landmarks:Set = set()
+        # Landmarks that will be created, by lower case name.
+        new_landmarks:Dict[str, str] = dict()
+        # All imported locations as (group, lower case landmark name, x, y, z,
+        # landmark name) tuples.
+        imported_links:List[Tuple] = []
 
         for n, (group_name, linked_landmarks) in enumerate(data):
             # Test if group exists already and raise error if they do and are
@@ -773,22 +796,22 @@ class LandmarkGroupImport(APIView):
                         name=group_name)
                 existing_group_id = group.id
                 landmarkgroups[group_name.lower()] = group.id
+                n_created_groups += 1
             else:
                 raise ValueError(f"Group \"{group_name}\" does not exist. Please create " \
                         "it or enable automatic creation.")
 
-            imported_landmarks:List = []
             imported_group = {
                     'id': existing_group_id,
                     'name': group_name,
-                    'members': imported_landmarks
+                    'members': []
             }
             imported_groups.append(imported_group)
 
             for m, link in enumerate(linked_landmarks):
                 landmark_name = link[0]
-                x, y, z = link[1], link[2], link[3]
-                existing_landmark_id = landmarks.get(landmark_name.lower())
+                landmark_key = landmark_name.lower()
+                existing_landmark_id = landmarks.get(landmark_key)
                 if existing_landmark_id:
                     # Test only on first look at landmark
                     if existing_landmark_id not in seen_landmarks:
@@ -797,46 +820,97 @@ class LandmarkGroupImport(APIView):
                                         "Please remove it or enable re-use of " \
                                         "existing landmarks.")
                         can_edit_or_fail(request.user, existing_landmark_id, 'class_instance')
+                    seen_landmarks.add(existing_landmark_id)
                 elif create_non_existing_landmarks:
-                    landmark = ClassInstance.objects.create(project_id=project_id,
-                            class_column_id=landmark_class, user=request.user,
-                            name=landmark_name)
-                    existing_landmark_id = landmark.id
-                    landmarks[landmark_name.lower()] = landmark.id
+                    if landmark_key not in new_landmarks:
+                        new_landmarks[landmark_key] = landmark_name
                 else:
                     raise ValueError(f"Landmark \"{landmark_name}\" does not exist. Please " \
                             "create it or enable automatic creation.")
-                seen_landmarks.add(existing_landmark_id)
-
-                # Make sure the landmark is linked to the group
-                landmark_link = ClassInstanceClassInstance.objects.get_or_create(
-                            project_id=project_id, relation_id=part_of_relation,
-                            class_instance_a_id=existing_landmark_id,
-                            class_instance_b_id=existing_group_id,
-                            defaults={'user': request.user})
-
-                # With an existing group and landmark in place, the location can
-                # be linked (to both).
-                point = Point.objects.create(project_id=project_id, user=request.user,
-                        editor=request.user, location_x=x, location_y=y, location_z=z)
-                point_landmark = PointClassInstance.objects.create(point=point,
-                        user=request.user, class_instance_id=existing_landmark_id,
-                        project_id=project_id, relation_id=annotated_with_relation)
-                point_landmark_group = PointClassInstance.objects.create(point=point,
-                        user=request.user, class_instance_id=existing_group_id,
-                        project_id=project_id, relation_id=annotated_with_relation)
-
-                imported_landmarks.append({
-                    'id': existing_landmark_id,
-                    'name': landmark_name,
-                    'x': x,
-                    'y': y,
-                    'z': z
-                })
+                imported_links.append((imported_group, landmark_key, link[1],
+                        link[2], link[3], landmark_name))
+
+        # Create all new landmarks at once
+        created_landmarks = ClassInstance.objects.bulk_create([ClassInstance(
+                project_id=project_id, class_column_id=landmark_class,
+                user=request.user, name=landmark_name)
+                for landmark_name in new_landmarks.values()])
+        for landmark in created_landmarks:
+            landmarks[landmark.name.lower()] = landmark.id
+
+        # Make sure the landmarks are linked to their groups. With an existing
+        # group and landmark in place, the locations can be linked (to both).
+        link_landmarks_to_groups(project_id, request.user, part_of_relation,
+                [(landmarks[landmark_key], group['id'])
+                for group, landmark_key, _, _, _, _ in imported_links])
+        create_landmark_locations(project_id, request.user,
+                annotated_with_relation, [(x, y, z, (landmarks[landmark_key], group['id']))
+                for group, landmark_key, x, y, z, _ in imported_links])
+
+        for group, landmark_key, x, y, z, landmark_name in imported_links:
+            group['members'].append({
+                'id': landmarks[landmark_key],
+                'name': landmark_name,
+                'x': x,
+                'y': y,
+                'z': z
+            })
+
+        if with_stats:
+            duration = time.time() - start_time
+            return Response({
+                'groups': imported_groups,
+                'stats': {
+                    'created_groups': n_created_groups,
+                    'created_landmarks': len(created_landmarks),
+                    'created_locations': len(imported_links),
+                    'duration': duration,
+                    'locations_per_second': len(imported_links) / max(duration, 1e-6),
+                },
+            })
 
         return Response(imported_groups)
 
 
+def link_landmarks_to_groups(project_id, user, part_of_rel, links) -> int:
+    """Make sure each passed in (landmark ID, group ID) pair is linked with a
+    part_of relation. Missing links are created with a single multi-row
+    insert. Returns the number of created links.
+    """
+    links = set(links)
+    if not links:
+        return 0
+    landmark_ids, group_ids = zip(*links)
+    existing_links = set(ClassInstanceClassInstance.objects.filter(
+            project_id=project_id, relation_id=part_of_rel,
+            class_instance_a_id__in=set(landmark_ids),
+            class_instance_b_id__in=set(group_ids)).values_list(
+            'class_instance_a_id', 'class_instance_b_id'))
+    new_links = [ClassInstanceClassInstance(project_id=project_id,
+            relation_id=part_of_rel, class_instance_a_id=landmark_id,
+            class_instance_b_id=group_id, user=user)
+            for landmark_id, group_id in sorted(links - existing_links)]
+    ClassInstanceClassInstance.objects.bulk_create(new_links)
+    return len(new_links)
+
+
+def create_landmark_locations(project_id, user, annotated_with_rel, locations) -> List[int]:
+    """Create a point for each passed in (x, y, z, class instance IDs) tuple
+    and link it to all its class instances, usually a landmark and a landmark
+    group, using annotated_with. Points and links are created with one
+    multi-row insert each. Returns the IDs of the new points.
+    """
+    points = Point.objects.bulk_create([Point(project_id=project_id,
+            location_x=x, location_y=y, location_z=z, user=user, editor=user)
+            for x, y, z, _ in locations])
+    PointClassInstance.objects.bulk_create([PointClassInstance(
+            project_id=project_id, point_id=point.id, user=user,
+            relation_id=annotated_with_rel, class_instance_id=class_instance_id)
+            for point, (_, _, _, class_instance_ids) in zip(points, locations)
+            for class_instance_id in class_instance_ids])
+    return [point.id for point in points]
+
+
 def get_landmark_group_members(project_id, landmarkgroup_ids) -> DefaultDict[Any, List]:
     cursor = connection.cursor()
     landmarkgroups_template = ','.join(['(%s)' for _ in landmarkgroup_ids])
@@ -1616,6 +1690,7 @@ class LandmarkGroupMaterializer(APIView):
         links = get_request_list(request.data, 'links')
         reuse_existing_landmarks = get_request_bool(request.data, 'reuse_existing_landmarks', False)
 
+        start_time = time.time()
         classes = get_class_to_id_map(project_id)
         relations = get_relation_to_id_map(project_id)
         landmark_class = classes['landmark']
@@ -1642,62 +1717,158 @@ class LandmarkGroupMaterializer(APIView):
         landmark_map:Dict = dict()
         link_map:Dict = dict()
 
-        n_created_landmarks = 0
-        for landmark_name, x1, y1, z1, x2, y2, z2 in landmarks:
-            if landmark_name in landmark_map:
-                continue
-
-            # Get or create landmark
-            landmark, created = ClassInstance.objects.get_or_create(project_id=project_id,
-                    name=landmark_name, class_column_id=landmark_class, defaults={
-                        'user': request.user
-                    })
-
-            if created:
-                n_created_landmarks += 1
-            elif not reuse_existing_landmarks:
-                raise ValueError('A landmark with name "' + landmark_name + '" exists alrady')
-
-            landmark_map[landmark_name] = landmark.id
-
-            # Link landmark to landmark groups
-            landmark_group_a_link = ClassInstanceClassInstance.objects.create(
-                    project_id=project_id, class_instance_a=landmark,
-                    relation_id=part_of_rel, class_instance_b=group_a,
-                    user=request.user)
-            landmark_group_b_link = ClassInstanceClassInstance.objects.create(
-                    project_id=project_id, class_instance_a=landmark,
-                    relation_id=part_of_rel, class_instance_b=group_b,
-                    user=request.user)
-
-            # Create points for both groups
-            point_a = Point.objects.create(project_id=project_id, location_x=x1,
-                    location_y=y1, location_z=z1, user=request.user,
-                    editor=request.user)
-            point_b = Point.objects.create(project_id=project_id, location_x=x2,
-                    location_y=y2, location_z=z2, user=request.user,
-                    editor=request.user)
-
-            # Link locations to landmark
-            location_a_landmark_link = PointClassInstance.objects.create(
-                    project_id=project_id, point=point_a, user=request.user,
-                    relation_id=annotated_with_rel, class_instance=landmark)
-            location_b_landmark_link = PointClassInstance.objects.create(
-                    project_id=project_id, point=point_b, user=request.user,
-                    relation_id=annotated_with_rel, class_instance=landmark)
-
-            # Link locations to landmark groups
-            location_a_landmark_group_link = PointClassInstance.objects.create(
-                    project_id=project_id, point=point_a, user=request.user,
-                    relation_id=annotated_with_rel, class_instance=group_a)
-            location_b_landmark_group_link = PointClassInstance.objects.create(
-                    project_id=project_id, point=point_b, user=request.user,
-                    relation_id=annotated_with_rel, class_instance=group_b)
+        # Only the first definition of a landmark is used.
+        landmark_definitions:Dict = dict()
+        for landmark in landmarks:
+            landmark_definitions.setdefault(landmark[0], landmark)
+
+        # Get or create all landmarks at once
+        existing_landmarks = dict(ClassInstance.objects.filter(
+                project_id=project_id, class_column_id=landmark_class,
+                name__in=list(landmark_definitions.keys())).values_list('name', 'id'))
+        if existing_landmarks and not reuse_existing_landmarks:
+            landmark_name = next(name for name in landmark_definitions
+                    if name in existing_landmarks)
+            raise ValueError('A landmark with name "' + landmark_name + '" exists alrady')
+
+        created_landmarks = ClassInstance.objects.bulk_create([ClassInstance(
+                project_id=project_id, name=landmark_name,
+                class_column_id=landmark_class, user=request.user)
+                for landmark_name in landmark_definitions
+                if landmark_name not in existing_landmarks])
+        n_created_landmarks = len(created_landmarks)
+        for landmark in created_landmarks:
+            existing_landmarks[landmark.name] = landmark.id
+
+        locations = []
+        for landmark_name, x1, y1, z1, x2, y2, z2 in landmark_definitions.values():
+            landmark_id = existing_landmarks[landmark_name]
+            landmark_map[landmark_name] = landmark_id
+            # Create points for both groups, linked to the landmark and the
+            # respective landmark group.
+            locations.append((x1, y1, z1, (landmark_id, group_a.id)))
+            locations.append((x2, y2, z2, (landmark_id, group_b.id)))
+
+        # Link landmarks to landmark groups
+        link_landmarks_to_groups(project_id, request.user, part_of_rel,
+                [(landmark_id, group.id) for landmark_id in landmark_map.values()
+                for group in (group_a, group_b)])
+        create_landmark_locations(project_id, request.user, annotated_with_rel,
+                locations)
+        duration = time.time() - start_time
 
         return Response({
             'group_a_id': group_a.id,
             'group_b_id': group_b.id,
             'landmarks': landmark_map,
             'created_landmarks': n_created_landmarks,
-            'links': link_map
+            'created_locations': len(locations),
+            'links': link_map,
+            'duration': duration,
+            'landmarks_per_second': len(landmark_map) / max(duration, 1e-6),
+        })
+
+
+class LandmarkGroupTransformation(APIView):
+
+    @method_decorator(requires_user_role(UserRole.Browse))
+    def post(self, request:Request, project_id) -> Response:
+        """Transform skeletons, point clouds and individual points from a
+        source landmark group into a target landmark group.
+
+        Like in the front-end, an affine moving least squares transform is
+        used, based on all landmarks shared by both groups that have exactly
+        one location in each group. At least four such landmarks are needed.
+        The fitted transform is cached on the server and reused as long as
+        neither group changes.
+
+        Skeletons are returned in the compact format as [nodes, connectors]
+        lists, nodes as [id, parent_id, user_id, x, y, z, radius, confidence]
+        and connectors as [treenode_id, connector_id, relation, x, y, z]. Point
+        clouds are returned as lists of [id, x, y, z] points.
+        ---
+        parameters:
+        - name: project_id
+          description: The project to operate in.
+          type: integer
+          paramType: path
+          required: true
+        - name: source_group_id
+          description: The landmark group to transform from.
+          required: true
+          type: integer
+          paramType: form
+        - name: target_group_id
+          description: The landmark group to transform into.
+          required: true
+          type: integer
+          paramType: form
+        - name: use_reverse_matches
+          description: Whether each point match should also be added in reverse.
+          required: false
+          defaultValue: false
+          type: boolean
+          paramType: form
+        - name: skeleton_ids
+          description: The skeletons to transform.
+          required: false
+          type: array
+          items:
+            type: integer
+          paramType: form
+        - name: with_connectors
+          description: Whether connector links of skeletons should be transformed as well.
+          required: false
+          defaultValue: false
+          type: boolean
+          paramType: form
+        - name: pointcloud_ids
+          description: The point clouds to transform.
+          required: false
+          type: array
+          items:
+            type: integer
+          paramType: form
+        - name: points
+          description: A list of [x, y, z] points to transform.
+          required: false
+          type: array
+          paramType: form
+        """
+        source_group_id = request.data.get('source_group_id')
+        if source_group_id is None:
+            raise ValueError('Need source group ID')
+        target_group_id = request.data.get('target_group_id')
+        if target_group_id is None:
+            raise ValueError('Need target group ID')
+        use_reverse_matches = get_request_bool(request.data, 'use_reverse_matches', False)
+        skeleton_ids = get_request_list(request.data, 'skeleton_ids', [], map_fn=int)
+        with_connectors = get_request_bool(request.data, 'with_connectors', False)
+        pointcloud_ids = get_request_list(request.data, 'pointcloud_ids', [], map_fn=int)
+        points = get_request_list(request.data, 'points', [], map_fn=float)
+
+        if not skeleton_ids and not pointcloud_ids and not points:
+            raise ValueError('Need at least one skeleton, point cloud or point')
+        if any(len(p) != 3 for p in points):
+            raise ValueError('Points need to be passed in as [x, y, z] lists')
+
+        pointclouds = PointCloud.objects.defer('point_data').filter(project_id=project_id,
+                id__in=pointcloud_ids)
+        if len(pointclouds) != len(set(pointcloud_ids)):
+            raise ValueError('Could not find all point clouds')
+        for pointcloud in pointclouds:
+            if 'can_read' not in get_perms(request.user, pointcloud) and \
+                    len(get_users_with_perms(pointcloud)) > 0:
+                raise PermissionError(f'User "{request.user.username}" not allowed to read point cloud #{pointcloud.id}')
+
+        transform = get_landmark_transform(project_id, source_group_id,
+                target_group_id, use_reverse_matches)
+
+        return Response({
+            'n_matches': len(transform),
+            'skeletons': transform_skeletons(project_id, transform,
+                    skeleton_ids, with_connectors) if skeleton_ids else {},
+            'pointclouds': transform_pointclouds(transform,
+                    pointcloud_ids) if pointcloud_ids else {},
+            'points': transform.apply(points).tolist() if points else [],
         })
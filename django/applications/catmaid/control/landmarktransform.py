@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+from functools import lru_cache
+import logging
+from typing import Any, DefaultDict, Dict, List, Tuple
+
+import numpy as np
+
+from django.db import connection
+
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.pointcloud import get_pointcloud_points
+from catmaid.control.skeletonexport import _compact_skeletons
+
+
+logger = logging.getLogger(__name__)
+
+# The maximum number of distances between points and point matches that are
+# held in memory at once while transforming points.
+MAX_BATCH_DISTANCES = 2000000
+
+# The number of fitted transforms kept per process.
+TRANSFORM_CACHE_SIZE = 32
+
+
+class MovingLeastSquaresTransform(object):
+    """An affine moving least squares transform of 3D points. Each point is
+    transformed by an affine model, fitted to all point matches, which are
+    weighted by the inverse of their squared distance to the point, raised to
+    the power of <alpha>. This is the same transform the front-end's
+    MovingLeastSquaresTransform computes with an AffineModel3D, but points are
+    transformed in batches with numpy.
+    """
+
+    def __init__(self, sources, targets, weights=None, alpha=1.0):
+        self.sources = np.asarray(sources, dtype=np.float64).reshape(-1, 3)
+        self.targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+        if len(self.sources) != len(self.targets):
+            raise ValueError("Need the same number of source and target points")
+        if len(self.sources) < 4:
+            raise ValueError(f"Need at least four point matches, found {len(self.sources)}")
+        self.weights = np.ones(len(self.sources)) if weights is None else \
+                np.asarray(weights, dtype=np.float64)
+        self.alpha = alpha
+
+        # Like the front-end, refuse point matches to which no single affine
+        # model can be fitted, e.g. because all of them are in one plane.
+        centered = self.sources - np.average(self.sources, axis=0,
+                weights=self.weights)
+        covariance = np.einsum('m,mi,mj->ij', self.weights, centered, centered)
+        if np.linalg.det(covariance) == 0:
+            raise ValueError("The point matches are ill defined, no affine " +
+                    "model can be fitted")
+
+        # The weighted sums of outer products of all point matches are computed
+        # for all points of a batch with one matrix product.
+        self.source_outer = np.einsum('mi,mj->mij', self.sources,
+                self.sources).reshape(-1, 9)
+        self.target_source_outer = np.einsum('mi,mj->mij', self.targets,
+                self.sources).reshape(-1, 9)
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    def apply(self, points) -> np.ndarray:
+        """Transform an N x 3 array of points and return the transformed
+        points as new array.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        result = np.empty_like(points)
+        batch_size = max(1, MAX_BATCH_DISTANCES // len(self.sources))
+        for start in range(0, len(points), batch_size):
+            end = start + batch_size
+            result[start:end] = self._apply_batch(points[start:end])
+        return result
+
+    def _apply_batch(self, points) -> np.ndarray:
+        n_points = len(points)
+        delta = points[:, np.newaxis, :] - self.sources[np.newaxis, :, :]
+        sq_distances = np.einsum('nmi,nmi->nm', delta, delta)
+
+        # Points at the location of a source point are mapped to its target.
+        exact = sq_distances <= 0
+        exact_points = np.flatnonzero(exact.any(axis=1))
+        sq_distances[exact_points] = 1.0
+
+        w = self.weights / sq_distances ** self.alpha
+        w_sum = w.sum(axis=1)
+        source_centers = (w @ self.sources) / w_sum[:, np.newaxis]
+        target_centers = (w @ self.targets) / w_sum[:, np.newaxis]
+
+        # Weighted covariance of the sources and of targets and sources, both
+        # relative to the weighted centers.
+        a = (w @ self.source_outer).reshape(n_points, 3, 3) - \
+                w_sum[:, np.newaxis, np.newaxis] * \
+                np.einsum('ni,nj->nij', source_centers, source_centers)
+        b = (w @ self.target_source_outer).reshape(n_points, 3, 3) - \
+                w_sum[:, np.newaxis, np.newaxis] * \
+                np.einsum('ni,nj->nij', target_centers, source_centers)
+
+        # The affine matrix m satisfies m a = b, a is symmetric. Points for
+        # which no model can be fitted aren't transformed, like in the
+        # front-end.
+        ill_defined = np.linalg.det(a) == 0
+        a[ill_defined] = np.identity(3)
+        m = np.transpose(np.linalg.solve(a, np.transpose(b, (0, 2, 1))), (0, 2, 1))
+
+        result = np.einsum('nij,nj->ni', m, points - source_centers) + target_centers
+        result[ill_defined] = points[ill_defined]
+        result[exact_points] = self.targets[np.argmax(exact[exact_points], axis=1)]
+        return result
+
+
+def get_point_matches(project_id, source_group_id, target_group_id,
+        use_reverse_matches:bool=False) -> Tuple[np.ndarray, np.ndarray]:
+    """Find all landmarks shared by both landmark groups that have exactly one
+    location linked to both the landmark and each group. Returns the source
+    and target locations of these landmarks as two N x 3 arrays. With
+    <use_reverse_matches>, each match is also added in reverse.
+    """
+    relations = get_relation_to_id_map(project_id, ('part_of', 'annotated_with'))
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT landmark.id, pci_g.class_instance_id, p.location_x,
+            p.location_y, p.location_z
+        FROM (
+            SELECT class_instance_a
+            FROM class_instance_class_instance
+            WHERE class_instance_b = %(source_group_id)s
+                AND relation_id = %(part_of)s
+                AND project_id = %(project_id)s
+            INTERSECT
+            SELECT class_instance_a
+            FROM class_instance_class_instance
+            WHERE class_instance_b = %(target_group_id)s
+                AND relation_id = %(part_of)s
+                AND project_id = %(project_id)s
+        ) landmark(id)
+        JOIN point_class_instance pci_l
+            ON pci_l.class_instance_id = landmark.id
+            AND pci_l.relation_id = %(annotated_with)s
+        JOIN point_class_instance pci_g
+            ON pci_g.point_id = pci_l.point_id
+            AND pci_g.relation_id = %(annotated_with)s
+            AND pci_g.class_instance_id IN (%(source_group_id)s, %(target_group_id)s)
+        JOIN point p
+            ON p.id = pci_l.point_id
+        ORDER BY landmark.id
+    """, {
+        'project_id': project_id,
+        'source_group_id': source_group_id,
+        'target_group_id': target_group_id,
+        'part_of': relations['part_of'],
+        'annotated_with': relations['annotated_with'],
+    })
+
+    locations:DefaultDict[Tuple[int, int], List] = defaultdict(list)
+    landmark_ids = []
+    for landmark_id, group_id, x, y, z in cursor.fetchall():
+        if not landmark_ids or landmark_ids[-1] != landmark_id:
+            landmark_ids.append(landmark_id)
+        locations[(landmark_id, group_id)].append((x, y, z))
+
+    sources, targets = [], []
+    for landmark_id in landmark_ids:
+        source_locations = locations[(landmark_id, source_group_id)]
+        target_locations = locations[(landmark_id, target_group_id)]
+        if len(source_locations) != 1 or len(target_locations) != 1:
+            logger.debug(f'Ignoring landmark {landmark_id}, it needs exactly ' +
+                    'one location in each group')
+            continue
+        sources.append(source_locations[0])
+        targets.append(target_locations[0])
+
+    if use_reverse_matches:
+        sources, targets = sources + targets, targets + sources
+
+    return np.array(sources, dtype=np.float64).reshape(-1, 3), \
+            np.array(targets, dtype=np.float64).reshape(-1, 3)
+
+
+def get_landmark_group_version(project_id, group_ids) -> Tuple[Any, int]:
+    """Return the latest edition time and the number of all rows the point
+    matches of the passed in landmark groups depend on: the groups, their
+    landmark memberships, the location links of groups and landmarks and the
+    locations themselves. Any change to the point matches changes this
+    version.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        WITH member AS (
+            SELECT cici.class_instance_a AS id, cici.edition_time
+            FROM class_instance_class_instance cici
+            JOIN relation r
+                ON r.id = cici.relation_id
+            WHERE cici.class_instance_b = ANY(%(group_ids)s::bigint[])
+                AND cici.project_id = %(project_id)s
+                AND r.relation_name = 'part_of'
+        ), location_link AS (
+            SELECT pci.point_id, pci.edition_time
+            FROM point_class_instance pci
+            WHERE pci.class_instance_id = ANY(%(group_ids)s::bigint[])
+                OR pci.class_instance_id IN (SELECT id FROM member)
+        )
+        SELECT max(edition_time), count(*)
+        FROM (
+            SELECT edition_time
+            FROM class_instance
+            WHERE id = ANY(%(group_ids)s::bigint[])
+            UNION ALL
+            SELECT edition_time FROM member
+            UNION ALL
+            SELECT edition_time FROM location_link
+            UNION ALL
+            SELECT p.edition_time
+            FROM point p
+            JOIN location_link ll
+                ON ll.point_id = p.id
+        ) dependency
+    """, {
+        'project_id': project_id,
+        'group_ids': list(group_ids),
+    })
+    return tuple(cursor.fetchone())
+
+
+@lru_cache(maxsize=TRANSFORM_CACHE_SIZE)
+def _get_cached_transform(project_id, source_group_id, target_group_id,
+        use_reverse_matches, version) -> MovingLeastSquaresTransform:
+    sources, targets = get_point_matches(project_id, source_group_id,
+            target_group_id, use_reverse_matches)
+    return MovingLeastSquaresTransform(sources, targets)
+
+
+def get_landmark_transform(project_id, source_group_id, target_group_id,
+        use_reverse_matches:bool=False) -> MovingLeastSquaresTransform:
+    """Get the transform that maps locations from the source to the target
+    landmark group. Fitted transforms are cached per process and reused as
+    long as the landmark groups don't change.
+    """
+    project_id, source_group_id, target_group_id = int(project_id), \
+            int(source_group_id), int(target_group_id)
+    version = get_landmark_group_version(project_id,
+            [source_group_id, target_group_id])
+    return _get_cached_transform(project_id, source_group_id, target_group_id,
+            bool(use_reverse_matches), version)
+
+
+def transform_rows(transform, rows, offset) -> List[List]:
+    """Transform the locations in the three columns starting at <offset> of
+    the passed in rows and return the rows as lists.
+    """
+    if not rows:
+        return []
+    locations = transform.apply([row[offset:offset + 3] for row in rows])
+    return [list(row[:offset]) + location + list(row[offset + 3:])
+            for row, location in zip(rows, locations.tolist())]
+
+
+def transform_skeletons(project_id, transform, skeleton_ids,
+        with_connectors:bool=False) -> Dict[int, List]:
+    """Get the compact representation of the passed in skeletons, with
+    transformed node and connector locations. Returns a dictionary that maps
+    each skeleton ID to its [nodes, connectors] list.
+    """
+    skeletons = _compact_skeletons(project_id, skeleton_ids,
+            with_connectors=with_connectors, with_tags=False)
+    # Nodes: [id, parent_id, user_id, x, y, z, radius, confidence],
+    # connectors: [treenode_id, connector_id, relation, x, y, z]
+    return {skeleton_id: [transform_rows(transform, data[0], 3),
+            transform_rows(transform, data[1], 3)]
+            for skeleton_id, data in skeletons.items()}
+
+
+def transform_pointclouds(transform, pointcloud_ids) -> Dict[int, List]:
+    """Get all points of the passed in point clouds, transformed. Returns a
+    dictionary that maps each point cloud ID to a list of [id, x, y, z] lists.
+    """
+    result = {}
+    for pointcloud_id, (point_ids, locations) in get_pointcloud_points(pointcloud_ids).items():
+        result[pointcloud_id] = [[point_id] + location for point_id, location
+                in zip(point_ids.tolist(), transform.apply(locations).tolist())]
+    return result
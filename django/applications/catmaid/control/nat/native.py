@@ -0,0 +1,723 @@
+# -*- coding: utf-8 -*-
+"""A NBLAST implementation based on NumPy and SciPy. It mirrors what the R
+packages nat and nat.nblast do (see catmaid.control.nat.r), but runs in-process
+and doesn't need to serialize neuron lists through R. Dotprops caches are
+stored as NumPy files that are memory mapped when loaded.
+"""
+
+import heapq
+from itertools import groupby
+import math
+from multiprocessing import current_process, Pool
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from django.conf import settings
+from django.db import connection
+
+from catmaid.apps import get_system_user
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.pointcloud import get_pointcloud_points
+from catmaid.models import NblastConfig, PointCloud, PointSet
+
+from celery.utils.log import get_task_logger
+
+
+logger = get_task_logger(__name__)
+
+# NAT works mostly in um space and CATMAID in nm.
+nm_to_um = 1e-3
+
+# How many skeletons are loaded from the database with a single query.
+SKELETON_BATCH_SIZE = 500
+
+# Each dotprops cache row stores a point, its tangent vector and alpha value.
+DPS_CACHE_COLUMNS = 7
+
+# Tags which mark a soma, the same as the R skeleton import uses to find the
+# root of a neuron.
+soma_tag_pattern = re.compile('(cell body|soma)', re.IGNORECASE)
+
+
+class Dotprops(object):
+    """Points along with the tangent vector and the alpha value (how linear the
+    neighborhood of a point is) of each point. A KD-tree of the points is
+    created when first needed.
+    """
+
+    def __init__(self, points, vect, alpha, tree=None) -> None:
+        self.points = points
+        self.vect = vect
+        self.alpha = alpha
+        self._tree = tree
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    @property
+    def tree(self) -> cKDTree:
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Trees are cheap to rebuild compared to pickling them.
+        return {
+            'points': np.asarray(self.points),
+            'vect': np.asarray(self.vect),
+            'alpha': np.asarray(self.alpha),
+            '_tree': None,
+        }
+
+
+class ScoringMatrix(object):
+    """Look up NBLAST scores for distance and absolute dot product pairs. Values
+    outside of the breaks are counted towards the first or last bin, like R's
+    findInterval(all.inside=TRUE) does in nat.nblast.
+    """
+
+    def __init__(self, scoring, distance_breaks, dot_breaks) -> None:
+        self.cells = np.asarray(scoring, dtype=np.float64)
+        self.distance_breaks = np.asarray(distance_breaks, dtype=np.float64)
+        self.dot_breaks = np.asarray(dot_breaks, dtype=np.float64)
+
+        expected_shape = (len(self.distance_breaks) - 1, len(self.dot_breaks) - 1)
+        if self.cells.shape != expected_shape:
+            raise ValueError(f"Scoring matrix has shape {self.cells.shape}, "
+                    f"but breaks require {expected_shape}")
+
+    @staticmethod
+    def from_config(config) -> 'ScoringMatrix':
+        return ScoringMatrix(config.scoring, config.distance_breaks,
+                config.dot_breaks)
+
+    def lookup(self, distances, dots) -> np.ndarray:
+        dist_bins = np.clip(np.searchsorted(self.distance_breaks, distances,
+                side='right') - 1, 0, self.cells.shape[0] - 1)
+        dot_bins = np.clip(np.searchsorted(self.dot_breaks, dots,
+                side='right') - 1, 0, self.cells.shape[1] - 1)
+        return self.cells[dist_bins, dot_bins]
+
+
+def make_dotprops(points, k=5, omit_failures=True) -> Optional[Dotprops]:
+    """Compute tangent vectors and alpha values from the <k> nearest neighbors
+    of each point (including itself), like nat's dotprops(). The tangent is the
+    first principal component of the neighborhood. If there are fewer than <k>
+    points, None is returned or, if <omit_failures> is False, an error is
+    raised.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if len(points) < max(k, 1):
+        if omit_failures:
+            return None
+        raise ValueError(f"Too few points to calculate properties: {len(points)}")
+
+    tree = cKDTree(points)
+    _, neighbors = tree.query(points, k=k)
+    if k == 1:
+        neighbors = neighbors[:, np.newaxis]
+
+    neighborhoods = points[neighbors]
+    neighborhoods -= neighborhoods.mean(axis=1, keepdims=True)
+    inertia = np.einsum('nki,nkj->nij', neighborhoods, neighborhoods)
+    # Eigenvalues are returned in ascending order.
+    eigenvalues, eigenvectors = np.linalg.eigh(inertia)
+    vect = eigenvectors[:, :, 2]
+    total = eigenvalues.sum(axis=1)
+    alpha = np.divide(eigenvalues[:, 2] - eigenvalues[:, 1], total,
+            out=np.zeros(len(points)), where=total > 0)
+
+    return Dotprops(points, vect, alpha, tree)
+
+
+def reroot(parents, new_root) -> np.ndarray:
+    """Return a copy of the passed in parent index array, in which the edges on
+    the path from <new_root> to the current root are reversed.
+    """
+    parents = parents.copy()
+    previous, node = -1, new_root
+    while node != -1:
+        next_node = parents[node]
+        parents[node] = previous
+        previous, node = node, next_node
+    return parents
+
+
+def get_children(parents) -> Tuple[List[List[int]], List[int]]:
+    children:List[List[int]] = [[] for _ in range(len(parents))]
+    roots = []
+    for node, parent in enumerate(parents):
+        if parent == -1:
+            roots.append(node)
+        else:
+            children[parent].append(node)
+    return children, roots
+
+
+def simplify_tree(parents, positions, n_branches) -> np.ndarray:
+    """Return a boolean mask of the nodes that are part of the longest subtree
+    with at most <n_branches> branch points. Like nat's simplify_neuron(), this
+    starts with the longest path from the root and greedily adds the branch that
+    adds the most cable <n_branches> times.
+    """
+    n_nodes = len(parents)
+    children, roots = get_children(parents)
+
+    order = list(roots)
+    for node in order:
+        order.extend(children[node])
+
+    has_parent = parents != -1
+    edge_length = np.zeros(n_nodes)
+    edge_length[has_parent] = np.linalg.norm(positions[has_parent] -
+            positions[parents[has_parent]], axis=1)
+
+    # The longest path length below each node and the child it continues in.
+    reach = np.zeros(n_nodes)
+    best_child = np.full(n_nodes, -1)
+    for node in reversed(order):
+        parent = parents[node]
+        if parent != -1:
+            length = reach[node] + edge_length[node]
+            if best_child[parent] == -1 or length > reach[parent]:
+                reach[parent] = length
+                best_child[parent] = node
+
+    keep = np.zeros(n_nodes, dtype=bool)
+    candidates:List[Tuple[float, int]] = []
+
+    def add_path(node):
+        while node != -1:
+            keep[node] = True
+            for child in children[node]:
+                if child != best_child[node]:
+                    heapq.heappush(candidates, (-(reach[child] + edge_length[child]), child))
+            node = best_child[node]
+
+    for root in roots:
+        add_path(root)
+    for _ in range(n_branches):
+        if not candidates:
+            break
+        add_path(heapq.heappop(candidates)[1])
+
+    return keep
+
+
+def resample_tree(parents, positions, step) -> np.ndarray:
+    """Resample a tree with a regular spacing of <step> along each segment
+    between root, branch and end nodes. Like nat's resample(), segment end nodes
+    are kept and the last internal point of a segment is dropped if it coincides
+    with the end node.
+    """
+    children, _ = get_children(parents)
+    n_children = np.array([len(c) for c in children], dtype=np.int64)
+    is_key = (n_children != 1) | (parents == -1)
+
+    resampled = [positions[is_key]]
+    for end in np.flatnonzero(is_key & (parents != -1)):
+        path = [end]
+        node = parents[end]
+        while not is_key[node]:
+            path.append(node)
+            node = parents[node]
+        path.append(node)
+
+        segment = positions[path[::-1]]
+        cumulative = np.concatenate(([0], np.cumsum(np.linalg.norm(
+                np.diff(segment, axis=0), axis=1))))
+        total = cumulative[-1]
+        if total <= step:
+            # Internal nodes get dropped if no new points fit in
+            continue
+        internal = np.arange(step, total, step)
+        if internal[-1] == total:
+            internal = internal[:-1]
+        resampled.append(np.column_stack([np.interp(internal, cumulative,
+                segment[:, dim]) for dim in range(3)]))
+
+    return np.concatenate(resampled)
+
+
+def skeleton_dotprops(node_ids, parent_ids, positions, soma_node_ids=None,
+        tangent_neighbors=5, resample_by=1e3, simplify=True,
+        required_branches=10, omit_failures=True) -> Optional[Dotprops]:
+    """Compute the dotprops of a single skeleton, given in nm. The result is in
+    um space, like the R results. If soma nodes are passed in, the skeleton is
+    rooted on the first one first.
+    """
+    index = {node_id: i for i, node_id in enumerate(node_ids)}
+    parents = np.array([-1 if p is None else index.get(p, -1) for p in parent_ids],
+            dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.float64) * nm_to_um
+
+    if soma_node_ids:
+        soma_index = index.get(soma_node_ids[0])
+        if soma_index is not None:
+            parents = reroot(parents, soma_index)
+
+    if simplify:
+        keep = simplify_tree(parents, positions, required_branches)
+        if not keep.all():
+            new_index = np.cumsum(keep) - 1
+            kept_parents = parents[keep]
+            parents = np.where(kept_parents == -1, -1, new_index[kept_parents])
+            positions = positions[keep]
+
+    points = resample_tree(parents, positions, resample_by * nm_to_um)
+    return make_dotprops(points, tangent_neighbors, omit_failures)
+
+
+def iter_skeletons(project_id, skeleton_ids, soma_tags=None,
+        batch_size=SKELETON_BATCH_SIZE):
+    """Load the nodes of the passed in skeletons from the database, <batch_size>
+    skeletons at a time. Yields tuples of the form (skeleton_id, node_ids,
+    parent_ids, positions, soma_node_ids).
+    """
+    cursor = connection.cursor()
+    relations = get_relation_to_id_map(project_id, ('labeled_as',), cursor)
+    for offset in range(0, len(skeleton_ids), batch_size):
+        batch = list(skeleton_ids[offset:offset + batch_size])
+
+        soma_nodes:Dict[int, List[int]] = {}
+        if soma_tags is not None and 'labeled_as' in relations:
+            cursor.execute("""
+                SELECT t.skeleton_id, t.id, ci.name
+                FROM treenode t
+                JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                    ON t.skeleton_id = query.skeleton_id
+                JOIN treenode_class_instance tci
+                    ON tci.treenode_id = t.id
+                JOIN class_instance ci
+                    ON ci.id = tci.class_instance_id
+                WHERE tci.relation_id = %(labeled_as)s
+                ORDER BY t.skeleton_id, t.id
+            """, {
+                'skeleton_ids': batch,
+                'labeled_as': relations['labeled_as'],
+            })
+            for skeleton_id, rows in groupby(cursor.fetchall(), lambda r: r[0]):
+                tagged = [(r[1], r[2]) for r in rows if soma_tag_pattern.search(r[2])]
+                # A "soma" tag is preferred over other matching tags.
+                preferred = [node_id for node_id, name in tagged if name in soma_tags]
+                soma_nodes[skeleton_id] = preferred or [node_id for node_id, _ in tagged]
+
+        cursor.execute("""
+            SELECT t.skeleton_id, t.id, t.parent_id, t.location_x,
+                t.location_y, t.location_z
+            FROM treenode t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON t.skeleton_id = query.skeleton_id
+            WHERE t.project_id = %(project_id)s
+            ORDER BY t.skeleton_id
+        """, {
+            'project_id': project_id,
+            'skeleton_ids': batch,
+        })
+        for skeleton_id, rows in groupby(cursor.fetchall(), lambda r: r[0]):
+            nodes = list(rows)
+            yield (skeleton_id, [n[1] for n in nodes], [n[2] for n in nodes],
+                    [n[3:6] for n in nodes], soma_nodes.get(skeleton_id))
+
+
+def get_skeleton_dotprops(project_id, skeleton_ids, tangent_neighbors=5,
+        resample_by=1e3, simplify=True, required_branches=10,
+        omit_failures=True, soma_tags=('soma',)) -> Dict[int, Dotprops]:
+    """Compute the dotprops of all passed in skeletons. Skeletons that can't be
+    represented are omitted, if <omit_failures> is True.
+    """
+    result = {}
+    for skeleton_id, node_ids, parent_ids, positions, soma_node_ids in \
+            iter_skeletons(project_id, skeleton_ids, soma_tags):
+        dps = skeleton_dotprops(node_ids, parent_ids, positions, soma_node_ids,
+                tangent_neighbors, resample_by, simplify, required_branches,
+                omit_failures)
+        if dps is not None:
+            result[skeleton_id] = dps
+    return result
+
+
+def get_pointcloud_dotprops(pointcloud_ids, tangent_neighbors=5,
+        omit_failures=True) -> Dict[int, Dotprops]:
+    result = {}
+    pointcloud_points = get_pointcloud_points(pointcloud_ids)
+    for pointcloud_id in pointcloud_ids:
+        if pointcloud_id not in pointcloud_points:
+            raise PointCloud.DoesNotExist(f'Could not find point cloud {pointcloud_id}')
+        points = pointcloud_points[pointcloud_id][1].astype(np.float64) * nm_to_um
+        dps = make_dotprops(points, tangent_neighbors, omit_failures)
+        if dps is not None:
+            result[pointcloud_id] = dps
+    return result
+
+
+def get_pointset_dotprops(pointset_ids, tangent_neighbors=5,
+        omit_failures=True) -> Dict[int, Dotprops]:
+    result = {}
+    for pointset_id in pointset_ids:
+        pointset = PointSet.objects.get(pk=pointset_id)
+        points = np.array(pointset.points, dtype=np.float64) * nm_to_um
+        dps = make_dotprops(points, tangent_neighbors, omit_failures)
+        if dps is not None:
+            result[pointset_id] = dps
+    return result
+
+
+def get_cache_path(project_id, object_type, simplification=10) -> str:
+    """Return the path prefix of the dotprops cache of an object type. The
+    actual cache is made up of a data file (<prefix>-data.npy) and an index file
+    (<prefix>-index.npy).
+    """
+    if object_type == 'skeleton':
+        extra = f"-simple-{simplification}"
+    elif object_type == 'pointcloud':
+        extra = ''
+    else:
+        raise ValueError(f"Unsupported object type: {object_type}")
+
+    cache_file = f"native-dps-cache-project-{project_id}-{object_type}{extra}"
+    return os.path.join(settings.MEDIA_ROOT, settings.MEDIA_CACHE_SUBDIRECTORY,
+            cache_file)
+
+
+def write_dps_cache(cache_path, object_dps) -> None:
+    """Store a mapping of object IDs to dotprops as cache files. Files are
+    written under a temporary name first, so that readers don't see partial
+    caches.
+    """
+    index = np.zeros((len(object_dps), 3), dtype=np.int64)
+    offset = 0
+    for n, (object_id, dps) in enumerate(object_dps.items()):
+        index[n] = (object_id, offset, len(dps))
+        offset += len(dps)
+
+    data = np.empty((offset, DPS_CACHE_COLUMNS), dtype=np.float64)
+    for (object_id, start, length), dps in zip(index, object_dps.values()):
+        data[start:start + length, 0:3] = dps.points
+        data[start:start + length, 3:6] = dps.vect
+        data[start:start + length, 6] = dps.alpha
+
+    for suffix, array in (('-data.npy', data), ('-index.npy', index)):
+        tmp_path = f'{cache_path}{suffix}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, f'{cache_path}{suffix}')
+
+
+def get_cached_dps_data(project_id, object_type, simplification=10) -> Optional[Dict[int, Dotprops]]:
+    """Return a mapping of object IDs to dotprops from the cache files of a
+    particular <object_type> (skeleton or pointcloud), if available. The
+    dotprops arrays are views into memory mapped files. If no cache is
+    available, None is returned.
+    """
+    cache_path = get_cache_path(project_id, object_type, simplification)
+    data_path, index_path = f'{cache_path}-data.npy', f'{cache_path}-index.npy'
+    if not all(os.path.isfile(p) and os.access(p, os.R_OK) for p in (data_path, index_path)):
+        return None
+
+    try:
+        data = np.load(data_path, mmap_mode='r')
+        index = np.load(index_path)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning(f'Could not read dotprops cache {cache_path}: {e}')
+        return None
+
+    return {int(object_id): Dotprops(data[start:start + length, 0:3],
+                data[start:start + length, 3:6], data[start:start + length, 6])
+            for object_id, start, length in index}
+
+
+def create_dps_data_cache(project_id, object_type, tangent_neighbors=20,
+        detail=10, omit_failures=True, min_nodes=500, min_soma_nodes=20,
+        soma_tags=('soma',), resample_by=1e3, max_nodes=None) -> None:
+    """Create a new cache for a particular project object type and detail
+    level. All objects of a type in a project are prepared.
+    """
+    # A circular dependency would be the result of a top level import
+    from catmaid.control.similarity import get_all_object_ids
+
+    cache_path = get_cache_path(project_id, object_type, detail)
+    cache_dir = os.path.dirname(cache_path)
+    if not os.path.exists(cache_dir) or not os.access(cache_dir, os.W_OK):
+        raise ValueError(f"Can not access cache directory: {cache_dir}")
+
+    user = get_system_user()
+    if object_type == 'skeleton':
+        object_ids = get_all_object_ids(project_id, user.id, object_type,
+                min_nodes, min_soma_nodes, soma_tags, max_nodes=max_nodes)
+        if not object_ids:
+            logger.info("No skeletons found to populate cache from")
+            return
+        logger.debug(f'Computing dotprops for {len(object_ids)} skeletons')
+        object_dps = get_skeleton_dotprops(project_id, object_ids,
+                tangent_neighbors, resample_by, detail > 0, detail,
+                omit_failures, soma_tags)
+    elif object_type == 'pointcloud':
+        object_ids = get_all_object_ids(project_id, user.id, object_type)
+        if not object_ids:
+            logger.info("No pointclouds found to populate cache from")
+            return
+        logger.debug(f'Computing dotprops for {len(object_ids)} point clouds')
+        object_dps = get_pointcloud_dotprops(object_ids, tangent_neighbors,
+                omit_failures)
+    else:
+        raise ValueError(f'Unsupported object type: {object_type}')
+
+    logger.debug(f'Storing {object_type} cache with {len(object_dps)} entries: {cache_path}')
+    write_dps_cache(cache_path, object_dps)
+
+
+def score_dotprops(query, target, smat, use_alpha=False) -> float:
+    """Sum up the scores of each query point, based on its distance to the
+    nearest target point and the absolute dot product of their tangents.
+    """
+    distances, nearest = target.tree.query(query.points)
+    dots = np.abs(np.einsum('ij,ij->i', query.vect, target.vect[nearest]))
+    if use_alpha:
+        dots *= np.sqrt(query.alpha * target.alpha[nearest])
+    return float(smat.lookup(distances, dots).sum())
+
+
+# The state of worker processes, set when a pool is created.
+_worker_state:Optional[Tuple] = None
+
+
+def _init_worker(queries, targets, smat, use_alpha) -> None:
+    global _worker_state
+    _worker_state = (queries, targets, smat, use_alpha)
+
+
+def score_rows(queries, targets, smat, use_alpha, start, end) -> np.ndarray:
+    return np.array([[score_dotprops(queries[i], t, smat, use_alpha)
+            for t in targets] for i in range(start, end)], dtype=np.float64)
+
+
+def _score_rows(rows) -> Tuple[int, np.ndarray]:
+    queries, targets, smat, use_alpha = _worker_state # type: ignore
+    start, end = rows
+    return start, score_rows(queries, targets, smat, use_alpha, start, end)
+
+
+def score_matrix(queries:Sequence[Dotprops], targets:Sequence[Dotprops], smat,
+        use_alpha=False, normalized=False, n_workers=1) -> np.ndarray:
+    """Compute a matrix of NBLAST scores with a row for each query and a column
+    for each target. If <n_workers> is larger than one and there are enough
+    queries, chunks of rows are scored in a process pool. Daemonic processes,
+    like Celery's worker processes, can't start a pool and score all rows
+    themselves. Normalized scores are divided by the self-match score of the
+    query.
+    """
+    n_queries = len(queries)
+    scores = np.empty((n_queries, len(targets)), dtype=np.float64)
+    use_pool = n_workers > 1 and n_queries >= settings.NBLAST_ALL_BY_ALL_MIN_SIZE
+    if use_pool and current_process().daemon:
+        logger.debug('Scoring NBLAST matrix in a single process, daemonic '
+                'processes can\'t have children')
+        use_pool = False
+    if use_pool:
+        chunk_size = max(1, math.ceil(n_queries / (n_workers * 4)))
+        chunks = [(start, min(start + chunk_size, n_queries))
+                for start in range(0, n_queries, chunk_size)]
+        with Pool(n_workers, _init_worker, (queries, targets, smat, use_alpha)) as pool:
+            for start, rows in pool.imap_unordered(_score_rows, chunks):
+                scores[start:start + len(rows)] = rows
+    else:
+        scores[:] = score_rows(queries, targets, smat, use_alpha, 0, n_queries)
+
+    if normalized:
+        self_scores = np.array([score_dotprops(q, q, smat, use_alpha)
+                for q in queries])
+        scores /= self_scores[:, np.newaxis]
+
+    return scores
+
+
+def get_object_dotprops(project_id, object_type, object_ids, cache,
+        tangent_neighbors, resample_by, simplify, required_branches,
+        omit_failures) -> Dict[int, Dotprops]:
+    """Return dotprops of the passed in objects, read from the passed in cache
+    if possible. Objects that are missing in the result couldn't be
+    represented.
+    """
+    result = {}
+    missing_ids = []
+    for object_id in object_ids:
+        if cache and object_id in cache:
+            result[object_id] = cache[object_id]
+        else:
+            missing_ids.append(object_id)
+
+    logger.debug(f'Fetching {len(missing_ids)} {object_type} objects '
+            f'({len(object_ids) - len(missing_ids)} cache hits)')
+    if not missing_ids:
+        return result
+
+    if object_type == 'skeleton':
+        result.update(get_skeleton_dotprops(project_id, missing_ids,
+                tangent_neighbors, resample_by, simplify, required_branches,
+                omit_failures))
+    elif object_type == 'pointcloud':
+        result.update(get_pointcloud_dotprops(missing_ids, tangent_neighbors,
+                omit_failures))
+    elif object_type == 'pointset':
+        result.update(get_pointset_dotprops(missing_ids, tangent_neighbors,
+                omit_failures))
+    else:
+        raise ValueError(f"Unknown object type: {object_type}")
+
+    return result
+
+
+def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
+        query_type='skeleton', target_type='skeleton', omit_failures=True,
+        normalized='raw', use_alpha=False, remove_target_duplicates=True,
+        min_nodes=500, min_soma_nodes=20, simplify=True, required_branches=10,
+        soma_tags=('soma', ), use_cache=True, reverse=False, top_n=0,
+        resample_by=1e3, use_http=False) -> Dict[str, Any]:
+    """Create NBLAST score for forward similarity from query objects to target
+    objects. This takes the same parameters and returns results in the same
+    format as catmaid.control.nat.r.nblast(), except that HTTP loading of
+    skeletons isn't supported.
+    """
+    similarity = None
+    query_object_ids_in_use = None
+    target_object_ids_in_use = None
+    errors = []
+    try:
+        if use_http:
+            raise ValueError("The native NBLAST engine doesn't load skeletons through HTTP")
+
+        config = NblastConfig.objects.get(project_id=project_id, pk=config_id)
+        smat = ScoringMatrix.from_config(config)
+
+        # Indicate an all-by-all computation. This disabled <remove_target_duplicates>.
+        all_by_all = not query_object_ids and not target_object_ids and \
+                query_type == target_type
+        if all_by_all:
+            logger.debug('Disabling remove_target_duplicates option due to all-by-all computation')
+            remove_target_duplicates = False
+
+        # In case either query_object_ids or target_object_ids is not given, the
+        # value will be filled in with all objects of the respective type.
+        from catmaid.control.similarity import get_all_object_ids
+        if all_by_all:
+            query_object_ids = get_all_object_ids(project_id, user_id,
+                    query_type, min_nodes, min_soma_nodes, soma_tags)
+            target_object_ids = query_object_ids
+        else:
+            if not query_object_ids:
+                query_object_ids = get_all_object_ids(project_id, user_id,
+                        query_type, min_nodes, min_soma_nodes, soma_tags)
+            if not target_object_ids:
+                target_object_ids = get_all_object_ids(project_id, user_id,
+                        target_type, min_nodes, min_soma_nodes, soma_tags)
+
+        # If both query and target IDs are of the same type, the target list of
+        # object IDs can't contain any of the query IDs.
+        if query_type == target_type and remove_target_duplicates:
+            target_object_ids = list(set(target_object_ids) - set(query_object_ids))
+
+        caches:Dict[str, Optional[Dict[int, Dotprops]]] = {}
+        if use_cache:
+            for object_type in {query_type, target_type} - {'pointset'}:
+                caches[object_type] = get_cached_dps_data(project_id,
+                        object_type, required_branches if simplify else 0)
+
+        dps_params = (config.tangent_neighbors, resample_by, simplify,
+                required_branches, omit_failures)
+        query_dps = get_object_dotprops(project_id, query_type,
+                query_object_ids, caches.get(query_type), *dps_params)
+        if all_by_all:
+            logger.debug('All-by-all computation: using query objects and dps for target')
+            target_dps = query_dps
+        else:
+            target_dps = get_object_dotprops(project_id, target_type,
+                    target_object_ids, caches.get(target_type), *dps_params)
+
+        if not query_dps:
+            raise ValueError("No valid query objects found")
+
+        if not target_dps:
+            raise ValueError("No valid target objects found")
+
+        query_object_ids_in_use = [o for o in query_object_ids if o in query_dps]
+        target_object_ids_in_use = [o for o in target_object_ids if o in target_dps]
+        queries = [query_dps[o] for o in query_object_ids_in_use]
+        targets = [target_dps[o] for o in target_object_ids_in_use]
+
+        logger.debug('Computing score (alpha: {a}, noramlized: {n}, reverse: {r}, top N: {tn})'.format(**{
+            'a': 'Yes' if use_alpha else 'No',
+            'n': 'No' if normalized == 'raw' else f'Yes ({normalized})',
+            'r': 'Yes' if reverse else 'No',
+            'tn': top_n if top_n else '-',
+        }))
+
+        n_workers = settings.MAX_PARALLEL_ASYNC_WORKERS
+        score_params = (smat, use_alpha, normalized != 'raw', n_workers)
+
+        def query_to_target():
+            return score_matrix(queries, targets, *score_params)
+
+        def target_to_query():
+            return score_matrix(targets, queries, *score_params).T
+
+        # Rows are always query objects and columns target objects. With
+        # reverse scoring, targets are scored against the query objects. In
+        # all-by-all computations both directions are transposes of each
+        # other, which is why only one of them is computed.
+        use_backward = normalized in ('mean', 'geometric-mean')
+        backward_scores = None
+        if all_by_all:
+            forward = query_to_target()
+            if reverse:
+                forward = forward.T
+            if use_backward:
+                backward_scores = forward.T
+        elif not reverse:
+            forward = query_to_target()
+            if use_backward:
+                backward_scores = target_to_query()
+        else:
+            forward = target_to_query()
+            if use_backward:
+                backward_scores = query_to_target()
+
+        if backward_scores is not None:
+            if normalized == 'mean':
+                scores = (forward + backward_scores) / 2.0
+            else:
+                # Clamp negative scores to zero and compute geometric mean.
+                scores = np.sqrt(np.clip(forward, 0, None) *
+                        np.clip(backward_scores, 0, None))
+        else:
+            scores = forward
+
+        # Like the R engine, only keep the top N forward matches of each query
+        # object. Columns are the targets among the top N of any query object
+        # and all other scores of a row are NaN.
+        if top_n and scores.shape[1] > top_n:
+            top_columns = np.argsort(-forward, axis=1, kind='stable')[:, :top_n]
+            in_top_n = np.zeros(scores.shape, dtype=bool)
+            np.put_along_axis(in_top_n, top_columns, True, axis=1)
+            used_columns = np.flatnonzero(in_top_n.any(axis=0))
+            scores = np.where(in_top_n, scores, np.nan)[:, used_columns]
+            target_object_ids_in_use = [target_object_ids_in_use[i] for i in used_columns]
+
+        similarity = scores.tolist()
+
+        logger.debug('NBLAST computation done')
+
+    except (IOError, OSError, ValueError) as e:
+        logger.exception(e)
+        errors.append(str(e))
+
+    return {
+        "errors": errors,
+        "similarity": similarity,
+        "query_object_ids": query_object_ids_in_use,
+        "target_object_ids": target_object_ids_in_use,
+    }
@@ -19,9 +19,10 @@ from django.http import HttpRequest, HttpResponse, JsonResponse
 from catmaid.apps import get_system_user
 from catmaid.control.common import get_request_bool, urljoin
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.pointcloud import get_pointcloud_points
 from catmaid.models import (Message, User, UserRole, NblastConfig,
         NblastConfigDefaultDistanceBreaks, NblastConfigDefaultDotBreaks,
-        PointCloud, PointSet)
+        PointSet)
 
 from celery.task import task
 from celery.utils.log import get_task_logger
@@ -407,14 +408,11 @@ def compute_scoring_matrix(project_id, user_id, matching_sample,
         # into one cloud.
         if matching_sample.sample_pointclouds:
             pointclouds = []
+            pointcloud_points = get_pointcloud_points(matching_sample.sample_pointclouds)
             for pcid in matching_sample.sample_pointclouds:
-                target_pointcloud = PointCloud.objects.prefetch_related('points').get(pk=pcid)
-                points_flat = list(chain.from_iterable(
-                        (p.location_x, p.location_y, p.location_z)
-                        for p in target_pointcloud.points.all()))
-                n_points = len(points_flat) / 3
-                point_data = Matrix(rinterface.FloatSexpVector(points_flat),
-                        nrow=n_points, byrow=True)
+                points = pointcloud_points[pcid][1].astype(numpy.float64)
+                point_data = Matrix(rinterface.FloatSexpVector(points.ravel()),
+                        nrow=len(points), byrow=True)
                 pointclouds.append(point_data)
 
             pointcloud_objects = rnat.as_neuronlist(pointclouds)
@@ -689,14 +687,11 @@ def create_dps_data_cache(project_id, object_type, tangent_neighbors=20,
             return
         logger.debug(f'Fetching {len(object_ids)} query point clouds')
         pointclouds = []
+        pointcloud_points = get_pointcloud_points(object_ids)
         for pcid in object_ids:
-            target_pointcloud = PointCloud.objects.prefetch_related('points').get(pk=pcid)
-            points_flat = list(chain.from_iterable(
-                    (p.location_x, p.location_y, p.location_z)
-                    for p in target_pointcloud.points.all()))
-            n_points = len(points_flat) / 3
-            point_data = Matrix(rinterface.FloatSexpVector(points_flat),
-                    nrow=n_points, byrow=True)
+            points = pointcloud_points[pcid][1].astype(numpy.float64)
+            point_data = Matrix(rinterface.FloatSexpVector(points.ravel()),
+                    nrow=len(points), byrow=True)
             pointclouds.append(point_data)
 
         objects = rnat.as_neuronlist(pointclouds)
@@ -917,14 +912,11 @@ def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
             logger.debug(f'Fetching {len(effective_query_object_ids)} query point clouds ({cache_hits} cache hits)')
             if effective_query_object_ids:
                 pointclouds = []
+                pointcloud_points = get_pointcloud_points(effective_query_object_ids)
                 for pcid in effective_query_object_ids:
-                    target_pointcloud = PointCloud.objects.prefetch_related('points').get(pk=pcid)
-                    points_flat = list(chain.from_iterable(
-                            (p.location_x, p.location_y, p.location_z)
-                            for p in target_pointcloud.points.all()))
-                    n_points = len(points_flat) / 3
-                    point_data = Matrix(rinterface.FloatSexpVector(points_flat),
-                            nrow=n_points, byrow=True)
+                    points = pointcloud_points[pcid][1].astype(numpy.float64)
+                    point_data = Matrix(rinterface.FloatSexpVector(points.ravel()),
+                            nrow=len(points), byrow=True)
                     pointclouds.append(point_data)
 
                 query_objects = rnat.as_neuronlist(pointclouds)
@@ -1083,14 +1075,11 @@ def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
                 logger.debug(f'Fetching {len(effective_target_object_ids)} target point clouds ({cache_hits} cache hits)')
                 if effective_target_object_ids:
                     pointclouds = []
+                    pointcloud_points = get_pointcloud_points(effective_target_object_ids)
                     for pcid in effective_target_object_ids:
-                        target_pointcloud = PointCloud.objects.prefetch_related('points').get(pk=pcid)
-                        points_flat = list(chain.from_iterable(
-                                (p.location_x, p.location_y, p.location_z)
-                                for p in target_pointcloud.points.all()))
-                        n_points = len(points_flat) / 3
-                        point_data = Matrix(rinterface.FloatSexpVector(points_flat),
-                                nrow=n_points, byrow=True)
+                        points = pointcloud_points[pcid][1].astype(numpy.float64)
+                        point_data = Matrix(rinterface.FloatSexpVector(points.ravel()),
+                                nrow=len(points), byrow=True)
                         pointclouds.append(point_data)
 
                     target_objects = rnat.as_neuronlist(pointclouds)
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import math
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpRequest, HttpResponse, JsonResponse, Http404
+
+from rest_framework.decorators import api_view
+
+from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.models import UserRole
+
+
+# The vertex attributes stored for each skeleton node, in the order they
+# follow vertex positions and edges in encoded skeletons.
+VERTEX_ATTRIBUTES = [
+    {'id': 'radius', 'data_type': 'float32', 'num_components': 1},
+    {'id': 'confidence', 'data_type': 'uint8', 'num_components': 1},
+]
+
+skeleton_node_dtype = np.dtype([('skeleton_id', np.int64), ('id', np.int64),
+        ('parent_id', np.int64), ('x', np.float32), ('y', np.float32),
+        ('z', np.float32), ('radius', np.float32), ('confidence', np.uint8)])
+
+
+def get_skeleton_info(sharding=None) -> Dict[str, Any]:
+    """Return the info file of a Neuroglancer precomputed skeleton source.
+    CATMAID's project space is in nanometers, no transformation of vertex
+    positions is needed.
+    """
+    info = {
+        '@type': 'neuroglancer_skeletons',
+        'transform': [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0],
+        'vertex_attributes': VERTEX_ATTRIBUTES,
+        'segment_properties': 'segment_properties',
+    }
+    if sharding:
+        info['sharding'] = sharding
+    return info
+
+
+def get_skeleton_nodes(project_id, skeleton_ids) -> Dict[int, np.ndarray]:
+    """Get the nodes of all passed in skeletons as structured arrays of type
+    skeleton_node_dtype, ordered by node ID. Root nodes have a parent ID of -1.
+    Returns a dictionary that maps each skeleton ID to its nodes, skeletons
+    without nodes are not included.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT t.skeleton_id, t.id, COALESCE(t.parent_id, -1), t.location_x,
+            t.location_y, t.location_z, t.radius, t.confidence
+        FROM treenode t
+        JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+            ON t.skeleton_id = query.skeleton_id
+        WHERE t.project_id = %(project_id)s
+        ORDER BY t.skeleton_id, t.id
+    """, {
+        'project_id': project_id,
+        'skeleton_ids': list(skeleton_ids),
+    })
+    nodes = np.array(cursor.fetchall(), dtype=skeleton_node_dtype)
+    if not len(nodes):
+        return {}
+    starts = np.r_[0, np.flatnonzero(np.diff(nodes['skeleton_id'])) + 1]
+    ends = np.r_[starts[1:], len(nodes)]
+    return dict((int(nodes['skeleton_id'][start]), nodes[start:end])
+            for start, end in zip(starts, ends))
+
+
+def encode_skeleton(nodes) -> bytes:
+    """Encode the passed in nodes of a single skeleton, ordered by ID (see
+    get_skeleton_nodes()), in Neuroglancer's precomputed skeleton format: the
+    number of vertices and edges, followed by all vertex positions, all edges
+    as pairs of vertex indices and an array for each vertex attribute. All
+    values are little-endian.
+    """
+    child_index = np.flatnonzero(nodes['parent_id'] >= 0)
+    parent_index = np.searchsorted(nodes['id'], nodes['parent_id'][child_index])
+    # Ignore edges to parents that aren't part of the skeleton.
+    parent_index = np.minimum(parent_index, max(len(nodes) - 1, 0))
+    valid = nodes['id'][parent_index] == nodes['parent_id'][child_index]
+    edges = np.column_stack((child_index[valid], parent_index[valid])).astype('<u4')
+
+    positions = np.column_stack((nodes['x'], nodes['y'], nodes['z'])).astype('<f4')
+    header = np.array([len(nodes), len(edges)], dtype='<u4')
+
+    return b''.join((header.tobytes(), positions.tobytes(), edges.tobytes(),
+            nodes['radius'].astype('<f4').tobytes(),
+            nodes['confidence'].astype(np.uint8).tobytes()))
+
+
+def get_skeleton_cache_key(skeleton_id) -> str:
+    return f'catmaid-neuroglancer-skeleton-{skeleton_id}'
+
+
+def get_skeleton_versions(project_id, skeleton_ids) -> Dict[int, Tuple[str, int]]:
+    """Return the latest edition time of all nodes and the number of nodes of
+    each passed in skeleton. These are read from the nodes themselves, because
+    the skeleton summary isn't updated for e.g. radius or confidence changes.
+    Skeletons without nodes are not included.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT t.skeleton_id, MAX(t.edition_time), COUNT(*)
+        FROM treenode t
+        WHERE t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            AND t.project_id = %(project_id)s
+        GROUP BY t.skeleton_id
+    """, {
+        'project_id': project_id,
+        'skeleton_ids': list(skeleton_ids),
+    })
+    return dict((row[0], (row[1].isoformat(), row[2])) for row in cursor.fetchall())
+
+
+def get_encoded_skeletons(project_id, skeleton_ids, versions=None) -> Dict[int, bytes]:
+    """Encode all passed in skeletons, see encode_skeleton(). If the <versions>
+    of skeletons are passed in (see get_skeleton_versions()), encoded skeletons
+    are stored in Django's cache. Cached skeletons are used as long as the
+    latest edition time of their nodes and their node count don't change.
+    """
+    skeleton_ids = list(skeleton_ids)
+    skeletons:Dict[int, bytes] = {}
+
+    if versions:
+        cached = cache.get_many([get_skeleton_cache_key(skid) for skid in versions])
+        for skid, version in versions.items():
+            entry = cached.get(get_skeleton_cache_key(skid))
+            if entry and entry[0] == version:
+                skeletons[skid] = entry[1]
+
+    skeleton_ids_to_encode = [skid for skid in skeleton_ids if skid not in skeletons]
+    if skeleton_ids_to_encode:
+        encoded = dict((skid, encode_skeleton(nodes)) for skid, nodes in
+                get_skeleton_nodes(project_id, skeleton_ids_to_encode).items())
+        skeletons.update(encoded)
+
+        if versions:
+            cache.set_many(dict((get_skeleton_cache_key(skid),
+                    (versions[skid], data)) for skid, data in encoded.items()
+                    if skid in versions))
+
+    return skeletons
+
+
+def get_segment_properties(project_id, with_bounding_boxes=False) -> Dict[str, Any]:
+    """Return the segment properties of all skeletons in a project: the name of
+    their neuron as label, the number of nodes and the cable length. With
+    <with_bounding_boxes>, the bounding box of each skeleton is added as
+    numeric properties (min_x, min_y, min_z, max_x, max_y, max_z), which allows
+    Neuroglancer to query skeletons by location. This requires reading all
+    nodes of the project.
+    """
+    relations = get_relation_to_id_map(project_id, ('model_of',))
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT DISTINCT ON (css.skeleton_id) css.skeleton_id, ci.name,
+            css.num_nodes, css.cable_length
+        FROM catmaid_skeleton_summary css
+        JOIN class_instance_class_instance cici
+            ON cici.class_instance_a = css.skeleton_id
+        JOIN class_instance ci
+            ON ci.id = cici.class_instance_b
+        WHERE css.project_id = %(project_id)s
+            AND css.num_nodes > 0
+            AND cici.relation_id = %(model_of)s
+        ORDER BY css.skeleton_id, ci.id
+    """, {
+        'project_id': project_id,
+        'model_of': relations['model_of'],
+    })
+    rows = cursor.fetchall()
+
+    properties:List[Dict[str, Any]] = [{
+        'id': 'label',
+        'type': 'label',
+        'values': [row[1] for row in rows],
+    }, {
+        'id': 'num_nodes',
+        'type': 'number',
+        'data_type': 'uint32',
+        'values': [row[2] for row in rows],
+    }, {
+        'id': 'cable_length',
+        'type': 'number',
+        'data_type': 'float32',
+        'values': [row[3] for row in rows],
+    }]
+
+    if with_bounding_boxes:
+        cursor.execute("""
+            SELECT skeleton_id, MIN(location_x), MIN(location_y),
+                MIN(location_z), MAX(location_x), MAX(location_y),
+                MAX(location_z)
+            FROM treenode
+            WHERE project_id = %(project_id)s
+            GROUP BY skeleton_id
+        """, {
+            'project_id': project_id,
+        })
+        bounding_boxes = dict((row[0], row[1:]) for row in cursor.fetchall())
+        for n, name in enumerate(('min_x', 'min_y', 'min_z', 'max_x', 'max_y', 'max_z')):
+            properties.append({
+                'id': name,
+                'type': 'number',
+                'data_type': 'float32',
+                'values': [bounding_boxes[row[0]][n] for row in rows],
+            })
+
+    return {
+        '@type': 'neuroglancer_segment_properties',
+        'inline': {
+            'ids': [str(row[0]) for row in rows],
+            'properties': properties,
+        },
+    }
+
+
+def get_sharding_spec(shard_bits, minishard_bits, preshift_bits=0,
+        compress=False) -> Dict[str, Any]:
+    """Return a Neuroglancer sharding specification. Skeleton IDs are used as
+    hash directly, which spreads consecutive IDs evenly over shards.
+    """
+    encoding = 'gzip' if compress else 'raw'
+    return {
+        '@type': 'neuroglancer_uint64_sharded_v1',
+        'hash': 'identity',
+        'preshift_bits': preshift_bits,
+        'minishard_bits': minishard_bits,
+        'shard_bits': shard_bits,
+        'minishard_index_encoding': encoding,
+        'data_encoding': encoding,
+    }
+
+
+def get_shard_locations(skeleton_ids, sharding) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the shard and the minishard of each passed in skeleton ID.
+    """
+    if sharding['hash'] != 'identity':
+        raise ValueError(f"Unsupported sharding hash: {sharding['hash']}")
+    hashed = np.asarray(skeleton_ids, dtype=np.uint64) >> np.uint64(sharding['preshift_bits'])
+    minishards = hashed & np.uint64((1 << sharding['minishard_bits']) - 1)
+    shards = (hashed >> np.uint64(sharding['minishard_bits'])) & \
+            np.uint64((1 << sharding['shard_bits']) - 1)
+    return shards, minishards
+
+
+def get_shard_file_name(shard, sharding) -> str:
+    return f"{int(shard):0{math.ceil(sharding['shard_bits'] / 4)}x}.shard"
+
+
+def encode_shard(chunks:Dict[int, bytes], sharding) -> bytes:
+    """Encode all passed in skeletons of a single shard, mapped by ID, as
+    Neuroglancer shard file. The shard index, with the location of each
+    minishard index, is followed by the data of each minishard and its index.
+    All locations are relative to the end of the shard index.
+    """
+    def identity(data):
+        return data
+    encode_data:Callable = gzip.compress if sharding['data_encoding'] == 'gzip' else identity
+    encode_index:Callable = gzip.compress if \
+            sharding['minishard_index_encoding'] == 'gzip' else identity
+
+    skeleton_ids = np.array(sorted(chunks), dtype=np.uint64)
+    _, minishards = get_shard_locations(skeleton_ids, sharding)
+
+    shard_index = np.zeros((2**sharding['minishard_bits'], 2), dtype='<u8')
+    parts:List[bytes] = []
+    offset = 0
+    for minishard in np.unique(minishards):
+        # The minishard index stores delta encoded IDs, delta encoded chunk
+        # offsets (relative to the end of the previous chunk) and chunk sizes.
+        ids, offsets, sizes = [], [], []
+        last_id, last_end = 0, 0
+        for skeleton_id in skeleton_ids[minishards == minishard].tolist():
+            data = encode_data(chunks[skeleton_id])
+            ids.append(skeleton_id - last_id)
+            offsets.append(offset - last_end)
+            sizes.append(len(data))
+            parts.append(data)
+            last_id, last_end = skeleton_id, offset + len(data)
+            offset = last_end
+        index = encode_index(np.array([ids, offsets, sizes], dtype='<u8').tobytes())
+        shard_index[minishard] = (offset, offset + len(index))
+        parts.append(index)
+        offset += len(index)
+
+    return shard_index.tobytes() + b''.join(parts)
+
+
+@api_view(['GET'])
+@requires_user_role(UserRole.Browse)
+def skeleton_info(request:HttpRequest, project_id=None) -> JsonResponse:
+    """The info file of the Neuroglancer precomputed skeleton source of this
+    project. The source is available as precomputed://<CATMAID URL>/<project
+    ID>/skeletons/neuroglancer.
+    """
+    return JsonResponse(get_skeleton_info())
+
+
+@api_view(['GET'])
+@requires_user_role(UserRole.Browse)
+def segment_properties_info(request:HttpRequest, project_id=None) -> JsonResponse:
+    """The segment properties of the Neuroglancer precomputed skeleton source
+    of this project: the neuron name, the number of nodes and the cable length
+    of each skeleton.
+    """
+    return JsonResponse(get_segment_properties(int(project_id)))
+
+
+@api_view(['GET'])
+@requires_user_role(UserRole.Browse)
+def skeleton_data(request:HttpRequest, project_id=None, skeleton_id=None) -> HttpResponse:
+    """Export a skeleton in Neuroglancer's precomputed skeleton format, with
+    the radius and the confidence of each node as vertex attributes. Encoded
+    skeletons are cached until they are edited and the response can be
+    revalidated with its ETag.
+    ---
+    parameters:
+    - name: project_id
+      description: The project to operate in
+      required: true
+      type: integer
+      paramType: path
+    - name: skeleton_id
+      description: The skeleton to export
+      required: true
+      type: integer
+      paramType: path
+    """
+    project_id = int(project_id)
+    skeleton_id = int(skeleton_id)
+    version = get_skeleton_versions(project_id, [skeleton_id]).get(skeleton_id)
+    if not version:
+        raise Http404(f'Could not find skeleton {skeleton_id}')
+
+    etag = f'"{skeleton_id}-{version[1]}-{version[0]}"'
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponse(status=304)
+    else:
+        data = get_encoded_skeletons(project_id, [skeleton_id],
+                {skeleton_id: version})[skeleton_id]
+        response = HttpResponse(data, content_type='application/octet-stream')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
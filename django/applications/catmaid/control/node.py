@@ -5,6 +5,7 @@ from aggdraw import Draw, Pen, Brush, Font
 from collections import defaultdict
 from concurrent import futures
 import copy
+import hashlib
 import json
 import math
 import msgpack
@@ -31,6 +32,7 @@ from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail
 from catmaid.control.common import (batches, get_relation_to_id_map,
         get_request_bool, get_request_list)
+from catmaid.control.gridcache import EMPTY_CELL, get_grid_cell_cache
 
 
 
@@ -221,17 +223,7 @@ class CachedMsgpackNodeProvder(CachedNodeProvider):
                 if extra_type != 'json':
                     raise ValueError("Unexpected type")
 
-                # To inject msgpack data, we expect a five element list, which
-                # means the first byte is '\x95'. For now an error is raised if,
-                # the first byte is something else.
-                if tuples[0] != b'\x95':
-                    raise ValueError("Unexpected cached Msgpack tuple format")
-
-                extra_msgpack = msgpack.packb([extra_tuples])
-
-                # Extend the five-element list with extra tuples by making it a
-                # six element list and just appending the extra list
-                tuples = b'\x96' + tuples[1:] + extra_msgpack
+                tuples = splice_msgpack_result(tuples, [], [extra_tuples])
 
             return bytes(tuples), 'msgpack'
         else:
@@ -252,66 +244,223 @@ def get_pack_array_header(n) -> bytes:
     raise ValueError("Array is too large")
 
 
+def splice_msgpack_result(target, encoded_extra_tuples, decoded_extra_tuples) -> bytes:
+    """Append extra results to a msgpack encoded five-element result list
+    without decoding it. Pre-encoded extra results (e.g. other grid cells) are
+    copied as they are, only decoded extra results are encoded. The returned
+    list has a sixth element, the list of extra results. All parts are copied
+    exactly once into a buffer of the final size.
+    """
+    # To inject msgpack data, we expect a five element list, which means the
+    # first byte is '\x95'. For now an error is raised if, the first byte is
+    # something else.
+    if target[0] != 0x95:
+        raise ValueError("Unexpected cached Msgpack tuple format")
+
+    extra_parts = [t for t in encoded_extra_tuples if t]
+    extra_parts.extend(msgpack.packb(t) for t in decoded_extra_tuples)
+
+    # Extend the five-element list with extra tuples by making it a six element
+    # list and just appending the extra list.
+    target_view = memoryview(target)
+    return b''.join([b'\x96', target_view[1:],
+            get_pack_array_header(len(extra_parts))] + extra_parts)
+
+
+def splice_json_text_result(target, encoded_extra_tuples, decoded_extra_tuples) -> str:
+    """Append extra results to a JSON text encoded result list without
+    decoding it. If the target has five elements, a sixth one with all extra
+    results is added. If there is already a sixth element, the extra results
+    are appended to it.
+    """
+    extra_parts = [t for t in encoded_extra_tuples if t]
+    extra_parts.extend(ujson.dumps(t) for t in decoded_extra_tuples)
+    if not extra_parts:
+        return target
+
+    if target[-2] == '}':
+        # If cached response doesn't contain any extra nodes, add a new field
+        return ''.join([target[0:-1], ', [', ', '.join(extra_parts), ']]'])
+    elif target[-2] == ']':
+        return ''.join([target[0:-2], ', ', ', '.join(extra_parts), ']]'])
+    else:
+        raise ValueError("Unexpected cached JSON text tuple format")
+
+
 class GridCachedNodeProvider(CachedNodeProvider):
     """Find nodes in node grid caches.
     """
 
     data_type = 'json'
 
-    def update_tuples(self, target, decoded_extra_tuples, encoded_extra_tuples=None) -> bytes:
-        if self.data_type == 'json':
+    def update_tuples(self, target, decoded_extra_tuples,
+            encoded_extra_tuples=None, data_type=None) -> Any:
+        data_type = data_type or self.data_type
+        if encoded_extra_tuples is None:
+            encoded_extra_tuples = []
+        if data_type == 'json':
             if len(target) == 5:
                 target.append([])
             extra_tuples = target[5]
             extra_tuples.extend(encoded_extra_tuples)
             extra_tuples.extend(decoded_extra_tuples)
             return target
-        elif self.data_type == 'json_text':
-            target_json = json.dumps(decoded_extra_tuples)
-            if encoded_extra_tuples:
-                for eet in encoded_extra_tuples:
-                    if eet:
-                        if eet[-1] == ']':
-                            target_json = '[' + eet + ', ' + target_json[1:]
-                        else:
-                            raise ValueError("Unexpected encoded JSON text tuple format")
-            if target[-2] == '}':
-                # If cached response doesn't contain any extra nodes, add a
-                # new field
-                return target[0:-1] + ', ' + target_json + ']'
-            elif target[-2] == ']':
-                return target[0:-2] + ', ' + target_json[1:] + ']'
-            else:
-                raise ValueError("Unexpected cached JSON text tuple format")
-        elif self.data_type == 'msgpack':
-            total_extra_tuples = len(decoded_extra_tuples)
-            if encoded_extra_tuples:
-                total_extra_tuples += len(encoded_extra_tuples)
-            # To inject msgpack data, we first check the binary data
-            # representing the list length. In the eaiest case, we have five
-            # elements (\x95) and we can just append the data and change the
-            # list length.
-            if target[0] == b'\x95':
-                # Construct a new msgpack array manually to not create
-                # unnecessary copies.
-                extra_msgpack = b''
-                if encoded_extra_tuples:
-                    extra_msgpack = b''.join(t for t in encoded_extra_tuples if t)
-                    total_extra_tuples -= sum(1 for t in encoded_extra_tuples if not t)
-                else:
-                    extra_msgpack = b''
+        elif data_type == 'json_text':
+            return splice_json_text_result(target, encoded_extra_tuples,
+                    decoded_extra_tuples)
+        elif data_type == 'msgpack':
+            return splice_msgpack_result(target, encoded_extra_tuples,
+                    decoded_extra_tuples)
+        else:
+            raise ValueError("Unexpected cached JSON tuple format")
 
-                for det in decoded_extra_tuples:
-                    extra_msgpack += msgpack.packb(det)
-                bin_len = get_pack_array_header(total_extra_tuples)
+    def get_data_type(self, grid, target_format) -> str:
+        """Select the representation to read from a grid. If the grid stores
+        the representation the response is requested in, it is used so that the
+        cached data can be returned without any decoding and encoding.
+        Otherwise the configured data type of this node provider is used.
+        """
+        has_json, has_json_text, has_msgpack = grid[5], grid[6], grid[7]
+        if target_format == 'msgpack':
+            if has_msgpack:
+                return 'msgpack'
+        elif target_format == 'json':
+            if has_json_text:
+                return 'json_text'
+            if has_json:
+                return 'json'
+        return self.data_type
+
+    def get_grid(self, project_id, volume, cursor, cache=None) -> Optional[Tuple]:
+        """Find the grid of the passed in project that has a cell configuration
+        closest to the passed in volume. The result is a tuple of the form
+        (id, cell_width, cell_height, cell_depth, n_lod_levels, has_json_data,
+        has_json_text_data, has_msgpack_data) or None.
+        """
+        grids = cache.get_grids(project_id) if cache else None
+        if grids is None:
+            cursor.execute("""
+                SELECT id, cell_width, cell_height, cell_depth, n_lod_levels,
+                    has_json_data, has_json_text_data, has_msgpack_data
+                FROM node_grid_cache g
+                WHERE project_id = %(project_id)s
+                ORDER BY id
+            """, {
+                'project_id': project_id,
+            })
+            grids = cursor.fetchall()
+            if cache:
+                cache.set_grids(project_id, grids)
 
-                # Extend the five-element list with extra tuples by making it a
-                # six element list and just appending the extra list
-                return bytes(b'\x96' + target[1:] + bin_len + extra_msgpack)
-            else:
-                raise ValueError("Unexpected cached Msgpack tuple format")
+        if not grids:
+            return None
+
+        return min(grids, key=lambda g: abs(float(g[1]) * float(g[2]) * float(g[3]) - volume))
+
+    def get_cells(self, grid_id, min_w_i, min_h_i, min_d_i, max_w_i, max_h_i,
+            max_d_i, lod_min, lod_max, cursor, cache=None, data_type=None) -> List[List]:
+        """Get the encoded LOD buckets of all non-empty grid cells in the
+        passed in index range. The Z index range is exclusive. If a grid cell
+        cache is passed in, it is asked first and updated with the database
+        result.
+        """
+        data_type = data_type or self.data_type
+        variant = (data_type, lod_min, lod_max)
+        cell_keys = None
+        if cache:
+            n_cells = (max_w_i - min_w_i + 1) * (max_h_i - min_h_i + 1) * \
+                    max(0, max_d_i - min_d_i)
+            if n_cells <= cache.max_cells_per_query:
+                cell_keys = [(grid_id, x, y, z)
+                        for z in range(min_d_i, max_d_i)
+                        for y in range(min_h_i, max_h_i + 1)
+                        for x in range(min_w_i, max_w_i + 1)]
+                cached_cells = cache.get_many(cell_keys, variant)
+                if cached_cells is not None:
+                    return [c for c in cached_cells if c is not EMPTY_CELL]
+                generation = cache.generation
+
+        # JSON data is read as text, so that it can be cached in encoded form.
+        # It is decoded below using ujson, which is what would be used by
+        # psycopg2 for the JSONB type as well.
+        if data_type == 'json':
+            data_select = 'json_data[%(lod_min)s:%(lod_max)s]::text[]'
         else:
-            raise ValueError("Unexpected cached JSON tuple format")
+            data_select = '{}_data[%(lod_min)s:%(lod_max)s]'.format(data_type)
+
+        query_params = {
+            'grid_id': grid_id,
+            'min_x_index': min_w_i,
+            'min_y_index': min_h_i,
+            'min_z_index': min_d_i,
+            'max_x_index': max_w_i,
+            'max_y_index': max_h_i,
+            'max_z_index': max_d_i,
+            'lod_min': lod_min,
+            'lod_max': lod_max,
+        }
+
+        # Do the actual grid cell lookup in a separate query, to only use
+        # constant values in the index checks. The Z index condition is slightly
+        # special, because the parameter is exclusive
+        cursor.execute("""
+            SELECT c.x_index, c.y_index, c.z_index, {data_select}
+            FROM node_grid_cache_cell c
+            LEFT JOIN dirty_node_grid_cache_cell dc
+                -- Alternative: use ON dc.id = c.id and have update function
+                -- create ID entries in the dirty table.
+                ON dc.grid_id = c.grid_id
+                AND dc.x_index = c.x_index
+                AND dc.y_index = c.y_index
+                AND dc.z_index = c.z_index
+            WHERE c.grid_id = %(grid_id)s
+                AND c.x_index >= %(min_x_index)s AND c.x_index <= %(max_x_index)s
+                AND c.y_index >= %(min_y_index)s AND c.y_index <= %(max_y_index)s
+                AND c.z_index >= %(min_z_index)s AND c.z_index < %(max_z_index)s
+                AND {data_type_column} IS NOT NULL
+        """.format(**{
+            'data_select': data_select,
+            'data_type_column': data_type + '_data',
+        }), query_params)
+        rows = cursor.fetchall()
+
+        if data_type == 'msgpack' and cell_keys is not None:
+            # Binary data is returned as memoryview, which would keep the
+            # complete result buffer alive if cached.
+            cell_map = dict(((r[0], r[1], r[2]), [None if v is None else bytes(v) for v in r[3]])
+                    for r in rows)
+        else:
+            cell_map = dict(((r[0], r[1], r[2]), r[3]) for r in rows)
+
+        if cell_keys is None:
+            cells = list(cell_map.values())
+        else:
+            # Dirty cells are about to be recomputed and are therefore not
+            # cached. This includes currently empty cells that will have data
+            # after the update.
+            cursor.execute("""
+                SELECT x_index, y_index, z_index
+                FROM dirty_node_grid_cache_cell
+                WHERE grid_id = %(grid_id)s
+                    AND x_index >= %(min_x_index)s AND x_index <= %(max_x_index)s
+                    AND y_index >= %(min_y_index)s AND y_index <= %(max_y_index)s
+                    AND z_index >= %(min_z_index)s AND z_index < %(max_z_index)s
+            """, query_params)
+            dirty_cells = set(cursor.fetchall())
+
+            cells = []
+            for cell_key in cell_keys:
+                index = cell_key[1:]
+                cell = cell_map.get(index, EMPTY_CELL)
+                if cell is not EMPTY_CELL:
+                    cells.append(cell)
+                if index not in dirty_cells:
+                    cache.put(cell_key, variant, cell, generation)
+
+        if data_type == 'json':
+            cells = [[None if v is None else ujson.loads(v) for v in c] for c in cells]
+
+        return cells
 
     def get_tuples(self, params, project_id, explicit_treenode_ids,
             explicit_connector_ids, include_labels, with_relation_map,
@@ -321,18 +470,11 @@ class GridCachedNodeProvider(CachedNodeProvider):
         params['volume'] = (params['right'] - params['left']) * \
                 (params['bottom'] - params['top']) * (params['z2'] - params['z1'])
 
-        # For JSONB type cache, use ujson to decode, this is roughly 2x faster
-        psycopg2.extras.register_default_jsonb(loads=ujson.loads)
-        # Find grid that has a cell configuration closest to what we are looking for.
-        cursor.execute("""
-            SELECT id, cell_width, cell_height, cell_depth, n_lod_levels
-            FROM node_grid_cache g
-            WHERE project_id = %(project_id)s
-            ORDER BY @((g.cell_width::double precision * g.cell_height::double precision * g.cell_depth::double precision) - %(volume)s::double precision) ASC
-            LIMIT 1;
-        """, params)
+        # Use a process local cache of recently used cells, if enabled.
+        cache = get_grid_cell_cache()
 
-        grid_data = cursor.fetchone()
+        # Find grid that has a cell configuration closest to what we are looking for.
+        grid_data = self.get_grid(project_id, params['volume'], cursor, cache)
         if not grid_data:
             return None, None
 
@@ -362,7 +504,7 @@ class GridCachedNodeProvider(CachedNodeProvider):
                 lod = 1.0
             else:
                 lod = max(0.0, min(1.0, float(lod)))
-            lod_max = max(1.0, int(lod * lod_levels))
+            lod_max = max(1, int(lod * lod_levels))
         elif lod_type == 'absolute':
             if lod == 'max' or lod in (0, '0'):
                 lod_max = lod_levels
@@ -371,43 +513,16 @@ class GridCachedNodeProvider(CachedNodeProvider):
         else:
             raise ValueError(f"Unknown LOD type: {lod_type}")
 
-        # Do the actual grid cell lookup in a separate query, to only use
-        # constant values in the index checks. The Z index condition is slightly
-        # special, because the parameter is exclusive
-        cursor.execute("""
-            SELECT {data_type_column}[%(lod_min)s:%(lod_max)s]
-            FROM node_grid_cache_cell c
-            LEFT JOIN dirty_node_grid_cache_cell dc
-                -- Alternative: use ON dc.id = c.id and have update function
-                -- create ID entries in the dirty table.
-                ON dc.grid_id = c.grid_id
-                AND dc.x_index = c.x_index
-                AND dc.y_index = c.y_index
-                AND dc.z_index = c.z_index
-            WHERE c.grid_id = %(grid_id)s
-                AND c.x_index >= %(min_x_index)s AND c.x_index <= %(max_x_index)s
-                AND c.y_index >= %(min_y_index)s AND c.y_index <= %(max_y_index)s
-                AND c.z_index >= %(min_z_index)s AND c.z_index < %(max_z_index)s
-                AND {data_type_column} IS NOT NULL
-        """.format(**{
-            'data_type_column': self.data_type + '_data',
-        }), {
-            'grid_id': grid_id,
-            'min_x_index': min_w_i,
-            'min_y_index': min_h_i,
-            'min_z_index': min_d_i,
-            'max_x_index': max_w_i,
-            'max_y_index': max_h_i,
-            'max_z_index': max_d_i,
-            'lod_min': lod_min,
-            'lod_max': lod_max,
-        })
-        rows = cursor.fetchall()
+        # Read the representation that matches the requested response format,
+        # if available, so that cached data can be returned as it is.
+        data_type = self.get_data_type(grid_data, params.get('format'))
 
+        cells = self.get_cells(grid_id, min_w_i, min_h_i, min_d_i, max_w_i,
+                max_h_i, max_d_i, lod_min, lod_max, cursor, cache, data_type)
 
-        if rows and rows[0]:
+        if cells:
             # It is the first LOD of the LOD set of the first result cell.
-            first_cell_lods = rows[0][0]
+            first_cell_lods = cells[0]
             tuples = first_cell_lods[0]
 
             # All extra LODs that are included are transmitted as extra tuples.
@@ -415,8 +530,8 @@ class GridCachedNodeProvider(CachedNodeProvider):
             encoded_extra_tuples = [r for r in extra_lod_cells if r]
 
             # Add all result LODs of each returned grid cell to extra tuples
-            for extra_row in rows[1:]:
-                encoded_extra_tuples.extend(r for r in extra_row[0])
+            for extra_cell in cells[1:]:
+                encoded_extra_tuples.extend(r for r in extra_cell)
 
             # If there are exta nodes required, query them explicitely using a
             # regular Postgis 2D query. Inject the result into cached data.
@@ -430,9 +545,9 @@ class GridCachedNodeProvider(CachedNodeProvider):
 
             tuples = self.update_tuples(tuples,
                     [decoded_extra_tuples] if decoded_extra_tuples else [],
-                    encoded_extra_tuples)
+                    encoded_extra_tuples, data_type)
 
-            return tuples, self.data_type
+            return tuples, data_type
         else:
             return None, None
 
@@ -1790,8 +1905,12 @@ def update_grid_cache(project_id, data_type, orientations,
         allow_empty=False, lod_levels=1, lod_bucket_size=500,
         lod_strategy='quadratic', jobs=1, depth_steps=1, chunksize=10,
         ordering=None) -> None:
-    if data_type not in ('json', 'json_text', 'msgpack'):
-        raise ValueError('Type must be one of: json, json_text, msgpack')
+    # Multiple representations can be stored in the same grid, which allows
+    # node providers to return the requested format without conversion.
+    data_types = data_type.split(',') if isinstance(data_type, str) else list(data_type)
+    for dt in data_types:
+        if dt not in ('json', 'json_text', 'msgpack'):
+            raise ValueError('Type must be one of: json, json_text, msgpack')
     if project_id is None:
         raise ValueError('Need project ID')
     if not cell_width:
@@ -1865,7 +1984,6 @@ def update_grid_cache(project_id, data_type, orientations,
         params['hidden_last_editor_id'] = int(hidden_last_editor_id)
         log(f' -> Only nodes not edited last by user {hidden_last_editor_id} will be allowed')
 
-    data_types = [data_type]
     update_json_cache = 'json' in data_types
     update_json_text_cache = 'json_text' in data_types
     update_msgpack_cache = 'msgpack' in data_types
@@ -1900,7 +2018,20 @@ def update_grid_cache(project_id, data_type, orientations,
         })
         grid_ids = cursor.fetchall()
         if grid_ids:
-            grid_id = grid_ids[0]
+            grid_id = grid_ids[0][0]
+            # Mark newly added representations as available.
+            cursor.execute("""
+                UPDATE node_grid_cache
+                SET has_json_data = has_json_data OR %(has_json_data)s,
+                    has_json_text_data = has_json_text_data OR %(has_json_text_data)s,
+                    has_msgpack_data = has_msgpack_data OR %(has_msgpack_data)s
+                WHERE id = %(grid_id)s
+            """, {
+                'grid_id': grid_id,
+                'has_json_data': update_json_cache,
+                'has_json_text_data': update_json_text_cache,
+                'has_msgpack_data': update_msgpack_cache,
+            })
         else:
             cursor.execute("""
                 INSERT INTO node_grid_cache (project_id, orientation,
@@ -2072,21 +2203,14 @@ def update_grid_cell(project_id, grid_id, w_i, h_i, d_i, cell_width,
         cell_height, cell_depth, params, allow_empty, lod_levels,
         lod_bucket_size, lod_strategy, update_json_cache,
         update_json_text_cache, update_msgpack_cache, provider=None, cursor=None) -> bool:
-    params['left'] = w_i * cell_width
-    params['right'] = (w_i + 1) * cell_width
-    params['top'] = h_i * cell_height
-    params['bottom'] = (h_i + 1) * cell_width
-    params['z1'] = d_i * cell_depth
-    params['z2'] = (d_i + 1) * cell_depth
-
     if not provider:
         provider = Postgis3dNodeProvider()
 
     if not cursor:
         cursor = connection.cursor()
 
-    result_tuple = _node_list_tuples_query(params, project_id, provider,
-            include_labels=True)
+    result_tuple = get_grid_cell_result(project_id, w_i, h_i, d_i, cell_width,
+            cell_height, cell_depth, params, provider)
 
     if not (allow_empty or result_tuple[0] or result_tuple[1]):
         return False
@@ -2145,6 +2269,115 @@ def update_grid_cell(project_id, grid_id, w_i, h_i, d_i, cell_width,
     return True
 
 
+def get_grid_cell_result(project_id, w_i, h_i, d_i, cell_width, cell_height,
+        cell_depth, params, provider) -> List:
+    """Run a spatial query for the bounding box of the grid cell with the
+    passed in indices.
+    """
+    params['left'] = w_i * cell_width
+    params['right'] = (w_i + 1) * cell_width
+    params['top'] = h_i * cell_height
+    params['bottom'] = (h_i + 1) * cell_height
+    params['z1'] = d_i * cell_depth
+    params['z2'] = (d_i + 1) * cell_depth
+
+    return _node_list_tuples_query(params, project_id, provider,
+            include_labels=True)
+
+
+def get_grid_query_params(grid) -> Dict[str, Any]:
+    """Get the spatial query parameters for the cells of the passed in
+    NodeGridCache instance.
+    """
+    params = {
+        'project_id': grid.project_id,
+        'limit': settings.NODE_LIST_MAXIMUM_COUNT,
+        'ordering': grid.ordering,
+    }
+    if grid.n_largest_skeletons_limit:
+        params['n_largest_skeletons_limit'] = int(grid.n_largest_skeletons_limit)
+    if grid.n_last_edited_skeletons_limit:
+        params['n_last_edited_skeletons_limit'] = int(grid.n_last_edited_skeletons_limit)
+    if grid.hidden_last_editor_id:
+        params['hidden_last_editor_id'] = int(grid.hidden_last_editor_id)
+    return params
+
+
+def update_grid_cells(grid, cells, provider=None, cursor=None) -> Tuple[int, int]:
+    """Recompute all passed in cells of a NodeGridCache instance and write them
+    back using a single multi-row upsert per grid. Cells are (x, y, z) index
+    tuples. Cells that are empty now are removed, unless the grid allows empty
+    cells. Returns a tuple with the number of updated and removed cells.
+    """
+    if not provider:
+        provider = Postgis3dNodeProvider()
+
+    if not cursor:
+        cursor = connection.cursor()
+
+    params = get_grid_query_params(grid)
+    data_columns = []
+    if grid.has_json_data:
+        data_columns.append(('json_data', '%s::jsonb[]'))
+    if grid.has_json_text_data:
+        data_columns.append(('json_text_data', '%s'))
+    if grid.has_msgpack_data:
+        data_columns.append(('msgpack_data', '%s'))
+
+    rows = []
+    empty_cells = []
+    for w_i, h_i, d_i in cells:
+        result_tuple = get_grid_cell_result(grid.project_id, w_i, h_i, d_i,
+                grid.cell_width, grid.cell_height, grid.cell_depth,
+                params, provider)
+
+        if not (grid.allow_empty or result_tuple[0] or result_tuple[1]):
+            empty_cells.append((w_i, h_i, d_i))
+            continue
+
+        result_buckets = get_lod_buckets(result_tuple, grid.n_lod_levels,
+                grid.lod_min_bucket_size, grid.lod_strategy)
+
+        row = [grid.id, w_i, h_i, d_i]
+        for column, _ in data_columns:
+            if column == 'msgpack_data':
+                row.append([None if not v else psycopg2.Binary(msgpack.packb(v))
+                        for v in result_buckets])
+            else:
+                row.append([None if not v else json.dumps(v) for v in result_buckets])
+        rows.append(row)
+
+    if rows and data_columns:
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index,
+                z_index, update_time, {columns})
+            VALUES %s
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET update_time = EXCLUDED.update_time, {updates}
+        """.format(**{
+            'columns': ', '.join(c[0] for c in data_columns),
+            'updates': ', '.join(f'{c[0]} = EXCLUDED.{c[0]}' for c in data_columns),
+        }), rows, template='(%s, %s, %s, %s, now(), {})'.format(
+            ', '.join(c[1] for c in data_columns)), page_size=len(rows))
+
+    if empty_cells:
+        cursor.execute("""
+            DELETE FROM node_grid_cache_cell c
+            USING UNNEST(%(x)s::int[], %(y)s::int[], %(z)s::int[]) cell(x, y, z)
+            WHERE c.grid_id = %(grid_id)s
+                AND c.x_index = cell.x
+                AND c.y_index = cell.y
+                AND c.z_index = cell.z
+        """, {
+            'grid_id': grid.id,
+            'x': [c[0] for c in empty_cells],
+            'y': [c[1] for c in empty_cells],
+            'z': [c[2] for c in empty_cells],
+        })
+
+    return len(rows), len(empty_cells)
+
+
 def prepare_db_statements(connection) -> None:
     node_providers = get_configured_node_providers(get_node_provider_configs(), connection)
     for node_provider in node_providers:
@@ -2305,6 +2538,26 @@ def node_list_tuples(request:HttpRequest, project_id=None, provider=None) -> Htt
       required: false
       type: string
       paramType: form
+    - name: with_delta_token
+      description: |
+        Whether a delta token should be returned in the
+        X-CATMAID-Node-Delta-Token response header. It can be passed as
+        delta_token to a later request with the same parameters.
+      required: false
+      type: boolean
+      defaultValue: false
+      paramType: form
+    - name: delta_token
+      description: |
+        A token returned by an earlier request with the same view box and
+        parameters. If it is still valid, only nodes that were added, changed
+        or deleted since then are returned, as an object with the fields
+        treenodes, connectors, labels, relation_map, deleted_treenode_ids
+        and deleted_connector_ids. Otherwise, the regular response is
+        returned. Both come with a new token.
+      required: false
+      type: string
+      paramType: form
     type:
     - type: array
       items:
@@ -2369,12 +2622,21 @@ def node_list_tuples(request:HttpRequest, project_id=None, provider=None) -> Htt
     params['orientation'] = orientation
     params['lod'] = data.get('lod', 'max')
     params['lod_type'] = data.get('lod_type', 'absolute')
+    params['format'] = target_format
 
     if override_provider:
         node_providers = get_configured_node_providers([override_provider])
     else:
         node_providers = get_configured_node_providers(get_node_provider_configs())
 
+    delta_token = data.get('delta_token')
+    with_delta_token = get_request_bool(data, 'with_delta_token', False)
+    if (delta_token or with_delta_token) and settings.HISTORY_TRACKING and \
+            target_format in ('json', 'msgpack'):
+        return compile_node_list_delta(project_id, node_providers, params,
+            treenode_ids, connector_ids, include_labels, target_format,
+            target_options, with_relation_map, with_origin, delta_token)
+
     return compile_node_list_result(project_id, node_providers, params,
         treenode_ids, connector_ids, include_labels, target_format,
         target_options, with_relation_map, with_origin)
@@ -2575,6 +2837,238 @@ def compile_node_list_result(project_id, node_providers, params,
 
     return create_node_response(result_tuple, params, target_format, target_options, data_type)
 
+NODE_DELTA_TOKEN_HEADER = 'X-CATMAID-Node-Delta-Token'
+
+
+def get_node_query_hash(params, explicit_treenode_ids, explicit_connector_ids,
+        include_labels, with_relation_map, with_origin) -> str:
+    """Get a hash of all parameters that influence which nodes a node query
+    returns, including the view box.
+    """
+    hashed_params = dict((k, v) for k, v in params.items() if k != 'format')
+    hashed_params['treenode_ids'] = sorted(explicit_treenode_ids)
+    hashed_params['connector_ids'] = sorted(explicit_connector_ids)
+    hashed_params['labels'] = include_labels
+    hashed_params['with_relation_map'] = with_relation_map
+    hashed_params['with_origin'] = with_origin
+    return hashlib.sha1(json.dumps(hashed_params, sort_keys=True,
+            default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def parse_node_delta_token(token, query_hash) -> Optional[int]:
+    """Return the transaction ID of a delta token, if the token was created for
+    a query with the passed in hash. Return None otherwise.
+    """
+    if not token:
+        return None
+    parts = token.split('-')
+    if len(parts) != 2 or parts[1] != query_hash:
+        return None
+    try:
+        return int(parts[0])
+    except ValueError:
+        return None
+
+
+def get_node_delta(cursor, project_id, result, txid, params,
+        explicit_treenode_ids=tuple()) -> Dict[str, Any]:
+    """Reduce a regular node query result to the nodes that were added or
+    changed since the passed in transaction ID. Treenodes and connectors that
+    were changed or deleted since then and aren't part of the result (anymore)
+    are returned as deleted. This uses the txid column of live tables and the
+    exec_transaction_id column of history tables. Only treenodes that could
+    have been part of the result for the bounding box in <params> are
+    returned as deleted.
+    """
+    treenodes, connectors, labels = result[0], result[1], result[2]
+    treenode_ids = [t[0] for t in treenodes]
+    connector_ids = [c[0] for c in connectors]
+
+    # Treenodes are changed if they have been updated themselves or their
+    # labels changed.
+    cursor.execute("""
+        SELECT t.id
+        FROM treenode t
+        JOIN UNNEST(%(treenode_ids)s::bigint[]) query(id)
+            ON t.id = query.id
+        WHERE t.txid >= %(txid)s
+        OR EXISTS (
+            SELECT 1 FROM treenode_class_instance tci
+            WHERE tci.treenode_id = t.id
+            AND tci.txid >= %(txid)s)
+        OR EXISTS (
+            SELECT 1 FROM treenode_class_instance__history tci
+            WHERE tci.treenode_id = t.id
+            AND tci.exec_transaction_id >= %(txid)s)
+    """, {
+        'treenode_ids': treenode_ids,
+        'txid': txid,
+    })
+    changed_treenode_ids = set(r[0] for r in cursor.fetchall())
+
+    # Connectors are changed if they have been updated themselves or one of
+    # their links changed.
+    cursor.execute("""
+        SELECT c.id
+        FROM connector c
+        JOIN UNNEST(%(connector_ids)s::bigint[]) query(id)
+            ON c.id = query.id
+        WHERE c.txid >= %(txid)s
+        OR EXISTS (
+            SELECT 1 FROM treenode_connector tc
+            WHERE tc.connector_id = c.id
+            AND tc.txid >= %(txid)s)
+        OR EXISTS (
+            SELECT 1 FROM treenode_connector__history tc
+            WHERE tc.connector_id = c.id
+            AND tc.exec_transaction_id >= %(txid)s)
+    """, {
+        'connector_ids': connector_ids,
+        'txid': txid,
+    })
+    changed_connector_ids = set(r[0] for r in cursor.fetchall())
+
+    # Every treenode that was changed or removed since the last request might
+    # have been part of the last result, if its former edge intersected the
+    # bounding box. This includes the former parents of changed nodes, whose
+    # edge might not intersect the view anymore. The former edge is
+    # approximated by the former node location and the current parent
+    # location, which only makes the result larger. Explicitly requested
+    # nodes and nodes linked to connectors of the result are included
+    # regardless of their location.
+    cursor.execute("""
+        SELECT th.id, th.parent_id
+        FROM treenode__history th
+        LEFT JOIN treenode p
+            ON p.id = th.parent_id
+        WHERE th.project_id = %(project_id)s
+        AND th.exec_transaction_id >= %(txid)s
+        AND ((
+            greatest(th.location_x, p.location_x) >= %(left)s
+            AND least(th.location_x, p.location_x) <= %(right)s
+            AND greatest(th.location_y, p.location_y) >= %(top)s
+            AND least(th.location_y, p.location_y) <= %(bottom)s
+            AND greatest(th.location_z, p.location_z) >= %(z1)s
+            AND least(th.location_z, p.location_z) <= %(z2)s
+        )
+        OR th.id = ANY(%(treenode_ids)s::bigint[])
+        OR EXISTS (
+            SELECT 1 FROM treenode_connector__history tc
+            WHERE tc.treenode_id = th.id
+            AND tc.connector_id = ANY(%(connector_ids)s::bigint[])
+            AND tc.exec_transaction_id >= %(txid)s))
+    """, {
+        'project_id': project_id,
+        'txid': txid,
+        'left': params['left'],
+        'right': params['right'],
+        'top': params['top'],
+        'bottom': params['bottom'],
+        'z1': params['z1'],
+        'z2': params['z2'],
+        'treenode_ids': list(map(int, explicit_treenode_ids)),
+        'connector_ids': connector_ids,
+    })
+    deleted_treenode_ids = set()
+    for node_id, parent_id in cursor.fetchall():
+        deleted_treenode_ids.add(node_id)
+        if parent_id:
+            deleted_treenode_ids.add(parent_id)
+    deleted_treenode_ids.difference_update(treenode_ids)
+
+    cursor.execute("""
+        SELECT id
+        FROM connector__history
+        WHERE project_id = %(project_id)s
+        AND exec_transaction_id >= %(txid)s
+    """, {
+        'project_id': project_id,
+        'txid': txid,
+    })
+    deleted_connector_ids = set(r[0] for r in cursor.fetchall())
+    deleted_connector_ids.difference_update(connector_ids)
+
+    delta = {
+        'treenodes': [t for t in treenodes if t[0] in changed_treenode_ids],
+        'connectors': [c for c in connectors if c[0] in changed_connector_ids],
+        'labels': dict((k, v) for k, v in labels.items()
+                if k in changed_treenode_ids or k in changed_connector_ids),
+        'relation_map': result[4],
+        'deleted_treenode_ids': list(deleted_treenode_ids),
+        'deleted_connector_ids': list(deleted_connector_ids),
+    }
+
+    if len(result) > 5:
+        delta['extra'] = result[5]
+
+    return delta
+
+
+def compile_node_list_delta(project_id, node_providers, params,
+        explicit_treenode_ids=tuple(), explicit_connector_ids=tuple(),
+        include_labels=False, target_format='json', target_options=None,
+        with_relation_map=True, with_origin=False, delta_token=None) -> HttpResponse:
+    """Like compile_node_list_result(), but the response comes with a delta
+    token in the X-CATMAID-Node-Delta-Token header. If a valid delta token is
+    passed in, only the changes since the token was created are returned.
+
+    The token consists of the transaction ID horizon before the query was run
+    and a hash of all query parameters. All transactions with a smaller ID were
+    visible to the query, so all changes made by later or concurrent
+    transactions have at least this ID. Only live data node providers are used,
+    because cached data can be outdated.
+    """
+    live_node_providers = [np for np in node_providers
+            if not isinstance(np, CachedNodeProvider)]
+    if not live_node_providers:
+        return compile_node_list_result(project_id, node_providers, params,
+                explicit_treenode_ids, explicit_connector_ids, include_labels,
+                target_format, target_options, with_relation_map, with_origin)
+
+    query_hash = get_node_query_hash(params, explicit_treenode_ids,
+            explicit_connector_ids, include_labels, with_relation_map,
+            with_origin)
+    last_txid = parse_node_delta_token(delta_token, query_hash)
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+    txid = cursor.fetchone()[0]
+    token = f'{txid}-{query_hash}'
+
+    result_tuple, data_type = None, None
+    for node_provider in live_node_providers:
+        if node_provider.matches(params):
+            result_tuple, data_type = node_provider.get_tuples(params,
+                project_id, explicit_treenode_ids, explicit_connector_ids,
+                include_labels, with_relation_map, with_origin)
+
+            if result_tuple and data_type:
+                break
+
+    if not (result_tuple and data_type):
+        raise ValueError("Could not find matching node provider for request")
+
+    # If the node limit is reached, nodes could have been dropped from the
+    # result without being changed and a delta isn't reliable.
+    node_limit_reached = result_tuple[3]
+    if last_txid is None or data_type != 'json' or node_limit_reached:
+        response = create_node_response(result_tuple, params, target_format,
+                target_options, data_type)
+    else:
+        delta = get_node_delta(cursor, project_id, result_tuple, last_txid,
+                params, explicit_treenode_ids)
+        delta['delta_token'] = token
+        if target_format == 'msgpack':
+            response = HttpResponse(msgpack.packb(delta),
+                    content_type='application/octet-stream')
+        else:
+            response = HttpResponse(ujson.dumps(delta),
+                    content_type='application/json')
+
+    response[NODE_DELTA_TOKEN_HEADER] = token
+    return response
+
+
 def create_node_response(result, params, target_format, target_options, data_type) -> HttpResponse:
     if target_format == 'json':
         if data_type == 'json':
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from guardian.models import GroupObjectPermission, UserObjectPermission
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from catmaid.models import Project
+
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+# Log the hit rate after this many lookups.
+STATS_LOG_INTERVAL = 10000
+
+
+class PermissionCache(object):
+    """A small, process local cache for the results of permission checks, keyed
+    by user, project, role set and whether the request is token authenticated.
+    Entries expire after a short time to live. Any change of object
+    permissions, groups, group memberships, users or projects made in this
+    process clears the whole cache. Changes made by other processes are only
+    noticed once the entries expire.
+    """
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # The generation is incremented with every invalidation. It allows
+        # callers to detect whether an invalidation happened while they were
+        # checking permissions.
+        self.generation = 0
+        self.entries:Dict[Hashable, Tuple[float, Any]] = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key:Hashable) -> Optional[Any]:
+        """Return the cached value for the passed in key or None if there is
+        no valid entry.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            n_lookups = self.hits + self.misses
+            if n_lookups % STATS_LOG_INTERVAL == 0:
+                logger.info(f'Permission cache: {self.hits} hits, '
+                        f'{self.misses} misses, {len(self.entries)} entries')
+            return None if entry is None else entry[1]
+
+    def put(self, key:Hashable, value:Any, generation:int=None) -> bool:
+        """Store a value for the passed in key. If a generation is passed in
+        and the cache saw invalidations since then, the value isn't stored,
+        because it might be outdated already.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return False
+            if len(self.entries) >= self.max_entries:
+                # Start over rather than tracking the age of all entries.
+                self.entries.clear()
+            self.entries[key] = (time.time(), value)
+            return True
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'n_entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'generation': self.generation,
+            }
+
+
+def get_permission_cache_key(user, project_id, roles,
+        is_token_authenticated:bool=False) -> Optional[Tuple]:
+    """The cache key of a permission check or None if the check can't be
+    cached, because the user isn't stored in the database.
+    """
+    if user.id is None:
+        return None
+    if isinstance(roles, str):
+        roles = [roles]
+    return (user.id, None if project_id is None else int(project_id),
+            tuple(sorted(set(roles))), bool(is_token_authenticated))
+
+
+_permission_cache:Optional[PermissionCache] = None
+_permission_cache_lock = threading.Lock()
+
+
+def get_permission_cache() -> Optional[PermissionCache]:
+    """Get the permission cache of this process, or None if the cache is
+    disabled (PERMISSION_CACHE_TTL = 0).
+    """
+    global _permission_cache
+    ttl = getattr(settings, 'PERMISSION_CACHE_TTL', 0)
+    if not ttl or ttl <= 0:
+        return None
+    if _permission_cache is None:
+        with _permission_cache_lock:
+            if _permission_cache is None:
+                _permission_cache = PermissionCache(ttl)
+    _permission_cache.ttl = ttl
+    return _permission_cache
+
+
+def on_permission_change(sender, **kwargs) -> None:
+    """Drop all cached permission checks of this process if permissions or
+    anything they depend on change. Other processes will notice after
+    PERMISSION_CACHE_TTL seconds.
+    """
+    if _permission_cache is not None:
+        _permission_cache.clear()
+
+
+for model in (UserObjectPermission, GroupObjectPermission, User, Group, Project):
+    post_save.connect(on_permission_change, sender=model)
+    post_delete.connect(on_permission_change, sender=model)
+
+for through_model in (User.groups.through, User.user_permissions.through,
+        Group.permissions.through):
+    m2m_changed.connect(on_permission_change, sender=through_model)
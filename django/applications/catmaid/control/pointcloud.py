@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from typing import Any, Dict, List, Union
+from collections import defaultdict
+from typing import Any, DefaultDict, Dict, List, Tuple, Union
 from io import StringIO, BytesIO
 import json
 import logging
+import numpy as np
 from PIL import Image
 
 from django.conf import settings
@@ -21,7 +23,7 @@ from catmaid.control.authentication import (requires_user_role,
 from catmaid.control.common import (insert_into_log, get_class_to_id_map,
         get_relation_to_id_map, _create_relation, get_request_bool,
         get_request_list)
-from catmaid.models import (Group, Point, PointCloud, PointCloudPoint, ImageData,
+from catmaid.models import (Group, Point, PointCloud, ImageData,
         PointCloudImageData, UserRole)
 
 logger = logging.getLogger('__name__')
@@ -72,6 +74,163 @@ def serialize_image_data(image, simple=False) -> Dict[str, Any]:
         }
 
 
+# Points in the packed point data of a point cloud are stored as little-endian
+# float32 X, Y and Z values.
+POINT_DATA_DTYPE = np.dtype('<f4')
+POINT_DATA_ITEM_SIZE = 3 * POINT_DATA_DTYPE.itemsize
+
+# The chunk size in bytes used to read point data uploads.
+POINT_DATA_UPLOAD_CHUNK_SIZE = 1024**2
+
+# Up to this sample ratio, samples of packed point data are read from the
+# database point by point. For larger ratios, reading all point data at once
+# and sampling it afterwards is faster.
+MAX_DATABASE_SAMPLE_RATIO = 0.1
+
+
+def pack_points(points) -> bytes:
+    """Pack an N x 3 list or array of points into point data.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if not np.isfinite(points).all():
+        raise ValueError("Points need to have finite coordinates")
+    return points.astype(POINT_DATA_DTYPE).tobytes()
+
+
+def unpack_points(point_data) -> np.ndarray:
+    """Return an N x 3 array view on the passed in point data, without copying
+    it. The returned array is therefore read-only.
+    """
+    if len(point_data) % POINT_DATA_ITEM_SIZE != 0:
+        raise ValueError(f"The length of point data has to be a multiple of {POINT_DATA_ITEM_SIZE}")
+    return np.frombuffer(point_data, dtype=POINT_DATA_DTYPE).reshape(-1, 3)
+
+
+def get_sample_indices(n_points, sample_ratio) -> np.ndarray:
+    """Return the indices of int(n_points * sample_ratio) points, evenly spread
+    over all points.
+    """
+    n_sample = int(n_points * sample_ratio)
+    return (np.arange(n_sample, dtype=np.int64) * n_points) // max(n_sample, 1)
+
+
+def get_pointcloud_points(pointcloud_ids, sample_ratio=1.0) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """Get the points of all passed in point clouds without creating a model
+    instance per point. Returns a dictionary that maps each point cloud ID to a
+    tuple of point IDs and an N x 3 array of locations. Points of point clouds
+    with packed point data have no IDs, their index is used instead and their
+    locations are a read-only view on the point data, if no sample is
+    requested.
+
+    With a <sample_ratio> below 1.0, a repeatable sample of the points is
+    returned. Samples of packed point data are evenly spread over all points
+    and small samples are read without reading all point data.
+    """
+    pointcloud_ids = list(pointcloud_ids)
+    if sample_ratio < 0 or sample_ratio > 1:
+        raise ValueError("The sample ratio has to be in [0,1]")
+    sample = sample_ratio < 1.0
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT pc.id, octet_length(pc.point_data) / %(item_size)s
+        FROM pointcloud pc
+        JOIN UNNEST(%(pointcloud_ids)s::bigint[]) query(id)
+            ON query.id = pc.id
+    """, {
+        'pointcloud_ids': pointcloud_ids,
+        'item_size': POINT_DATA_ITEM_SIZE,
+    })
+    n_packed_points = dict(cursor.fetchall())
+    packed_ids = [pcid for pcid, n in n_packed_points.items() if n is not None]
+    linked_ids = [pcid for pcid, n in n_packed_points.items() if n is None]
+
+    result:Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+    if packed_ids and sample and sample_ratio <= MAX_DATABASE_SAMPLE_RATIO:
+        # Read only the sampled points. Point data isn't compressed, which
+        # allows Postgres to read only the parts of it that are needed.
+        for pointcloud_id in packed_ids:
+            sample_indices = get_sample_indices(n_packed_points[pointcloud_id],
+                    sample_ratio)
+            cursor.execute("""
+                SELECT string_agg(substring(pc.point_data
+                        FROM (s.i * %(item_size)s + 1)::int FOR %(item_size)s),
+                    ''::bytea ORDER BY s.i)
+                FROM pointcloud pc, UNNEST(%(sample_indices)s::bigint[]) s(i)
+                WHERE pc.id = %(pointcloud_id)s
+            """, {
+                'pointcloud_id': pointcloud_id,
+                'sample_indices': sample_indices.tolist(),
+                'item_size': POINT_DATA_ITEM_SIZE,
+            })
+            point_data = cursor.fetchone()[0]
+            result[pointcloud_id] = (sample_indices,
+                    unpack_points(b'' if point_data is None else point_data))
+    elif packed_ids:
+        cursor.execute("""
+            SELECT id, point_data
+            FROM pointcloud
+            WHERE id = ANY(%(pointcloud_ids)s::bigint[])
+        """, {
+            'pointcloud_ids': packed_ids,
+        })
+        for pointcloud_id, point_data in cursor.fetchall():
+            points = unpack_points(point_data)
+            if sample:
+                point_ids = get_sample_indices(len(points), sample_ratio)
+                points = points[point_ids]
+            else:
+                point_ids = np.arange(len(points), dtype=np.int64)
+            result[pointcloud_id] = (point_ids, points)
+
+    if linked_ids and sample:
+        for pointcloud_id in linked_ids:
+            # Select a random sample of N points in a repeatable fashion.
+            cursor.execute("""
+                SELECT setseed(0);
+                SELECT id, location_x, location_y, location_z
+                FROM point p
+                JOIN (
+                    SELECT pcp.point_id
+                    FROM pointcloud_point pcp
+                    WHERE pcp.pointcloud_id = %(pointcloud_id)s
+                    ORDER BY random()
+                ) ordered_points(id)
+                    USING(id)
+                LIMIT (
+                    SELECT floor(COUNT(*) * %(sample_ratio)s)::bigint
+                    FROM pointcloud_point
+                    WHERE pointcloud_id = %(pointcloud_id)s
+                )
+            """, {
+                'pointcloud_id': pointcloud_id,
+                'sample_ratio': sample_ratio,
+            })
+            rows = cursor.fetchall()
+            result[pointcloud_id] = (np.array([r[0] for r in rows], dtype=np.int64),
+                    np.array([r[1:] for r in rows], dtype=np.float64).reshape(-1, 3))
+    elif linked_ids:
+        cursor.execute("""
+            SELECT pcp.pointcloud_id, p.id, p.location_x, p.location_y, p.location_z
+            FROM pointcloud_point pcp
+            JOIN point p
+                ON p.id = pcp.point_id
+            WHERE pcp.pointcloud_id = ANY(%(pointcloud_ids)s::bigint[])
+            ORDER BY pcp.pointcloud_id, p.id
+        """, {
+            'pointcloud_ids': linked_ids,
+        })
+        rows_by_pointcloud:DefaultDict[int, List] = defaultdict(list)
+        for row in cursor.fetchall():
+            rows_by_pointcloud[row[0]].append(row[1:])
+        for pointcloud_id in linked_ids:
+            rows = rows_by_pointcloud[pointcloud_id]
+            result[pointcloud_id] = (np.array([r[0] for r in rows], dtype=np.int64),
+                    np.array([r[1:] for r in rows], dtype=np.float64).reshape(-1, 3))
+
+    return result
+
+
 def list_pointclouds(project_id, user_id, simple, with_images=False,
         with_points=True, sample_ratio=1.0, pointcloud_ids=None, order_by='id') -> List[Dict[str, Any]]:
     extra_select = []
@@ -339,6 +498,13 @@ class PointCloudList(APIView):
             type: integer
             paramType: form
             required: false
+          - name: binary
+            description: Whether points should be stored as packed point data
+                         rather than as individual points.
+            type: bool
+            paramType: form
+            required: false
+            defaultValue: false
         """
         name = request.POST.get('name')
         if not name:
@@ -355,11 +521,12 @@ class PointCloudList(APIView):
         #        map_fn=lambda x: [float(x[0]), float(x[1]), float(x[2])])
         if not points:
             raise ValueError("Need points to create point cloud")
+        binary = get_request_bool(request.POST, 'binary', False)
 
         pc = PointCloud.objects.create(project_id=project_id,
                 name=name, description=description, user=request.user,
-                source_path=source_path)
-        pc.save()
+                source_path=source_path,
+                point_data=pack_points(points) if binary else None)
 
         image_names = get_request_list(request.POST, 'image_names')
         image_descriptions = get_request_list(request.POST, 'image_descriptions')
@@ -413,28 +580,28 @@ class PointCloudList(APIView):
             group = Group.objects.get(pk=group_id)
             assigned_perm = assign_perm('can_read', group, pc)
 
-        # Add points
-        cursor = connection.cursor()
-        cursor.execute("""
-            WITH added_point AS (
-                INSERT INTO point (project_id, user_id, editor_id, location_x,
-                    location_y, location_z)
-                SELECT %(project_id)s, %(user_id)s, %(editor_id)s,
-                    p.location[1], p.location[2], p.location[3]
-                FROM reduce_dim(%(points)s) p(location)
-                RETURNING id
-            )
-            INSERT INTO pointcloud_point (project_id, pointcloud_id, point_id)
-            SELECT %(project_id)s, %(pointcloud_id)s, ap.id
-            FROM added_point ap
-        """, {
-            "project_id": project_id,
-            "user_id": request.user.id,
-            "editor_id": request.user.id,
-            "pointcloud_id": pc.id,
-            "points": points,
-        })
-
+        # Add points, unless they are stored as point data
+        if not binary:
+            cursor = connection.cursor()
+            cursor.execute("""
+                WITH added_point AS (
+                    INSERT INTO point (project_id, user_id, editor_id, location_x,
+                        location_y, location_z)
+                    SELECT %(project_id)s, %(user_id)s, %(editor_id)s,
+                        p.location[1], p.location[2], p.location[3]
+                    FROM reduce_dim(%(points)s) p(location)
+                    RETURNING id
+                )
+                INSERT INTO pointcloud_point (project_id, pointcloud_id, point_id)
+                SELECT %(project_id)s, %(pointcloud_id)s, ap.id
+                FROM added_point ap
+            """, {
+                "project_id": project_id,
+                "user_id": request.user.id,
+                "editor_id": request.user.id,
+                "pointcloud_id": pc.id,
+                "points": points,
+            })
 
         # If images are provided, store them in the database and link them to the
         # point cloud.
@@ -443,6 +610,82 @@ class PointCloudList(APIView):
         return JsonResponse(serialize_pointcloud(pc))
 
 
+class PointCloudUpload(APIView):
+
+    @method_decorator(requires_user_role(UserRole.Annotate))
+    def post(self, request:HttpRequest, project_id) -> JsonResponse:
+        """Create a new point cloud from packed point data, sent as request
+        body. Point data is a sequence of little-endian float32 X, Y and Z
+        values, i.e. 12 bytes per point. The request body is read in chunks and
+        stored as is, no point is created individually.
+        ---
+        parameters:
+          - name: project_id
+            description: Project of the new point cloud
+            type: integer
+            paramType: path
+            required: true
+          - name: name
+            description: Name of the new point cloud
+            type: string
+            paramType: query
+            required: true
+          - name: description
+            description: Description of the new point cloud
+            type: string
+            paramType: query
+            required: false
+          - name: source_path
+            description: A reference to the source file
+            type: string
+            paramType: query
+            required: false
+          - name: group_id
+            description: A group for which this point cloud will be visible exclusivly.
+            type: integer
+            paramType: query
+            required: false
+        """
+        name = request.query_params.get('name')
+        if not name:
+            raise ValueError("Need name")
+        description = request.query_params.get('description', '')
+        source_path = request.query_params.get('source_path', '')
+
+        max_size = settings.POINTCLOUD_UPLOAD_MAXIMUM_SIZE
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        if content_length > max_size:
+            raise ValueError(f"Point data is bigger than POINTCLOUD_UPLOAD_MAXIMUM_SIZE ({max_size / 1024**2} MB)")
+
+        point_data = bytearray()
+        while True:
+            chunk = request.read(POINT_DATA_UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            point_data.extend(chunk)
+            if len(point_data) > max_size:
+                raise ValueError(f"Point data is bigger than POINTCLOUD_UPLOAD_MAXIMUM_SIZE ({max_size / 1024**2} MB)")
+        if not point_data:
+            raise ValueError("Need points to create point cloud")
+        if not np.isfinite(unpack_points(point_data)).all():
+            raise ValueError("Points need to have finite coordinates")
+
+        pc = PointCloud.objects.create(project_id=project_id,
+                name=name, description=description, user=request.user,
+                source_path=source_path, point_data=point_data)
+
+        # Find an optional restriction group permission. If a group has no
+        # permission assigned, it is considered readable by all.
+        group_id = request.query_params.get('group_id')
+        if group_id is not None:
+            group = Group.objects.get(pk=int(group_id))
+            assign_perm('can_read', group, pc)
+
+        pointcloud_data = serialize_pointcloud(pc)
+        pointcloud_data['n_points'] = len(point_data) // POINT_DATA_ITEM_SIZE
+        return JsonResponse(pointcloud_data)
+
+
 class PointCloudImageDetail(APIView):
 
     @method_decorator(requires_user_role(UserRole.Browse))
@@ -465,7 +708,7 @@ class PointCloudImageDetail(APIView):
             paramType: path
             required: true
         """
-        pointcloud = PointCloud.objects.get(pk=pointcloud_id, project_id=project_id)
+        pointcloud = PointCloud.objects.defer('point_data').get(pk=pointcloud_id, project_id=project_id)
 
         # Check permissions. If there are no read permission assigned at all,
         # everyone can read.
@@ -532,13 +775,18 @@ class PointCloudDetail(APIView):
             paramType: form
             required: false
             defaultValue: false
+          - name: sample_ratio
+            description: Number in [0,1] to optionally sample point cloud
+            type: number
+            paramType: form
+            required: false
         """
         with_images = get_request_bool(request.query_params, 'with_images', False)
         with_points = get_request_bool(request.query_params, 'with_points', False)
         sample_ratio = float(request.query_params.get('sample_ratio', '1.0'))
         simple = get_request_bool(request.query_params, 'simple', False)
 
-        pointcloud = PointCloud.objects.get(pk=pointcloud_id, project_id=project_id)
+        pointcloud = PointCloud.objects.defer('point_data').get(pk=pointcloud_id, project_id=project_id)
         pointcloud_data = serialize_pointcloud(pointcloud, simple)
 
         # Check permissions. If there are no read permission assigned at all,
@@ -552,31 +800,10 @@ class PointCloudDetail(APIView):
             pointcloud_data['images'] = images
 
         if with_points:
-            if sample_ratio == 1.0:
-                points = [serialize_point(p, compact=True) for p in pointcloud.points.all()]
-                pointcloud_data['points'] = points
-            else:
-                n_points = PointCloudPoint.objects.filter(pointcloud_id=pointcloud.id).count()
-                n_sample = int(n_points * sample_ratio)
-                cursor = connection.cursor()
-                # Select a random sample of N points in a repeatable fashion.
-                cursor.execute("""
-                    SELECT setseed(0);
-                    SELECT id, location_x, location_y, location_z
-                    FROM point p
-                    JOIN (
-                        SELECT pcp.point_id
-                        FROM pointcloud_point pcp
-                        WHERE pcp.pointcloud_id = %(pointcloud_id)s
-                        ORDER BY random()
-                    ) ordered_points(id)
-                        USING(id)
-                    LIMIT %(n_sample)s
-                """, {
-                    'pointcloud_id': pointcloud.id,
-                    'n_sample': n_sample
-                })
-                pointcloud_data['points'] = cursor.fetchall()
+            point_ids, locations = get_pointcloud_points([pointcloud.id],
+                    sample_ratio)[pointcloud.id]
+            pointcloud_data['points'] = [[point_id] + location for point_id, location
+                    in zip(point_ids.tolist(), locations.tolist())]
 
         return JsonResponse(pointcloud_data)
 
@@ -585,7 +812,7 @@ class PointCloudDetail(APIView):
         """Delete a point cloud.
         """
         can_edit_or_fail(request.user, pointcloud_id, 'pointcloud')
-        pointcloud = PointCloud.objects.get(pk=pointcloud_id, project_id=project_id)
+        pointcloud = PointCloud.objects.defer('point_data').get(pk=pointcloud_id, project_id=project_id)
 
         cursor = connection.cursor()
         cursor.execute("""
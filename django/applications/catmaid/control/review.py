@@ -2,7 +2,7 @@
 
 from collections import defaultdict
 import json
-from typing import Any, DefaultDict, Dict, List
+from typing import Any, DefaultDict, Dict, List, Tuple
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
@@ -90,7 +90,10 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
     according to the user's whitelist. Otherwise, if <user_ids>
     evaluates to false a union review is returned. Otherwise a list of
     user IDs is expected to create a review status for a sub-union or a
-    single user.
+    single user. Reviewed nodes are read from the review summary tables where
+    possible. Only skeletons with reviews of multiple accepted reviewers or
+    with whitelisted reviews from before the accepted date need their reviews
+    to be counted.
     """
     if user_ids and excluding_user_ids:
         raise ValueError("user_ids and excluding_user_ids can't be used at the same time")
@@ -117,9 +120,71 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
     for row in cursor.fetchall():
         skeletons[row[0]] = [row[1], 0]
 
+    if not (whitelist_id or user_ids or excluding_user_ids):
+        # The union review status is maintained per skeleton.
+        cursor.execute("""
+            SELECT skeleton_id, n_reviewed_nodes
+            FROM catmaid_skeleton_review_summary
+            WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        """, {
+            'skeleton_ids': skeleton_ids,
+        })
+        for row in cursor.fetchall():
+            skeletons[row[0]][1] = row[1]
+        return skeletons
+
+    if whitelist_id:
+        accept_after = dict(ReviewerWhitelist.objects.filter(
+                project_id=project_id, user_id=whitelist_id).values_list(
+                'reviewer_id', 'accept_after'))
+    elif user_ids:
+        user_ids = set(user_ids)
+    else:
+        excluding_user_ids = set(excluding_user_ids)
+
+    # Reviews of a single accepted reviewer can be counted from the per
+    # reviewer summary. If multiple reviewers are accepted, the same node can
+    # be reviewed by more than one of them and the reviews have to be counted.
+    # This is also the case if a whitelisted reviewer reviewed a skeleton both
+    # before and after the accepted date.
+    cursor.execute("""
+        SELECT skeleton_id, reviewer_id, n_reviewed_nodes, first_review_time,
+            last_review_time
+        FROM catmaid_skeleton_reviewer_summary
+        WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+    """, {
+        'skeleton_ids': skeleton_ids,
+    })
+    accepted_reviews:DefaultDict[int, List[int]] = defaultdict(list)
+    count_reviews = set()
+    for skeleton_id, reviewer_id, n_reviewed_nodes, first_review_time, \
+            last_review_time in cursor.fetchall():
+        if whitelist_id:
+            reviewer_accept_after = accept_after.get(reviewer_id)
+            if reviewer_accept_after is None or \
+                    last_review_time < reviewer_accept_after:
+                continue
+            if first_review_time < reviewer_accept_after:
+                count_reviews.add(skeleton_id)
+        elif user_ids:
+            if reviewer_id not in user_ids:
+                continue
+        elif reviewer_id in excluding_user_ids:
+            continue
+        accepted_reviews[skeleton_id].append(n_reviewed_nodes)
+
+    for skeleton_id, n_reviewed_nodes in accepted_reviews.items():
+        if len(n_reviewed_nodes) > 1:
+            count_reviews.add(skeleton_id)
+        elif skeleton_id not in count_reviews:
+            skeletons[skeleton_id][1] = n_reviewed_nodes[0]
+
+    if not count_reviews:
+        return skeletons
+
     query_params = {
         'project_id': project_id,
-        'skeleton_ids': skeleton_ids
+        'skeleton_ids': list(count_reviews),
     }
 
     query_joins = []
@@ -175,6 +240,103 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
 
     return skeletons
 
+
+def check_review_summary(project_id, cursor=None) -> List[Tuple]:
+    """Compare the number of reviewed nodes in the review summary tables of a
+    project with the reviews. Returns a list of (skeleton ID, reviewer ID,
+    summary count, actual count) tuples for each mismatch. Mismatches of the
+    per skeleton summary have a reviewer ID of None.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    cursor.execute("""
+        WITH actual AS (
+            SELECT skeleton_id, reviewer_id,
+                COUNT(DISTINCT treenode_id) AS n_reviewed_nodes
+            FROM review
+            WHERE project_id = %(project_id)s
+            GROUP BY skeleton_id, reviewer_id
+        ), actual_skeleton AS (
+            SELECT skeleton_id, COUNT(DISTINCT treenode_id) AS n_reviewed_nodes
+            FROM review
+            WHERE project_id = %(project_id)s
+            GROUP BY skeleton_id
+        ), summary AS (
+            SELECT skeleton_id, reviewer_id, n_reviewed_nodes
+            FROM catmaid_skeleton_reviewer_summary
+            WHERE project_id = %(project_id)s
+        ), summary_skeleton AS (
+            SELECT skeleton_id, n_reviewed_nodes
+            FROM catmaid_skeleton_review_summary
+            WHERE project_id = %(project_id)s
+        )
+        SELECT skeleton_id, reviewer_id, COALESCE(s.n_reviewed_nodes, 0),
+            COALESCE(a.n_reviewed_nodes, 0)
+        FROM summary s
+        FULL OUTER JOIN actual a
+            USING (skeleton_id, reviewer_id)
+        WHERE s.n_reviewed_nodes IS DISTINCT FROM a.n_reviewed_nodes
+        UNION ALL
+        SELECT skeleton_id, NULL, COALESCE(s.n_reviewed_nodes, 0),
+            COALESCE(a.n_reviewed_nodes, 0)
+        FROM summary_skeleton s
+        FULL OUTER JOIN actual_skeleton a
+            USING (skeleton_id)
+        WHERE s.n_reviewed_nodes IS DISTINCT FROM a.n_reviewed_nodes
+        ORDER BY 1, 2
+    """, {
+        'project_id': project_id,
+    })
+    return cursor.fetchall()
+
+
+def rebuild_review_summary(project_id, skeleton_ids=None, cursor=None) -> int:
+    """Recompute the review summary entries of all skeletons of a project, or
+    of the passed in skeletons only, from the reviews. Reviews can't be changed
+    until the transaction ends. Returns the number of reviewed skeletons.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    review_filter = 'project_id = %(project_id)s'
+    if skeleton_ids is not None:
+        review_filter += ' AND skeleton_id = ANY(%(skeleton_ids)s::bigint[])'
+    params = {
+        'project_id': project_id,
+        'skeleton_ids': list(skeleton_ids or []),
+    }
+
+    cursor.execute("LOCK TABLE review IN SHARE MODE")
+    cursor.execute(f"""
+        DELETE FROM catmaid_skeleton_reviewer_summary
+        WHERE {review_filter}
+    """, params)
+    cursor.execute(f"""
+        DELETE FROM catmaid_skeleton_review_summary
+        WHERE {review_filter}
+    """, params)
+    cursor.execute(f"""
+        INSERT INTO catmaid_skeleton_reviewer_summary (project_id, skeleton_id,
+            reviewer_id, n_reviewed_nodes, first_review_time, last_review_time)
+        SELECT project_id, skeleton_id, reviewer_id, COUNT(DISTINCT treenode_id),
+            MIN(review_time), MAX(review_time)
+        FROM review
+        WHERE {review_filter}
+        GROUP BY project_id, skeleton_id, reviewer_id
+    """, params)
+    cursor.execute(f"""
+        INSERT INTO catmaid_skeleton_review_summary (project_id, skeleton_id,
+            n_reviewed_nodes, last_review_time)
+        SELECT project_id, skeleton_id, COUNT(DISTINCT treenode_id),
+            MAX(review_time)
+        FROM review
+        WHERE {review_filter}
+        GROUP BY project_id, skeleton_id
+    """, params)
+    return cursor.rowcount
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def reviewer_whitelist(request:HttpRequest, project_id=None) -> JsonResponse:
     """ Allows users to retrieve (GET) or update (POST) the set of users whose
@@ -26,7 +26,8 @@ from catmaid.control.common import (insert_into_log, get_class_to_id_map,
         get_request_list)
 from catmaid.models import (NblastConfig, NblastSample, Project, PointSet,
         NblastConfigDefaultDistanceBreaks, NblastConfigDefaultDotBreaks,
-        NblastSimilarity, PointCloud, UserRole)
+        NblastEngineChoices, NblastSimilarity, PointCloud, UserRole)
+from catmaid.control.nat import native
 from catmaid.control.nat.r import (compute_scoring_matrix, nblast,
         test_environment, setup_environment)
 from catmaid.control.pointcloud import list_pointclouds
@@ -74,6 +75,7 @@ def serialize_config(config, simple=False) -> Dict[str, Any]:
             'scoring': config.scoring,
             'resample_step': config.resample_step,
             'tangent_neighbors': config.tangent_neighbors,
+            'engine': config.engine,
         }
 
 
@@ -257,6 +259,14 @@ class ConfigurationList(APIView):
             required: false
             defaultValue: 20
             paramType: form
+          - name: engine
+            description: |
+                Which implementation computes similarities with this
+                configuration. Either "r" (nat.nblast through Rpy2) or
+                "native" (NumPy/SciPy).
+            required: false
+            defaultValue: r
+            paramType: form
           - name: matching_skeleton_ids
             description: A list of matching skeleton IDs if <source> is not "data".
             required: false
@@ -314,6 +324,9 @@ class ConfigurationList(APIView):
 
         source = request.data.get('source', 'backend-random')
         tangent_neighbors = int(request.data.get('tangent_neighbors', '20'))
+        engine = request.data.get('engine', 'r')
+        if engine not in dict(NblastEngineChoices):
+            raise ValueError(f"Unknown NBLAST engine: {engine}")
         matching_sample_id = int(request.data.get('matching_sample_id')) \
                 if 'matching_sample_id' in request.data else None
         random_sample_id = int(request.data.get('random_sample_id')) \
@@ -388,7 +401,8 @@ class ConfigurationList(APIView):
 
         if scoring:
             config = self.add_from_raw_data(project_id, request.user.id, name,
-                    scoring, distance_breaks, dot_breaks, tangent_neighbors)
+                    scoring, distance_breaks, dot_breaks, tangent_neighbors,
+                    engine)
             return Response(serialize_config(config))
         elif source == 'request':
             if not matching_skeleton_ids and not matching_pointset_ids:
@@ -398,7 +412,7 @@ class ConfigurationList(APIView):
             config = self.add_delayed(project_id, user_id, name, matching_skeleton_ids,
                     matching_pointset_ids, random_skeleton_ids, distance_breaks,
                     dot_breaks, tangent_neighbors=tangent_neighbors,
-                    matching_subset=matching_subset)
+                    matching_subset=matching_subset, engine=engine)
             return Response(serialize_config(config))
         elif source == 'backend-random':
             if not matching_skeleton_ids and not matching_pointset_ids:
@@ -416,7 +430,7 @@ class ConfigurationList(APIView):
                     matching_skeleton_ids, matching_pointset_ids,
                     matching_pointcloud_ids, distance_breaks, dot_breaks, None,
                     None, n_random_skeletons, min_length, min_nodes,
-                    tangent_neighbors, matching_subset)
+                    tangent_neighbors, matching_subset, engine)
             return Response(serialize_config(config))
         else:
             raise ValueError("Unknown source: " + source)
@@ -425,21 +439,23 @@ class ConfigurationList(APIView):
     def add_from_raw_data(self, project_id, user_id, name, scoring,
             distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks,
-            tangent_neighbors=20):
+            tangent_neighbors=20, engine='r'):
         """Add a scoring matrix based on the passed in array of arrays and
         dimensions.
         """
         return NblastConfig.objects.create(project_id=project_id,
             user_id=user_id, name=name, status='complete',
             distance_breaks=distance_breaks, dot_breaks=dot_breaks,
-            match_sample=None, random_sample=None, scoring=scoring)
+            match_sample=None, random_sample=None, scoring=scoring,
+            engine=engine)
 
 
     def add_delayed(self, project_id, user_id, name, matching_skeleton_ids,
             matching_pointset_ids, random_skeleton_ids,
             distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks, match_sample_id=None,
-            random_sample_id=None, tangent_neighbors=20, matching_subset=None):
+            random_sample_id=None, tangent_neighbors=20, matching_subset=None,
+            engine='r'):
         """Create and queue a new Celery task to create the scoring matrix.
         """
         histogram:List = []
@@ -466,7 +482,7 @@ class ConfigurationList(APIView):
             user=user_id, name=name, status='queued',
             distance_breaks=distance_breaks, dot_breaks=dot_breaks,
             match_sample=match_sample, random_sample=random_sample,
-            scoring=None, tangent_neighbors=tangent_neighbors)
+            scoring=None, tangent_neighbors=tangent_neighbors, engine=engine)
 
         # Queue recomputation task
         task = recompute_config.delay(config.id)
@@ -478,7 +494,8 @@ class ConfigurationList(APIView):
             matching_pointcloud_ids, distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks, match_sample_id=None,
             random_sample_id=None, n_random_skeletons=5000, min_length=0,
-            min_nodes=100, tangent_neighbors=20, matching_subset=None):
+            min_nodes=100, tangent_neighbors=20, matching_subset=None,
+            engine='r'):
         """Select a random set of neurons, optionally of a minimum length and
         queue a job to compute the scoring matrix.
         """
@@ -547,7 +564,8 @@ class ConfigurationList(APIView):
                 user_id=user_id, name=name, status='queued',
                 distance_breaks=distance_breaks, dot_breaks=dot_breaks,
                 match_sample=match_sample, random_sample=random_sample,
-                scoring=None, tangent_neighbors=tangent_neighbors)
+                scoring=None, tangent_neighbors=tangent_neighbors,
+                engine=engine)
 
             transaction.on_commit(lambda: compute_nblast_config.delay(config.id,
                     user_id))
@@ -713,7 +731,10 @@ def compute_nblast(project_id, user_id, similarity_id, remove_target_duplicates,
             raise ValueError(f"NBLAST config #{config.id}" +
                 " does not have a computed scoring.")
 
-        scoring_info = nblast(project_id, user_id, config.id,
+        # Scoring matrices are always computed with R, but similarities can
+        # also be computed natively.
+        nblast_fn = native.nblast if config.engine == 'native' else nblast
+        scoring_info = nblast_fn(project_id, user_id, config.id,
                 query_object_ids, target_object_ids,
                 similarity.query_type_id, similarity.target_type_id,
                 normalized=similarity.normalized,
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 from collections import defaultdict
-import csv
 from datetime import datetime, timedelta
 from itertools import chain
 import dateutil.parser
@@ -34,7 +33,11 @@ from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail, can_edit_all_or_fail
 from catmaid.control.common import (insert_into_log, get_class_to_id_map,
         get_relation_to_id_map, _create_relation, get_request_bool,
-        get_request_list, Echo)
+        get_request_list)
+from catmaid.control.connectivity import (CONNECTIVITY_MATRIX_FORMATS,
+        get_connectivity_matrix_npz, get_sparse_connectivity_matrix,
+        get_synapse_counts, iter_connectivity_matrix,
+        iter_connectivity_matrix_arrow, iter_connectivity_matrix_csv)
 from catmaid.control.link import LINK_TYPES
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.annotation import (annotations_for_skeleton,
@@ -42,7 +45,8 @@ from catmaid.control.annotation import (annotations_for_skeleton,
         clear_annotations)
 from catmaid.control.provenance import get_data_source, normalize_source_url
 from catmaid.control.review import get_review_status
-from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
+from catmaid.control.tree_util import (ArrayTree, find_root, reroot,
+        edge_count_to_root)
 from catmaid.control.volume import get_volume_details
 
 
@@ -129,34 +133,26 @@ def _open_leaves(project_id, skeleton_id, tnid=None):
         WHERE t.skeleton_id = %s
         ''', (int(skeleton_id),))
 
-    # Some entries repeated, when a node has more than one tag
-    # Create a graph with edges from parent to child, and accumulate parents.
-    tree = nx.DiGraph()
-    n_nodes = 0
-    for row in cursor.fetchall():
-        n_nodes += 1
-        node_id = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], node_id)
-        else:
-            tree.add_node(node_id)
+    rows = cursor.fetchall()
+    n_nodes = len(rows)
+    tree = ArrayTree.from_rows(rows)
 
-            # Default to root node
-            if not tnid:
-                tnid = node_id
+    # Default to root node
+    if not tnid and n_nodes:
+        tnid = int(tree.node_ids[tree.root])
 
     if tnid not in tree:
         raise ValueError("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
-    reroot(tree, tnid)
-    distances = edge_count_to_root(tree, root_node=tnid)
-    leaves = set()
-
-    for node_id, out_degree in tree.out_degree():
-        if 0 == out_degree or node_id == tnid and 1 == out_degree:
-            # Found an end node
-            leaves.add(node_id)
+    root = tree.index(tnid)
+    tree = tree.reroot(root)
+    # Distances count the root as one edge, like edge_count_to_root().
+    distances = tree.depths + 1
+    n_children = tree.n_children
+    # Ends, including the new root if it has only one child.
+    is_leaf = n_children == 0
+    is_leaf[root] |= n_children[root] == 1
+    leaves = set(tree.node_ids[is_leaf].tolist())
 
     # Select all nodes and their tags
     cursor.execute('''
@@ -185,7 +181,7 @@ def _open_leaves(project_id, skeleton_id, tnid=None):
         # Check if not tagged with a tag containing 'end'
         if tags == [None] or not any(end_regex.match(s) for s in tags):
             # Found an open end
-            d = distances[node_id]
+            d = int(distances[tree.index(node_id)])
             nearest.append([node_id, (row[1], row[2], row[3]), d, row[4]])
 
     return nearest, n_nodes
@@ -1964,29 +1960,86 @@ def connectivity_matrix_csv(request:HttpRequest, project_id) -> StreamingHttpRes
     cols = tuple(get_request_list(request.POST, 'columns', [], map_fn=int))
     names:Dict = dict(map(lambda x: (int(x[0]), x[1]), get_request_list(request.POST, 'names', [])))
 
-    matrix = get_connectivity_matrix(project_id, rows, cols)
+    # Rows are written as soon as the block of row skeletons they are part of
+    # has been queried.
+    blocks = iter_connectivity_matrix(project_id, rows, cols)
+    response = StreamingHttpResponse(iter_connectivity_matrix_csv(blocks, rows,
+            cols, names), content_type='text/csv')
 
-    csv_data = []
-    header = [''] + list(map(lambda x: names.get(x, x), cols))
-    csv_data.append(header)
+    filename = 'catmaid-connectivity-matrix.csv'
+    response['Content-Disposition'] = f'attachment; filename={filename}'
 
-    for n, skid_a in enumerate(rows):
-        # Add row header skeleton ID
-        row = [names.get(skid_a, skid_a)]
-        csv_data.append(row)
-        # Add connectivity information
-        for m, skid_b in enumerate(cols):
-            p = matrix.get(skid_a, {})
-            c = p.get(skid_b, 0)
-            row.append(c)
+    return response
 
-    pseudo_buffer = Echo()
-    writer = csv.writer(pseudo_buffer, quoting=csv.QUOTE_NONNUMERIC)
 
-    response = StreamingHttpResponse((writer.writerow(row) for row in csv_data), # type: ignore
-            content_type='text/csv')
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def connectivity_matrix_export(request:HttpRequest, project_id) -> HttpResponse:
+    """
+    Export the synapse count matrix of a set of row skeletons and a set of
+    column skeletons.
+
+    In CSV format, the first row contains the column skeleton IDs and each
+    following row starts with a row skeleton ID. In NPZ format, a compressed
+    NumPy archive is returned, which can be read with
+    `scipy.sparse.load_npz()` and includes the arrays `row_skeleton_ids` and
+    `column_skeleton_ids`. In Arrow format, an Arrow IPC stream of
+    (`row_skeleton_id`, `column_skeleton_id`, `count`) records for all
+    connected pairs is returned, if pyarrow is available. CSV and Arrow
+    responses are streamed in blocks of row skeletons.
+    ---
+    parameters:
+      - name: project_id
+        description: Project of skeletons
+        type: integer
+        paramType: path
+        required: true
+      - name: rows
+        description: IDs of row skeletons
+        required: true
+        type: array
+        items:
+          type: integer
+        paramType: form
+      - name: columns
+        description: IDs of column skeletons
+        required: true
+        type: array
+        items:
+          type: integer
+        paramType: form
+      - name: format
+        description: The export format, one of "csv", "npz" or "arrow".
+        required: false
+        default: csv
+        type: string
+        paramType: form
+    """
+    project_id = int(project_id)
+    rows = tuple(get_request_list(request.POST, 'rows', [], map_fn=int))
+    cols = tuple(get_request_list(request.POST, 'columns', [], map_fn=int))
+    export_format = request.POST.get('format', 'csv')
+    if export_format not in CONNECTIVITY_MATRIX_FORMATS:
+        raise ValueError(f"Unknown format: {export_format}, expected one of: "
+                f"{', '.join(CONNECTIVITY_MATRIX_FORMATS)}")
+
+    response:HttpResponse
+    if export_format == 'npz':
+        matrix = get_sparse_connectivity_matrix(project_id, rows, cols)
+        response = HttpResponse(get_connectivity_matrix_npz(matrix, rows, cols),
+                content_type='application/octet-stream')
+    elif export_format == 'arrow':
+        # Raise a missing pyarrow error before the response is started.
+        stream = iter_connectivity_matrix_arrow(
+                iter_connectivity_matrix(project_id, rows, cols), rows, cols)
+        response = StreamingHttpResponse(chain([next(stream)], stream), # type: ignore
+                content_type='application/vnd.apache.arrow.stream')
+    else:
+        response = StreamingHttpResponse(iter_connectivity_matrix_csv(
+                iter_connectivity_matrix(project_id, rows, cols), rows, cols),
+                content_type='text/csv')
 
-    filename = 'catmaid-connectivity-matrix.csv'
+    filename = f'catmaid-connectivity-matrix.{export_format}'
     response['Content-Disposition'] = f'attachment; filename={filename}'
 
     return response
@@ -2006,65 +2059,57 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids,
     post_rel_id = relation_map['postsynaptic_to']
     pre_rel_id = relation_map['presynaptic_to']
 
-    if with_locations:
-        extra_select = ', c.id, c.location_x, c.location_y, c.location_z'
-        extra_join = 'JOIN connector c ON c.id = t2.connector_id'
-    else:
-        extra_select = ''
-        extra_join = ''
-
-    # Obtain all synapses made between row skeletons and column skeletons.
+    # Build a sparse connectivity representation. For all skeletons requested
+    # map a dictionary of partner skeletons and the number of synapses
+    # connecting to each partner. Without locations, synapse counts are read
+    # from the skeleton connectivity summary or aggregated in the database.
+    outgoing:DefaultDict[Any, Dict] = defaultdict(dict)
+    if not with_locations:
+        for source, target, count in get_synapse_counts(project_id,
+                row_skeleton_ids, col_skeleton_ids, pre_rel_id, post_rel_id, cursor):
+            outgoing[source][target] = count
+        return outgoing
+
+    # Obtain all synapses made between row skeletons and column skeletons. If
+    # locations should be returned as well, an object with the fields 'count'
+    # and 'locations' is returned instead of a single count.
     cursor.execute('''
-        SELECT t1.skeleton_id, t2.skeleton_id
-            {extra_select}
+        SELECT t1.skeleton_id, t2.skeleton_id, c.id, c.location_x,
+            c.location_y, c.location_z
         FROM treenode_connector t1,
              treenode_connector t2
-            {extra_join}
+            JOIN connector c ON c.id = t2.connector_id
         WHERE t1.skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
           AND t2.skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
           AND t1.connector_id = t2.connector_id
           AND t1.relation_id = %(pre_rel_id)s
           AND t2.relation_id = %(post_rel_id)s
-    '''.format(extra_select=extra_select, extra_join=extra_join), {
+    ''', {
         'row_skeleton_ids': list(row_skeleton_ids),
         'col_skeleton_ids': list(col_skeleton_ids),
         'pre_rel_id': pre_rel_id,
         'post_rel_id': post_rel_id
     })
 
-    # Build a sparse connectivity representation. For all skeletons requested
-    # map a dictionary of partner skeletons and the number of synapses
-    # connecting to each partner. If locations should be returned as well, an
-    # object with the fields 'count' and 'locations' is returned instead of a
-    # single count.
-    if with_locations:
-        outgoing:DefaultDict[Any, Dict] = defaultdict(dict)
-        for r in cursor.fetchall():
-            source, target = r[0], r[1]
-            mapping = outgoing[source]
-            connector_id = r[2]
-            info = mapping.get(target)
-            if not info:
-                info = { 'count': 0, 'locations': {} }
-                mapping[target] = info
-            count = info['count']
-            info['count'] = count + 1
-
-            if connector_id not in info['locations']:
-                location = [r[3], r[4], r[5]]
-                info['locations'][connector_id] = {
-                    'pos': location,
-                    'count': 1,
-                }
-            else:
-                info['locations'][connector_id]['count'] += 1
-    else:
-        outgoing = defaultdict(dict)
-        for r in cursor.fetchall():
-            source, target = r[0], r[1]
-            mapping = outgoing[source]
-            count = mapping.get(target, 0)
-            mapping[target] = count + 1
+    for r in cursor.fetchall():
+        source, target = r[0], r[1]
+        mapping = outgoing[source]
+        connector_id = r[2]
+        info = mapping.get(target)
+        if not info:
+            info = { 'count': 0, 'locations': {} }
+            mapping[target] = info
+        count = info['count']
+        info['count'] = count + 1
+
+        if connector_id not in info['locations']:
+            location = [r[3], r[4], r[5]]
+            info['locations'][connector_id] = {
+                'pos': location,
+                'count': 1,
+            }
+        else:
+            info['locations'][connector_id]['count'] += 1
 
     return outgoing
 
@@ -1,22 +1,22 @@
 # -*- coding: utf-8 -*-
 
-import array
 from collections import defaultdict, deque
 from datetime import datetime
 from functools import partial
 import json
 import logging
-from math import sqrt
 import msgpack
-import networkx as nx
+import numpy as np
 from psycopg2.extras import DateTimeTZRange
 import pytz
-import struct
-from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple, Union
+from typing import (Any, DefaultDict, Dict, Iterator, List, Optional, Tuple,
+        Union)
 
+from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import connection
-from django.http import HttpRequest, HttpResponse, JsonResponse, Http404
+from django.db import connection, transaction
+from django.http import (HttpRequest, HttpResponse, JsonResponse, Http404,
+        StreamingHttpResponse)
 from django.db.models.query import QuerySet
 
 from rest_framework.decorators import api_view
@@ -26,10 +26,10 @@ from catmaid.models import UserRole, ClassInstance, Treenode, \
 from catmaid.control import export_NeuroML_Level3
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import (get_relation_to_id_map, get_request_bool,
-        get_request_list, is_empty)
+        get_request_list)
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
-from catmaid.control.tree_util import edge_count_to_root, partition
+from catmaid.control.tree_util import ArrayTree, get_path_sums
 
 
 try:
@@ -37,6 +37,10 @@ try:
 except ImportError:
     logging.getLogger(__name__).warning("NeuroML module could not be loaded.")
 
+# The number of skeletons that are loaded together when multiple compact
+# skeletons are requested.
+COMPACT_SKELETON_BATCH_SIZE = 200
+
 
 def default(obj:Union[DateTimeTZRange, datetime]) -> str:
     """Default JSON serializer."""
@@ -392,7 +396,7 @@ def compact_skeleton(request:HttpRequest, project_id=None, skeleton_id=None,
 
 @api_view(['POST'])
 @requires_user_role(UserRole.Browse)
-def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> Union[HttpResponse, JsonResponse]:
+def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> StreamingHttpResponse:
     """Get a compact treenode representation of a list of skeletons, optionally
     with the history of individual nodes and connectors.
 
@@ -499,24 +503,23 @@ def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> Union[
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
 
-    skeletons = {}
-    for skeleton_id in skeleton_ids:
-        skeletons[skeleton_id] = _compact_skeleton(project_id, skeleton_id,
-                with_connectors, with_tags, with_history, with_merge_history,
-                with_reviews, with_annotations, with_user_info, ordered)
+    # Remove duplicates, but keep the order. All skeletons are checked before
+    # the response is started, so that missing skeletons can still result in
+    # an error response.
+    skeleton_ids = list(dict.fromkeys(skeleton_ids))
+    _check_skeletons_exist(connection.cursor(), skeleton_ids, with_history)
 
-    result = {
-        "skeletons": skeletons
-    }
+    result = _stream_compact_skeletons(project_id, skeleton_ids,
+            return_format, with_connectors=with_connectors,
+            with_tags=with_tags, with_history=with_history,
+            with_merge_history=with_merge_history, with_reviews=with_reviews,
+            with_annotations=with_annotations, with_user_info=with_user_info,
+            ordered=ordered)
 
     if return_format == 'msgpack':
-        data = msgpack.packb(result)
-        return HttpResponse(data, content_type='application/octet-stream')
+        return StreamingHttpResponse(result, content_type='application/octet-stream')
     else:
-        return JsonResponse(result, safe=False, json_dumps_params={
-            'separators': (',', ':'),
-            'default': default
-        })
+        return StreamingHttpResponse(result, content_type='application/json')
 
 
 def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
@@ -542,116 +545,149 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
     the original creation time is needed for data that was created without
     history tables enabled.
     """
+    skeleton_id = int(skeleton_id)
+    return _compact_skeletons(project_id, [skeleton_id], with_connectors,
+            with_tags, with_history, with_merge_history, with_reviews,
+            with_annotations, with_user_info, ordered, scale)[skeleton_id]
+
+
+def _check_skeletons_exist(cursor, skeleton_ids, with_history=False) -> None:
+    """Raise a Http404 error for the first passed in skeleton that doesn't
+    exist. If history is requested, skeletons that don't exist anymore, but
+    for which historic nodes are available, are accepted.
+    """
+    history_check = '''
+        AND NOT EXISTS (
+            SELECT 1 FROM treenode__history th
+            WHERE th.skeleton_id = query.skeleton_id
+        )
+    ''' if with_history else ''
+    cursor.execute(f'''
+        SELECT query.skeleton_id
+        FROM UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+        LEFT JOIN class_instance ci
+            ON ci.id = query.skeleton_id
+        WHERE ci.id IS NULL
+        {history_check}
+        LIMIT 1
+    ''', {
+        'skeleton_ids': list(skeleton_ids),
+    })
+    missing = cursor.fetchone()
+    if missing:
+        raise Http404(f"Skeleton #{missing[0]} doesn't exist")
+
 
+def _compact_skeletons(project_id, skeleton_ids, with_connectors=True,
+        with_tags=True, with_history=False, with_merge_history=True,
+        with_reviews=False, with_annotations=False, with_user_info=False,
+        ordered=False, scale=None) -> Dict[int, Tuple[Tuple, Tuple, DefaultDict[Any, List], List, List]]:
+    """Get the compact representation described in _compact_skeleton() for
+    multiple skeletons at once. Rather than running multiple queries per
+    skeleton, one query per data kind is run for all skeletons and the result
+    rows are grouped by skeleton. Returns a dictionary that maps each skeleton
+    ID to its compact representation. Raises Http404 if a skeleton doesn't
+    exist.
+    """
+    skeleton_ids = list(skeleton_ids)
     cursor = connection.cursor()
+    scale_sql = '*%(scale)s' if scale else ''
+
+    nodes:DefaultDict[int, List] = defaultdict(list)
+    connectors:DefaultDict[int, List] = defaultdict(list)
+    tags:DefaultDict[int, DefaultDict[Any, List]] = defaultdict(lambda: defaultdict(list))
+    reviews:DefaultDict[int, List] = defaultdict(list)
+    annotations:DefaultDict[int, List] = defaultdict(list)
 
     if not with_history:
-        cursor.execute('''
-            SELECT id, parent_id, user_id,
-                location_x{scale}, location_y{scale}, location_z{scale},
-                radius{scale}, confidence
-            FROM treenode
-            WHERE skeleton_id = %(skeleton_id)s
-            {order}
-        '''.format(**{
-            'order': 'ORDER BY id' if ordered else '',
-            'scale': '*%(scale)s' if scale else '',
-        }), {
-            'skeleton_id': skeleton_id,
+        cursor.execute(f'''
+            SELECT t.skeleton_id, t.id, t.parent_id, t.user_id,
+                t.location_x{scale_sql}, t.location_y{scale_sql}, t.location_z{scale_sql},
+                t.radius{scale_sql}, t.confidence
+            FROM treenode t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON t.skeleton_id = query.skeleton_id
+            {'ORDER BY t.id' if ordered else ''}
+        ''', {
+            'skeleton_ids': skeleton_ids,
             'scale': scale,
         })
-
-        nodes = tuple(cursor.fetchall())
     else:
-        params = {
-            'skeleton_id': skeleton_id,
-            'scale': scale,
-        }
         # Get present and historic nodes. If a historic validity range is empty
         # (e.g. due to a change in the same transaction), the edition time is
         # taken for both start and end validity, because this is what actually
         # happened.
-        query = '''
+        merge_query = f'''
+            UNION ALL
+            SELECT
+                t.skeleton_id,
+                th.id,
+                th.parent_id,
+                th.user_id,
+                th.location_x{scale_sql},
+                th.location_y{scale_sql},
+                th.location_z{scale_sql},
+                th.radius{scale_sql},
+                th.confidence,
+                COALESCE(lower(th.sys_period), th.edition_time),
+                COALESCE(upper(th.sys_period), th.edition_time),
+                3 as ordering
+            FROM treenode__history th
+            JOIN treenode t
+                ON th.id = t.id
+                AND th.skeleton_id <> t.skeleton_id
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON t.skeleton_id = query.skeleton_id
+        ''' if with_merge_history else ''
+
+        cursor.execute(f'''
             SELECT
+                treenode.skeleton_id,
                 treenode.id,
                 treenode.parent_id,
                 treenode.user_id,
-                treenode.location_x{scale},
-                treenode.location_y{scale},
-                treenode.location_z{scale},
-                treenode.radius{scale},
+                treenode.location_x{scale_sql},
+                treenode.location_y{scale_sql},
+                treenode.location_z{scale_sql},
+                treenode.radius{scale_sql},
                 treenode.confidence,
                 treenode.edition_time,
                 treenode.creation_time,
                 1 as ordering
             FROM treenode
-            WHERE treenode.skeleton_id = %(skeleton_id)s
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON treenode.skeleton_id = query.skeleton_id
             UNION ALL
             SELECT
-                treenode__history.id,
-                treenode__history.parent_id,
-                treenode__history.user_id,
-                treenode__history.location_x{scale},
-                treenode__history.location_y{scale},
-                treenode__history.location_z{scale},
-                treenode__history.radius{scale},
-                treenode__history.confidence,
-                COALESCE(lower(treenode__history.sys_period), treenode__history.edition_time),
-                COALESCE(upper(treenode__history.sys_period), treenode__history.edition_time),
+                th.skeleton_id,
+                th.id,
+                th.parent_id,
+                th.user_id,
+                th.location_x{scale_sql},
+                th.location_y{scale_sql},
+                th.location_z{scale_sql},
+                th.radius{scale_sql},
+                th.confidence,
+                COALESCE(lower(th.sys_period), th.edition_time),
+                COALESCE(upper(th.sys_period), th.edition_time),
                 2 as ordering
-            FROM treenode__history
-            WHERE treenode__history.skeleton_id = %(skeleton_id)s
-        '''.format(**{
-            'scale': '*%(scale)s' if scale else '',
-        })
-
-        if with_merge_history:
-            query = '''
-                {query}
-                UNION ALL
-                SELECT
-                    th.id,
-                    th.parent_id,
-                    th.user_id,
-                    th.location_x{scale},
-                    th.location_y{scale},
-                    th.location_z{scale},
-                    th.radius{scale},
-                    th.confidence,
-                    COALESCE(lower(th.sys_period), th.edition_time),
-                    COALESCE(upper(th.sys_period), th.edition_time),
-                    3 as ordering
-                FROM treenode__history th
-                JOIN treenode t
-                    ON th.id = t.id
-                    AND t.skeleton_id = %(skeleton_id)s
-                    AND th.skeleton_id <> t.skeleton_id
-            '''.format(**{
-                'query': query,
-                'scale': '*%(scale)s' if scale else '',
-            })
-
-        query = """
-            {query}
-            {order}
-        """.format(**{
-            'query': query,
-            'order': 'ORDER BY treenode.id, ordering' if ordered else 'ORDER BY ordering',
+            FROM treenode__history th
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON th.skeleton_id = query.skeleton_id
+            {merge_query}
+            {'ORDER BY 2, ordering' if ordered else 'ORDER BY ordering'}
+        ''', {
+            'skeleton_ids': skeleton_ids,
+            'scale': scale,
         })
 
-        cursor.execute(query, params)
-
-        nodes = tuple(cursor.fetchall())
+    for row in cursor.fetchall():
+        nodes[row[0]].append(row[1:])
 
-    if 0 == len(nodes):
-        # Check if the skeleton exists
-        if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-            raise Http404(f"Skeleton #{skeleton_id} doesn't exist")
-        # Otherwise returns an empty list of nodes
-
-    connectors:Tuple = ()
-    tags:DefaultDict[Any, List] = defaultdict(list)
-    reviews = []
+    # Skeletons without any nodes are checked for existence.
+    empty_skeleton_ids = [skid for skid in skeleton_ids if skid not in nodes]
+    if empty_skeleton_ids:
+        _check_skeletons_exist(cursor, empty_skeleton_ids, with_history)
 
     if with_connectors or with_tags or with_annotations:
         # postgres is caching this query
@@ -665,182 +701,193 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         gj = relations.get('gapjunction_with', -1)
         dm = relations.get('desmosome_with', -3)
         relation_index = {pre: 0, post: 1, gj: 2, dm: 3}
+        params = {
+            'skeleton_ids': skeleton_ids,
+            'pre': pre,
+            'post': post,
+            'gj': gj,
+            'dm': dm,
+            'scale': scale,
+        }
         if not with_history:
             user_select = ', tc.user_id' if with_user_info else ''
-            cursor.execute('''
-                SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                    c.location_x{scale}, c.location_y{scale}, c.location_z{scale}
+            cursor.execute(f'''
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id, tc.relation_id,
+                    c.location_x{scale_sql}, c.location_y{scale_sql}, c.location_z{scale_sql}
                     {user_select}
-                FROM treenode_connector tc,
-                    connector c
-                WHERE tc.skeleton_id = %(skeleton_id)s
-                AND tc.connector_id = c.id
-                AND tc.relation_id IN (%(pre_id)s, %(post_id)s, %(gj_id)s, %(dm_id)s)
-            '''.format(**{
-                'user_select': user_select,
-                'scale': '*%(scale)s' if scale else '',
-            }), {
-                'skeleton_id': skeleton_id,
-                'pre_id': pre,
-                'post_id': post,
-                'gj_id': gj,
-                'dm_id': dm,
-                'scale': scale,
-            })
-
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5]) for row in cursor.fetchall())
+                FROM treenode_connector tc
+                JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                    ON tc.skeleton_id = query.skeleton_id
+                JOIN connector c
+                    ON tc.connector_id = c.id
+                WHERE tc.relation_id IN (%(pre)s, %(post)s, %(gj)s, %(dm)s)
+            ''', params)
         else:
-            params = {
-                'skeleton_id': skeleton_id,
-                'pre': pre,
-                'post': post,
-                'gj': gj,
-                'dm': dm,
-                'scale': scale,
-            }
             user_select = ', links.user_id' if with_user_info else ''
-
-            # Get present and historic connectors. If a historic validity range
-            # is empty (e.g. due to a change in the same transaction), the
-            # edition time is taken for both start and end validity, because
-            # this is what actually happened.
-            query = '''
-                SELECT links.treenode_id, links.connector_id, links.relation_id,
-                        c.location_x{scale}, c.location_y{scale}, c.location_z{scale},
+            merge_query = '''
+                UNION ALL
+                SELECT tc.skeleton_id, tch.treenode_id, tch.connector_id, tch.relation_id,
+                    COALESCE(lower(tch.sys_period), tch.edition_time),
+                    COALESCE(upper(tch.sys_period), tch.edition_time),
+                    tch.user_id, 3 AS ordering
+                FROM treenode_connector__history tch
+                JOIN treenode_connector tc
+                    ON tc.id = tch.id
+                    AND tch.skeleton_id <> tc.skeleton_id
+                JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                    ON tc.skeleton_id = query.skeleton_id
+            ''' if with_merge_history else ''
+
+            # Get present and historic connectors, with the same validity
+            # ranges as nodes.
+            cursor.execute(f'''
+                SELECT links.skeleton_id, links.treenode_id, links.connector_id,
+                        links.relation_id, c.location_x{scale_sql},
+                        c.location_y{scale_sql}, c.location_z{scale_sql},
                         links.valid_from, links.valid_to
                         {user_select}
                 FROM (
-                    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                        tc.edition_time, tc.creation_time, tc.user_id,
-                        1 AS ordering
+                    SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                        tc.relation_id, tc.edition_time, tc.creation_time,
+                        tc.user_id, 1 AS ordering
                     FROM treenode_connector tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
+                    JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                        ON tc.skeleton_id = query.skeleton_id
                     UNION ALL
-                    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
+                    SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                        tc.relation_id,
                         COALESCE(lower(tc.sys_period), tc.edition_time),
                         COALESCE(upper(tc.sys_period), tc.edition_time),
                         tc.user_id, 2 AS ordering
                     FROM treenode_connector__history tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
-                    {extra_query}
-                    {order}
-                ) links(treenode_id, connector_id, relation_id, valid_from, valid_to, user_id)
+                    JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                        ON tc.skeleton_id = query.skeleton_id
+                    {merge_query}
+                    {'ORDER BY 2, ordering' if ordered else 'ORDER BY ordering'}
+                ) links(skeleton_id, treenode_id, connector_id, relation_id,
+                        valid_from, valid_to, user_id)
                 JOIN connector__with_history c
                     ON links.connector_id = c.id
                 WHERE links.relation_id IN (%(pre)s, %(post)s, %(gj)s, %(dm)s)
-            '''
+            ''', params)
 
-            if with_merge_history:
-                merge_user_select = ', tch.user_id' if with_user_info else ''
-                extra_query = '''
-                    UNION ALL
-                    SELECT tch.treenode_id, tch.connector_id, tch.relation_id,
-                        COALESCE(lower(tch.sys_period), tch.edition_time),
-                        COALESCE(upper(tch.sys_period), tch.edition_time),
-                        tch.user_id, 3 AS ordering
-                    FROM treenode_connector__history tch
-                    JOIN treenode_connector tc
-                        ON tc.id = tch.id
-                        AND tc.skeleton_id = %(skeleton_id)s
-                        AND tch.skeleton_id <> tc.skeleton_id
-                '''
-            else:
-                extra_query = ''
-
-            cursor.execute(query.format(**{
-                'extra_query': extra_query,
-                'user_select': user_select,
-                'order': 'ORDER BY 1, ordering' if ordered else 'ORDER BY ordering',
-                'scale': '*%(scale)s' if scale else '',
-            }), params)
-
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7], row[8]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7]) for row in cursor.fetchall())
+        for row in cursor.fetchall():
+            connectors[row[0]].append((row[1], row[2],
+                    relation_index.get(row[3], -1)) + row[4:])
 
     if with_tags:
         history_suffix = '__with_history' if with_history else ''
         t_history_query = ', tci.edition_time' if with_history else ''
         user_select = ', tci.user_id' if with_user_info else ''
         # Fetch all node tags
-        cursor.execute('''
-            SELECT c.name, tci.treenode_id
-                   {history_query}
+        cursor.execute(f'''
+            SELECT t.skeleton_id, c.name, tci.treenode_id
+                   {t_history_query}
                    {user_select}
-            FROM treenode{history_suffix} t,
-                 treenode_class_instance{history_suffix} tci,
-                 class_instance{history_suffix} c
-            WHERE t.skeleton_id = %(skeleton_id)s
-              AND t.id = tci.treenode_id
-              AND tci.relation_id = %(relation_id)s
-              AND c.id = tci.class_instance_id
-            {order}
-        '''.format(**{
-            'history_query': t_history_query,
-            'history_suffix': history_suffix,
-            'user_select': user_select,
-            'order': 'ORDER BY tci.treenode_id ASC' if ordered else '',
-        }), {
-            'skeleton_id': skeleton_id,
+            FROM treenode{history_suffix} t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON t.skeleton_id = query.skeleton_id
+            JOIN treenode_class_instance{history_suffix} tci
+                ON t.id = tci.treenode_id
+            JOIN class_instance{history_suffix} c
+                ON c.id = tci.class_instance_id
+            WHERE tci.relation_id = %(relation_id)s
+            {'ORDER BY tci.treenode_id ASC' if ordered else ''}
+        ''', {
+            'skeleton_ids': skeleton_ids,
             'relation_id': relations['labeled_as'],
         })
 
-        if with_history:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2], row[3]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
+        if with_history or with_user_info:
+            for row in cursor.fetchall():
+                tags[row[0]][row[1]].append(list(row[2:]))
         else:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append(row[1])
+            for row in cursor.fetchall():
+                tags[row[0]][row[1]].append(row[2])
 
     if with_reviews:
         r_history_query = ', r.review_time' if with_history else ''
         history_suffix = '__with_history' if with_history else ''
         cursor.execute(f"""
-            SELECT r.treenode_id, r.id, r.reviewer_id{r_history_query}
+            SELECT r.skeleton_id, r.treenode_id, r.id, r.reviewer_id{r_history_query}
             FROM review{history_suffix} r
-            WHERE r.skeleton_id = %s
-        """, [skeleton_id])
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON r.skeleton_id = query.skeleton_id
+        """, {
+            'skeleton_ids': skeleton_ids,
+        })
 
-        for r in cursor.fetchall():
-            reviews.append(r)
+        for row in cursor.fetchall():
+            reviews[row[0]].append(row[1:])
 
-    annotations:List[Optional[Tuple]] = []
     if with_annotations:
         history_suffix = '__with_history' if with_history else ''
         link_history_query = ', annotation_link.edition_time' if with_history else ''
         user_select = ', neuron_link.user_id' if with_user_info else ''
-        # Fetch all node tags
         cursor.execute(f'''
-            SELECT annotation_link.class_instance_b
+            SELECT neuron_link.class_instance_a, annotation_link.class_instance_b
                    {link_history_query}
                    {user_select}
             FROM class_instance_class_instance{history_suffix} neuron_link
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON neuron_link.class_instance_a = query.skeleton_id
             JOIN class_instance_class_instance{history_suffix} annotation_link
                 ON annotation_link.class_instance_a = neuron_link.class_instance_b
-            WHERE neuron_link.class_instance_a = %(skeleton_id)s
-              AND neuron_link.relation_id = %(model_of)s
+            WHERE neuron_link.relation_id = %(model_of)s
               AND annotation_link.relation_id = %(annotated_with)s
         ''', {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'model_of': relations['model_of'],
             'annotated_with': relations['annotated_with']
         })
 
-        annotations = list(cursor.fetchall())
+        for row in cursor.fetchall():
+            annotations[row[0]].append(row[1:])
+
+    return dict((skid, (tuple(nodes[skid]), tuple(connectors[skid]), tags[skid],
+            reviews[skid], annotations[skid])) for skid in skeleton_ids)
+
+
+def _stream_compact_skeletons(project_id, skeleton_ids, return_format='json',
+        batch_size=COMPACT_SKELETON_BATCH_SIZE, **options) -> Iterator[bytes]:
+    """Generate the encoded result of compact_skeleton_detail_many() in the
+    form {"skeletons": {<skeleton_id>: <compact skeleton>}}, one batch of
+    skeletons at a time. This allows responses to start before all skeletons
+    are loaded. All skeletons are expected to exist.
+
+    The generator is consumed after the view returned, i.e. outside of the
+    request's transaction and after its permission checks. Callers have to
+    check permissions and the existence of skeletons before creating the
+    response. All batches are read in a single REPEATABLE READ transaction, so
+    that the result reflects one snapshot of the database, unless the
+    generator is consumed within another transaction already. Skeletons that
+    are deleted between the existence check and this snapshot abort the
+    response with an Http404 error.
+    """
+    if return_format == 'msgpack':
+        packer = msgpack.Packer()
+        yield packer.pack_map_header(1) + packer.pack('skeletons') + \
+                packer.pack_map_header(len(skeleton_ids))
+    else:
+        yield b'{"skeletons":{'
+
+    in_transaction = connection.in_atomic_block
+    with transaction.atomic():
+        if not in_transaction:
+            connection.cursor().execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        for n, offset in enumerate(range(0, len(skeleton_ids), batch_size)):
+            batch = skeleton_ids[offset:offset + batch_size]
+            skeletons = _compact_skeletons(project_id, batch, **options)
+            if return_format == 'msgpack':
+                yield b''.join(packer.pack(skid) + packer.pack(skeletons[skid])
+                        for skid in batch)
+            else:
+                data = ','.join(f'"{skid}":' + json.dumps(skeletons[skid],
+                        separators=(',', ':'), default=default) for skid in batch)
+                yield (data if n == 0 else ',' + data).encode('utf-8')
 
-    return nodes, connectors, tags, reviews, annotations
+    if return_format != 'msgpack':
+        yield b'}}'
 
 
 def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
@@ -1186,152 +1233,207 @@ def skeleton_with_metadata(request:HttpRequest, project_id=None, skeleton_id=Non
         },
     )
 
-def _measure_skeletons(skeleton_ids) -> Dict[Any, Any]:
+class SkeletonMeasurements(object):
+    """Morphology measurements and synapse counts of a single skeleton.
+    """
+    morphology_fields = ('n_nodes', 'raw_cable', 'smooth_cable',
+            'principal_branch_cable', 'n_ends', 'n_branch')
+
+    def __init__(self, n_nodes=0, raw_cable=0.0, smooth_cable=0.0,
+            principal_branch_cable=0.0, n_ends=0, n_branch=0):
+        self.n_nodes = n_nodes
+        self.raw_cable = raw_cable
+        self.smooth_cable = smooth_cable
+        self.principal_branch_cable = principal_branch_cable
+        self.n_ends = n_ends
+        self.n_branch = n_branch
+        self.n_pre = 0
+        self.n_post = 0
+
+    def get_morphology(self) -> Tuple:
+        return tuple(getattr(self, f) for f in SkeletonMeasurements.morphology_fields)
+
+
+# The record type of node arrays that can be measured with measure_arbors().
+# Root nodes have a parent ID of -1.
+arbor_node_dtype = np.dtype([('id', np.int64), ('parent_id', np.int64),
+        ('skeleton_id', np.int64), ('x', np.float64), ('y', np.float64),
+        ('z', np.float64)])
+
+
+def measure_arbors(nodes:np.ndarray) -> Dict[int, SkeletonMeasurements]:
+    """Measure the raw and smoothed cable length, the principal branch cable
+    length as well as the number of end and branch nodes for all skeletons in
+    the passed in array of arbor_node_dtype records. All computations are done
+    on arrays of parent indices and need memory linear in the number of nodes.
+
+    A root with a single child counts as end node, a root with more than two
+    children as branch node. Positions of slab nodes (including roots with two
+    children) are smoothed: each node moves 60% towards the average position
+    of its neighbors, weighted by their distance. The principal branch is the
+    path from the root to the end node with the most edges to the root.
+    """
+    n = len(nodes)
+    if not n:
+        return {}
+
+    nodes = nodes[np.argsort(nodes['id'], kind='stable')]
+    ids = nodes['id']
+    positions = np.column_stack((nodes['x'], nodes['y'], nodes['z']))
+
+    # Map parent IDs to indices, unknown parents make a node a root.
+    parents = np.searchsorted(ids, nodes['parent_id'])
+    np.minimum(parents, n - 1, out=parents)
+    parents[(nodes['parent_id'] < 0) | (ids[parents] != nodes['parent_id'])] = -1
+
+    skeleton_ids, skeleton_index = np.unique(nodes['skeleton_id'], return_inverse=True)
+    n_skeletons = len(skeleton_ids)
+
+    has_parent = parents >= 0
+    children = np.flatnonzero(has_parent)
+    child_parents = parents[children]
+
+    # Raw distance of each node to its parent, zero for roots
+    lengths = np.zeros(n)
+    lengths[children] = np.linalg.norm(positions[children] - positions[child_parents], axis=1)
+
+    n_children = np.bincount(child_parents, minlength=n)
+    is_end = np.where(has_parent, n_children == 0, n_children == 1)
+    is_branch = np.where(has_parent, n_children > 1, n_children > 2)
+    is_slab = ~(is_end | is_branch)
+
+    # Distance weighted sum of the positions of all neighbors of each node,
+    # i.e. its children and its parent.
+    distance_sums = np.bincount(child_parents, weights=lengths[children], minlength=n) + lengths
+    weighted_sums = np.zeros((n, 3))
+    for dim in range(3):
+        weighted_sums[:, dim] = np.bincount(child_parents,
+                weights=lengths[children] * positions[children, dim], minlength=n)
+    weighted_sums[children] += lengths[children, None] * positions[child_parents]
+    neighbor_avg = np.divide(weighted_sums, distance_sums[:, None],
+            out=np.zeros_like(weighted_sums), where=distance_sums[:, None] != 0)
+
+    smoothed = positions.copy()
+    smoothed[is_slab] = positions[is_slab] * 0.4 + neighbor_avg[is_slab] * 0.6
+    smooth_lengths = np.zeros(n)
+    smooth_lengths[children] = np.linalg.norm(smoothed[children] - smoothed[child_parents], axis=1)
+
+    # Find the node with the most edges to the root in each skeleton, which is
+    # always an end node, and get the smoothed length of its path to the root.
+    depths = get_path_sums(parents, has_parent.astype(np.int64))
+    path_lengths = get_path_sums(parents, smooth_lengths)
+    order = np.lexsort((-depths, skeleton_index))
+    deepest = order[np.r_[0, np.flatnonzero(np.diff(skeleton_index[order])) + 1]]
+
+    n_nodes = np.bincount(skeleton_index, minlength=n_skeletons)
+    raw_cable = np.bincount(skeleton_index, weights=lengths, minlength=n_skeletons)
+    smooth_cable = np.bincount(skeleton_index, weights=smooth_lengths, minlength=n_skeletons)
+    n_ends = np.bincount(skeleton_index, weights=is_end, minlength=n_skeletons)
+    n_branch = np.bincount(skeleton_index, weights=is_branch, minlength=n_skeletons)
+    principal_branch_cable = path_lengths[deepest]
+
+    return dict((int(skeleton_ids[i]), SkeletonMeasurements(int(n_nodes[i]),
+            float(raw_cable[i]), float(smooth_cable[i]),
+            float(principal_branch_cable[i]), int(n_ends[i]), int(n_branch[i])))
+            for i in range(n_skeletons))
+
+
+def get_measurement_cache_key(skeleton_id) -> str:
+    return f'catmaid-skeleton-measurements-{skeleton_id}'
+
+
+def _measure_skeletons(skeleton_ids, use_cache=False) -> Dict[int, SkeletonMeasurements]:
+    """Measure all passed in skeletons, see measure_arbors(). Additionally, the
+    number of postsynaptic links (n_pre) and of links from presynaptic links
+    to postsynaptic partners (n_post) is counted. If <use_cache> is true,
+    morphology measurements are stored in Django's cache. Cached results are
+    used as long as the last edition time and the node count of a skeleton
+    don't change.
+    """
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
 
-    skids_string = ",".join(map(str, skeleton_ids))
-
+    skeleton_ids = list(skeleton_ids)
     cursor = connection.cursor()
-    cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x  # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children:Dict[Any, float] = {}  # node ID vs distance - is first type an int or an str?
-
-    class Skeleton():
-        def __init__(self):
-            self.nodes:Dict[Any, Node] = {}
-            self.raw_cable = 0.0
-            self.smooth_cable = 0.0
-            self.principal_branch_cable = 0.0
-            self.n_ends = 0
-            self.n_branch = 0
-            self.n_pre = 0
-            self.n_post = 0
-
-    skeletons:Dict[Any, Skeleton] = {}  # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        if row[2] not in skeletons:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        else:
-            skeleton = skeletons[row[2]]
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
+    skeletons:Dict[int, SkeletonMeasurements] = {}
+    versions:Dict[int, Tuple[str, int]] = {}
 
-    for skeleton in skeletons.values():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.items():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.items():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.values())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.items():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.items():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+    if use_cache:
+        cursor.execute('''
+            SELECT css.skeleton_id, css.last_edition_time, css.num_nodes
+            FROM catmaid_skeleton_summary css
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON css.skeleton_id = query.skeleton_id
+        ''', {
+            'skeleton_ids': skeleton_ids,
+        })
+        versions = dict((row[0], (row[1].isoformat(), row[2])) for row in cursor.fetchall())
+        cached = cache.get_many([get_measurement_cache_key(skid) for skid in versions])
+        for skid, version in versions.items():
+            entry = cached.get(get_measurement_cache_key(skid))
+            if entry and entry[0] == version:
+                skeletons[skid] = SkeletonMeasurements(*entry[1])
+
+    skeleton_ids_to_measure = [skid for skid in skeleton_ids if skid not in skeletons]
+    if skeleton_ids_to_measure:
+        cursor.execute('''
+            SELECT t.id, COALESCE(t.parent_id, -1), t.skeleton_id,
+                t.location_x, t.location_y, t.location_z
+            FROM treenode t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON t.skeleton_id = query.skeleton_id
+        ''', {
+            'skeleton_ids': skeleton_ids_to_measure,
+        })
+        nodes = np.array(cursor.fetchall(), dtype=arbor_node_dtype)
+        measured = measure_arbors(nodes)
+        skeletons.update(measured)
+
+        if use_cache:
+            cache.set_many(dict((get_measurement_cache_key(skid),
+                    (versions[skid], m.get_morphology()))
+                    for skid, m in measured.items() if skid in versions))
 
     # Count inputs
     cursor.execute('''
-    SELECT tc.skeleton_id, count(tc.skeleton_id)
-    FROM treenode_connector tc,
-         relation r
-    WHERE tc.skeleton_id IN (%s)
-      AND tc.relation_id = r.id
-      AND r.relation_name = 'postsynaptic_to'
-    GROUP BY tc.skeleton_id
-    ''' % skids_string)
+        SELECT tc.skeleton_id, count(tc.skeleton_id)
+        FROM treenode_connector tc
+        JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+            ON tc.skeleton_id = query.skeleton_id
+        JOIN relation r
+            ON tc.relation_id = r.id
+        WHERE r.relation_name = 'postsynaptic_to'
+        GROUP BY tc.skeleton_id
+    ''', {
+        'skeleton_ids': skeleton_ids,
+    })
 
     for row in cursor.fetchall():
-        skeletons[row[0]].n_pre = row[1]
+        if row[0] in skeletons:
+            skeletons[row[0]].n_pre = row[1]
 
     # Count outputs
     cursor.execute('''
-    SELECT tc1.skeleton_id, count(tc1.skeleton_id)
-    FROM treenode_connector tc1,
-         treenode_connector tc2,
-         relation r1,
-         relation r2
-    WHERE tc1.skeleton_id IN (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = r1.id
-      AND r1.relation_name = 'presynaptic_to'
-      AND tc2.relation_id = r2.id
-      AND r2.relation_name = 'postsynaptic_to'
-      GROUP BY tc1.skeleton_id
-    ''' % skids_string)
+        SELECT tc1.skeleton_id, count(tc1.skeleton_id)
+        FROM treenode_connector tc1
+        JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+            ON tc1.skeleton_id = query.skeleton_id
+        JOIN relation r1
+            ON tc1.relation_id = r1.id
+        JOIN treenode_connector tc2
+            ON tc1.connector_id = tc2.connector_id
+        JOIN relation r2
+            ON tc2.relation_id = r2.id
+        WHERE r1.relation_name = 'presynaptic_to'
+          AND r2.relation_name = 'postsynaptic_to'
+        GROUP BY tc1.skeleton_id
+    ''', {
+        'skeleton_ids': skeleton_ids,
+    })
 
     for row in cursor.fetchall():
-        skeletons[row[0]].n_post = row[1]
+        if row[0] in skeletons:
+            skeletons[row[0]].n_post = row[1]
 
     return skeletons
 
@@ -1339,10 +1441,11 @@ def _measure_skeletons(skeleton_ids) -> Dict[Any, Any]:
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def measure_skeletons(request:HttpRequest, project_id=None) -> JsonResponse:
     skeleton_ids = tuple(int(v) for k,v in request.POST.items() if k.startswith('skeleton_ids['))
+    use_cache = get_request_bool(request.POST, 'use_cache', False)
 
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
-    return JsonResponse([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).items()], safe=False)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+    return JsonResponse([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids, use_cache).items()], safe=False)
 
 
 def _skeleton_neuroml_cell(skeleton_id, preID, postID):
@@ -1547,52 +1650,23 @@ def _export_review_skeleton(project_id=None, skeleton_id=None,
     if 0 == len(treenodes):
         return []
 
-    # The root node will be assigned below, depending on retrieved nodes and
-    # sub-arbor requests
-    root_id = None
-
-    # Add each treenode to a networkx graph and attach reviewer information to
-    # it.
-    g = nx.DiGraph()
-    reviewed = set()
-    for t in treenodes:
-        # While at it, send the reviewer IDs, which is useful to iterate fwd
-        # to the first unreviewed node in the segment.
-        g.add_node(t[0], **{
-            'id': t[0],
-            'x': t[2],
-            'y': t[3],
-            'z': t[4],
-            'rids': reviews[t[0]],
-            'sup': [[o, l] for [o, l] in zip(t[5], t[6]) if o is not None],
-            'user_id': t[7],
-        })
-        if reviews[t[0]]:
-            reviewed.add(t[0])
-        if t[1]:  # if parent
-            g.add_edge(t[1], t[0])  # edge from parent to child
-        else:
-            root_id = t[0]
+    tree = ArrayTree.from_rows(treenodes)
+    roots = tree.roots
+    root_id = int(tree.node_ids[roots[0]]) if len(roots) else None
 
     if subarbor_node_id and subarbor_node_id != root_id:
         # Make sure the subarbor node ID (if any) is part of this skeleton
-        if subarbor_node_id not in g:
+        if subarbor_node_id not in tree:
             raise ValueError("Supplied subarbor node ID (%s) is not part of "
                              "provided skeleton (%s)" % (subarbor_node_id, skeleton_id))
 
-        # Remove connection to parent
-        parent = list(g.predecessors(subarbor_node_id))[0]
-        g.remove_edge(parent, subarbor_node_id)
-        # Remove all nodes that are upstream from the subarbor node
-        to_delete = set()
-        to_lookat = [root_id]
-        while to_lookat:
-            n = to_lookat.pop()
-            to_lookat.extend(list(g.successors(n)))
-            to_delete.add(n)
-        g.remove_nodes_from(to_delete)
-        # Replace root id with sub-arbor ID
-        root_id=subarbor_node_id
+        # Keep only the nodes downstream from the subarbor node, which becomes
+        # the new root.
+        subarbor = tree.index(subarbor_node_id)
+        mask = tree.subtree_mask(subarbor)
+        treenodes = [t for t, keep in zip(treenodes, mask) if keep]
+        tree = tree.extract(mask)
+        root_id = subarbor_node_id
 
     if not root_id:
         if subarbor_node_id:
@@ -1602,25 +1676,29 @@ def _export_review_skeleton(project_id=None, skeleton_id=None,
             raise ValueError("Couldn't find a reference root node for provided "
                              "subarbor (%s) in provided skeleton (%s)" % (subarbor_node_id, skeleton_id))
 
-    # Create all sequences, as long as possible and always from end towards root
-    distances = edge_count_to_root(g, root_node=root_id)  # distance in number of edges from root
-    seen:Set = set()
-    sequences = []
-    # Iterate end nodes sorted from highest to lowest distance to root
-    endNodeIDs = list(nID for nID in g.nodes() if is_empty(g.successors(nID)))
-    for nodeID in sorted(endNodeIDs, key=distances.get, reverse=True):
-        sequence = [g.nodes[nodeID]]
-        parents = list(g.predecessors(nodeID))
-        while parents:
-            parentID = parents[0]
-            sequence.append(g.nodes[parentID])
-            if parentID in seen:
-                break
-            seen.add(parentID)
-            parents = list(g.predecessors(parentID))
-
-        # Single node sequences are ok
-        sequences.append(sequence)
+    # Attach reviewer information to each node. While at it, send the
+    # reviewer IDs, which is useful to iterate fwd to the first unreviewed
+    # node in the segment. The tree keeps the order of the passed in nodes.
+    nodes = []
+    reviewed = set()
+    for t in treenodes:
+        nodes.append({
+            'id': t[0],
+            'x': t[2],
+            'y': t[3],
+            'z': t[4],
+            'rids': reviews[t[0]],
+            'sup': [[o, l] for [o, l] in zip(t[5], t[6]) if o is not None],
+            'user_id': t[7],
+        })
+        if reviews[t[0]]:
+            reviewed.add(t[0])
+
+    # Create all sequences, as long as possible and always from end towards
+    # root, end nodes with the highest distance to root come first. Single node
+    # sequences are ok.
+    sequences = [[nodes[i] for i in sequence]
+            for sequence in tree.partition(with_single_nodes=True)]
 
     # Calculate status
 
@@ -1911,40 +1989,6 @@ def connector_polyadicity(request:HttpRequest, project_id=None) -> JsonResponse:
     return JsonResponse(skeleton_map)
 
 
-@api_view(['GET'])
-@requires_user_role(UserRole.Browse)
-def neuroglancer_skeleton(request:HttpRequest, project_id=None, skeleton_id=None) -> JsonResponse:
-    """Export a morphology-only skeleton in neuroglancer's binary format.
-    """
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT id, parent_id, location_x, location_y, location_z
-        FROM treenode
-        WHERE project_id = %s AND skeleton_id = %s
-    """, (project_id, skeleton_id))
-
-    rows = cursor.fetchall()
-
-    num_vertices = cursor.rowcount
-    id_map = {row[0]: i for i, row in enumerate(rows)}
-
-    vertices = [row[2:] for row in rows]
-    edges = [[i, id_map[row[1]]] for i, row in enumerate(rows) if row[1] is not None]
-
-    total_size = (16 + 12*num_vertices + 8*(num_vertices - 1))
-    buff = array.array('c', b'\x00'*total_size)
-
-    struct.pack_into('3I', buff, 0, num_vertices, 0, num_vertices - 1)
-    offset = 16
-    for v in vertices:
-        struct.pack_into('3f', buff, offset, *v)
-        offset += 12
-    for e in edges:
-        struct.pack_into('2I', buff, offset, *e)
-        offset += 8
-
-    return JsonResponse(buff, safe=False)
-
 @api_view(['GET'])
 @requires_user_role(UserRole.Browse)
 def treenode_overview(request:HttpRequest, project_id=None, skeleton_id=None) -> HttpResponse:
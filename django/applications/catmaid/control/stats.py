@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
 from dateutil import parser as dateparser
 import json
 import os
 import pytz
 import time
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
 from django.conf import settings
 from django.http import HttpRequest, JsonResponse
@@ -1062,7 +1063,8 @@ def populate_stats_summary(project_id, delete:bool=False, incremental:bool=True)
     cursor = connection.cursor()
     if delete:
         cursor.execute("""
-            DELETE FROM catmaid_stats_summary WHERE project_id = %(project_id)s
+            DELETE FROM catmaid_stats_summary WHERE project_id = %(project_id)s;
+            DELETE FROM catmaid_stats_summary_watermark WHERE project_id = %(project_id)s;
         """, dict(project_id=project_id))
 
     populate_review_stats_summary(project_id, incremental, cursor)
@@ -1072,7 +1074,8 @@ def populate_stats_summary(project_id, delete:bool=False, incremental:bool=True)
     populate_import_nodecount_stats_summary(project_id, incremental, cursor)
     populate_import_cable_stats_summary(project_id, incremental, cursor)
 
-def populate_review_stats_summary(project_id, incremental:bool=True, cursor=None) -> None:
+def populate_review_stats_summary(project_id, incremental:bool=True, cursor=None,
+        hours:Optional[List]=None) -> int:
     """Add review summary information to the summary table. Create hourly
     aggregates in UTC time. These aggregates can still be moved in other
     timezones with good enough precision for our purpose. By default, this
@@ -1085,7 +1088,10 @@ def populate_review_stats_summary(project_id, incremental:bool=True, cursor=None
     # Add reviewer info
     cursor.execute("""
         WITH last_precomputation AS (
-            SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
+            SELECT CASE WHEN %(hours)s::timestamptz[] IS NOT NULL THEN (
+                    SELECT min(h) - interval '1 hour'
+                    FROM UNNEST(%(hours)s::timestamptz[]) h)
+                WHEN %(incremental)s = FALSE THEN '-infinity'
                 ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
                     '-infinity') END AS max_date
             FROM catmaid_stats_summary
@@ -1099,6 +1105,8 @@ def populate_review_stats_summary(project_id, incremental:bool=True, cursor=None
             FROM review r, last_precomputation
             WHERE r.project_id = %(project_id)s
             AND r.review_time > last_precomputation.max_date
+            AND (%(hours)s::timestamptz[] IS NULL
+                OR date_trunc('hour', r.review_time) = ANY(%(hours)s::timestamptz[]))
             AND r.review_time < date_trunc('hour', CURRENT_TIMESTAMP)
             GROUP BY r.reviewer_id, date
         )
@@ -1108,9 +1116,11 @@ def populate_review_stats_summary(project_id, incremental:bool=True, cursor=None
         FROM review_info ri
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET n_reviewed_nodes = EXCLUDED.n_reviewed_nodes;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, incremental=incremental, hours=hours))
+    return cursor.rowcount
 
-def populate_connector_stats_summary(project_id, incremental:bool=True, cursor=None) -> None:
+def populate_connector_stats_summary(project_id, incremental:bool=True, cursor=None,
+        hours:Optional[List]=None) -> int:
     """Add connector summary information to the summary table. Create hourly
     aggregates in UTC time. These aggregates can still be moved in other
     timezones with good enough precision for our purpose. By default, this
@@ -1125,7 +1135,10 @@ def populate_connector_stats_summary(project_id, incremental:bool=True, cursor=N
     if pre_id and post_id:
         cursor.execute("""
             WITH last_precomputation AS (
-                SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
+                SELECT CASE WHEN %(hours)s::timestamptz[] IS NOT NULL THEN (
+                        SELECT min(h) - interval '1 hour'
+                        FROM UNNEST(%(hours)s::timestamptz[]) h)
+                    WHEN %(incremental)s = FALSE THEN '-infinity'
                     ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
                         '-infinity') END AS max_date
                 FROM catmaid_stats_summary
@@ -1140,6 +1153,8 @@ def populate_connector_stats_summary(project_id, incremental:bool=True, cursor=N
                 JOIN treenode_connector t2 ON t1.connector_id = t2.connector_id
                 WHERE t1.project_id=%(project_id)s
                 AND t1.creation_time >= last_precomputation.max_date
+                AND (%(hours)s::timestamptz[] IS NULL
+                    OR date_trunc('hour', t1.creation_time) = ANY(%(hours)s::timestamptz[]))
                 AND t1.creation_time < date_trunc('hour', CURRENT_TIMESTAMP)
                 AND t1.relation_id <> t2.relation_id
                 AND (t1.relation_id = %(pre_id)s OR t1.relation_id = %(post_id)s)
@@ -1154,9 +1169,12 @@ def populate_connector_stats_summary(project_id, incremental:bool=True, cursor=N
             ON CONFLICT (project_id, user_id, date) DO UPDATE
             SET n_connector_links = EXCLUDED.n_connector_links;
         """, dict(project_id=project_id, pre_id=pre_id, post_id=post_id,
-                  incremental=incremental))
+                  incremental=incremental, hours=hours))
+        return cursor.rowcount
+    return 0
 
-def populate_cable_stats_summary(project_id, incremental:bool=True, cursor=None) -> None:
+def populate_cable_stats_summary(project_id, incremental:bool=True, cursor=None,
+        hours:Optional[List]=None) -> int:
     """Add cable length summary data to the statistics summary table. By
     default, this happens in an incremental manner, but can optionally be fone
     for all data from scratch (overriding existing statistics).
@@ -1166,7 +1184,10 @@ def populate_cable_stats_summary(project_id, incremental:bool=True, cursor=None)
 
     cursor.execute("""
         WITH last_precomputation AS (
-            SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
+            SELECT CASE WHEN %(hours)s::timestamptz[] IS NOT NULL THEN (
+                    SELECT min(h) - interval '1 hour'
+                    FROM UNNEST(%(hours)s::timestamptz[]) h)
+                WHEN %(incremental)s = FALSE THEN '-infinity'
                 ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
                     '-infinity') END AS max_date
             FROM catmaid_stats_summary
@@ -1188,6 +1209,8 @@ def populate_cable_stats_summary(project_id, incremental:bool=True, cursor=None)
                 FROM treenode child, last_precomputation
                 WHERE child.project_id = %(project_id)s
                   AND child.creation_time >= last_precomputation.max_date
+                  AND (%(hours)s::timestamptz[] IS NULL
+                      OR date_trunc('hour', child.creation_time) = ANY(%(hours)s::timestamptz[]))
                   AND child.creation_time < date_trunc('hour', CURRENT_TIMESTAMP)
             ) AS child
             INNER JOIN LATERAL (
@@ -1207,10 +1230,11 @@ def populate_cable_stats_summary(project_id, incremental:bool=True, cursor=None)
         FROM cable_info ci
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET cable_length = EXCLUDED.cable_length;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, incremental=incremental, hours=hours))
+    return cursor.rowcount
 
 def populate_nodecount_stats_summary(project_id, incremental:bool=True,
-                                     cursor=None) -> None:
+                                     cursor=None, hours:Optional[List]=None) -> int:
     """Add node count summary data to the statistics summary table. By default,
     this happens in an incremental manner, but can optionally be fone for all
     data from scratch (overriding existing statistics).
@@ -1224,7 +1248,10 @@ def populate_nodecount_stats_summary(project_id, incremental:bool=True,
     # might be recomputed, which is done to increase reobustness.
     cursor.execute("""
         WITH last_precomputation AS (
-            SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
+            SELECT CASE WHEN %(hours)s::timestamptz[] IS NOT NULL THEN (
+                    SELECT min(h) - interval '1 hour'
+                    FROM UNNEST(%(hours)s::timestamptz[]) h)
+                WHEN %(incremental)s = FALSE THEN '-infinity'
                 ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
                     '-infinity') END AS max_date
             FROM catmaid_stats_summary
@@ -1238,6 +1265,8 @@ def populate_nodecount_stats_summary(project_id, incremental:bool=True,
             FROM treenode, last_precomputation
             WHERE project_id=%(project_id)s
             AND creation_time >= last_precomputation.max_date
+            AND (%(hours)s::timestamptz[] IS NULL
+                OR date_trunc('hour', creation_time) = ANY(%(hours)s::timestamptz[]))
             GROUP BY 1, 2
         )
         INSERT INTO catmaid_stats_summary (project_id, user_id, date,
@@ -1246,10 +1275,11 @@ def populate_nodecount_stats_summary(project_id, incremental:bool=True,
         FROM node_info ni
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET n_treenodes = EXCLUDED.n_treenodes;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, incremental=incremental, hours=hours))
+    return cursor.rowcount
 
 def populate_import_nodecount_stats_summary(project_id, incremental:bool=True,
-                                            cursor=None) -> None:
+                                            cursor=None, hours:Optional[List]=None) -> int:
     """Add import node count summary data to the statistics summary table. By
     default, this happens in an incremental manner, but can optionally be fone
     for all data from scratch (overriding existing statistics).
@@ -1269,7 +1299,10 @@ def populate_import_nodecount_stats_summary(project_id, incremental:bool=True,
     # one hour (3600 seconds). This should be robust enough for our use case.
     cursor.execute("""
         WITH last_precomputation AS (
-            SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
+            SELECT CASE WHEN %(hours)s::timestamptz[] IS NOT NULL THEN (
+                    SELECT min(h) - interval '1 hour'
+                    FROM UNNEST(%(hours)s::timestamptz[]) h)
+                WHEN %(incremental)s = FALSE THEN '-infinity'
                 ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
                     '-infinity') END AS max_date
             FROM catmaid_stats_summary
@@ -1289,6 +1322,8 @@ def populate_import_nodecount_stats_summary(project_id, incremental:bool=True,
                 WHERE cti.project_id = %(project_id)s
                   AND ABS(EXTRACT(EPOCH FROM t.creation_time) - EXTRACT(EPOCH FROM cti.execution_time)) < 3600
                   AND t.creation_time >= last_precomputation.max_date
+                  AND (%(hours)s::timestamptz[] IS NULL
+                      OR date_trunc('hour', t.creation_time) = ANY(%(hours)s::timestamptz[]))
                   AND label = 'skeletons.import'
             ) sorted_row_history
             WHERE sorted_row_history.n = 1
@@ -1300,9 +1335,11 @@ def populate_import_nodecount_stats_summary(project_id, incremental:bool=True,
         FROM node_info ni
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET n_imported_treenodes = EXCLUDED.n_imported_treenodes;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, incremental=incremental, hours=hours))
+    return cursor.rowcount
 
-def populate_import_cable_stats_summary(project_id, incremental:bool=True, cursor=None) -> None:
+def populate_import_cable_stats_summary(project_id, incremental:bool=True, cursor=None,
+        hours:Optional[List]=None) -> int:
     """Add imported cable length summary data to the statistics summary table.
     By default, this happens in an incremental manner, but can optionally be
     fone for all data from scratch (overriding existing statistics).
@@ -1312,7 +1349,10 @@ def populate_import_cable_stats_summary(project_id, incremental:bool=True, curso
 
     cursor.execute("""
         WITH last_precomputation AS (
-            SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
+            SELECT CASE WHEN %(hours)s::timestamptz[] IS NOT NULL THEN (
+                    SELECT min(h) - interval '1 hour'
+                    FROM UNNEST(%(hours)s::timestamptz[]) h)
+                WHEN %(incremental)s = FALSE THEN '-infinity'
                 ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
                     '-infinity') END AS max_date
             FROM catmaid_stats_summary
@@ -1329,6 +1369,8 @@ def populate_import_cable_stats_summary(project_id, incremental:bool=True, curso
             WHERE cti.project_id = %(project_id)s
               AND ABS(EXTRACT(EPOCH FROM t.creation_time) - EXTRACT(EPOCH FROM cti.execution_time)) < 3600
               AND t.creation_time >= last_precomputation.max_date
+              AND (%(hours)s::timestamptz[] IS NULL
+                  OR date_trunc('hour', t.creation_time) = ANY(%(hours)s::timestamptz[]))
               AND t.creation_time < date_trunc('hour', CURRENT_TIMESTAMP)
               AND label = 'skeletons.import'
         ),
@@ -1366,7 +1408,201 @@ def populate_import_cable_stats_summary(project_id, incremental:bool=True, curso
         FROM cable_info ci
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET import_cable_length = EXCLUDED.cable_length;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, incremental=incremental, hours=hours))
+    return cursor.rowcount
+
+
+# Changes can become visible after the point in time they are recorded with,
+# if their transaction takes a while to commit. Watermarks are therefore moved
+# back by this interval before looking for changes.
+STATS_WATERMARK_OVERLAP = timedelta(hours=1)
+
+# Queries for the creation hours of summary entries that could have changed
+# since a point in time. Changed and deleted rows are found using the edition
+# time and history tables, imports using the transaction log.
+_nodecount_touched_hours = """
+    SELECT date_trunc('hour', t.creation_time)
+    FROM treenode t
+    WHERE t.project_id = %(project_id)s
+      AND t.edition_time >= %(since)s
+    UNION
+    SELECT date_trunc('hour', th.creation_time)
+    FROM treenode__history th
+    WHERE th.project_id = %(project_id)s
+      AND upper(th.sys_period) >= %(since)s
+"""
+
+_import_touched_hours = """
+    SELECT DISTINCT date_trunc('hour', t.creation_time)
+    FROM catmaid_transaction_info cti
+    JOIN treenode__with_history t
+      ON t.txid = cti.transaction_id
+    WHERE cti.project_id = %(project_id)s
+      AND cti.label = 'skeletons.import'
+      AND cti.execution_time >= %(since)s
+"""
+
+STATS_SUMMARY_STATISTICS = {
+    'n_reviewed_nodes': (populate_review_stats_summary, """
+        SELECT date_trunc('hour', r.review_time)
+        FROM review r
+        WHERE r.project_id = %(project_id)s
+          AND r.review_time >= %(since)s
+        UNION
+        SELECT date_trunc('hour', rh.review_time)
+        FROM review__history rh
+        WHERE rh.project_id = %(project_id)s
+          AND upper(rh.sys_period) >= %(since)s
+    """),
+    # Links are counted in the hour of the later link to a connector, changes
+    # to one link can therefore affect all other links to the same connector.
+    'n_connector_links': (populate_connector_stats_summary, """
+        WITH changed AS (
+            SELECT tc.connector_id, tc.creation_time
+            FROM treenode_connector tc
+            WHERE tc.project_id = %(project_id)s
+              AND tc.edition_time >= %(since)s
+            UNION ALL
+            SELECT tch.connector_id, tch.creation_time
+            FROM treenode_connector__history tch
+            WHERE tch.project_id = %(project_id)s
+              AND upper(tch.sys_period) >= %(since)s
+        )
+        SELECT date_trunc('hour', c.creation_time)
+        FROM changed c
+        UNION
+        SELECT date_trunc('hour', tc.creation_time)
+        FROM treenode_connector tc
+        JOIN (SELECT DISTINCT connector_id FROM changed) c
+          ON c.connector_id = tc.connector_id
+    """),
+    # The cable of a node is the length of the edge to its parent, which
+    # changes as well if the parent is moved.
+    'cable_length': (populate_cable_stats_summary, _nodecount_touched_hours + """
+        UNION
+        SELECT date_trunc('hour', c.creation_time)
+        FROM treenode p
+        JOIN treenode c
+          ON c.parent_id = p.id
+        WHERE p.project_id = %(project_id)s
+          AND p.edition_time >= %(since)s
+    """),
+    'n_treenodes': (populate_nodecount_stats_summary, _nodecount_touched_hours),
+    'n_imported_treenodes': (populate_import_nodecount_stats_summary, _import_touched_hours),
+    'import_cable_length': (populate_import_cable_stats_summary, _import_touched_hours),
+}
+
+
+def refresh_project_stats_summary(project_id, clean:bool=False) -> List[Dict[str, Any]]:
+    """Update the statistics summary of a project in a single transaction and
+    return a report with the number of written rows and the duration for each
+    statistic. Each statistic has its own watermark in the table
+    catmaid_stats_summary_watermark: all changes before it are reflected in the
+    summary. Only the hours touched by changes after the watermark are
+    recomputed. Without a watermark, the statistic is updated like
+    populate_stats_summary() does it, from the last summary entry on.
+    """
+    report = []
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT date_trunc('hour', CURRENT_TIMESTAMP)
+        """)
+        new_watermark = cursor.fetchone()[0]
+
+        if clean:
+            cursor.execute("""
+                DELETE FROM catmaid_stats_summary WHERE project_id = %(project_id)s;
+                DELETE FROM catmaid_stats_summary_watermark WHERE project_id = %(project_id)s;
+            """, dict(project_id=project_id))
+
+        cursor.execute("""
+            SELECT statistic, watermark
+            FROM catmaid_stats_summary_watermark
+            WHERE project_id = %(project_id)s
+        """, dict(project_id=project_id))
+        watermarks = dict(cursor.fetchall())
+
+        for statistic, (populate, touched_hours_query) in STATS_SUMMARY_STATISTICS.items():
+            start = time.perf_counter()
+            watermark = watermarks.get(statistic)
+            hours = None
+            if clean:
+                mode = 'full'
+                n_rows = populate(project_id, False, cursor)
+            elif watermark is None:
+                mode = 'incremental'
+                n_rows = populate(project_id, True, cursor)
+            else:
+                mode = 'hours'
+                cursor.execute(touched_hours_query, dict(project_id=project_id,
+                        since=watermark - STATS_WATERMARK_OVERLAP))
+                # The current hour is still changing, it is looked at again
+                # in the next run.
+                hours = sorted(row[0] for row in cursor.fetchall()
+                        if row[0] is not None and row[0] < new_watermark)
+                n_rows = 0
+                if hours:
+                    # Entries without any remaining data in a touched hour
+                    # aren't part of the recomputation, reset them first.
+                    cursor.execute(f"""
+                        UPDATE catmaid_stats_summary
+                        SET {statistic} = 0
+                        WHERE project_id = %(project_id)s
+                          AND date = ANY(%(hours)s::timestamptz[])
+                          AND {statistic} <> 0
+                    """, dict(project_id=project_id, hours=hours))
+                    n_rows = populate(project_id, cursor=cursor, hours=hours)
+
+            cursor.execute("""
+                INSERT INTO catmaid_stats_summary_watermark (project_id,
+                    statistic, watermark)
+                VALUES (%(project_id)s, %(statistic)s, %(watermark)s)
+                ON CONFLICT (project_id, statistic) DO UPDATE
+                SET watermark = EXCLUDED.watermark
+            """, dict(project_id=project_id, statistic=statistic,
+                    watermark=new_watermark))
+
+            report.append({
+                'project_id': project_id,
+                'statistic': statistic,
+                'mode': mode,
+                'n_hours': None if hours is None else len(hours),
+                'n_rows': n_rows,
+                'duration': time.perf_counter() - start,
+            })
+
+    return report
+
+
+def refresh_stats_summary(project_ids, clean:bool=False, n_workers:int=1,
+        log=None) -> List[Dict[str, Any]]:
+    """Refresh the statistics summary of multiple projects, using a pool of
+    worker threads with their own database connections. Returns the combined
+    report of all projects.
+    """
+    if not log:
+        log = lambda x: None
+
+    def refresh(project_id):
+        try:
+            project_report = refresh_project_stats_summary(project_id, clean)
+            log(f'Computed statistics for project {project_id}')
+            return project_report
+        finally:
+            if n_workers > 1:
+                connection.close()
+
+    report:List[Dict[str, Any]] = []
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for project_report in executor.map(refresh, project_ids):
+                report.extend(project_report)
+    else:
+        for project_id in project_ids:
+            report.extend(refresh(project_id))
+
+    return report
 
 
 class ServerStats(APIView):
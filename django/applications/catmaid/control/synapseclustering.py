@@ -4,110 +4,223 @@ from collections import namedtuple
 import logging
 import networkx as nx
 import numpy as np
-from numpy import array, float32
-from numpy.linalg import norm
-from typing import Any, DefaultDict, Dict, List, NamedTuple, Tuple
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.tree_util import ArrayTree
+from catmaid.models import TreenodeConnector, ClassInstance, Relation
 
 logger = logging.getLogger(__name__)
 
-try:
-    from scipy.sparse.csgraph import dijkstra
-except ImportError:
-    logger.warning("CATMAID was unable to load the scipy module. "
-        "Synapse clustering won't be available")
+# Synapses contribute to the density of nodes up to this many bandwidths away,
+# beyond that their contribution would be below exp(-16), i.e. 1e-7.
+DENSITY_KERNEL_CUTOFF = 4.0
 
-from catmaid.control.common import get_relation_to_id_map
-from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
+SynapseGroup:NamedTuple = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
 
 
 def synapse_clustering(skeleton_id, h_list) -> Dict:
 
-    Gwud = createSpatialGraphFromSkeletonID( skeleton_id )
+    tree = ArrayTree.from_skeleton(skeleton_id, with_locations=True)
     synNodes, connector_ids, relations = synapseNodesFromSkeletonID( skeleton_id )
 
-    return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
+    return array_tree_max_density(tree, synNodes, connector_ids, relations, h_list)
 
 
-def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list) -> Dict:
-    """ Gwud: networkx graph were the edges are weighted by length, and undirected.
+class TreeDensityField(object):
+    """The kernel density of synapses along the cable of a tree. Rather than
+    computing the distance of every node to every synapse, the distances are
+    found by walking outwards along the tree from all synapses at once, up to
+    the cutoff distance of the largest bandwidth seen so far. The reached
+    (node, distance) pairs are kept, so that a larger bandwidth only needs to
+    walk the additional distance.
+    """
+
+    def __init__(self, tree:ArrayTree, synapse_indices,
+            edge_lengths:Optional[np.ndarray]=None,
+            cutoff:float=DENSITY_KERNEL_CUTOFF):
+        self.n_nodes = len(tree)
+        self.cutoff = cutoff
+        if edge_lengths is None:
+            edge_lengths = tree.edge_lengths
+
+        # Undirected adjacency in CSR form: parents and children of each node.
+        child = np.flatnonzero(tree.parents >= 0)
+        parent = tree.parents[child]
+        source = np.concatenate([child, parent])
+        order = np.argsort(source, kind='stable')
+        self.adj_idx = np.concatenate([parent, child])[order].astype(np.int32)
+        self.adj_len = np.concatenate([edge_lengths[child]] * 2)[order]
+        self.adj_ptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=self.n_nodes), out=self.adj_ptr[1:])
+
+        # Each synapse node counts once, no matter how many links it has.
+        start = np.unique(np.asarray(synapse_indices, dtype=np.int32))
+        self.frontier = (start, np.full(len(start), -1, dtype=np.int32),
+                np.zeros(len(start)))
+        self.radius = 0.0
+        self.pair_nodes = np.zeros(0, dtype=np.int32)
+        self.pair_dists = np.zeros(0, dtype=np.float32)
+
+    def expand(self, radius:float) -> None:
+        """Find all (node, synapse distance) pairs up to the passed in radius.
+        """
+        if radius <= self.radius:
+            return
+        nodes, prev, dists = self.frontier
+        pair_nodes = [self.pair_nodes]
+        pair_dists = [self.pair_dists]
+        outside:List[Tuple] = []
+        adj_ptr, adj_idx, adj_len = self.adj_ptr, self.adj_idx, self.adj_len
+        while len(nodes):
+            inside = dists <= radius
+            outside.append((nodes[~inside], prev[~inside], dists[~inside]))
+            nodes, prev, dists = nodes[inside], prev[inside], dists[inside]
+            pair_nodes.append(nodes)
+            pair_dists.append(dists.astype(np.float32))
+
+            # Step to all neighbors, except for the one we came from.
+            starts = adj_ptr[nodes]
+            counts = adj_ptr[nodes + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + \
+                    np.arange(counts.sum())
+            owners = np.repeat(np.arange(len(nodes)), counts)
+            neighbors = adj_idx[offsets]
+            forward = neighbors != prev[owners]
+            owners, offsets = owners[forward], offsets[forward]
+            nodes, prev, dists = neighbors[forward], nodes[owners], \
+                    dists[owners] + adj_len[offsets]
+
+        self.frontier = tuple(np.concatenate(a) for a in zip(*outside)) \
+                if outside else self.frontier
+        self.pair_nodes = np.concatenate(pair_nodes)
+        self.pair_dists = np.concatenate(pair_dists)
+        self.radius = radius
+
+    def density(self, h:float) -> np.ndarray:
+        """The density of synapses for every node, using a Gaussian kernel with
+        bandwidth h that is cut off at DENSITY_KERNEL_CUTOFF * h.
+        """
+        radius = self.cutoff * h
+        self.expand(radius)
+        near = self.pair_dists <= radius
+        d = self.pair_dists[near].astype(np.float64)
+        return np.bincount(self.pair_nodes[near], weights=np.exp(-d * d / (h * h)),
+                minlength=self.n_nodes)
+
+    def local_maxima(self, density:np.ndarray) -> np.ndarray:
+        """For every node, the node reached by repeatedly moving to the
+        neighbor with the highest density, as long as it is higher than the
+        current node's density.
+        """
+        n = self.n_nodes
+        uphill = np.arange(n)
+        if not len(self.adj_idx):
+            return uphill
+        degrees = np.diff(self.adj_ptr)
+        owners = np.repeat(np.arange(n), degrees)
+        neighbor_density = density[self.adj_idx]
+        has_neighbors = degrees > 0
+        best = np.full(n, -np.inf)
+        best[has_neighbors] = np.maximum.reduceat(neighbor_density,
+                self.adj_ptr[:-1][has_neighbors])
+
+        # The first neighbor with the highest density of each node
+        candidates = np.flatnonzero(neighbor_density == best[owners])
+        _, first = np.unique(owners[candidates], return_index=True)
+        candidates = candidates[first]
+        sources = owners[candidates]
+        move = best[sources] > density[sources]
+        uphill[sources[move]] = self.adj_idx[candidates[move]]
+
+        # Follow the uphill pointers to the local maxima
+        while True:
+            following = uphill[uphill]
+            if np.array_equal(following, uphill):
+                return uphill
+            uphill = following
+
+
+def array_tree_max_density(tree:ArrayTree, synNodes, connector_ids, relations,
+        h_list, edge_lengths:Optional[np.ndarray]=None,
+        timings:Optional[Dict]=None) -> Dict:
+    """ tree: ArrayTree, edge lengths are computed from node locations, unless
+            edge_lengths are passed in.
         synNodes: list of node IDs where there is a synapse.
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
+        timings: optional dictionary that is filled with the time in seconds
+            needed for each bandwidth.
+
+        Returns a dictionary of bandwidth vs a dictionary of group index vs
+        SynapseGroup.
     """
+    if any(h <= 0 for h in h_list):
+        raise ValueError("Bandwidths need to be positive")
 
-    D, id2index = distanceMatrix(Gwud, synNodes)
+    syn_indices = tree.indices(synNodes)
+    field = TreeDensityField(tree, syn_indices, edge_lengths)
 
-    SynapseGroup:NamedTuple = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups:Dict = {}
-
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-
-        targLoc:Dict = {}           # targLocs hosts the final destination nodes of the hill climbing
-        densityField:Dict = {}      # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:
-                currNode = startNode
-                allOnPath = []
-
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-
-                while True:
-                    allOnPath.append(currNode)
-
-                    # Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-
-                    for nn in Gwud.neighbors( currNode ):
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-
-                    if currNode == prevNode:
-                        break
-
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
-
-        loc2group = {}
-
-        synapseGroups[h] = {}
-        for ind, val in enumerate(uniqueTargs):
-            loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
-
-        for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
-            synapseGroups[h][ gi ].node_ids.append( node )
-            synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
-            synapseGroups[h][ gi ].relations.append( relations[ind] )
-
-    return synapseGroups
-
-def distanceMatrix(G, synNodes) -> Tuple[Any, Dict]:
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat:Dict = {}
-    nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
-
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
-
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+    # Bandwidths are processed from small to large, so that each one only
+    # needs to walk the additional distance.
+    for h in sorted(set(h_list)):
+        start = time.perf_counter()
+        targets = field.local_maxima(field.density(h))[syn_indices]
+
+        target_ids = tree.node_ids[targets].tolist()
+        uniqueTargs = set(target_ids)
+        loc2group = {t: i for i, t in enumerate(uniqueTargs)}
+        groups = {i: SynapseGroup([], [], [], t) for t, i in loc2group.items()}
+        for ind, (node, target) in enumerate(zip(synNodes, target_ids)):
+            group = groups[loc2group[target]]
+            group.node_ids.append(node)
+            group.connector_ids.append(connector_ids[ind])
+            group.relations.append(relations[ind])
+        synapseGroups[h] = groups
+
+        duration = time.perf_counter() - start
+        if timings is not None:
+            timings[h] = duration
+        logger.debug(f'Synapse density with bandwidth {h}: {len(groups)} '
+                f'groups, {len(field.pair_nodes)} node-synapse pairs, {duration:.3f}s')
+
+    return {h: synapseGroups[h] for h in h_list}
+
+
+def graph_as_array_tree(graph) -> Tuple[ArrayTree, np.ndarray]:
+    """Create an ArrayTree from an undirected networkx graph, whose edges have
+    a 'weight' attribute, along with the edge length of each node.
+    """
+    node_ids:List = []
+    parent_ids:List = []
+    weights:List = []
+    for component in nx.connected_components(graph):
+        root = next(iter(component))
+        node_ids.append(root)
+        parent_ids.append(-1)
+        weights.append(0.0)
+        for parent, child in nx.bfs_edges(graph, root):
+            node_ids.append(child)
+            parent_ids.append(parent)
+            weights.append(graph[parent][child].get('weight', 1.0))
+    return ArrayTree(node_ids, parent_ids), np.array(weights)
+
+
+def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list,
+        timings:Optional[Dict]=None) -> Dict:
+    """ Gwud: networkx graph were the edges are weighted by length, and undirected.
+        synNodes: list of node IDs where there is a synapse.
+        connector_ids: list of connector IDs.
+        relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
+        The three lists are synchronized by index.
+        See array_tree_max_density().
+    """
+    tree, edge_lengths = graph_as_array_tree(Gwud)
+    return array_tree_max_density(tree, synNodes, connector_ids, relations,
+            h_list, edge_lengths, timings)
 
 def countTargets(skeleton_id, pid) -> Dict:
     nTargets = {}
@@ -119,21 +232,6 @@ def countTargets(skeleton_id, pid) -> Dict:
             nTargets[cid] = TreenodeConnector.objects.filter(connector_id=cid,relation_id=PRE).count()
     return nTargets
 
-def createSpatialGraphFromSkeletonID(sid) -> nx.Graph:
-    # retrieve all nodes of the skeleton
-    treenode_qs = Treenode.objects.filter(skeleton_id=sid).values_list(
-        'id', 'parent_id', 'location_x', 'location_y', 'location_z')
-    # build the networkx graph from it
-    G = nx.Graph()
-    locations = {}
-    for tnid, parent_id, location_x, location_y, location_z in treenode_qs:
-        if parent_id:
-            G.add_edge(parent_id, tnid)
-        locations[tnid] = array((location_x, location_y, location_z), dtype=float32)
-    for iFrom, iTo in G.edges(data=False):
-        G[iFrom][iTo]['weight'] = norm(locations[iFrom] - locations[iTo])
-    return G
-
 def synapseNodesFromSkeletonID(sid) -> Tuple[List, List, List]:
     sk = ClassInstance.objects.get(pk=sid)
     pid = sk.project_id
@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
 
 import base64
-from contextlib import closing
+from collections import OrderedDict
+from contextlib import closing, contextmanager
 from io import BytesIO
 import logging
 import numpy as np
 import os
 import math
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from django.conf import settings
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse
 
 from catmaid.models import UserRole, TileSourceTypes
-from catmaid.control.common import ConfigurationError, get_request_bool
+from catmaid.control.common import (ConfigurationError, get_request_bool,
+        get_request_list)
 from catmaid.control.authentication import requires_user_role
 
 
@@ -72,43 +77,322 @@ def get_tile(request:HttpRequest, project_id=None, stack_id=None) -> HttpRespons
     return tile
 
 
+class HDF5FilePool(object):
+    """A bounded pool of read-only HDF5 file handles. A handle is reopened if
+    the modification time of its file changed since it was opened. If more
+    than max_size files are open, the least recently used one is closed.
+    Handles are only used while holding the pool's lock, so that they can't be
+    closed while in use. Since h5py serializes all file access anyway, this
+    doesn't limit concurrency.
+    """
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.handles:OrderedDict = OrderedDict()
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def open(self, path) -> Iterator[Any]:
+        """Provide an open HDF5 file handle for the passed in path. Raises an
+        OSError if the file doesn't exist.
+        """
+        with self.lock:
+            mtime = os.stat(path).st_mtime
+            entry = self.handles.get(path)
+            if entry is not None and entry[0] == mtime:
+                self.handles.move_to_end(path)
+                hfile = entry[1]
+            else:
+                self.invalidate(path)
+                hfile = h5py.File(path, 'r')
+                self.handles[path] = (mtime, hfile)
+                while len(self.handles) > max(1, self.max_size):
+                    _, (_, evicted) = self.handles.popitem(last=False)
+                    evicted.close()
+            yield hfile
+
+    def invalidate(self, path) -> None:
+        with self.lock:
+            entry = self.handles.pop(path, None)
+            if entry is not None:
+                entry[1].close()
+
+    def clear(self) -> None:
+        with self.lock:
+            for _, hfile in self.handles.values():
+                hfile.close()
+            self.handles.clear()
+
+
+class EncodedTileCache(object):
+    """A size-bounded LRU cache for encoded tiles. The size is measured in
+    bytes of encoded data.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries:OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key) -> Optional[bytes]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value:bytes) -> None:
+        if len(value) > self.max_size:
+            return
+        with self.lock:
+            old_value = self.entries.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+# Supported output formats of HDF5 tiles, mapped from file extensions to PIL
+# format name and content type. Raw tiles are the uint8 tile data in row-major
+# order.
+hdf5_tile_formats = {
+    'png': ('PNG', 'image/png'),
+    'jpg': ('JPEG', 'image/jpeg'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'raw': (None, 'application/octet-stream'),
+}
+
+_hdf5_file_pool:Optional[HDF5FilePool] = None
+_hdf5_tile_cache:Optional[EncodedTileCache] = None
+_hdf5_lock = threading.Lock()
+
+
+def get_hdf5_file_pool() -> HDF5FilePool:
+    """Get the HDF5 file handle pool of this process.
+    """
+    global _hdf5_file_pool
+    if _hdf5_file_pool is None:
+        with _hdf5_lock:
+            if _hdf5_file_pool is None:
+                _hdf5_file_pool = HDF5FilePool(settings.HDF5_FILE_POOL_SIZE)
+    return _hdf5_file_pool
+
+
+def get_hdf5_tile_cache() -> Optional[EncodedTileCache]:
+    """Get the encoded HDF5 tile cache of this process or None if it is
+    disabled (HDF5_TILE_CACHE_SIZE = 0).
+    """
+    global _hdf5_tile_cache
+    if not settings.HDF5_TILE_CACHE_SIZE:
+        return None
+    if _hdf5_tile_cache is None:
+        with _hdf5_lock:
+            if _hdf5_tile_cache is None:
+                _hdf5_tile_cache = EncodedTileCache(settings.HDF5_TILE_CACHE_SIZE)
+    return _hdf5_tile_cache
+
+
+def read_hdf5_tile(hfile, scale, height, width, x, y, z) -> np.ndarray:
+    """Read a (height, width) uint8 array from the passed in HDF5 file. Parts
+    of the tile that are outside of the data set are zero.
+    """
+    data = np.zeros((height, width), dtype=np.uint8)
+    scale_key = str(int(scale))
+    if not scale_key in hfile['/'].keys():
+        return data
+    hdfpath = '/' + scale_key + '/' + str(z) + '/data'
+    if hdfpath not in hfile:
+        return data
+    image_data = hfile[hdfpath]
+    # Only read the part of the tile that intersects with the data set.
+    y_end = min(y + height, image_data.shape[0])
+    x_end = min(x + width, image_data.shape[1])
+    y_start, x_start = max(y, 0), max(x, 0)
+    if y_end > y_start and x_end > x_start:
+        data[(y_start - y):(y_end - y), (x_start - x):(x_end - x)] = \
+                image_data[y_start:y_end, x_start:x_end]
+    return data
+
+
+def encode_hdf5_tile(data:np.ndarray, file_extension) -> bytes:
+    """Encode a (height, width) uint8 array in the format of the passed in
+    file extension.
+    """
+    pil_format, _ = hdf5_tile_formats[file_extension]
+    if pil_format is None:
+        return data.tobytes()
+    height, width = data.shape
+    if pil_format == 'PNG':
+        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
+    else:
+        pilImage = Image.frombuffer('L',(width,height),data,'raw','L',0,1)
+    buf = BytesIO()
+    pilImage.save(buf, pil_format)
+    return buf.getvalue()
+
+
 def get_hdf5_tile(project_id, stack_id, scale, height, width, x, y, z, col, row,
         file_extension, basename):
+    """Get a tile from the HDF5 file of the passed in stack and base name.
+    Open files are kept in a per process pool and encoded tiles are cached,
+    both are invalidated if the file's modification time changes. Supported
+    file extensions are "png", "jpg" and "raw" (uint8 data in row-major order),
+    PNG is used for all others.
+    """
     if not tile_loading_enabled:
         raise ConfigurationError("HDF5 tile loading is currently disabled")
+    file_extension = file_extension.lower()
+    # Other formats fall back to PNG, which used to be the only format.
+    if file_extension not in hdf5_tile_formats:
+        file_extension = 'png'
+    _, content_type = hdf5_tile_formats[file_extension]
+
     # need to know the stack name
     fpath=os.path.join(settings.HDF5_STORAGE_PATH, f'{project_id}_{stack_id}_{basename}.hdf')
 
-    if not os.path.exists( fpath ):
-        data=np.zeros( (height, width) )
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-
-    with closing(h5py.File(fpath, 'r')) as hfile:
-        # import math
-        # zoomlevel = math.log(int(scale), 2)
-        hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
-        if not str(int(scale)) in hfile['/'].keys():
-            data=np.zeros( (height, width) )
-            pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-            response = HttpResponse(content_type="image/png")
-            pilImage.save(response, "PNG")
-            return response
-        image_data=hfile[hdfpath]
-        data=image_data[y:y+height,x:x+width]
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
+    try:
+        mtime:Optional[float] = os.stat(fpath).st_mtime
+    except FileNotFoundError:
+        mtime = None
+
+    cache = get_hdf5_tile_cache()
+    # Missing files are cached with a None file modification time.
+    cache_key = (fpath, mtime, int(scale), z, x, y, width, height, file_extension)
+    tile = cache.get(cache_key) if cache else None
+    if tile is None:
+        if mtime is None:
+            data = np.zeros((height, width), dtype=np.uint8)
+        else:
+            with get_hdf5_file_pool().open(fpath) as hfile:
+                data = read_hdf5_tile(hfile, scale, height, width, x, y, z)
+        tile = encode_hdf5_tile(data, file_extension)
+        if cache:
+            cache.put(cache_key, tile)
+
+    return HttpResponse(tile, content_type=content_type)
+
+
+class CloudVolumePool(object):
+    """A process wide pool of CloudVolume handles, keyed by the volume's base
+    name, the mip level and the fill_missing and cache options. Creating a
+    handle requires reading the volume's meta data, which would otherwise
+    happen for every tile. The available mip levels of each volume are cached
+    as well. Handles expire after a configurable time to live, so that changes
+    to a volume are picked up eventually.
+    """
 
-    return response
+    def __init__(self, ttl=300, max_size=32):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.handles:OrderedDict = OrderedDict()
+        self.scales:Dict[str, Tuple[float, List[int]]] = dict()
+        self.lock = threading.Lock()
+
+    def get(self, basename, mip, fill_missing=False, cache=True) -> Any:
+        """Get a CloudVolume handle for the passed in volume and mip level.
+        """
+        key = (basename, mip, fill_missing, cache)
+        now = time.time()
+        with self.lock:
+            entry = self.handles.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self.handles.move_to_end(key)
+                    return entry[1]
+                del self.handles[key]
+
+        # Handles are created outside of the lock, because this requires I/O.
+        cv = cloudvolume.CloudVolume(basename, use_https=True, parallel=False,
+                cache=cache, mip=mip, bounded=False, fill_missing=fill_missing)
 
+        with self.lock:
+            self.handles[key] = (now, cv)
+            self.handles.move_to_end(key)
+            while len(self.handles) > self.max_size:
+                self.handles.popitem(last=False)
+        return cv
 
-def get_cloudvolume_tile(project_id, stack_id, scale, height, width, x, y, z,
-        col, row, file_extension='png', basename=None, fill_missing=False,
-        cache=True, upscale=False):
+    def get_available_mips(self, basename, fill_missing=False, cache=True) -> List[int]:
+        """Get the mip levels that are available for the passed in volume.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.scales.get(basename)
+            if entry is not None and now - entry[0] <= self.ttl:
+                return entry[1]
+
+        mips = sorted(self.get(basename, 0, fill_missing, cache).available_mips)
+
+        with self.lock:
+            self.scales[basename] = (now, mips)
+        return mips
+
+    def get_closest(self, basename, mip, fill_missing=False, cache=True) -> Tuple[Any, int]:
+        """Get a CloudVolume handle for the available mip level that is closest
+        to the requested one. Returns a tuple of the handle and its mip level.
+        """
+        available_mips = self.get_available_mips(basename, fill_missing, cache)
+        if mip not in available_mips:
+            # Find mip closest to the request
+            min_mip = None
+            min_mip_dist = float('infinity')
+            for ex_mip in available_mips:
+                if abs(mip - ex_mip) < min_mip_dist:
+                    min_mip = ex_mip
+                    min_mip_dist = abs(mip - ex_mip)
+
+            if min_mip is None:
+                raise ValueError('No fitting scale level found')
+            logger.info(f'Need to use extra scaling, because mip level {mip} is not available')
+            mip = min_mip
+
+        return self.get(basename, mip, fill_missing, cache), mip
+
+    def clear(self) -> None:
+        with self.lock:
+            self.handles.clear()
+            self.scales.clear()
+
+
+# The maximum area, in tiles, that a single batch tile request can cover
+MAX_BATCH_TILES = 256
+
+_cloudvolume_pool:Optional[CloudVolumePool] = None
+_cloudvolume_pool_lock = threading.Lock()
+
+
+def get_cloudvolume_pool() -> CloudVolumePool:
+    """Get the CloudVolume handle pool of this process.
+    """
+    global _cloudvolume_pool
+    if _cloudvolume_pool is None:
+        with _cloudvolume_pool_lock:
+            if _cloudvolume_pool is None:
+                _cloudvolume_pool = CloudVolumePool(
+                        ttl=settings.CLOUDVOLUME_HANDLE_TTL,
+                        max_size=settings.CLOUDVOLUME_HANDLE_POOL_SIZE)
+    return _cloudvolume_pool
+
+
+def get_cloudvolume_cutout(basename, scale, height, width, x, y, z,
+        fill_missing=False, cache=True, upscale=False) -> Tuple[Any, float]:
+    """Read a 2D cutout in the XY plane of section z from a CloudVolume. The
+    requested area is expected in the pixel space of the passed in scale. If
+    no mip level for this scale is available, the cutout is read from the
+    closest available one. Returns a tuple of the (height, width) data array,
+    with height and width relative to the mip level used, and the effective
+    scale, which is the factor to apply to the requested coordinates to get
+    to that mip level.
+    """
     if not cv_tile_loading_enabled:
         raise ConfigurationError("CloudVolume tile loading is currently disabled")
 
@@ -116,36 +400,15 @@ def get_cloudvolume_tile(project_id, stack_id, scale, height, width, x, y, z,
         mip = math.ceil(abs(math.log(scale) / math.log(2)))
     else:
         mip = math.floor(abs(math.log(scale) / math.log(2)))
-    scale_to_fit = False
+
+    cv, cv_mip = get_cloudvolume_pool().get_closest(basename, mip,
+            fill_missing, cache)
     effective_scale = 1.0
-    voxel_offset = (0, 0, 0)
-    try:
-        cv = cloudvolume.CloudVolume(basename, use_https=True, parallel=False,
-                cache=cache, mip=mip, bounded=False, fill_missing=fill_missing)
-        cutout = cv[x:(x + width), y:(y + height), z]
-    except cloudvolume.exceptions.ScaleUnavailableError as e:
-        logger.info(f'Need to use extra scaling, because mip level {mip} is not available: {e}')
-        cv_test = cloudvolume.CloudVolume(basename, use_https=True, parallel=False,
-                cache=cache, bounded=False, fill_missing=fill_missing)
-        # Find mip closest to the request
-        min_mip = None
-        min_mip_dist = float('infinity')
-        for ex_mip in cv_test.available_mips:
-            if abs(mip - ex_mip) < min_mip_dist:
-                min_mip = ex_mip
-                min_mip_dist = abs(mip - ex_mip)
-
-        if min_mip is None:
-            raise ValueError('No fitting scale level found')
-
-        # Get volume with best fit
-        cv = cloudvolume.CloudVolume(basename, use_https=True, parallel=False,
-                cache=cache, mip=min_mip, bounded=False, fill_missing=fill_missing)
-        effective_scale = 2**mip / 2**min_mip
+    if cv_mip != mip:
+        effective_scale = 2**mip / 2**cv_mip
 
         # TODO: Correctly walk downsample factors / scale levels in each
         # dimensions for exact scaling in non power-of-two scale pyramids.
-        scale_to_fit = True
         x, y = math.floor(x * effective_scale), math.floor(y * effective_scale)
         width, height = math.ceil(width * effective_scale), math.ceil(height * effective_scale)
 
@@ -156,20 +419,100 @@ def get_cloudvolume_tile(project_id, stack_id, scale, height, width, x, y, z,
     ]
 
     if cutout is None:
-        data = np.zeros((height, width))
+        data = np.zeros((height, width), dtype=np.uint8)
     else:
-        data = np.transpose(cutout[:,:,0,0])
+        data = np.ascontiguousarray(np.transpose(cutout[:,:,0,0]))
+
+    return data, effective_scale
+
 
+def make_cloudvolume_image(data, effective_scale=1.0) -> Any:
+    """Create a PIL image from 2D CloudVolume data and scale it to the
+    requested size, if the data was read from a different mip level.
+    """
+    height, width = data.shape[:2]
     img = Image.frombuffer('RGBA', (width, height), data, 'raw', 'L', 0, 1)
 
-    if scale_to_fit:
+    if effective_scale != 1.0:
         img = img.resize((math.ceil(width / effective_scale), math.ceil(height / effective_scale)))
 
+    return img
+
+
+def get_cloudvolume_tile(project_id, stack_id, scale, height, width, x, y, z,
+        col, row, file_extension='png', basename=None, fill_missing=False,
+        cache=True, upscale=False):
+    data, effective_scale = get_cloudvolume_cutout(basename, scale, height,
+            width, x, y, z, fill_missing, cache, upscale)
+    img = make_cloudvolume_image(data, effective_scale)
+
     response = HttpResponse(content_type=f"image/{file_extension.lower()}")
     img.save(response, file_extension.upper())
     return response
 
 
+@requires_user_role([UserRole.Browse])
+def get_tiles(request:HttpRequest, project_id=None, stack_id=None) -> JsonResponse:
+    """Get multiple tiles of the same size of a single section at once.
+
+    All tiles are created from a single cutout of the bounding box of the
+    requested tiles, which saves per-request overhead of back-end tile
+    sources. The list of tiles is expected in the "tiles" parameter as a list
+    of [x, y] pixel offsets in the requested scale, e.g. tiles[0][0]=0,
+    tiles[0][1]=0, tiles[1][0]=512, tiles[1][1]=0. Each tile has the passed in
+    width and height. The result is a list of objects of the form {x: <x>, y:
+    <y>, image: <base64 encoded image>}. Currently only the "cloudvolume"
+    format is supported.
+    """
+    scale = float(request.GET.get('scale', '0'))
+    height = int(request.GET.get('height', '0'))
+    width = int(request.GET.get('width', '0'))
+    z = int(request.GET.get('z', '0'))
+    file_extension = request.GET.get('file_extension', 'png')
+    basename = request.GET.get('basename', 'raw')
+    data_format = request.GET.get('format', 'cloudvolume')
+    upscale = get_request_bool(request.GET, 'upscale', False)
+    tiles = get_request_list(request.GET, 'tiles', [], map_fn=int)
+
+    if data_format != 'cloudvolume':
+        raise ValueError(f'Unsupported data format for batch requests: {data_format}')
+    if not tiles:
+        raise ValueError('Need at least one tile')
+    if width <= 0 or height <= 0:
+        raise ValueError('Need positive tile width and height')
+
+    x_min = min(t[0] for t in tiles)
+    y_min = min(t[1] for t in tiles)
+    x_max = max(t[0] for t in tiles) + width
+    y_max = max(t[1] for t in tiles) + height
+    if (x_max - x_min) * (y_max - y_min) > MAX_BATCH_TILES * width * height:
+        raise ValueError(f'The requested tiles span an area larger than '
+                f'{MAX_BATCH_TILES} tiles')
+
+    data, effective_scale = get_cloudvolume_cutout(basename, scale,
+            y_max - y_min, x_max - x_min, x_min, y_min, z, upscale=upscale)
+
+    result = []
+    for tile_x, tile_y in tiles:
+        # The tile's bounding box relative to the cutout, in the pixel space of
+        # the mip level the data was read from.
+        dx = math.floor((tile_x - x_min) * effective_scale)
+        dy = math.floor((tile_y - y_min) * effective_scale)
+        tile_data = data[dy:(dy + math.ceil(height * effective_scale)),
+                dx:(dx + math.ceil(width * effective_scale))]
+        img = make_cloudvolume_image(np.ascontiguousarray(tile_data),
+                effective_scale)
+        buf = BytesIO()
+        img.save(buf, file_extension.upper())
+        result.append({
+            'x': tile_x,
+            'y': tile_y,
+            'image': base64.b64encode(buf.getvalue()).decode('ascii'),
+        })
+
+    return JsonResponse(result, safe=False)
+
+
 @requires_user_role([UserRole.Annotate])
 def put_tile(request:HttpRequest, project_id=None, stack_id=None) -> HttpResponse:
     """ Store labels to HDF5 """
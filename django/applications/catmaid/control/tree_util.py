@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 
-# A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+# A 'tree' is a networkx.DiGraph with a single root node (a node without
+# parents). Alternatively, an ArrayTree stores a tree (or forest) in NumPy
+# arrays, which needs much less memory and allows vectorized traversals.
 import networkx as nx
+import numpy as np
 
 from collections import defaultdict
 from itertools import islice
 from math import sqrt
 from operator import itemgetter
-from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple
+from typing import (Any, DefaultDict, Dict, Iterator, List, Optional, Set,
+        Tuple)
+
+from django.db import connection
 
 from catmaid.control.common import is_empty
 from catmaid.models import Treenode
@@ -228,3 +234,420 @@ def lazy_load_trees(skeleton_ids, node_properties):
 
     if tree:
         yield (skid, tree)
+
+
+def get_path_sums(parents:np.ndarray, values:np.ndarray) -> np.ndarray:
+    """For every node of a forest, represented by an array of parent indices
+    with -1 for root nodes, sum the passed in per-node values along the path
+    from the node to its root, including the node itself. This uses pointer
+    jumping, which needs O(log(depth)) vectorized steps.
+    """
+    totals = values.copy()
+    ancestors = parents.copy()
+    active = np.flatnonzero(ancestors >= 0)
+    while active.size:
+        # Both the totals and the ancestors of the previous step are used.
+        totals[active] += totals[ancestors[active]]
+        ancestors[active] = ancestors[ancestors[active]]
+        active = active[ancestors[active] >= 0]
+    return totals
+
+
+class ArrayTree(object):
+    """A tree (or forest) of nodes, stored in NumPy arrays. Nodes are referred
+    to by their index, i.e. their position in the node_ids array, which keeps
+    the order in which nodes were passed in. Use index() and indices() to map
+    node IDs to indices and node_ids[...] for the reverse.
+
+    node_ids: int64 node IDs
+    parents: int32 parent index of each node, -1 for roots
+    child_ptr, child_idx: children of node i are child_idx[child_ptr[i]:child_ptr[i+1]],
+        in the order of the nodes
+    locations: optional float32 (n, 3) array of node positions
+
+    Trees are immutable, operations like reroot() and extract() return a new
+    tree. Derived arrays like depths are computed on first use.
+    """
+
+    def __init__(self, node_ids, parent_ids, locations=None):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        n = len(self.node_ids)
+        self._sorter = np.argsort(self.node_ids, kind='stable').astype(np.int32)
+        self._sorted_ids = self.node_ids[self._sorter]
+
+        # Map parent IDs to indices, unknown parents make a node a root.
+        parent_ids = np.asarray(parent_ids, dtype=np.int64)
+        if n:
+            pos = np.minimum(np.searchsorted(self._sorted_ids, parent_ids), n - 1)
+            parents = self._sorter[pos]
+            parents[(parent_ids < 0) | (self._sorted_ids[pos] != parent_ids)] = -1
+        else:
+            parents = np.zeros(0, dtype=np.int32)
+        self._init_structure(parents.astype(np.int32))
+
+        self.locations = None if locations is None else \
+                np.asarray(locations, dtype=np.float32).reshape(n, 3)
+
+    def _init_structure(self, parents:np.ndarray) -> None:
+        self.parents = parents
+        n = len(parents)
+        has_parent = parents >= 0
+        self.child_idx = np.flatnonzero(has_parent)
+        self.child_idx = self.child_idx[np.argsort(parents[self.child_idx],
+                kind='stable')].astype(np.int32)
+        self.child_ptr = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(np.bincount(parents[has_parent], minlength=n),
+                out=self.child_ptr[1:])
+        self._levels:Optional[List[np.ndarray]] = None
+        self._depths:Optional[np.ndarray] = None
+        self._edge_lengths:Optional[np.ndarray] = None
+
+    @classmethod
+    def from_rows(cls, rows, with_locations=False) -> 'ArrayTree':
+        """Create a tree from (id, parent_id[, x, y, z]) rows, parent IDs of
+        root nodes are None.
+        """
+        data = np.array([(r[0], -1 if r[1] is None else r[1]) for r in rows],
+                dtype=np.int64).reshape(-1, 2)
+        locations = np.array([r[2:5] for r in rows], dtype=np.float32) \
+                if with_locations else None
+        return cls(data[:, 0], data[:, 1], locations)
+
+    @classmethod
+    def from_digraph(cls, graph, locations=None) -> 'ArrayTree':
+        """Create a tree from a networkx DiGraph with edges from parents to
+        children, like the trees of the functions above. Node positions are
+        read from the optional <locations> dictionary.
+        """
+        node_ids = list(graph.nodes)
+        parent_ids = [next(graph.predecessors(n), -1) for n in node_ids]
+        return cls(node_ids, parent_ids, None if locations is None else
+                [locations[n] for n in node_ids])
+
+    @classmethod
+    def from_skeleton(cls, skeleton_id, with_locations=False,
+            cursor=None) -> 'ArrayTree':
+        """Load all nodes of a skeleton into a tree.
+        """
+        for _, tree in load_array_trees([skeleton_id], with_locations, cursor):
+            return tree
+        return cls([], [])
+
+    def copy_with_parents(self, parents:np.ndarray) -> 'ArrayTree':
+        tree = ArrayTree.__new__(ArrayTree)
+        tree.node_ids = self.node_ids
+        tree._sorter = self._sorter
+        tree._sorted_ids = self._sorted_ids
+        tree.locations = self.locations
+        tree._init_structure(parents)
+        return tree
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def __contains__(self, node_id) -> bool:
+        if node_id is None:
+            return False
+        i = np.searchsorted(self._sorted_ids, node_id)
+        return i < len(self) and self._sorted_ids[i] == node_id
+
+    def indices(self, node_ids) -> np.ndarray:
+        """Map node IDs to node indices, raises a ValueError for unknown IDs.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self._sorted_ids, node_ids), max(len(self) - 1, 0))
+        if not len(self) or np.any(self._sorted_ids[pos] != node_ids):
+            raise ValueError("Unknown node IDs")
+        return self._sorter[pos]
+
+    def index(self, node_id) -> int:
+        return int(self.indices([node_id])[0])
+
+    @property
+    def roots(self) -> np.ndarray:
+        return np.flatnonzero(self.parents < 0)
+
+    @property
+    def root(self) -> int:
+        """The index of the first root node.
+        """
+        return int(self.roots[0])
+
+    @property
+    def n_children(self) -> np.ndarray:
+        return np.diff(self.child_ptr)
+
+    def children(self, i) -> np.ndarray:
+        return self.child_idx[self.child_ptr[i]:self.child_ptr[i + 1]]
+
+    def children_of(self, indices:np.ndarray) -> np.ndarray:
+        """Return the children of all passed in nodes as one array.
+        """
+        starts = self.child_ptr[indices]
+        counts = self.child_ptr[np.asarray(indices) + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return self.child_idx[offsets + np.arange(counts.sum())]
+
+    def is_end(self) -> np.ndarray:
+        """Nodes without children, a root with a single child isn't an end.
+        """
+        return self.n_children == 0
+
+    def is_branch(self) -> np.ndarray:
+        return self.n_children > 1
+
+    @property
+    def levels(self) -> List[np.ndarray]:
+        """Node indices grouped by their number of edges to the root, in
+        breadth first order. Nodes on cycles are not included.
+        """
+        if self._levels is None:
+            levels = []
+            frontier = self.roots
+            while frontier.size:
+                levels.append(frontier)
+                frontier = self.children_of(frontier)
+            self._levels = levels
+        return self._levels
+
+    @property
+    def depths(self) -> np.ndarray:
+        """The number of edges to the root of each node.
+        """
+        if self._depths is None:
+            depths = np.full(len(self), -1, dtype=np.int32)
+            for d, level in enumerate(self.levels):
+                depths[level] = d
+            self._depths = depths
+        return self._depths
+
+    @property
+    def edge_lengths(self) -> np.ndarray:
+        """The distance of each node to its parent, zero for roots.
+        """
+        if self._edge_lengths is None:
+            if self.locations is None:
+                raise ValueError("Tree has no locations")
+            lengths = np.zeros(len(self))
+            children = np.flatnonzero(self.parents >= 0)
+            lengths[children] = np.linalg.norm(self.locations[children].astype(np.float64) -
+                    self.locations[self.parents[children]], axis=1)
+            self._edge_lengths = lengths
+        return self._edge_lengths
+
+    def root_distances(self) -> np.ndarray:
+        """The path length of each node to the root.
+        """
+        return get_path_sums(self.parents, self.edge_lengths)
+
+    def subtree_sums(self, values:np.ndarray) -> np.ndarray:
+        """Sum the passed in per-node values over the subtree of each node,
+        including the node itself.
+        """
+        totals = np.array(values, copy=True)
+        for level in reversed(self.levels[1:]):
+            np.add.at(totals, self.parents[level], totals[level])
+        return totals
+
+    def cable_length(self, mask:Optional[np.ndarray]=None) -> float:
+        """The summed length of all edges, or of all edges between nodes of
+        the passed in boolean mask.
+        """
+        if mask is None:
+            return float(self.edge_lengths.sum())
+        children = np.flatnonzero(mask & (self.parents >= 0))
+        children = children[mask[self.parents[children]]]
+        return float(self.edge_lengths[children].sum())
+
+    def strahler(self) -> np.ndarray:
+        """The Strahler order of each node: ends have order 1, a parent gets the
+        maximum order of its children, plus one if two or more children have
+        this order.
+        """
+        orders = np.ones(len(self), dtype=np.int32)
+        max_orders = np.zeros(len(self), dtype=np.int32)
+        n_max = np.zeros(len(self), dtype=np.int32)
+        levels = self.levels
+        for d in range(len(levels) - 1, 0, -1):
+            level = levels[d]
+            parents = self.parents[level]
+            np.maximum.at(max_orders, parents, orders[level])
+            np.add.at(n_max, parents, orders[level] == max_orders[parents])
+            unique_parents = np.unique(parents)
+            orders[unique_parents] = max_orders[unique_parents] + \
+                    (n_max[unique_parents] > 1)
+        return orders
+
+    def path_to_root(self, i) -> np.ndarray:
+        """The node indices from the passed in node to its root.
+        """
+        depth = self.depths[i]
+        path = np.empty(depth + 1 if depth >= 0 else 0, dtype=np.int32)
+        parents = self.parents
+        for k in range(len(path)):
+            path[k] = i
+            i = parents[i]
+        return path
+
+    def subtree_mask(self, i) -> np.ndarray:
+        """A boolean mask of the passed in node and all its descendants.
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        frontier = np.array([i], dtype=np.int32)
+        while frontier.size:
+            mask[frontier] = True
+            frontier = self.children_of(frontier)
+        return mask
+
+    def extract(self, mask:np.ndarray) -> 'ArrayTree':
+        """Return a new tree with only the nodes of the passed in boolean mask,
+        nodes whose parent isn't part of it become roots.
+        """
+        parents = self.parents
+        parent_ids = np.where(parents >= 0, self.node_ids[parents], -1)
+        parent_ids[(parents >= 0) & ~mask[parents]] = -1
+        return ArrayTree(self.node_ids[mask], parent_ids[mask],
+                None if self.locations is None else self.locations[mask])
+
+    def reroot(self, i) -> 'ArrayTree':
+        """Return a new tree with the passed in node as root, edges on the path
+        to the old root are reversed.
+        """
+        path = self.path_to_root(i)
+        if len(path) < 2:
+            return self
+        parents = self.parents.copy()
+        parents[path[1:]] = path[:-1]
+        parents[i] = -1
+        return self.copy_with_parents(parents)
+
+    def common_ancestor(self, indices) -> int:
+        """The nearest common ancestor of the passed in nodes.
+        """
+        depths = self.depths
+        nodes = np.unique(np.asarray(indices, dtype=np.int32))
+        # Move the deepest nodes up until all nodes are the same.
+        while len(nodes) > 1:
+            max_depth = depths[nodes].max()
+            deepest = depths[nodes] == max_depth
+            nodes[deepest] = self.parents[nodes[deepest]]
+            if np.any(nodes < 0):
+                raise ValueError("Nodes are not part of the same tree")
+            nodes = np.unique(nodes)
+        return int(nodes[0])
+
+    def spanning_mask(self, indices) -> np.ndarray:
+        """A boolean mask of all nodes on the paths between the passed in
+        nodes, which need to be part of the same tree.
+        """
+        marked = np.zeros(len(self), dtype=np.int32)
+        marked[np.asarray(indices, dtype=np.int32)] = 1
+        total = marked.sum()
+        counts = self.subtree_sums(marked)
+        mask = (counts > 0) & (counts < total)
+        mask[self.common_ancestor(np.flatnonzero(marked))] = True
+        return mask
+
+    def partition(self, with_single_nodes=False) -> Iterator[List[int]]:
+        """Partition the tree into lists of node indices, with branch nodes
+        repeated as ends of all sequences except the longest one that finishes
+        at the root. Each sequence runs from an end node to either the root or a
+        branch node, end nodes with more edges to the root are visited first.
+        Single node sequences (a root without children) are only included if
+        requested.
+        """
+        depths = self.depths
+        ends = np.flatnonzero(self.is_end())
+        ends = ends[np.argsort(-depths[ends], kind='stable')]
+        parents = self.parents.tolist()
+        seen = bytearray(len(self))
+        for end in ends.tolist():
+            sequence = [end]
+            parent = parents[end]
+            while parent != -1:
+                sequence.append(parent)
+                if seen[parent]:
+                    break
+                seen[parent] = 1
+                parent = parents[parent]
+
+            if with_single_nodes or len(sequence) > 1:
+                yield sequence
+
+    def simplify(self, keepers) -> Tuple['ArrayTree', List[Tuple[int, int]]]:
+        """Given a set of node indices to keep, return the edges of a minified
+        tree where only the nodes to keep and the branch points between them are
+        preserved. Like simplify(), the tree is rerooted at the first of the
+        keepers, which is returned along with the edges.
+        """
+        keepers = list(dict.fromkeys(int(k) for k in keepers))
+        tree = self.reroot(keepers[0])
+        parents = tree.parents.tolist()
+        n_children = tree.n_children.tolist()
+        is_keeper = bytearray(len(tree))
+        for k in keepers:
+            is_keeper[k] = 1
+        children:DefaultDict[int, int] = defaultdict(int)
+        seen_branch_nodes = set(keepers[1:])
+        paths = []
+        for node in keepers[1:]:
+            path = [node]
+            paths.append(path)
+            parent = parents[node]
+            while parent != -1:
+                if is_keeper[parent]:
+                    path.append(parent)
+                    break
+                elif n_children[parent] > 1:
+                    children[parent] += 1
+                    path.append(parent)
+                    if parent in seen_branch_nodes:
+                        break
+                    seen_branch_nodes.add(parent)
+                parent = parents[parent]
+
+        edges = []
+        for path in paths:
+            origin = path[0]
+            for i in range(1, len(path) - 1):
+                if children[path[i]] > 1:
+                    edges.append((origin, path[i]))
+                    origin = path[i]
+            edges.append((origin, path[-1]))
+
+        return tree, edges
+
+
+def load_array_trees(skeleton_ids, with_locations=False,
+        cursor=None) -> Iterator[Tuple[int, ArrayTree]]:
+    """Return a lazy collection of (skeleton ID, ArrayTree) pairs, like
+    lazy_load_trees(). All nodes are loaded with a single query, but trees are
+    only created when they are requested.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    cursor.execute(f'''
+        SELECT t.skeleton_id, t.id, COALESCE(t.parent_id, -1)
+            {', t.location_x, t.location_y, t.location_z' if with_locations else ''}
+        FROM treenode t
+        JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+            ON skeleton.id = t.skeleton_id
+        ORDER BY t.skeleton_id
+    ''', {
+        'skeleton_ids': list(skeleton_ids),
+    })
+    rows = cursor.fetchall()
+    if not rows:
+        return
+
+    # IDs are kept as integers, float64 can't represent all bigint values.
+    columns = list(zip(*rows))
+    ids = np.array(columns[:3], dtype=np.int64)
+    locations = np.array(columns[3:6], dtype=np.float32).T if with_locations else None
+    skeleton_col = ids[0]
+    bounds = np.r_[0, np.flatnonzero(np.diff(skeleton_col)) + 1, len(rows)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        tree = ArrayTree(ids[1, start:end], ids[2, start:end],
+                locations[start:end] if with_locations else None)
+        yield int(skeleton_col[start]), tree
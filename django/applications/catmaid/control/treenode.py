@@ -3,7 +3,7 @@
 from collections import defaultdict
 import itertools
 import math
-import networkx as nx
+import numpy as np
 import re
 from typing import Any, DefaultDict, Dict, List, Union
 
@@ -24,6 +24,7 @@ from catmaid.control.common import (get_relation_to_id_map,
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.node import _fetch_location, _fetch_locations
 from catmaid.control.link import create_connector_link
+from catmaid.control.tree_util import ArrayTree
 from catmaid.util import Point3D, is_collinear
 
 
@@ -1149,23 +1150,14 @@ def update_confidence(request:HttpRequest, project_id=None, treenode_id=None) ->
     else:
         raise ValueError('Failed to update confidence at treenode %s.' % tnid)
 
-def _skeleton_as_graph(skeleton_id) -> nx.DiGraph:
+def _skeleton_as_tree(skeleton_id) -> ArrayTree:
     # Fetch all nodes of the skeleton
     cursor = connection.cursor()
     cursor.execute('''
         SELECT id, parent_id
         FROM treenode
         WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
+    return ArrayTree.from_rows(cursor.fetchall())
 
 
 def _find_first_interesting_node(sequence):
@@ -1212,19 +1204,16 @@ def find_previous_branchnode_or_root(request:HttpRequest, project_id=None, treen
         tnid = int(treenode_id)
         alt = 1 == int(request.POST['alt'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        tree = _skeleton_as_tree(skid)
         # Travel upstream until finding a parent node with more than one child
-        # or reaching the root node
-        seq = [] # Does not include the starting node tnid
-        while True:
-            parents = list(graph.predecessors(tnid))
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
-                seq.append(tnid)
-                if 1 != len(list(graph.successors(tnid))):
-                    break # Found a branch node
-            else:
-                break # Found the root node
+        # or reaching the root node. The path doesn't include the starting node.
+        path = tree.path_to_root(tree.index(tnid))[1:]
+        n_children = tree.n_children[path]
+        branch = np.flatnonzero(n_children != 1)
+        path = path[:branch[0] + 1] if branch.size else path
+        seq = tree.node_ids[path].tolist()
+        if seq:
+            tnid = seq[-1]
 
         if seq and alt:
             tnid = _find_first_interesting_node(seq)
@@ -1239,32 +1228,31 @@ def find_next_branchnode_or_end(request:HttpRequest, project_id=None, treenode_i
     try:
         tnid = int(treenode_id)
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        tree = _skeleton_as_tree(skid)
 
-        children = list(graph.successors(tnid))
+        n_children = tree.n_children
+        children = tree.children(tree.index(tnid))
         branches = []
-        for child_node_id in children:
+        for child in children:
             # Travel downstream until finding a child node with more than one
             # child or reaching an end node
-            seq = [child_node_id] # Does not include the starting node tnid
-            branch_end = child_node_id
-            while True:
-                branch_children = list(graph.successors(branch_end))
-                if 1 == len(branch_children):
-                    branch_end = branch_children[0]
-                    seq.append(branch_end)
-                else:
-                    break # Found an end node or a branch node
-
-            branches.append([child_node_id,
-                             _find_first_interesting_node(seq),
-                             branch_end])
-
-        # If more than one branch exists, sort based on downstream arbor size.
+            seq = [child] # Does not include the starting node tnid
+            branch_end = child
+            while 1 == n_children[branch_end]:
+                branch_end = tree.children(branch_end)[0]
+                seq.append(branch_end)
+
+            branches.append([int(tree.node_ids[child]),
+                             _find_first_interesting_node(tree.node_ids[seq].tolist()),
+                             int(tree.node_ids[branch_end])])
+
+        # If more than one branch exists, sort based on downstream arbor size,
+        # i.e. the number of nodes with children in each branch.
         if len(children) > 1:
-            branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
-                   reverse=True)
+            n_parents = tree.subtree_sums((n_children > 0).astype(np.int32))
+            branch_sizes = dict(zip(tree.node_ids[children].tolist(),
+                    n_parents[children].tolist()))
+            branches.sort(key=lambda b: branch_sizes[b[0]], reverse=True)
 
         # Leaf nodes will have no branches
         if len(children) > 0:
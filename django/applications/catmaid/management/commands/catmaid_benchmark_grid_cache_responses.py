@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+import msgpack
+import ujson
+
+from django.core.management.base import BaseCommand
+
+from catmaid.control.node import (get_pack_array_header, splice_json_text_result,
+        splice_msgpack_result)
+
+
+def make_cell(n_nodes, n_connectors, id_offset=0) -> List:
+    """Create a random node query result in the format used by grid caches."""
+    now = time.time()
+    treenodes = [[id_offset + i, id_offset + i - 1 if i else None,
+            random.uniform(0, 1e5), random.uniform(0, 1e5), random.uniform(0, 1e5),
+            5, -1.0, id_offset, now, 3] for i in range(n_nodes)]
+    connectors = [[id_offset + n_nodes + i, random.uniform(0, 1e5),
+            random.uniform(0, 1e5), random.uniform(0, 1e5), 5, now, 3,
+            [[id_offset + i, 12, 5, now, id_offset + i]]] for i in range(n_connectors)]
+    return [treenodes, connectors, {}, False, {'12': 'presynaptic_to'}]
+
+
+def legacy_msgpack_splice(target, encoded_extra_tuples, decoded_extra_tuples) -> bytes:
+    """The previous msgpack splicing implementation, which built the result
+    with repeated concatenation."""
+    extra_msgpack = b''.join(t for t in encoded_extra_tuples if t)
+    for det in decoded_extra_tuples:
+        extra_msgpack += msgpack.packb(det)
+    bin_len = get_pack_array_header(len(encoded_extra_tuples) + len(decoded_extra_tuples))
+    return bytes(b'\x96' + target[1:] + bin_len + extra_msgpack)
+
+
+class Command(BaseCommand):
+    help = ("Measure time and allocated bytes per node query response that is "
+            "created from grid cache cells, comparing the conversion between "
+            "representations with the direct use of the cached representation.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cells', type=int, default=9,
+                help='The number of grid cells per request')
+        parser.add_argument('--nodes', type=int, default=500,
+                help='The number of treenodes per grid cell')
+        parser.add_argument('--connectors', type=int, default=50,
+                help='The number of connectors per grid cell')
+        parser.add_argument('--repeat', type=int, default=50,
+                help='The number of simulated requests per case')
+
+    def handle(self, *args, **options):
+        n_cells = options['cells']
+        cells = [make_cell(options['nodes'], options['connectors'], i * 100000)
+                for i in range(n_cells)]
+        extra = make_cell(10, 2, 10000000)
+
+        msgpack_cells = [msgpack.packb(c) for c in cells]
+        json_text_cells = [ujson.dumps(c) for c in cells]
+
+        cases:List[Tuple[str, Callable]] = [
+            ('msgpack request, msgpack cache (previous)',
+                lambda: legacy_msgpack_splice(msgpack_cells[0], msgpack_cells[1:], [extra])),
+            ('msgpack request, json_text cache (previous)',
+                lambda: msgpack.packb(ujson.loads(splice_json_text_result(
+                    json_text_cells[0], json_text_cells[1:], [extra])))),
+            ('msgpack request, msgpack cache',
+                lambda: splice_msgpack_result(msgpack_cells[0], msgpack_cells[1:], [extra])),
+            ('json request, msgpack cache (previous)',
+                lambda: ujson.dumps(msgpack.unpackb(legacy_msgpack_splice(
+                    msgpack_cells[0], msgpack_cells[1:], [extra]), use_list=False))),
+            ('json request, json_text cache',
+                lambda: splice_json_text_result(json_text_cells[0], json_text_cells[1:], [extra])),
+        ]
+
+        payload_size = sum(len(c) for c in msgpack_cells)
+        self.stdout.write(f'{n_cells} cells, {payload_size} bytes of msgpack '
+                f'cell data, {options["repeat"]} requests per case')
+
+        for name, fn in cases:
+            response = fn()
+            # The peak of newly allocated memory is an upper bound of the
+            # number of bytes copied for a single request.
+            tracemalloc.start()
+            fn()
+            _, peak_allocated = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                fn()
+            duration = (time.perf_counter() - start) / options['repeat']
+
+            self.stdout.write(f'{name}: {duration * 1000:.2f} ms/request, '
+                    f'{peak_allocated} bytes peak allocation, '
+                    f'{len(response)} bytes response')
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import networkx as nx
+import numpy as np
+
+from django.core.management.base import BaseCommand
+
+from catmaid.control.synapseclustering import array_tree_max_density
+from catmaid.control.tree_util import (ArrayTree, cable_length,
+        edge_count_to_root, partition, reroot)
+
+
+def make_tree(n_nodes, branch_probability=0.01, seed=0) -> Tuple[np.ndarray,
+        np.ndarray, np.ndarray]:
+    """Create a random tree of node IDs, parent IDs (-1 for the root) and node
+    locations. Most nodes continue the previous node, some branch off a random
+    earlier node, which results in a neuron-like mix of long paths and branches.
+    """
+    rng = np.random.RandomState(seed)
+    node_ids = np.arange(1, n_nodes + 1, dtype=np.int64)
+    parent_ids = node_ids - 1
+    branch = rng.random_sample(n_nodes) < branch_probability
+    parent_ids[branch] = (rng.random_sample(branch.sum()) * node_ids[branch]).astype(np.int64)
+    parent_ids[0] = -1
+    parent_ids[parent_ids == 0] = 1
+    locations = np.cumsum(rng.normal(0, 50, (n_nodes, 3)), axis=0)
+    # Shuffle the nodes, like they would come from the database.
+    order = rng.permutation(n_nodes)
+    return node_ids[order], parent_ids[order], locations[order]
+
+
+def make_nx_tree(node_ids, parent_ids, locations) -> Tuple[nx.DiGraph, dict]:
+    tree = nx.DiGraph()
+    node_locations = {}
+    for node_id, parent_id, location in zip(node_ids.tolist(),
+            parent_ids.tolist(), locations.tolist()):
+        tree.add_node(node_id)
+        if parent_id != -1:
+            tree.add_edge(parent_id, node_id)
+        node_locations[node_id] = location
+    return tree, node_locations
+
+
+class Command(BaseCommand):
+    help = ("Measure time and allocated memory per million nodes of common tree "
+            "operations, comparing networkx graphs with array based trees on "
+            "random trees. Optionally, the time per bandwidth of synapse "
+            "clustering is measured.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=200000,
+                help='The number of nodes of the random tree')
+        parser.add_argument('--branch-probability', dest='branch_probability',
+                type=float, default=0.01,
+                help='The probability of a node to start a new branch')
+        parser.add_argument('--repeat', type=int, default=3,
+                help='The number of runs per case')
+        parser.add_argument('--synapses', type=int, default=0,
+                help='If set, cluster this many random synapses on the tree')
+        parser.add_argument('--bandwidths', type=float, nargs='+',
+                default=[1000, 5000, 10000],
+                help='The synapse clustering bandwidths in nanometers')
+
+    def handle(self, *args, **options):
+        n_nodes = options['nodes']
+        node_ids, parent_ids, locations = make_tree(n_nodes,
+                options['branch_probability'])
+        scale = 1e6 / n_nodes
+
+        nx_tree, nx_locations = make_nx_tree(node_ids, parent_ids, locations)
+        array_tree = ArrayTree(node_ids, parent_ids, locations)
+        root_id = int(node_ids[parent_ids == -1][0])
+        new_root_id = int(node_ids[-1])
+
+        def nx_reroot():
+            tree = nx_tree.copy()
+            reroot(tree, new_root_id)
+
+        def array_depths():
+            # Don't measure cached values
+            return ArrayTree(node_ids, parent_ids).depths
+
+        cases:List[Tuple[str, Callable]] = [
+            ('build (networkx)', lambda: make_nx_tree(node_ids, parent_ids, locations)),
+            ('build (arrays)', lambda: ArrayTree(node_ids, parent_ids, locations)),
+            ('edge count to root (networkx)', lambda: edge_count_to_root(nx_tree, root_id)),
+            ('edge count to root (arrays)', array_depths),
+            ('cable length (networkx)', lambda: cable_length(nx_tree, nx_locations)),
+            ('cable length (arrays)', lambda: ArrayTree(node_ids, parent_ids,
+                    locations).cable_length()),
+            ('root distances (arrays)', lambda: array_tree.root_distances()),
+            ('strahler order (arrays)', lambda: array_tree.strahler()),
+            ('partition (networkx)', lambda: list(partition(nx_tree, root_id))),
+            ('partition (arrays)', lambda: list(array_tree.partition())),
+            ('reroot (networkx)', nx_reroot),
+            ('reroot (arrays)', lambda: array_tree.reroot(array_tree.index(new_root_id))),
+        ]
+
+        self.stdout.write(f'{n_nodes} nodes, {int(array_tree.is_branch().sum())} '
+                f'branch nodes, {options["repeat"]} runs per case, values are '
+                'scaled to one million nodes')
+
+        for name, fn in cases:
+            tracemalloc.start()
+            fn()
+            _, peak_allocated = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                fn()
+            duration = (time.perf_counter() - start) / options['repeat']
+
+            self.stdout.write(f'{name}: {duration * scale:.3f} s, '
+                    f'{peak_allocated * scale / 2**20:.1f} MiB peak allocation')
+
+        n_synapses = options['synapses']
+        if n_synapses:
+            synapse_nodes = np.random.RandomState(1).choice(node_ids, n_synapses).tolist()
+            timings:Dict = {}
+            start = time.perf_counter()
+            groups = array_tree_max_density(array_tree, synapse_nodes,
+                    list(range(n_synapses)), [0] * n_synapses,
+                    options['bandwidths'], timings=timings)
+            duration = time.perf_counter() - start
+            self.stdout.write(f'synapse clustering of {n_synapses} synapses: '
+                    f'{duration:.3f} s total')
+            for h, seconds in timings.items():
+                self.stdout.write(f'bandwidth {h}: {seconds:.3f} s, '
+                        f'{len(groups[h])} groups')
@@ -1,6 +1,7 @@
 from collections import defaultdict
 import json
 import logging
+import multiprocessing
 import select
 import signal
 import time
@@ -9,11 +10,12 @@ from typing import Dict, List, Set
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import connection
+from django.db import connection, connections, transaction
 
 from catmaid.control.edge import get_intersected_grid_cells
 from catmaid.control.node import (get_configured_node_providers,
-        GridCachedNodeProvider, Postgis3dNodeProvider, update_grid_cell)
+        get_grid_query_params, GridCachedNodeProvider, Postgis3dNodeProvider,
+        update_grid_cell, update_grid_cells)
 from catmaid.models import NodeGridCache, DirtyNodeGridCacheCell
 from catmaid.util import str2bool
 from .common import set_log_level
@@ -47,17 +49,7 @@ class GridWorker():
             g = grid_map[update['grid_id']]
             w_i, h_i, d_i = update['x'], update['y'], update['z']
 
-            params = {
-                'project_id': g.project_id,
-                'limit': settings.NODE_LIST_MAXIMUM_COUNT,
-                'ordering': g.ordering,
-            }
-            if g.n_last_edited_skeletons_limit:
-                params['n_largest_skeletons_limit'] = int(g.n_largest_skeletons_limit)
-            if g.n_last_edited_skeletons_limit:
-                params['n_last_edited_skeletons_limit'] = int(g.n_last_edited_skeletons_limit)
-            if g.hidden_last_editor_id:
-                params['hidden_last_editor_id'] = int(g.hidden_last_editor_id)
+            params = get_grid_query_params(g)
 
             added = update_grid_cell(g.project_id, g.id, w_i, h_i, d_i,
                     g.cell_width, g.cell_height, g.cell_depth,
@@ -68,13 +60,98 @@ class GridWorker():
             if added:
                 updated_cells += 1
 
-                # TODO: delete in batches
                 DirtyNodeGridCacheCell.objects.filter(grid_id=g.id, x_index=w_i,
                         y_index=h_i, z_index=d_i).delete()
 
         logger.debug(f'Updated {updated_cells} grid cell(s) in {len(referenced_grid_ids)} grid cache(s)')
 
 
+class BatchGridWorker():
+    """Process the dirty cell queue in batches, independent of the cells
+    referenced in notifications. Each batch is claimed using SELECT ... FOR
+    UPDATE SKIP LOCKED, so that multiple workers can process the queue in
+    parallel without processing the same cell twice. Cells of a batch are
+    written back with one multi-row upsert per grid and their dirty entries are
+    removed with a single query, all in one transaction per batch. If cells are
+    marked dirty again while a batch is processed, the respective dirty entry
+    is recreated after the batch is committed.
+    """
+
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self.grid_map:Dict = {}
+        self.provider = Postgis3dNodeProvider()
+        self.start_time = time.time()
+        self.total_cells = 0
+        self.total_time = 0.0
+
+    def update(self, updates, cursor):
+        """Process batches until the dirty cell queue is empty or all remaining
+        entries are locked by other workers.
+        """
+        while self.update_batch(cursor):
+            pass
+
+    def get_grid(self, grid_id):
+        grid = self.grid_map.get(grid_id)
+        if not grid:
+            grid = self.grid_map[grid_id] = NodeGridCache.objects.get(pk=grid_id)
+        return grid
+
+    def update_batch(self, cursor) -> int:
+        """Claim, recompute and remove one batch of dirty cells. Returns the
+        number of processed cells.
+        """
+        start = time.time()
+        with transaction.atomic():
+            cursor.execute("""
+                SELECT id, grid_id, x_index, y_index, z_index
+                FROM dirty_node_grid_cache_cell
+                ORDER BY invalidation_time, grid_id, z_index, y_index, x_index
+                LIMIT %(batch_size)s
+                FOR UPDATE SKIP LOCKED
+            """, {
+                'batch_size': self.batch_size,
+            })
+            dirty_cells = cursor.fetchall()
+            if not dirty_cells:
+                return 0
+
+            # The oldest cells are claimed first. Cells invalidated at the same
+            # time, typically by the same change, are ordered by grid and
+            # position, which keeps neighboring cells together.
+            grid_cells:Dict[int, List] = defaultdict(list)
+            for _, grid_id, x, y, z in dirty_cells:
+                grid_cells[grid_id].append((x, y, z))
+
+            n_updated, n_removed = 0, 0
+            for grid_id, cells in grid_cells.items():
+                updated, removed = update_grid_cells(self.get_grid(grid_id),
+                        cells, self.provider, cursor)
+                n_updated += updated
+                n_removed += removed
+
+            cursor.execute("""
+                DELETE FROM dirty_node_grid_cache_cell
+                WHERE id = ANY(%(ids)s::bigint[])
+            """, {
+                'ids': [c[0] for c in dirty_cells],
+            })
+
+        duration = time.time() - start
+        n_cells = len(dirty_cells)
+        self.total_cells += n_cells
+        self.total_time += duration
+        rate = n_cells / duration if duration > 0 else 0
+        total_rate = self.total_cells / self.total_time if self.total_time > 0 else 0
+        logger.info(f'Processed {n_cells} dirty grid cell(s) in {len(grid_cells)} '
+                f'grid cache(s) ({n_updated} updated, {n_removed} removed) in '
+                f'{duration:.2f}s, {rate:.1f} cells/s. Total: {self.total_cells} '
+                f'cells, {total_rate:.1f} cells/s')
+
+        return n_cells
+
+
 class Command(BaseCommand):
     help = ""
     # The queue to process. Subclass and set this.
@@ -90,6 +167,12 @@ class Command(BaseCommand):
         )
         parser.add_argument("--grid-cache", type=str2bool, nargs='?',
                 const=True, default=True, help="Update spatial grid caches.")
+        parser.add_argument('--batch-size', type=int, default=0,
+                help="If set, the dirty cell queue is processed in batches of "
+                "this size, independent of the cells referenced in "
+                "notifications. Multiple workers can run in parallel in this mode.")
+        parser.add_argument('--jobs', type=int, default=1,
+                help="The number of worker processes to start. Requires --batch-size.")
 
     def handle(self, **options):
         set_log_level(logger, options.get('verbosity', 1))
@@ -98,15 +181,48 @@ class Command(BaseCommand):
         self.delay = options['delay']
         self.grid_cache_update = options['grid_cache']
 
-        self.workers:List = []
+        self.batch_size = options['batch_size']
+        jobs = options['jobs']
 
-        if options['grid_cache']:
-            self.workers.append(GridWorker())
+        if jobs > 1 and not self.batch_size:
+            logger.error("Parallel workers (--jobs) require --batch-size")
+            return
 
-        if not self.workers:
+        if not self.grid_cache_update:
             logger.warn("No grids provided")
             return
 
+        if jobs > 1:
+            # We need to close all database connections to not accidentally
+            # share the file descriptors of current connections with forks.
+            connections.close_all()
+            processes = [multiprocessing.Process(target=self.run, name=f'worker-{i}')
+                    for i in range(jobs)]
+            for p in processes:
+                p.start()
+            logger.info(f'Started {jobs} worker processes')
+
+            # Workers handle SIGINT themselves, SIGTERM is forwarded to them.
+            def terminate(sig, frame):
+                for p in processes:
+                    p.terminate()
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, terminate)
+
+            for p in processes:
+                p.join()
+        else:
+            self.run()
+
+    def run(self):
+        self.workers:List = []
+
+        if self.grid_cache_update:
+            if self.batch_size:
+                self.workers.append(BatchGridWorker(self.batch_size))
+            else:
+                self.workers.append(GridWorker())
+
         self.listen()
 
         try:
@@ -114,6 +230,11 @@ class Command(BaseCommand):
             signal.signal(signal.SIGINT, self.handle_shutdown)
             signal.signal(signal.SIGTERM, self.handle_shutdown)
 
+            # In batch mode, cells that were marked dirty while no worker was
+            # running are processed right away.
+            if self.batch_size:
+                self.process([])
+
             while True:
                 self.wait_and_queue()
                 # Wait for 0.01s to not have the busy waiting cause 100% CPU.
@@ -162,8 +283,6 @@ class Command(BaseCommand):
     def wait_and_queue(self):
         notifications = self.wait()
         if notifications:
-            cursor = connection.cursor()
-
             updates = []
             for n in notifications:
                 try:
@@ -173,5 +292,15 @@ class Command(BaseCommand):
                     logger.warn(f'Could not parse Postgres NOTIFY message: {n.payload}')
                     continue
 
+            self.process(updates)
+
+    def process(self, updates):
+        cursor = connection.cursor()
+        self._in_task = True
+        try:
             for worker in self.workers:
                 worker.update(updates, cursor)
+        finally:
+            self._in_task = False
+        if self._shutdown:
+            raise InterruptedError
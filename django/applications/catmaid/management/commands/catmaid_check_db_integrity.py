@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+from multiprocessing import Pool
 import numpy as np
-import progressbar
 import sys
-from typing import Dict
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import connection
+from django.db import connection, connections, transaction
 from catmaid.models import Project
 from catmaid.util import str2bool
 from .common import set_log_level
@@ -24,6 +26,187 @@ except ImportError:
     winding_check_enabled = False
 
 
+def find_tree_problems(node_ids, parent_ids, skeleton_ids,
+        max_listed_nodes=10) -> List[Dict[str, Any]]:
+    """Check that the nodes of each passed in skeleton form a single tree: each
+    skeleton has exactly one root, no node has a parent in another skeleton,
+    there are no cycles and all nodes are connected to the root. All nodes of
+    the passed in skeletons are expected and the parent ID of root nodes is
+    -1. An entry is returned for each skeleton that fails any of the tests,
+    with up to <max_listed_nodes> examples of offending nodes.
+    """
+    n_nodes = len(node_ids)
+    if not n_nodes:
+        return []
+    index = np.arange(n_nodes)
+
+    # Find the index of each parent. Parents that aren't part of the passed in
+    # nodes belong to other skeletons.
+    order = np.argsort(node_ids)
+    sorted_node_ids = node_ids[order]
+    has_parent = parent_ids != -1
+    parent_pos = np.minimum(np.searchsorted(sorted_node_ids, parent_ids), n_nodes - 1)
+    parents = np.where(has_parent & (sorted_node_ids[parent_pos] == parent_ids),
+            order[parent_pos], -1)
+    cross_skeleton = has_parent & ((parents == -1) |
+            (skeleton_ids[parents] != skeleton_ids))
+    self_parent = parents == index
+
+    # Each node is linked to its parent, if it is in the same skeleton. All
+    # other nodes represent their own set. The representative of each node's
+    # set is found by pointer jumping, i.e. path compression applied to all
+    # nodes at once. After log2(n) rounds all nodes that aren't on or leading
+    # into a cycle point to their representative.
+    links = np.where(has_parent & ~cross_skeleton & ~self_parent, parents, index)
+    is_representative = links == index
+    for _ in range(int(np.ceil(np.log2(max(n_nodes, 2)))) + 1):
+        next_links = links[links]
+        if np.array_equal(next_links, links):
+            break
+        links = next_links
+    cyclic = ~is_representative[links] | self_parent[links]
+    reaches_root = ~cyclic & ~has_parent[links]
+
+    skeletons, skeleton_index, skeleton_size = np.unique(skeleton_ids,
+            return_inverse=True, return_counts=True)
+    n_skeletons = len(skeletons)
+    n_roots = np.bincount(skeleton_index[~has_parent], minlength=n_skeletons)
+    n_cross_skeleton = np.bincount(skeleton_index[cross_skeleton], minlength=n_skeletons)
+    n_cyclic = np.bincount(skeleton_index[cyclic], minlength=n_skeletons)
+    n_unreachable = np.bincount(skeleton_index[~reaches_root], minlength=n_skeletons)
+
+    problems = []
+    failed = (n_roots != 1) | (n_cross_skeleton > 0) | (n_cyclic > 0) | (n_unreachable > 0)
+    for i in np.flatnonzero(failed):
+        in_skeleton = skeleton_index == i
+        errors = []
+        if n_roots[i] == 0:
+            errors.append('no_root')
+        elif n_roots[i] > 1:
+            errors.append('multiple_roots')
+        if n_cross_skeleton[i]:
+            errors.append('cross_skeleton_parent')
+        if n_cyclic[i]:
+            errors.append('cycle')
+        if n_unreachable[i]:
+            errors.append('unreachable_nodes')
+        cross = in_skeleton & cross_skeleton
+        problems.append({
+            'skeleton_id': int(skeletons[i]),
+            'errors': errors,
+            'n_nodes': int(skeleton_size[i]),
+            'n_roots': int(n_roots[i]),
+            'n_unreachable_nodes': int(n_unreachable[i]),
+            'root_ids': node_ids[in_skeleton & ~has_parent][:max_listed_nodes].tolist(),
+            'cross_skeleton_parents': np.column_stack((node_ids[cross],
+                    parent_ids[cross]))[:max_listed_nodes].tolist(),
+            'cycle_node_ids': node_ids[in_skeleton & cyclic][:max_listed_nodes].tolist(),
+            'unreachable_node_ids': node_ids[in_skeleton & ~reaches_root][:max_listed_nodes].tolist(),
+        })
+
+    return problems
+
+
+def get_skeleton_chunks(project_ids=None, skeleton_ids=None,
+        chunk_size=1000000) -> List[Tuple[Optional[List[int]], Optional[int], Optional[int]]]:
+    """Split the skeleton ID space into ranges of about <chunk_size> nodes,
+    based on the skeleton summary. The first and last range are open, so that
+    nodes of skeletons without summary entry are checked as well. If skeleton
+    IDs are passed in, they are split into lists of about <chunk_size> nodes
+    instead. Each chunk is a tuple of an optional skeleton ID list and an
+    optional lower and upper skeleton ID bound.
+    """
+    cursor = connection.cursor()
+    if skeleton_ids is None:
+        cursor.execute("""
+            SELECT skeleton_id, num_nodes
+            FROM catmaid_skeleton_summary
+            WHERE %(project_ids)s::int[] IS NULL
+                OR project_id = ANY(%(project_ids)s::int[])
+            ORDER BY skeleton_id
+        """, {
+            'project_ids': project_ids or None,
+        })
+    else:
+        cursor.execute("""
+            SELECT s.id, COALESCE(css.num_nodes, 1)
+            FROM UNNEST(%(skeleton_ids)s::bigint[]) s(id)
+            LEFT JOIN catmaid_skeleton_summary css
+                ON css.skeleton_id = s.id
+            ORDER BY s.id
+        """, {
+            'skeleton_ids': list(skeleton_ids),
+        })
+    rows = cursor.fetchall()
+    if not rows:
+        return [(None, None, None)] if skeleton_ids is None else []
+
+    summary = np.array(rows, dtype=np.int64)
+    chunk_index = np.cumsum(summary[:, 1]) // max(chunk_size, 1)
+    splits = np.flatnonzero(np.diff(chunk_index)) + 1
+    if skeleton_ids is not None:
+        return [(chunk.tolist(), None, None)
+                for chunk in np.split(summary[:, 0], splits)]
+    boundaries = summary[splits, 0].tolist()
+    return list(zip([None] * (len(boundaries) + 1), [None] + boundaries,
+            boundaries + [None]))
+
+
+def _check_skeleton_chunk(task) -> Tuple[int, int, List[Dict[str, Any]]]:
+    """Read all treenodes of a range of skeleton IDs with a server-side cursor,
+    ordered by skeleton, and check the skeletons of each batch as soon as
+    all of their nodes are read. Returns the number of checked skeletons and
+    nodes along with all found problems.
+    """
+    project_ids, (skeleton_ids, min_skeleton_id, max_skeleton_id), batch_size = task
+    conditions = ['TRUE']
+    if project_ids:
+        conditions.append('project_id = ANY(%(project_ids)s::int[])')
+    if skeleton_ids is not None:
+        conditions.append('skeleton_id = ANY(%(skeleton_ids)s::bigint[])')
+    if min_skeleton_id is not None:
+        conditions.append('skeleton_id >= %(min_skeleton_id)s')
+    if max_skeleton_id is not None:
+        conditions.append('skeleton_id < %(max_skeleton_id)s')
+
+    n_skeletons, n_nodes = 0, 0
+    problems:List[Dict[str, Any]] = []
+    pending = np.empty((0, 3), dtype=np.int64)
+    with transaction.atomic():
+        cursor = connection.chunked_cursor()
+        cursor.execute(f"""
+            SELECT id, COALESCE(parent_id, -1), skeleton_id
+            FROM treenode
+            WHERE {' AND '.join(conditions)}
+            ORDER BY skeleton_id
+        """, {
+            'project_ids': project_ids,
+            'skeleton_ids': skeleton_ids,
+            'min_skeleton_id': min_skeleton_id,
+            'max_skeleton_id': max_skeleton_id,
+        })
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if rows:
+                nodes = np.concatenate((pending, np.array(rows, dtype=np.int64)))
+                # The last skeleton of a batch might continue in the next one.
+                last_start = np.searchsorted(nodes[:, 2], nodes[-1, 2])
+                nodes, pending = nodes[:last_start], nodes[last_start:]
+            else:
+                nodes = pending
+            if len(nodes):
+                problems.extend(find_tree_problems(nodes[:, 0], nodes[:, 1],
+                        nodes[:, 2]))
+                n_nodes += len(nodes)
+                n_skeletons += int(np.count_nonzero(np.diff(nodes[:, 2]))) + 1
+            if not rows:
+                break
+        cursor.close()
+
+    return n_skeletons, n_nodes, problems
+
+
+
 class Command(BaseCommand):
     help = '''
         Tests the integrity of the specified projects with several sanity checks
@@ -35,109 +218,137 @@ class Command(BaseCommand):
                         const=True, default=True, help="Check tracing data.")
         parser.add_argument("--volumes", type=str2bool, nargs='?',
                         const=True, default=True, help="Check volumes data.")
+        parser.add_argument('--since', default=None, help='Only check ' +
+                'skeletons with nodes that were created, changed or deleted ' +
+                'since this point in time, e.g. "2020-06-01" or "yesterday"')
+        parser.add_argument('--workers', type=int, default=4,
+                help='The number of processes that check tracing data in parallel')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                default=1000000, help='The approximate number of treenodes ' +
+                'a worker checks at a time')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=100000, help='The number of treenodes read from the ' +
+                'database at a time')
+        parser.add_argument('--report', default=None, help='Write a JSON ' +
+                'report of all found problems to this file')
 
     def handle(self, *args, **options):
         set_log_level(logger, options.get('verbosity', 1))
         project_ids = options['project_id']
-        if not len(project_ids):
-            project_ids = Project.objects.all().values_list('id', flat=True)
+        for project_id in project_ids:
+            if not Project.objects.filter(id=project_id).exists():
+                raise CommandError('Project with id %s does not exist.' % project_id)
 
+        report:Dict[str, Any] = {
+            'project_ids': project_ids or None,
+            'since': options['since'],
+        }
         passed = True
-        for project_id in project_ids:
-            passed = self.check_project(project_id, options) and passed
+        if options['tracing']:
+            tracing_passed, report['tracing'] = self.check_tracing_data(
+                    project_ids, options)
+            passed = tracing_passed and passed
+
+        if options['volumes']:
+            if not project_ids:
+                project_ids = list(Project.objects.all().values_list('id', flat=True))
+            for project_id in project_ids:
+                passed = self.check_project(project_id, options) and passed
+
+        report['passed'] = passed
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Wrote report to {options["report"]}')
 
         if not passed:
             sys.exit(1)
 
     def check_project(self, project_id, options):
-        if not Project.objects.filter(id=project_id).exists():
-            raise CommandError('Project with id %s does not exist.' % project_id)
         self.stdout.write('Checking integrity of project %s' % project_id)
 
-        passed = True
-        if options['tracing']:
-            passed = passed and self.check_tracing_data(project_id)
-
-        if options['volumes']:
-            passed = passed and self.check_volumes(project_id)
+        passed = self.check_volumes(project_id)
 
         self.stdout.write('')
 
         return passed
 
 
-    def check_tracing_data(self, project_id):
-        self.stdout.write('Check that no connected treenodes are in different skeletons...', ending='')
-        cursor = connection.cursor()
-        cursor.execute('''
-                SELECT tn1.id, tn2.id
-                FROM treenode tn1,
-                     treenode tn2
-                WHERE tn2.id = tn1.parent_id
-                  AND tn1.skeleton_id <> tn2.skeleton_id
-                  AND tn1.project_id = %s
-                ''', (project_id,))
-        if cursor.rowcount == 0:
-            self.stdout.write('OK')
-        else:
-            project_passed = False
-            self.stdout.write('')
-            self.stdout.write('FAILED: found %s rows (should be 0)' % cursor.rowcount)
-
-        self.stdout.write('Check that each skeleton has exactly one root node...', ending='')
-        cursor.execute('''
-                SELECT t.skeleton_id, count(*)
+    def check_tracing_data(self, project_ids, options) -> Tuple[bool, Dict[str, Any]]:
+        """Check all skeletons of the passed in projects, or of all projects if
+        no project IDs are passed in, in a single pass over the treenode
+        table. Skeleton ID ranges are checked in parallel by multiple
+        processes.
+        """
+        skeleton_ids = None
+        if options['since']:
+            cursor = connection.cursor()
+            cursor.execute("""
+                SELECT t.skeleton_id
                 FROM treenode t
-                WHERE t.parent_id IS NULL
-                  AND t.project_id = %s
-                GROUP BY t.skeleton_id
-                  HAVING count(*) <> 1
-                ''', (project_id,))
-        if cursor.rowcount == 0:
-            self.stdout.write('OK')
+                WHERE t.edition_time >= %(since)s::timestamptz
+                    AND (%(project_ids)s::int[] IS NULL
+                        OR t.project_id = ANY(%(project_ids)s::int[]))
+                UNION
+                SELECT th.skeleton_id
+                FROM treenode__history th
+                WHERE upper(th.sys_period) >= %(since)s::timestamptz
+                    AND (%(project_ids)s::int[] IS NULL
+                        OR th.project_id = ANY(%(project_ids)s::int[]))
+            """, {
+                'since': options['since'],
+                'project_ids': project_ids or None,
+            })
+            skeleton_ids = [row[0] for row in cursor.fetchall()]
+            self.stdout.write(f'Found {len(skeleton_ids)} skeletons with '
+                    f'changes since {options["since"]}')
+
+        self.stdout.write('Check that each skeleton is a single tree with ' +
+                'exactly one root node, no cycles and no parents in other ' +
+                'skeletons...', ending='')
+        start_time = time.time()
+        chunks = get_skeleton_chunks(project_ids, skeleton_ids,
+                options['chunk_size'])
+        tasks = [(project_ids, chunk, options['batch_size']) for chunk in chunks]
+
+        n_skeletons, n_nodes = 0, 0
+        problems:List[Dict[str, Any]] = []
+        def add_result(result):
+            nonlocal n_skeletons, n_nodes
+            n_skeletons += result[0]
+            n_nodes += result[1]
+            problems.extend(result[2])
+
+        n_workers = options['workers']
+        if n_workers > 1 and len(tasks) > 1:
+            # Close all database connections to not share them with the
+            # worker processes. Each worker opens its own connection.
+            connections.close_all()
+            with Pool(n_workers) as pool:
+                for result in pool.imap_unordered(_check_skeleton_chunk, tasks):
+                    add_result(result)
         else:
-            project_passed = False
-            self.stdout.write('')
-            self.stdout.write('FAILED: found %s rows (should be 0)' % cursor.rowcount)
-
-        self.stdout.write('Check that all treenodes in a skeleton are connected to the root node...', ending='')
-        cursor.execute('''
-                SELECT DISTINCT skeleton_id
-                FROM treenode
-                WHERE project_id = %s
-                ''', (project_id,))
-        skeleton_ids = cursor.fetchall()
-        if len(skeleton_ids):
+            for task in tasks:
+                add_result(_check_skeleton_chunk(task))
+
+        problems.sort(key=lambda p: p['skeleton_id'])
+        duration = time.time() - start_time
+        if problems:
             self.stdout.write('')
-        test_passed = True
-        with progressbar.ProgressBar(max_value=len(skeleton_ids), redirect_stdout=True) as pbar:
-            for i, skeleton_id in enumerate(skeleton_ids):
-                pbar.update(i)
-                cursor.execute('''
-                        WITH RECURSIVE nodes (id) AS (
-                          SELECT t.id
-                          FROM treenode t
-                          WHERE t.parent_id IS NULL
-                            AND t.skeleton_id = %s
-                          UNION ALL
-                          SELECT t.id
-                          FROM treenode t
-                          JOIN nodes p ON t.parent_id = p.id)
-                        SELECT t.id, t.skeleton_id
-                        FROM treenode t
-                        WHERE t.skeleton_id = %s
-                          AND NOT EXISTS (SELECT n.id FROM nodes n WHERE n.id = t.id);
-                        ''', (skeleton_id, skeleton_id))
-                if cursor.rowcount:
-                    if test_passed:
-                        self.stdout.write('')
-                    test_passed = False
-                    project_passed = False
-                    row = cursor.fetchone()
-                    self.stdout.write('FAILED: node %s in skeleton %s has no path to root' % row)
-
-        if test_passed:
+            for problem in problems:
+                self.stdout.write(f'FAILED: skeleton {problem["skeleton_id"]}: '
+                        f'{", ".join(problem["errors"])}')
+        else:
             self.stdout.write('OK')
+        self.stdout.write(f'Checked {n_nodes} nodes in {n_skeletons} ' +
+                f'skeletons in {duration:.1f}s')
+
+        return not problems, {
+            'n_skeletons': n_skeletons,
+            'n_nodes': n_nodes,
+            'duration': duration,
+            'problems': problems,
+        }
 
 
     def check_volumes(self, project_id):
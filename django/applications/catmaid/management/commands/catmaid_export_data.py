@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from itertools import chain
+from itertools import chain, islice
 from functools import reduce
-from typing import Dict, List, Optional, Set, DefaultDict
+import json
+from typing import Deque, Dict, Iterator, List, Optional, Set, DefaultDict
 from enum import Enum
 
 from catmaid.control.annotation import (get_annotated_entities,
@@ -17,16 +19,26 @@ from catmaid.models import (Class, ClassInstance, ClassInstanceClassInstance,
         TreenodeClassInstance, TreenodeConnector, User, ReducedInfoUser,
         ExportUser, Volume)
 from catmaid.util import str2bool, str2list
-from django.db import connection
+from django.db import connection, transaction
+from django.db.models import Count, Max, Min, QuerySet
 from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.hashers import make_password
-from .common import set_log_level
+from .common import (EXPORT_COMPRESSION_SUFFIXES, open_export_file,
+        set_log_level)
 
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Fields of exported objects that reference users
+USER_REFERENCE_FIELDS = ('user_id', 'reviewer_id', 'editor_id')
+
+# Models that are written in parallel chunks by the streaming exporter. Their
+# fields don't need any conversion for serialization.
+CHUNKED_EXPORT_MODELS = (Treenode, Connector, TreenodeConnector)
+
 def ask_to_continue():
     """ Return a valid project object.
     """
@@ -47,6 +59,26 @@ def ask_to_continue():
             return c
 
 
+def get_referenced_user_ids(group) -> Set:
+    """Return the IDs of all users referenced by the objects of an export group.
+    Querysets that haven't been evaluated yet are asked in the database, to not
+    load all their objects.
+    """
+    user_ids:Set = set()
+    if isinstance(group, QuerySet) and group._result_cache is None \
+            and not group.query.is_sliced:
+        for field in group.model._meta.concrete_fields:
+            if field.attname in USER_REFERENCE_FIELDS:
+                user_ids.update(group.order_by() \
+                        .values_list(field.attname, flat=True).distinct())
+    else:
+        for o in group:
+            for attname in USER_REFERENCE_FIELDS:
+                if hasattr(o, attname):
+                    user_ids.add(getattr(o, attname))
+    return user_ids
+
+
 class ExportAnnotation(Enum):
     AnnotationsYes = 'export: annotations'
     AnnotationsNo = 'export: no-annotations'
@@ -808,9 +840,11 @@ class Exporter():
 
 
         # Export referenced neurons and skeletons
-        exported_tids:Set = set()
-        if treenodes:
-            treenode_skeleton_ids = set(t.skeleton_id for t in treenodes)
+        # Treenodes are only counted and looked at in the database, to not load
+        # them into memory before serialization.
+        if treenodes is not None and treenodes.exists():
+            treenode_skeleton_ids = set(treenodes.order_by() \
+                    .values_list('skeleton_id', flat=True).distinct())
             n_skeletons = ClassInstance.objects.filter(
                     project=self.project,
                     id__in=treenode_skeleton_ids).count()
@@ -820,8 +854,7 @@ class Exporter():
             n_neuron_links = len(neuron_links)
             neurons = set([link.class_instance_b_id for link in neuron_links])
 
-            exported_tids = set(treenodes.values_list('id', flat=True))
-            logger.info(f"Exporting {len(exported_tids)} treenodes in {n_skeletons} skeletons and {len(neurons)} neurons")
+            logger.info(f"Exporting {treenodes.count()} treenodes in {n_skeletons} skeletons and {len(neurons)} neurons")
 
         # Get current maximum concept ID
         cursor = connection.cursor()
@@ -840,6 +873,10 @@ class Exporter():
                     .filter(project=self.project, connector__in=connector_ids) \
                     .exclude(skeleton_id__in=skeleton_id_constraints))
                 connector_tids = set(c.treenode_id for c in connector_links)
+                exported_tids:Set = set()
+                if treenodes is not None:
+                    exported_tids = set(treenodes.filter(id__in=connector_tids) \
+                            .values_list('id', flat=True))
                 extra_tids = connector_tids - exported_tids
 
                 connector_export_settings = export_settings['connectors']
@@ -987,13 +1024,7 @@ class Exporter():
         seen_user_ids = set()
         # Find users involved in exported data
         for group in self.to_serialize:
-            for o in group:
-                if hasattr(o, 'user_id'):
-                    seen_user_ids.add(o.user_id)
-                if hasattr(o, 'reviewer_id'):
-                    seen_user_ids.add(o.reviewer_id)
-                if hasattr(o, 'editor_id'):
-                    seen_user_ids.add(o.editor_id)
+            seen_user_ids.update(get_referenced_user_ids(group))
         users = [ExportUser(id=u.id, username=u.username, password=u.password,
                 first_name=u.first_name, last_name=u.last_name, email=u.email,
                 date_joined=u.date_joined) \
@@ -1032,6 +1063,164 @@ class Exporter():
             raise CommandError("Unable to serialize database: %s" % e)
 
 
+class StreamingExporter(Exporter):
+    """An exporter that writes objects to the output file while it reads them,
+    keeping memory use independent of the number of exported treenodes.
+    Treenodes, connectors and connector links are queried in chunks of about
+    <chunk_size> rows by a pool of <n_workers> threads, each with its own
+    database connection. All connections share the snapshot of the main
+    transaction, so that the export is consistent. The output can be
+    compressed and treenodes, connectors and links can optionally be written as
+    column blocks rather than individual records. The importer reads both
+    layouts.
+    """
+
+    def __init__(self, project, options):
+        super().__init__(project, options)
+        self.n_workers = max(1, options.get('workers') or 1)
+        self.chunk_size = options.get('chunk_size') or 50000
+        self.compression = options.get('compression')
+        self.columnar = options.get('layout') == 'columnar'
+        self.snapshot:Optional[str] = None
+        if self.compression and not options.get('file'):
+            self.target_file += EXPORT_COMPRESSION_SUFFIXES[self.compression]
+
+    def export(self):
+        try:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                cursor.execute('SELECT pg_export_snapshot()')
+                self.snapshot = cursor.fetchone()[0]
+
+                self.collect_data()
+
+                n_chunks = 0
+                with open_export_file(self.target_file, 'w', self.compression) as out:
+                    out.write('[')
+                    for group in self.to_serialize:
+                        for text in self.serialize_group(group):
+                            if text:
+                                out.write(',\n' if n_chunks else '\n')
+                                out.write(text)
+                                n_chunks += 1
+                    out.write('\n]\n')
+        except Exception as e:
+            if self.show_traceback:
+                raise
+            raise CommandError("Unable to serialize database: %s" % e)
+
+    def serialize_group(self, group) -> Iterator[str]:
+        """Yield the serialized objects of an export group as text chunks.
+        """
+        if isinstance(group, QuerySet) and group._result_cache is None:
+            if group.model in CHUNKED_EXPORT_MODELS:
+                logger.info(f"Exporting {group.model.__name__} objects in chunks")
+                yield from self.serialize_chunks(self.split_queryset(group))
+                return
+            objects = group.iterator(chunk_size=self.chunk_size)
+        else:
+            objects = iter(group)
+
+        while True:
+            chunk = list(islice(objects, self.chunk_size))
+            if not chunk:
+                break
+            yield ',\n'.join(json.dumps(record, cls=DjangoJSONEncoder)
+                    for record in serializers.serialize('python', chunk))
+
+    def split_queryset(self, queryset) -> Iterator[QuerySet]:
+        """Split a queryset of treenodes, connectors or connector links into
+        querysets of about <chunk_size> rows. Models with a skeleton reference
+        are split into sets of whole skeletons, using the skeleton summary for
+        their size, connectors are split into ID ranges.
+        """
+        queryset = queryset.order_by()
+        cursor = connection.cursor()
+        if queryset.model in (Treenode, TreenodeConnector):
+            skeleton_ids = list(queryset.values_list('skeleton_id', flat=True).distinct())
+            cursor.execute("""
+                SELECT q.skeleton_id, COALESCE(css.num_nodes, 1)
+                FROM UNNEST(%(skeleton_ids)s::bigint[]) q(skeleton_id)
+                LEFT JOIN catmaid_skeleton_summary css
+                    ON css.skeleton_id = q.skeleton_id
+                ORDER BY q.skeleton_id
+            """, {
+                'skeleton_ids': skeleton_ids,
+            })
+            chunk_skeleton_ids:List = []
+            chunk_rows = 0
+            for skeleton_id, num_nodes in cursor.fetchall():
+                if chunk_skeleton_ids and chunk_rows + num_nodes > self.chunk_size:
+                    yield queryset.filter(skeleton_id__in=chunk_skeleton_ids)
+                    chunk_skeleton_ids, chunk_rows = [], 0
+                chunk_skeleton_ids.append(skeleton_id)
+                chunk_rows += num_nodes
+            if chunk_skeleton_ids:
+                yield queryset.filter(skeleton_id__in=chunk_skeleton_ids)
+        else:
+            bounds = queryset.aggregate(min_id=Min('id'), max_id=Max('id'),
+                    n_rows=Count('id'))
+            if not bounds['n_rows']:
+                return
+            n_chunks = (bounds['n_rows'] - 1) // self.chunk_size + 1
+            step = (bounds['max_id'] - bounds['min_id']) // n_chunks + 1
+            for start in range(bounds['min_id'], bounds['max_id'] + 1, step):
+                yield queryset.filter(id__gte=start, id__lt=start + step)
+
+    def serialize_chunks(self, querysets:Iterator[QuerySet]) -> Iterator[str]:
+        """Serialize querysets in parallel and yield the results in order. Only
+        a few chunks are in flight at any time.
+        """
+        if self.n_workers == 1:
+            for queryset in querysets:
+                yield self.serialize_rows(queryset)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            pending:Deque[Future] = deque()
+            for queryset in querysets:
+                pending.append(executor.submit(self.serialize_chunk, queryset))
+                if len(pending) >= 2 * self.n_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def serialize_chunk(self, queryset) -> str:
+        """Serialize a queryset from a worker thread, in a transaction that
+        uses the snapshot of the main transaction.
+        """
+        try:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                cursor.execute('SET TRANSACTION SNAPSHOT %(snapshot)s', {
+                    'snapshot': self.snapshot,
+                })
+                return self.serialize_rows(queryset)
+        finally:
+            connection.close()
+
+    def serialize_rows(self, queryset) -> str:
+        model = queryset.model
+        fields = [f for f in model._meta.concrete_fields if f.serialize]
+        names = ['pk'] + [f.name for f in fields]
+        rows = list(queryset.values_list('pk', *[f.attname for f in fields]))
+        if not rows:
+            return ''
+        label = model._meta.label_lower
+        if self.columnar:
+            return json.dumps({
+                'model': label,
+                'columns': dict(zip(names, map(list, zip(*rows)))),
+            }, cls=DjangoJSONEncoder)
+        return ',\n'.join(json.dumps({
+                'model': label,
+                'pk': row[0],
+                'fields': dict(zip(names[1:], row[1:])),
+            }, cls=DjangoJSONEncoder) for row in rows)
+
+
 class ConnectorMode(Enum):
     """The way connector links are handled if they are outside of the current
     set of exported neurons. These can either be all neurons or annotation based
@@ -1115,6 +1304,25 @@ class Command(BaseCommand):
             action='store_true', default=False, help='Whether or not neurons ' +
             'should be excluded if in addition to an exclusion annotation ' +
             'they are also annotated with a required (inclusion) annotation.')
+        parser.add_argument('--streaming', dest='streaming',
+            action='store_true', default=False, help='Write objects to the ' +
+            'output file while reading them, rather than loading all of them ' +
+            'first. Treenodes, connectors and connector links are read in ' +
+            'parallel chunks. Needed for large exports.')
+        parser.add_argument('--workers', dest='workers', type=int, default=4,
+            help='The number of parallel database connections used with ' +
+            '--streaming')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+            default=50000, help='The approximate number of rows read per ' +
+            'query with --streaming')
+        parser.add_argument('--compression', dest='compression', default=None,
+            choices=list(EXPORT_COMPRESSION_SUFFIXES.keys()), help='Compress ' +
+            'the output file with --streaming. Zstandard compression ' +
+            'requires the zstandard library.')
+        parser.add_argument('--layout', dest='layout', default='records',
+            choices=['records', 'columnar'], help='With --streaming, ' +
+            'treenodes, connectors and connector links can be written in a ' +
+            'compact columnar layout, which only the CATMAID importer reads.')
 
     def ask_for_project(self, title):
         """ Return a valid project object.
@@ -1180,7 +1388,13 @@ class Command(BaseCommand):
             logger.info("Excluding skeletons with the following annotation: " +
                   ", ".join(options['excluded_annotations']))
 
-        exporter = Exporter(source, options)
+        if options['streaming']:
+            exporter:Exporter = StreamingExporter(source, options)
+        else:
+            if options['compression'] or options['layout'] != 'records':
+                raise CommandError("Compression and the columnar layout " +
+                        "require --streaming")
+            exporter = Exporter(source, options)
         exporter.export()
 
         logger.info("Finished export, result written to: %s" % exporter.target_file)
@@ -0,0 +1,101 @@
+import json
+import math
+import os
+
+import numpy as np
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from catmaid.control.neuroglancer import (encode_shard, get_encoded_skeletons,
+        get_segment_properties, get_shard_file_name, get_shard_locations,
+        get_sharding_spec, get_skeleton_info)
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = ("Write all skeletons of a project as Neuroglancer precomputed "
+            "skeleton source into a folder, which can be served as static files.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', type=int,
+            required=True, help='The project to export'),
+        parser.add_argument('--output', dest='output', required=True,
+            help='The folder to write the precomputed skeleton source to'),
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=1000, help='The number of skeletons read at once'),
+        parser.add_argument('--sharded', action='store_true', default=False,
+            help='Write skeletons in the sharded format rather than one file per skeleton'),
+        parser.add_argument('--shard-bits', dest='shard_bits', type=int,
+            default=None, help='The number of bits used for shard numbers. '
+            'By default, about 10000 skeletons are stored in each shard.'),
+        parser.add_argument('--minishard-bits', dest='minishard_bits', type=int,
+            default=6, help='The number of bits used for minishard numbers'),
+        parser.add_argument('--gzip', action='store_true', default=False,
+            help='Compress skeletons and minishard indices in shards'),
+        parser.add_argument('--no-bounding-boxes', dest='bounding_boxes',
+            action='store_false', default=True, help='Don\'t add the bounding '
+            'box of each skeleton to the segment properties'),
+
+    def handle(self, *args, **options):
+        project_id = options['project_id']
+        if not Project.objects.filter(id=project_id).exists():
+            raise CommandError(f'Could not find project {project_id}')
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('The batch size needs to be positive')
+        output = options['output']
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT skeleton_id
+            FROM catmaid_skeleton_summary
+            WHERE project_id = %(project_id)s
+                AND num_nodes > 0
+            ORDER BY skeleton_id
+        """, {
+            'project_id': project_id,
+        })
+        skeleton_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+        self.stdout.write(f'Exporting {len(skeleton_ids)} skeletons of project {project_id}')
+
+        os.makedirs(os.path.join(output, 'segment_properties'), exist_ok=True)
+
+        sharding = None
+        if options['sharded']:
+            shard_bits = options['shard_bits']
+            if shard_bits is None:
+                shard_bits = max(0, math.ceil(math.log2(max(len(skeleton_ids), 1) / 10000)))
+            sharding = get_sharding_spec(shard_bits, options['minishard_bits'],
+                    compress=options['gzip'])
+            shards, _ = get_shard_locations(skeleton_ids, sharding)
+            for shard in np.unique(shards):
+                shard_skeleton_ids = skeleton_ids[shards == shard].tolist()
+                chunks = {}
+                for i in range(0, len(shard_skeleton_ids), batch_size):
+                    chunks.update(get_encoded_skeletons(project_id,
+                            shard_skeleton_ids[i:i + batch_size]))
+                with open(os.path.join(output, get_shard_file_name(shard, sharding)), 'wb') as f:
+                    f.write(encode_shard(chunks, sharding))
+                self.stdout.write(f'Wrote shard {get_shard_file_name(shard, sharding)} '
+                        f'with {len(chunks)} skeletons')
+        else:
+            n_written = 0
+            for i in range(0, len(skeleton_ids), batch_size):
+                skeletons = get_encoded_skeletons(project_id,
+                        skeleton_ids[i:i + batch_size].tolist())
+                for skeleton_id, data in skeletons.items():
+                    with open(os.path.join(output, str(skeleton_id)), 'wb') as f:
+                        f.write(data)
+                n_written += len(skeletons)
+                self.stdout.write(f'Wrote {n_written}/{len(skeleton_ids)} skeletons')
+
+        with open(os.path.join(output, 'info'), 'w') as f:
+            json.dump(get_skeleton_info(sharding), f)
+
+        segment_properties = get_segment_properties(project_id,
+                options['bounding_boxes'])
+        with open(os.path.join(output, 'segment_properties', 'info'), 'w') as f:
+            json.dump(segment_properties, f)
+
+        self.stdout.write(self.style.SUCCESS(f'Wrote precomputed skeleton source to {output}'))
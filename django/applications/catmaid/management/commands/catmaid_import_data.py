@@ -4,9 +4,11 @@ from abc import ABC, abstractmethod
 import argparse
 from collections import defaultdict
 import inspect
+import io
 import logging
+import numpy as np
 import progressbar
-from typing import Any, DefaultDict, Dict, List, Set, Type
+from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Set, Tuple, Type
 
 from catmaid.apps import get_system_user
 from catmaid.control.annotationadmin import copy_annotations
@@ -14,13 +16,14 @@ from catmaid.control.edge import rebuild_edge_tables, rebuild_edges_selectively
 import catmaid.models
 from catmaid.models import (Class, ClassClass, ClassInstance,
         ClassInstanceClassInstance, Project, Relation, User, Treenode,
-        Connector, Concept, SkeletonSummary)
+        Connector, Concept, SkeletonSummary, TreenodeConnector)
 from catmaid.util import str2bool
 from django.apps import apps
 from django.core import serializers
 from django.core.management.base import BaseCommand, CommandError
-from django.db import connection, transaction
-from .common import set_log_level
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from .common import iter_export_records, open_export_file, set_log_level
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +34,105 @@ ordered_save_tasks = [Project, User, Class, Relation, ClassClass,
         ClassInstance, ClassInstanceClassInstance, Treenode, Connector]
 
 
+# Models that are written with COPY in bulk-load mode, by their name in Django's
+# serialization format.
+BULK_MODELS = {
+    'catmaid.treenode': Treenode,
+    'catmaid.connector': Connector,
+    'catmaid.treenodeconnector': TreenodeConnector,
+}
+
+# Row level insert triggers that are disabled during a bulk load. The work they
+# would do is repeated for all imported data after the load.
+BULK_LOAD_TRIGGERS = {
+    'connector': ['on_insert_connector_update_connector_geom'],
+    'treenode_connector': ['on_insert_treenode_connector_update_edges',
+            'on_create_treenode_connector_check_review'],
+}
+
+
+def reserve_sequence_range(cursor, sequence:str, n:int) -> int:
+    """Reserve <n> consecutive values of a sequence and return the first one.
+    Values handed out by other sessions between nextval() and setval() would
+    end up in the range, which makes this only safe if nothing else writes to
+    the database, like during maintenance.
+    """
+    cursor.execute("""
+        SELECT setval(%(sequence)s, nextval(%(sequence)s) + %(n)s - 1)
+    """, {
+        'sequence': sequence,
+        'n': n,
+    })
+    return cursor.fetchone()[0] - n + 1
+
+
+class MappedObject(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class BulkImportIds(object):
+    """The import IDs of one type of bulk loaded objects and their new IDs,
+    which are either a consecutive range starting at <first_id> or, if
+    <first_id> is None, the import IDs themselves. Lookups work like the ones in
+    the per-type dictionaries of saved objects: get() returns an object with
+    the new ID.
+    """
+
+    def __init__(self, import_ids, first_id:Optional[int]=None):
+        self.import_ids = np.unique(np.asarray(import_ids, dtype=np.int64))
+        self.first_id = first_id
+
+    def __len__(self) -> int:
+        return len(self.import_ids)
+
+    @property
+    def new_ids(self) -> np.ndarray:
+        if self.first_id is None:
+            return self.import_ids
+        return np.arange(self.first_id, self.first_id + len(self.import_ids),
+                dtype=np.int64)
+
+    def map(self, ids:List) -> List:
+        """Map a list of import IDs, which can contain None, to new IDs. IDs
+        that aren't part of the bulk data are returned unchanged.
+        """
+        if self.first_id is None or not len(self.import_ids):
+            return ids
+        values = np.array([-1 if i is None else i for i in ids], dtype=np.int64)
+        index = np.searchsorted(self.import_ids, values)
+        index[index == len(self.import_ids)] = 0
+        found = self.import_ids[index] == values
+        mapped = np.where(found, self.first_id + index, values).tolist()
+        return [None if i is None else m for i, m in zip(ids, mapped)]
+
+    def get(self, import_id, default=None):
+        index = np.searchsorted(self.import_ids, import_id)
+        if index == len(self.import_ids) or self.import_ids[index] != import_id:
+            return default
+        return MappedObject(int(index) + self.first_id
+                if self.first_id is not None else import_id)
+
+
+class UserReference(object):
+    """Stands in for a model object with a single user reference when the user
+    of bulk loaded rows is mapped.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    @property
+    def user(self):
+        return None
+
+    @user.setter
+    def user(self, user):
+        self.user_id = user.id
+
+
+
 def ask_a_b(a, b, title):
     """Return true if a, False if b.
     """
@@ -356,6 +458,46 @@ class FileImporter(AbstractImporter):
             if hasattr(obj, 'editor_id'):
                 obj.editor = self.user
 
+    def load_import_data(self) -> Tuple[DefaultDict[Any, List], int]:
+        """Read the import file and return its deserialized objects grouped by
+        type, along with the number of read objects.
+        """
+        # Map data types to lists of object of the respective type
+        import_data:DefaultDict[Any, List] = defaultdict(list)
+        n_objects = 0
+
+        # Read the file and sort by type
+        logger.info(f"Loading data from {self.source}")
+        with open_export_file(self.source) as data:
+            loaded_data = serializers.deserialize('python', iter_export_records(data))
+            for deserialized_object in progressbar.progressbar(loaded_data,
+                    max_value=progressbar.UnknownLength, redirect_stdout=True):
+                obj = deserialized_object.object
+                import_data[type(obj)].append(deserialized_object)
+                n_objects += 1
+
+        return import_data, n_objects
+
+    def prepare_bulk_data(self, cursor, import_objects_by_type_and_id,
+            import_users, replacement_users, mapped_user_ids,
+            mapped_user_target_ids, created_users) -> None:
+        """Called before foreign keys of imported objects are updated. Importers
+        that write some of the data in bulk can register the new IDs of these
+        objects in <import_objects_by_type_and_id> here and map their users.
+        """
+        pass
+
+    def import_bulk_data(self, cursor, import_objects_by_type_and_id) -> None:
+        """Called after all other objects have been saved and before ID
+        sequences are reset.
+        """
+        pass
+
+    def get_bulk_connector_ids(self) -> List:
+        """The IDs of all connectors written by import_bulk_data().
+        """
+        return []
+
     @transaction.atomic
     def import_data(self):
         """ Imports data from a file and overrides its properties, if wanted.
@@ -377,19 +519,7 @@ class FileImporter(AbstractImporter):
         mapped_user_ids:Set = set()
         mapped_user_target_ids:Set = set()
 
-        # Map data types to lists of object of the respective type
-        import_data:DefaultDict[Any, List] = defaultdict(list)
-        n_objects = 0
-
-        # Read the file and sort by type
-        logger.info(f"Loading data from {self.source}")
-        with open(self.source, "r") as data:
-            loaded_data = serializers.deserialize(self.format, data)
-            for deserialized_object in progressbar.progressbar(loaded_data,
-                    max_value=progressbar.UnknownLength, redirect_stdout=True):
-                obj = deserialized_object.object
-                import_data[type(obj)].append(deserialized_object)
-                n_objects += 1
+        import_data, n_objects = self.load_import_data()
 
         if n_objects == 0:
             raise CommandError("Nothing to import, no importable data found")
@@ -518,6 +648,10 @@ class FileImporter(AbstractImporter):
                 # Remember for saving
                 objects_to_save[object_type].append(deserialized_object)
 
+        self.prepare_bulk_data(cursor, import_objects_by_type_and_id,
+                import_users, username_mapping, mapped_user_ids,
+                mapped_user_target_ids, created_users)
+
         if len(created_users) > 0:
             logger.info("Created {} new users: {}".format(len(created_users),
                     ", ".join(sorted([u.username for u in created_users.values()]))))
@@ -578,6 +712,8 @@ class FileImporter(AbstractImporter):
                 if deserialized_object.object.username in created_users.keys():
                     deserialized_object.save()
 
+        self.import_bulk_data(cursor, import_objects_by_type_and_id)
+
         # Reset counters to current maximum IDs
         cursor.execute('''
             SELECT setval('concept_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
@@ -648,6 +784,7 @@ class FileImporter(AbstractImporter):
             connectors = objects_to_save.get(Connector)
             if connectors:
                 connector_ids.extend(i.object.id for i in connectors)
+            connector_ids.extend(self.get_bulk_connector_ids())
 
             # Find all skeleton classes both in imported data and existing data.
             skeleton_classes = set()
@@ -692,6 +829,270 @@ class FileImporter(AbstractImporter):
                 logger.info('No skeleton summary table updated needed')
 
 
+class StreamingFileImporter(FileImporter):
+    """A file importer for large imports, which keeps treenodes, connectors and
+    their links out of memory. The file is read twice: the first pass
+    deserializes all other objects and only collects the IDs and users of
+    treenodes, connectors and links. New IDs for them are reserved as
+    consecutive ranges of the respective ID sequences, which makes it possible
+    to write them with COPY in batches in a second pass. Row level insert
+    triggers are disabled during the load and a consistency check and the
+    materialization update run afterwards.
+    """
+
+    def __init__(self, source, target, user, options):
+        super().__init__(source, target, user, options)
+        self.batch_size = options.get('bulk_batch_size') or 50000
+        self.bulk_ids:Dict[Any, BulkImportIds] = dict()
+        self.n_links = 0
+        self.first_link_id:Optional[int] = None
+        self.bulk_user_ids:Set = set()
+        self.user_id_mapping:Dict = dict()
+
+    def load_import_data(self) -> Tuple[DefaultDict[Any, List], int]:
+        import_data:DefaultDict[Any, List] = defaultdict(list)
+        n_objects = 0
+        import_ids:Dict[Any, List] = {Treenode: [], Connector: []}
+
+        logger.info(f"Loading data from {self.source}, treenodes, connectors "
+                "and links are only indexed")
+        with open_export_file(self.source) as data:
+            for record in progressbar.progressbar(iter_export_records(data),
+                    max_value=progressbar.UnknownLength, redirect_stdout=True):
+                n_objects += 1
+                model = BULK_MODELS.get(record['model'])
+                if model is None:
+                    for deserialized_object in serializers.deserialize('python', [record]):
+                        import_data[type(deserialized_object.object)].append(deserialized_object)
+                    continue
+
+                fields = record['fields']
+                self.bulk_user_ids.add(fields['user'])
+                if model == TreenodeConnector:
+                    self.n_links += 1
+                else:
+                    import_ids[model].append(record['pk'])
+                    self.bulk_user_ids.add(fields['editor'])
+
+        for model, ids in import_ids.items():
+            self.bulk_ids[model] = BulkImportIds(ids)
+
+        return import_data, n_objects
+
+    def prepare_bulk_data(self, cursor, import_objects_by_type_and_id,
+            import_users, replacement_users, mapped_user_ids,
+            mapped_user_target_ids, created_users) -> None:
+        # Block writes to the bulk loaded tables until the import transaction
+        # ends, reads are still possible. Other tables remain writable.
+        tables = ', '.join(model._meta.db_table for model in BULK_MODELS.values())
+        cursor.execute(f'LOCK TABLE {tables} IN EXCLUSIVE MODE')
+
+        # Reserve new IDs in append-only mode and make them available to
+        # foreign keys of the other imported objects.
+        if not self.preserve_ids:
+            for model, ids in self.bulk_ids.items():
+                if len(ids):
+                    ids.first_id = reserve_sequence_range(cursor,
+                            'location_id_seq', len(ids))
+                import_objects_by_type_and_id[model] = ids
+            if self.n_links:
+                self.first_link_id = reserve_sequence_range(cursor,
+                        'concept_id_seq', self.n_links)
+        else:
+            for model, ids in self.bulk_ids.items():
+                import_objects_by_type_and_id[model] = ids
+
+        logger.info(f"Mapping {len(self.bulk_user_ids)} users of "
+                f"{len(self.bulk_ids[Treenode])} treenodes, "
+                f"{len(self.bulk_ids[Connector])} connectors and "
+                f"{self.n_links} links")
+        for user_id in self.bulk_user_ids:
+            if self.user:
+                self.user_id_mapping[user_id] = self.user.id
+                continue
+            user_ref = UserReference(user_id)
+            self.map_or_create_users(user_ref, import_users, replacement_users,
+                    mapped_user_ids, mapped_user_target_ids, created_users)
+            self.user_id_mapping[user_id] = user_ref.user_id
+
+    def import_bulk_data(self, cursor, import_objects_by_type_and_id) -> None:
+        classinstance_ids = dict((k, v.id) for k, v in
+                import_objects_by_type_and_id.get(ClassInstance, {}).items())
+        relation_ids = dict((k, v.id) for k, v in
+                import_objects_by_type_and_id.get(Relation, {}).items())
+        project_id = self.target.id
+        user_ids = self.user_id_mapping
+        treenode_ids = self.bulk_ids[Treenode]
+        connector_ids = self.bulk_ids[Connector]
+        now = timezone.now().isoformat()
+        next_link_id = self.first_link_id
+
+        def common_fields(f):
+            return [project_id, user_ids[f['user']],
+                    f.get('creation_time') or now, f.get('edition_time') or now]
+
+        def treenode_rows(records):
+            ids = treenode_ids.map([r['pk'] for r in records])
+            parent_ids = treenode_ids.map([r['fields']['parent'] for r in records])
+            for r, node_id, parent_id in zip(records, ids, parent_ids):
+                f = r['fields']
+                yield [node_id] + common_fields(f) + [user_ids[f['editor']],
+                        f['location_x'], f['location_y'], f['location_z'],
+                        parent_id, f['radius'], f.get('confidence', 5),
+                        classinstance_ids.get(f['skeleton'], f['skeleton'])]
+
+        def connector_rows(records):
+            ids = connector_ids.map([r['pk'] for r in records])
+            for r, connector_id in zip(records, ids):
+                f = r['fields']
+                yield [connector_id] + common_fields(f) + [user_ids[f['editor']],
+                        f['location_x'], f['location_y'], f['location_z'],
+                        f.get('confidence', 5)]
+
+        def link_rows(records):
+            nonlocal next_link_id
+            node_ids = treenode_ids.map([r['fields']['treenode'] for r in records])
+            linked_connector_ids = connector_ids.map([r['fields']['connector'] for r in records])
+            for r, node_id, connector_id in zip(records, node_ids, linked_connector_ids):
+                f = r['fields']
+                if next_link_id is None:
+                    link_id = r['pk']
+                else:
+                    link_id = next_link_id
+                    next_link_id += 1
+                yield [link_id] + common_fields(f) + [
+                        relation_ids.get(f['relation'], f['relation']),
+                        node_id, connector_id,
+                        classinstance_ids.get(f['skeleton'], f['skeleton']),
+                        f.get('confidence', 5)]
+
+        common_columns = ['id', 'project_id', 'user_id', 'creation_time', 'edition_time']
+        tables = {
+            Treenode: ('treenode', common_columns + ['editor_id', 'location_x',
+                    'location_y', 'location_z', 'parent_id', 'radius',
+                    'confidence', 'skeleton_id'], treenode_rows),
+            Connector: ('connector', common_columns + ['editor_id', 'location_x',
+                    'location_y', 'location_z', 'confidence'], connector_rows),
+            TreenodeConnector: ('treenode_connector', common_columns + [
+                    'relation_id', 'treenode_id', 'connector_id', 'skeleton_id',
+                    'confidence'], link_rows),
+        }
+
+        def flush(model, records):
+            table, columns, make_rows = tables[model]
+            buffer = io.StringIO()
+            for row in make_rows(records):
+                buffer.write('\t'.join('\\N' if v is None else str(v) for v in row))
+                buffer.write('\n')
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN",
+                    buffer)
+            records.clear()
+
+        logger.info(f"Writing treenodes, connectors and links in batches of {self.batch_size}")
+        self.set_bulk_load_triggers(cursor, enabled=False)
+        batches:Dict[Any, List] = dict((model, []) for model in tables)
+        with open_export_file(self.source) as data:
+            for record in progressbar.progressbar(iter_export_records(data),
+                    max_value=progressbar.UnknownLength, redirect_stdout=True):
+                model = BULK_MODELS.get(record['model'])
+                if model is None:
+                    continue
+                batch = batches[model]
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    flush(model, batch)
+        for model, batch in batches.items():
+            if batch:
+                flush(model, batch)
+        self.set_bulk_load_triggers(cursor, enabled=True)
+
+        self.check_bulk_data(cursor)
+
+    def set_bulk_load_triggers(self, cursor, enabled:bool) -> None:
+        cursor.execute("""
+            SELECT c.relname, t.tgname
+            FROM pg_trigger t
+            JOIN pg_class c
+                ON c.oid = t.tgrelid
+            WHERE c.relname = ANY(%(tables)s)
+            AND t.tgname = ANY(%(triggers)s)
+        """, {
+            'tables': list(BULK_LOAD_TRIGGERS.keys()),
+            'triggers': [t for triggers in BULK_LOAD_TRIGGERS.values() for t in triggers],
+        })
+        action = 'ENABLE' if enabled else 'DISABLE'
+        for table, trigger in cursor.fetchall():
+            cursor.execute(f'ALTER TABLE {table} {action} TRIGGER {trigger}')
+
+    def check_bulk_data(self, cursor) -> None:
+        """Make sure all bulk loaded rows are stored and reference existing,
+        consistent data.
+        """
+        logger.info("Checking consistency of bulk loaded data")
+        try:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        except IntegrityError as e:
+            raise CommandError(f"Imported data references missing objects: {e}")
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+        # Reserved ranges allow to look only at the imported rows, otherwise
+        # the whole target project is checked.
+        if self.preserve_ids:
+            node_filter = 't.project_id = %(project_id)s'
+            link_filter = 'tc.project_id = %(project_id)s'
+        else:
+            node_filter = 't.id BETWEEN %(first_node)s AND %(last_node)s'
+            link_filter = 'tc.id BETWEEN %(first_link)s AND %(last_link)s'
+        treenode_ids = self.bulk_ids[Treenode]
+        params = {
+            'project_id': self.target.id,
+            'first_node': treenode_ids.first_id or 0,
+            'last_node': (treenode_ids.first_id or 0) + len(treenode_ids) - 1,
+            'first_link': self.first_link_id or 0,
+            'last_link': (self.first_link_id or 0) + self.n_links - 1,
+        }
+
+        problems = []
+        if not self.preserve_ids:
+            cursor.execute(f"""
+                SELECT count(*) FROM treenode t WHERE {node_filter}
+            """, params)
+            n_nodes = cursor.fetchone()[0]
+            if n_nodes != len(treenode_ids):
+                problems.append(f"{n_nodes} of {len(treenode_ids)} treenodes stored")
+
+        cursor.execute(f"""
+            SELECT count(*)
+            FROM treenode t
+            JOIN treenode p
+                ON p.id = t.parent_id
+            WHERE {node_filter}
+            AND p.skeleton_id <> t.skeleton_id
+        """, params)
+        n_bad_parents = cursor.fetchone()[0]
+        if n_bad_parents:
+            problems.append(f"{n_bad_parents} treenodes with a parent in another skeleton")
+
+        cursor.execute(f"""
+            SELECT count(*)
+            FROM treenode_connector tc
+            JOIN treenode t
+                ON t.id = tc.treenode_id
+            WHERE {link_filter}
+            AND t.skeleton_id <> tc.skeleton_id
+        """, params)
+        n_bad_links = cursor.fetchone()[0]
+        if n_bad_links:
+            problems.append(f"{n_bad_links} links with a skeleton other than their treenode's")
+
+        if problems:
+            raise CommandError("Inconsistent import data: " + ", ".join(problems))
+
+    def get_bulk_connector_ids(self) -> List:
+        return self.bulk_ids[Connector].new_ids.tolist()
+
+
 class InternalImporter(AbstractImporter):
     def import_data(self):
         # Process with import
@@ -756,6 +1157,10 @@ class Command(BaseCommand):
                 action='store_true', help='Whether all materializations (edges, summary) of the current project should be updated or only the ones of imported skeletons.')
         parser.add_argument('--update-instance-materializations', dest='update_instance_materializations', default=False,
                 action='store_true', help='Whether all materializations (edges, summary) of this CATMAID instance should be updated. This is faster when a majority of the data changed.')
+        parser.add_argument('--bulk-load', dest='bulk_load', default=False,
+                action='store_true', help='Read treenodes, connectors and their links from the import file in a streaming fashion and write them in batches using COPY. Writes to these tables are blocked until the import is done. New IDs are reserved as sequence ranges, which is only safe without concurrent writers to other tables, this is meant for large imports during maintenance.')
+        parser.add_argument('--bulk-batch-size', dest='bulk_batch_size', default=50000,
+                type=int, help='The number of rows written per COPY batch with --bulk-load')
 
     def ask_for_project(self, title):
         """ Return a valid project object.
@@ -816,8 +1221,12 @@ class Command(BaseCommand):
                 Importer: Type[AbstractImporter] = InternalImporter
             except ValueError:
                 source = options['source']
-                logger.info("Using file importer")
-                Importer = FileImporter
+                if options['bulk_load']:
+                    logger.info("Using streaming file importer")
+                    Importer = StreamingFileImporter
+                else:
+                    logger.info("Using file importer")
+                    Importer = FileImporter
         else:
             source = self.ask_for_project('source')
 
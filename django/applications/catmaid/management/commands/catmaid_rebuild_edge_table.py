@@ -6,7 +6,8 @@ import catmaid
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, transaction
 from catmaid.models import Project
-from catmaid.control.edge import rebuild_edge_tables
+from catmaid.control.edge import (EDGE_REBUILD_CHUNK_SIZE, rebuild_edge_tables,
+        rebuild_edge_tables_chunked)
 
 
 class DryRunRollback(Exception):
@@ -21,8 +22,23 @@ class Command(BaseCommand):
             default=False, help='Don\'t actually apply changes')
         parser.add_argument('--project_id', dest='project_id', nargs='+',
             help='Rebuild edge tables for these projects')
+        parser.add_argument('--chunked', action='store_true', default=False,
+            help='Rebuild the tables in ID ranges that are committed individually, ' \
+                 'rather than in a single transaction. Implied by --jobs, ' \
+                 '--resume and --shadow.')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+            default=EDGE_REBUILD_CHUNK_SIZE,
+            help='The number of source IDs materialized per chunk')
+        parser.add_argument('--jobs', type=int, default=1,
+            help='The number of worker processes that materialize chunks')
+        parser.add_argument('--resume', action='store_true', default=False,
+            help='Continue an interrupted chunked rebuild with the same parameters')
+        parser.add_argument('--shadow', action='store_true', default=False,
+            help='Rebuild each table into a new table, which replaces the ' \
+                 'existing one at the end. Only available for all projects.')
+        parser.add_argument('--table', dest='tables', nargs='+',
+            help='Only rebuild these edge tables in chunked mode')
 
-    @transaction.atomic
     def handle(self, *args, **options):
         project_ids = options['project_id']
         if not project_ids:
@@ -30,6 +46,12 @@ class Command(BaseCommand):
 
         # Check arguments
         dryrun = options['dryrun']
+        chunked = options['chunked'] or options['jobs'] > 1 or \
+                options['resume'] or options['shadow'] or bool(options['tables'])
+
+        if chunked and dryrun:
+            raise CommandError('A chunked rebuild commits each chunk, a dry run '
+                    'isn\'t possible')
 
         if dryrun:
             self.stdout.write('DRY RUN - no changes will be made')
@@ -41,13 +63,25 @@ class Command(BaseCommand):
             self.stdout.write('Canceled on user request')
             return
 
-        try:
+        if chunked:
+            try:
+                rebuild_edge_tables_chunked(project_ids,
+                        chunk_size=options['chunk_size'], n_workers=options['jobs'],
+                        resume=options['resume'], shadow=options['shadow'],
+                        edge_tables=options['tables'],
+                        log=lambda msg: self.stdout.write(msg))
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write('Successfully rebuilt edge tables')
+            return
 
-            rebuild_edge_tables(project_ids, log=lambda msg: self.stdout.write(msg))
+        try:
+            with transaction.atomic():
+                rebuild_edge_tables(project_ids, log=lambda msg: self.stdout.write(msg))
 
-            if dryrun:
-                # For a dry run, cancel the transaction by raising an exception
-                raise DryRunRollback()
+                if dryrun:
+                    # For a dry run, cancel the transaction by raising an exception
+                    raise DryRunRollback()
 
             self.stdout.write('Successfully rebuilt edge tables')
 
@@ -1,7 +1,10 @@
+from collections import defaultdict
+from typing import DefaultDict, Dict
+
 from django.core.management.base import BaseCommand
 from django.db import connection
 
-from catmaid.control.stats import populate_stats_summary
+from catmaid.control.stats import refresh_stats_summary
 from catmaid.models import Project
 
 
@@ -13,6 +16,11 @@ class Command(BaseCommand):
             default=False, help='Remove all existing statistics before recomputation'),
         parser.add_argument('--project_id', dest='project_id', nargs='+',
             default=False, help='Compute only statistics for these projects only (otherwise all)'),
+        parser.add_argument('--workers', dest='workers', type=int, default=4,
+            help='The number of projects that are processed in parallel'),
+        parser.add_argument('--report', action='store_true', dest='report',
+            default=False, help='Print the number of written rows and the '
+            'duration for each project and statistic'),
 
     def handle(self, *args, **options):
         cursor = connection.cursor()
@@ -23,16 +31,30 @@ class Command(BaseCommand):
         else:
             projects = Project.objects.all()
 
-        delete = False
         clean = options['clean']
-        if clean:
-            if project_ids:
-                delete = True
-            else:
-                # Removing statistics for all projects is much faster this way.
-                cursor.execute("TRUNCATE catmaid_stats_summary")
-
-        incremental = not clean
-        for p in projects:
-            populate_stats_summary(p.id, delete, incremental)
-            self.stdout.write(f'Computed statistics for project {p.id}')
+        if clean and not project_ids:
+            # Removing statistics for all projects is much faster this way.
+            cursor.execute("""
+                TRUNCATE catmaid_stats_summary;
+                TRUNCATE catmaid_stats_summary_watermark;
+            """)
+
+        project_ids = list(projects.values_list('id', flat=True))
+        report = refresh_stats_summary(project_ids, clean,
+                max(1, min(options['workers'], len(project_ids))),
+                log=lambda msg: self.stdout.write(msg))
+
+        totals:DefaultDict[str, Dict] = defaultdict(lambda: {'n_rows': 0, 'duration': 0.0})
+        for entry in report:
+            if options['report']:
+                hours = '' if entry['n_hours'] is None else f", {entry['n_hours']} hours"
+                self.stdout.write(f"Project {entry['project_id']}, "
+                        f"{entry['statistic']} ({entry['mode']}{hours}): "
+                        f"{entry['n_rows']} rows, {entry['duration']:.3f} s")
+            total = totals[entry['statistic']]
+            total['n_rows'] += entry['n_rows']
+            total['duration'] += entry['duration']
+
+        for statistic, total in totals.items():
+            self.stdout.write(f"{statistic}: {total['n_rows']} rows, "
+                    f"{total['duration']:.3f} s in {len(project_ids)} projects")
@@ -22,7 +22,9 @@ class Command(BaseCommand):
         parser.add_argument('--cache', dest='cache_type', default="section",
             help='Which type of cache should be used: grid or section'),
         parser.add_argument('--type', dest='data_type', default="msgpack",
-            help='Which type of cache to populate: json, json_text, msgpack'),
+            help='Which type of cache to populate: json, json_text, msgpack. '
+            'Grid caches can store multiple types, provided as comma separated '
+            'list, e.g. "json_text,msgpack".'),
         parser.add_argument('--orientation', dest='orientations', nargs='+',
             default='xy', help='Which orientations should be generated: xy, ' +
             'xz, zy. Only used if a section cache type is used.'),
@@ -150,9 +152,14 @@ class Command(BaseCommand):
             hidden_last_editor_id = user.id
 
         data_type = options['data_type']
+        data_types = data_type.split(',')
 
-        if data_type not in ('json', 'json_text', 'msgpack'):
-            raise CommandError('Type must be one of: json, json_text, msgpack')
+        for dt in data_types:
+            if dt not in ('json', 'json_text', 'msgpack'):
+                raise CommandError('Type must be one of: json, json_text, msgpack')
+
+        if len(data_types) > 1 and cache_type != 'grid':
+            raise CommandError('Multiple types are only supported for grid caches')
 
         cell_width = options['cell_width']
         if cell_width:
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from catmaid.control.review import check_review_summary, rebuild_review_summary
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = "Compare the review summary tables with the reviews and fix " \
+           "mismatches. Optionally, all summary entries can be rebuilt."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            type=int, default=None, help='Check only these projects (otherwise all)')
+        parser.add_argument('--rebuild', action='store_true', default=False,
+            help='Recompute the summary of all skeletons from their reviews')
+        parser.add_argument('--check', action='store_true', default=False,
+            help='Compare the summary with the reviews and recompute the ' \
+                 'summary of all skeletons with mismatches')
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+        project_ids = options['project_id']
+        if project_ids:
+            projects = Project.objects.filter(id__in=project_ids)
+        else:
+            projects = Project.objects.all()
+        project_ids = [p.id for p in projects]
+
+        if not (options['rebuild'] or options['check']):
+            self.stdout.write('Nothing to do, use --check or --rebuild')
+            return
+
+        for project_id in project_ids:
+            with transaction.atomic():
+                if options['rebuild']:
+                    n_skeletons = rebuild_review_summary(project_id, cursor=cursor)
+                    self.stdout.write(f'Rebuilt review summary of {n_skeletons} '
+                            f'skeletons in project {project_id}')
+
+                if options['check']:
+                    mismatches = check_review_summary(project_id, cursor)
+                    if not mismatches:
+                        self.stdout.write(f'Review summary of project {project_id} is consistent')
+                        continue
+                    for m in mismatches:
+                        reviewer = 'all reviewers' if m[1] is None else f'reviewer {m[1]}'
+                        self.stdout.write(f'Skeleton {m[0]} ({reviewer}): '
+                                f'{m[2]} summarized reviewed nodes, {m[3]} reviewed nodes')
+                    skeleton_ids = set(m[0] for m in mismatches)
+                    rebuild_review_summary(project_id, skeleton_ids, cursor)
+                    self.stdout.write(f'Found {len(mismatches)} mismatches in '
+                            f'project {project_id}, rebuilt the summary of '
+                            f'{len(skeleton_ids)} skeletons')
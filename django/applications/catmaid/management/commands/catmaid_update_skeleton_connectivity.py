@@ -0,0 +1,85 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from catmaid.control.connectivity import (SKELETON_CONNECTIVITY_BATCH_SIZE,
+        check_skeleton_connectivity, mark_skeleton_connectivity_dirty,
+        update_dirty_skeleton_connectivity)
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = "Update the skeleton connectivity summary for all skeletons with " \
+           "changed connector links. Optionally, all summary entries can be " \
+           "rebuilt or compared with the connector links."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            type=int, default=None, help='Update only these projects (otherwise all)')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=SKELETON_CONNECTIVITY_BATCH_SIZE,
+            help='The number of skeletons updated in one transaction')
+        parser.add_argument('--rebuild', action='store_true', default=False,
+            help='Mark all skeletons as changed before the update')
+        parser.add_argument('--check', action='store_true', default=False,
+            help='Compare the summary with the connector links after the ' \
+                 'update and mark the skeletons of all mismatches as changed')
+        parser.add_argument('--watch', action='store_true', default=False,
+            help='Keep running and update changed skeletons periodically')
+        parser.add_argument('--delay', type=float, default=5,
+            help='The number of seconds to wait for new changes in watch mode')
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+        project_ids = options['project_id']
+
+        if options['rebuild'] or options['check']:
+            if project_ids:
+                projects = Project.objects.filter(id__in=project_ids)
+            else:
+                projects = Project.objects.all()
+            project_ids = [p.id for p in projects]
+
+        if options['rebuild']:
+            for project_id in project_ids:
+                n_marked = mark_skeleton_connectivity_dirty(project_id, cursor=cursor)
+                self.stdout.write(f'Marked {n_marked} skeletons in project {project_id} as changed')
+
+        self.update(project_ids, options['batch_size'], cursor)
+
+        if options['check']:
+            for project_id in project_ids:
+                mismatches = check_skeleton_connectivity(project_id, cursor=cursor)
+                if not mismatches:
+                    self.stdout.write(f'Summary of project {project_id} is consistent')
+                    continue
+                for m in mismatches:
+                    self.stdout.write(f'Skeleton {m[0]} (relation {m[2]}) to '
+                            f'skeleton {m[1]} (relation {m[3]}), confidence '
+                            f'{m[4]}: {m[5]} summarized links, {m[6]} links')
+                skeleton_ids = set(m[0] for m in mismatches) | set(m[1] for m in mismatches)
+                mark_skeleton_connectivity_dirty(project_id, skeleton_ids, cursor)
+                self.stdout.write(f'Found {len(mismatches)} mismatches in '
+                        f'project {project_id}, marked {len(skeleton_ids)} '
+                        'skeletons as changed')
+            self.update(project_ids, options['batch_size'], cursor)
+
+        while options['watch']:
+            time.sleep(options['delay'])
+            self.update(project_ids, options['batch_size'], cursor)
+
+    def update(self, project_ids, batch_size, cursor):
+        total = 0
+        start = time.time()
+        while True:
+            n_updated = update_dirty_skeleton_connectivity(project_ids,
+                    batch_size, cursor)
+            if not n_updated:
+                break
+            total += n_updated
+
+        if total:
+            duration = time.time() - start
+            self.stdout.write(f'Updated connectivity of {total} skeletons in '
+                    f'{duration:.2f}s')
@@ -1,5 +1,29 @@
-import sys
+import gzip
+import io
+import json
 import logging
+import sys
+from typing import Any, Dict, Iterator, Optional
+
+from django.core.management.base import CommandError
+
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+    logger.info("CATMAID was unable to load the zstandard library, which is an "
+          "optional dependency. Zstandard compressed exports are therefore "
+          "disabled. To enable, install zstandard.")
+
+# Compression methods of export files by their file name suffix
+EXPORT_COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
 
 def set_log_level(logger, verbosity=1):
     """This sets the log level of the passed in logger according to the
@@ -18,3 +42,110 @@ def set_log_level(logger, verbosity=1):
     if verbosity > 2:
         # Enable statements taht reach the root logger.
         logging.getLogger().setLevel(logging.DEBUG)
+
+
+def iter_json_array(stream, chunk_size:int=2**20) -> Iterator[Any]:
+    """Parse the elements of a JSON array from a text stream one at a time,
+    without reading the whole stream into memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    seen_start = False
+    while True:
+        # Skip white space, the array start and separators.
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,[':
+                if buffer[pos] == '[':
+                    if seen_start:
+                        raise ValueError("Nested JSON arrays are not supported")
+                    seen_start = True
+                pos += 1
+            if pos < len(buffer):
+                break
+            buffer, pos = stream.read(chunk_size), 0
+            if not buffer:
+                raise ValueError("Unexpected end of JSON array")
+
+        if not seen_start:
+            raise ValueError("Expected a JSON array")
+        if buffer[pos] == ']':
+            return
+
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                end = None
+            # An element is only complete if a separator or the end of the
+            # array follows, numbers could be cut off otherwise.
+            if end is not None:
+                next_pos = end
+                while next_pos < len(buffer) and buffer[next_pos] in ' \t\r\n':
+                    next_pos += 1
+                if next_pos < len(buffer) and buffer[next_pos] in ',]':
+                    break
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise ValueError("Unexpected end of JSON array")
+            buffer, pos = buffer[pos:] + chunk, 0
+
+        yield element
+        pos = end
+
+
+def guess_export_compression(path:str) -> Optional[str]:
+    """Find the compression of an existing export file by looking at its first
+    bytes. Returns None for uncompressed files.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic[:2] == b'\x1f\x8b':
+        return 'gzip'
+    if magic == b'\x28\xb5\x2f\xfd':
+        return 'zstd'
+    return None
+
+
+def open_export_file(path:str, mode:str='r', compression:Optional[str]=None):
+    """Open an export file as text stream. In read mode, the compression is
+    detected automatically.
+    """
+    if mode == 'r':
+        compression = guess_export_compression(path)
+    if compression == 'gzip':
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if compression == 'zstd':
+        if not zstandard:
+            raise CommandError("Zstandard compression requires the zstandard library")
+        raw = open(path, mode + 'b')
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(raw)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    if compression:
+        raise CommandError(f"Unknown compression: {compression}")
+    return open(path, mode, encoding='utf-8')
+
+
+def iter_export_records(stream) -> Iterator[Dict]:
+    """Read the records of an export file in Django's serialization format one
+    at a time. Column blocks of the compact columnar layout, which look like
+    {"model": <label>, "columns": {"pk": [...], <field>: [...], ...}}, are
+    expanded into individual records.
+    """
+    for element in iter_json_array(stream):
+        columns = element.get('columns')
+        if columns is None:
+            yield element
+            continue
+        model = element['model']
+        names = [name for name in columns.keys() if name != 'pk']
+        values = [columns[name] for name in names]
+        for i, pk in enumerate(columns['pk']):
+            yield {
+                'model': model,
+                'pk': pk,
+                'fields': dict((name, v[i]) for name, v in zip(names, values)),
+            }
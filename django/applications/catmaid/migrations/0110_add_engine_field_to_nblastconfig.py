@@ -0,0 +1,51 @@
+from django.db import migrations, models
+
+
+forward = """
+    SELECT disable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass));
+    SELECT drop_history_view_for_table('nblast_config'::regclass);
+
+    ALTER TABLE nblast_config
+    ADD COLUMN engine text NOT NULL DEFAULT 'r';
+
+    ALTER TABLE nblast_config__history
+    ADD COLUMN engine text;
+
+    SELECT create_history_view_for_table('nblast_config'::regclass);
+    SELECT enable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass), FALSE);
+"""
+
+backward = """
+    SELECT disable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass));
+    SELECT drop_history_view_for_table('nblast_config'::regclass);
+
+    ALTER TABLE nblast_config
+    DROP COLUMN engine;
+
+    ALTER TABLE nblast_config__history
+    DROP COLUMN engine;
+
+    SELECT create_history_view_for_table('nblast_config'::regclass);
+    SELECT enable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass), FALSE);
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0109_paintlabel'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nblastconfig',
+                name='engine',
+                field=models.TextField(default='r',
+                    choices=[('r', 'R (nat.nblast)'), ('native', 'NumPy/SciPy')]),
+            ),
+        ]),
+    ]
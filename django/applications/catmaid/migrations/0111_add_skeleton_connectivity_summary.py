@@ -0,0 +1,141 @@
+from django.db import migrations
+
+
+forward = """
+    -- Number of links between pairs of skeletons, for each pair of link
+    -- relations and the minimum confidence of both links. This table is
+    -- maintained by a worker, which processes the dirty skeleton table below.
+    -- Pairs of different relations are stored only once, with the lower
+    -- relation ID as source relation. Pairs of identical relations are only
+    -- stored for undirected relations, in both directions.
+    CREATE TABLE catmaid_skeleton_connectivity (
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE,
+        source_skeleton_id bigint NOT NULL,
+        target_skeleton_id bigint NOT NULL,
+        source_relation_id bigint NOT NULL,
+        target_relation_id bigint NOT NULL,
+        confidence smallint NOT NULL,
+        n_links integer NOT NULL,
+        PRIMARY KEY (source_skeleton_id, target_skeleton_id,
+            source_relation_id, target_relation_id, confidence)
+    );
+
+    CREATE INDEX catmaid_skeleton_connectivity_target_skeleton_id_idx
+        ON catmaid_skeleton_connectivity (target_skeleton_id);
+
+    -- Skeletons with link changes that aren't yet reflected in the summary
+    -- table. As long as a skeleton is listed here, queries involving it use
+    -- treenode_connector directly. Existing entries are updated rather than
+    -- ignored on conflict, so that invalidations wait for a worker that
+    -- currently processes the skeleton and aren't lost when it removes its
+    -- entry.
+    CREATE TABLE catmaid_skeleton_connectivity_dirty (
+        skeleton_id bigint PRIMARY KEY,
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE,
+        invalidation_time timestamp with time zone DEFAULT now() NOT NULL
+    );
+
+    CREATE OR REPLACE FUNCTION on_insert_treenode_connector_mark_connectivity_dirty() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        INSERT INTO catmaid_skeleton_connectivity_dirty (skeleton_id, project_id)
+        SELECT DISTINCT skeleton_id, project_id
+        FROM inserted_treenode_connector
+        ON CONFLICT (skeleton_id)
+        DO UPDATE SET invalidation_time = EXCLUDED.invalidation_time;
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION on_edit_treenode_connector_mark_connectivity_dirty() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        -- Only changes to the fields that make up the summary matter. The old
+        -- and the new skeleton are both affected by a skeleton change.
+        INSERT INTO catmaid_skeleton_connectivity_dirty (skeleton_id, project_id)
+        SELECT DISTINCT s.skeleton_id, s.project_id
+        FROM old_treenode_connector ot
+        JOIN new_treenode_connector nt
+            ON nt.id = ot.id
+        CROSS JOIN LATERAL (VALUES
+            (ot.skeleton_id, ot.project_id),
+            (nt.skeleton_id, nt.project_id)) s(skeleton_id, project_id)
+        WHERE ot.skeleton_id <> nt.skeleton_id
+           OR ot.connector_id <> nt.connector_id
+           OR ot.relation_id <> nt.relation_id
+           OR ot.confidence <> nt.confidence
+        ON CONFLICT (skeleton_id)
+        DO UPDATE SET invalidation_time = EXCLUDED.invalidation_time;
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION on_delete_treenode_connector_mark_connectivity_dirty() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        INSERT INTO catmaid_skeleton_connectivity_dirty (skeleton_id, project_id)
+        SELECT DISTINCT dt.skeleton_id, dt.project_id
+        FROM deleted_treenode_connector dt
+        -- Deleted projects don't need to be updated anymore.
+        JOIN project p
+            ON p.id = dt.project_id
+        ON CONFLICT (skeleton_id)
+        DO UPDATE SET invalidation_time = EXCLUDED.invalidation_time;
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_insert_treenode_connector_mark_connectivity_dirty
+    AFTER INSERT ON treenode_connector
+    REFERENCING NEW TABLE as inserted_treenode_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_treenode_connector_mark_connectivity_dirty();
+
+    CREATE TRIGGER on_edit_treenode_connector_mark_connectivity_dirty
+    AFTER UPDATE ON treenode_connector
+    REFERENCING NEW TABLE as new_treenode_connector OLD TABLE as old_treenode_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_connector_mark_connectivity_dirty();
+
+    CREATE TRIGGER on_delete_treenode_connector_mark_connectivity_dirty
+    AFTER DELETE ON treenode_connector
+    REFERENCING OLD TABLE as deleted_treenode_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_treenode_connector_mark_connectivity_dirty();
+
+    -- The summary is empty, all skeletons with links start out as dirty and
+    -- are read from treenode_connector until the summary table is updated.
+    INSERT INTO catmaid_skeleton_connectivity_dirty (skeleton_id, project_id)
+    SELECT DISTINCT skeleton_id, project_id
+    FROM treenode_connector;
+"""
+
+backward = """
+    DROP TRIGGER on_insert_treenode_connector_mark_connectivity_dirty ON treenode_connector;
+    DROP TRIGGER on_edit_treenode_connector_mark_connectivity_dirty ON treenode_connector;
+    DROP TRIGGER on_delete_treenode_connector_mark_connectivity_dirty ON treenode_connector;
+
+    DROP FUNCTION on_insert_treenode_connector_mark_connectivity_dirty();
+    DROP FUNCTION on_edit_treenode_connector_mark_connectivity_dirty();
+    DROP FUNCTION on_delete_treenode_connector_mark_connectivity_dirty();
+
+    DROP TABLE catmaid_skeleton_connectivity_dirty;
+    DROP TABLE catmaid_skeleton_connectivity;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a summary table of links between skeletons, which connectivity
+    queries can use instead of joining treenode_connector with itself.
+    """
+
+    dependencies = [
+        ('catmaid', '0110_add_engine_field_to_nblastconfig'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+forward = """
+    -- For each project and statistic of the statistics summary table, the
+    -- point in time until which all changes are reflected in the summary.
+    CREATE TABLE catmaid_stats_summary_watermark (
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE,
+        statistic text NOT NULL,
+        watermark timestamp with time zone NOT NULL,
+        PRIMARY KEY (project_id, statistic)
+    );
+"""
+
+backward = """
+    DROP TABLE catmaid_stats_summary_watermark;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a table of watermarks for incremental updates of the statistics
+    summary.
+    """
+
+    dependencies = [
+        ('catmaid', '0111_add_skeleton_connectivity_summary'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
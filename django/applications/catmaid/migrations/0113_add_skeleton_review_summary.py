@@ -0,0 +1,276 @@
+from django.db import migrations
+
+
+# The summary tables count distinct reviewed nodes, because the same reviewer
+# can review a node more than once. A change of review rows is applied as a
+# delta: for each changed combination of skeleton, reviewer and node (and of
+# skeleton and node for the union), it is checked whether a matching review
+# existed before the change (a review that wasn't added by the statement or a
+# removed one) and whether one exists after it. Updates remove the old and add
+# the new version of a row. The first and last review times are only extended,
+# removing reviews doesn't shrink them. They are therefore bounds of the actual
+# review times.
+update_summary_template = """
+    CREATE OR REPLACE FUNCTION {name}() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        WITH added AS (
+            SELECT id, project_id, skeleton_id, reviewer_id, treenode_id, review_time
+            FROM {added}
+        ),
+        removed AS (
+            SELECT id, project_id, skeleton_id, reviewer_id, treenode_id, review_time
+            FROM {removed}
+        ),
+        changed AS (
+            SELECT project_id, skeleton_id, reviewer_id, treenode_id FROM added
+            UNION
+            SELECT project_id, skeleton_id, reviewer_id, treenode_id FROM removed
+        ),
+        reviewed_after AS (
+            SELECT DISTINCT c.skeleton_id, c.reviewer_id, c.treenode_id
+            FROM changed c
+            JOIN review r
+                ON r.treenode_id = c.treenode_id
+                AND r.skeleton_id = c.skeleton_id
+                AND r.reviewer_id = c.reviewer_id
+        ),
+        reviewed_before AS (
+            SELECT c.skeleton_id, c.reviewer_id, c.treenode_id
+            FROM changed c
+            JOIN review r
+                ON r.treenode_id = c.treenode_id
+                AND r.skeleton_id = c.skeleton_id
+                AND r.reviewer_id = c.reviewer_id
+            LEFT JOIN added a
+                ON a.id = r.id
+            WHERE a.id IS NULL
+            UNION
+            SELECT skeleton_id, reviewer_id, treenode_id FROM removed
+        ),
+        reviewer_delta AS (
+            SELECT c.project_id, c.skeleton_id, c.reviewer_id,
+                COUNT(ra.treenode_id) - COUNT(rb.treenode_id) AS n_reviewed_nodes,
+                MIN(t.first_review_time) AS first_review_time,
+                MAX(t.last_review_time) AS last_review_time
+            FROM changed c
+            LEFT JOIN reviewed_after ra
+                USING (skeleton_id, reviewer_id, treenode_id)
+            LEFT JOIN reviewed_before rb
+                USING (skeleton_id, reviewer_id, treenode_id)
+            LEFT JOIN (
+                SELECT skeleton_id, reviewer_id,
+                    MIN(review_time) AS first_review_time,
+                    MAX(review_time) AS last_review_time
+                FROM added
+                GROUP BY skeleton_id, reviewer_id
+            ) t
+                USING (skeleton_id, reviewer_id)
+            GROUP BY c.project_id, c.skeleton_id, c.reviewer_id
+        ),
+        changed_node AS (
+            SELECT DISTINCT project_id, skeleton_id, treenode_id
+            FROM changed
+        ),
+        node_reviewed_after AS (
+            SELECT DISTINCT c.skeleton_id, c.treenode_id
+            FROM changed_node c
+            JOIN review r
+                ON r.treenode_id = c.treenode_id
+                AND r.skeleton_id = c.skeleton_id
+        ),
+        node_reviewed_before AS (
+            SELECT c.skeleton_id, c.treenode_id
+            FROM changed_node c
+            JOIN review r
+                ON r.treenode_id = c.treenode_id
+                AND r.skeleton_id = c.skeleton_id
+            LEFT JOIN added a
+                ON a.id = r.id
+            WHERE a.id IS NULL
+            UNION
+            SELECT skeleton_id, treenode_id FROM removed
+        ),
+        skeleton_delta AS (
+            SELECT c.project_id, c.skeleton_id,
+                COUNT(ra.treenode_id) - COUNT(rb.treenode_id) AS n_reviewed_nodes,
+                MAX(t.last_review_time) AS last_review_time
+            FROM changed_node c
+            LEFT JOIN node_reviewed_after ra
+                USING (skeleton_id, treenode_id)
+            LEFT JOIN node_reviewed_before rb
+                USING (skeleton_id, treenode_id)
+            LEFT JOIN (
+                SELECT skeleton_id, MAX(review_time) AS last_review_time
+                FROM added
+                GROUP BY skeleton_id
+            ) t
+                USING (skeleton_id)
+            GROUP BY c.project_id, c.skeleton_id
+        ),
+        -- Only combinations with added reviews can be new, all others are
+        -- updated in place.
+        upserted_reviewer_summary AS (
+            INSERT INTO catmaid_skeleton_reviewer_summary AS s (project_id,
+                skeleton_id, reviewer_id, n_reviewed_nodes, first_review_time,
+                last_review_time)
+            SELECT project_id, skeleton_id, reviewer_id, n_reviewed_nodes,
+                first_review_time, last_review_time
+            FROM reviewer_delta
+            WHERE first_review_time IS NOT NULL
+            ON CONFLICT (skeleton_id, reviewer_id) DO UPDATE
+            SET n_reviewed_nodes = s.n_reviewed_nodes + EXCLUDED.n_reviewed_nodes,
+                first_review_time = LEAST(s.first_review_time, EXCLUDED.first_review_time),
+                last_review_time = GREATEST(s.last_review_time, EXCLUDED.last_review_time)
+        ),
+        updated_reviewer_summary AS (
+            UPDATE catmaid_skeleton_reviewer_summary s
+            SET n_reviewed_nodes = s.n_reviewed_nodes + d.n_reviewed_nodes
+            FROM reviewer_delta d
+            WHERE d.first_review_time IS NULL
+                AND d.n_reviewed_nodes <> 0
+                AND s.skeleton_id = d.skeleton_id
+                AND s.reviewer_id = d.reviewer_id
+        ),
+        upserted_skeleton_summary AS (
+            INSERT INTO catmaid_skeleton_review_summary AS s (project_id,
+                skeleton_id, n_reviewed_nodes, last_review_time)
+            SELECT project_id, skeleton_id, n_reviewed_nodes, last_review_time
+            FROM skeleton_delta
+            WHERE last_review_time IS NOT NULL
+            ON CONFLICT (skeleton_id) DO UPDATE
+            SET n_reviewed_nodes = s.n_reviewed_nodes + EXCLUDED.n_reviewed_nodes,
+                last_review_time = GREATEST(s.last_review_time, EXCLUDED.last_review_time)
+        )
+        UPDATE catmaid_skeleton_review_summary s
+        SET n_reviewed_nodes = s.n_reviewed_nodes + d.n_reviewed_nodes
+        FROM skeleton_delta d
+        WHERE d.last_review_time IS NULL
+            AND d.n_reviewed_nodes <> 0
+            AND s.skeleton_id = d.skeleton_id;
+
+        -- Remove entries without reviewed nodes. They can only be the result
+        -- of removed reviews.
+        DELETE FROM catmaid_skeleton_reviewer_summary s
+        USING (SELECT DISTINCT skeleton_id, reviewer_id FROM {removed}) r
+        WHERE s.skeleton_id = r.skeleton_id
+            AND s.reviewer_id = r.reviewer_id
+            AND s.n_reviewed_nodes <= 0;
+
+        DELETE FROM catmaid_skeleton_review_summary s
+        USING (SELECT DISTINCT skeleton_id FROM {removed}) r
+        WHERE s.skeleton_id = r.skeleton_id
+            AND s.n_reviewed_nodes <= 0;
+
+        RETURN NULL;
+    END;
+    $$;
+"""
+
+forward = """
+    -- The number of distinct nodes of a skeleton reviewed by a particular
+    -- reviewer, along with the first and last review time of this reviewer on
+    -- this skeleton.
+    CREATE TABLE catmaid_skeleton_reviewer_summary (
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE,
+        skeleton_id bigint NOT NULL,
+        reviewer_id integer NOT NULL,
+        n_reviewed_nodes integer NOT NULL,
+        first_review_time timestamp with time zone NOT NULL,
+        last_review_time timestamp with time zone NOT NULL,
+        PRIMARY KEY (skeleton_id, reviewer_id)
+    );
+
+    -- The number of distinct nodes of a skeleton reviewed by any reviewer.
+    -- This can't be derived from the table above, because nodes can be
+    -- reviewed by multiple reviewers.
+    CREATE TABLE catmaid_skeleton_review_summary (
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE,
+        skeleton_id bigint PRIMARY KEY,
+        n_reviewed_nodes integer NOT NULL,
+        last_review_time timestamp with time zone NOT NULL
+    );
+""" + update_summary_template.format(name='on_insert_review_update_summary',
+        added='inserted_review', removed='inserted_review WHERE FALSE') + \
+    update_summary_template.format(name='on_edit_review_update_summary',
+        added='new_review', removed='old_review') + \
+    update_summary_template.format(name='on_delete_review_update_summary',
+        added='deleted_review WHERE FALSE', removed='deleted_review') + """
+
+    CREATE OR REPLACE FUNCTION on_truncate_review_update_summary() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        TRUNCATE catmaid_skeleton_reviewer_summary;
+        TRUNCATE catmaid_skeleton_review_summary;
+        RETURN NULL;
+    END;
+    $$;
+
+    -- Changes of the skeleton of treenodes are applied to the review table
+    -- explicitly and deleted treenodes delete their reviews. Triggers on the
+    -- review table are therefore enough to keep the summary up to date.
+    CREATE TRIGGER on_insert_review_update_summary
+    AFTER INSERT ON review
+    REFERENCING NEW TABLE as inserted_review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_review_update_summary();
+
+    CREATE TRIGGER on_edit_review_update_summary
+    AFTER UPDATE ON review
+    REFERENCING NEW TABLE as new_review OLD TABLE as old_review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_review_update_summary();
+
+    CREATE TRIGGER on_delete_review_update_summary
+    AFTER DELETE ON review
+    REFERENCING OLD TABLE as deleted_review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_review_update_summary();
+
+    CREATE TRIGGER on_truncate_review_update_summary
+    AFTER TRUNCATE ON review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_truncate_review_update_summary();
+
+    INSERT INTO catmaid_skeleton_reviewer_summary (project_id, skeleton_id,
+        reviewer_id, n_reviewed_nodes, first_review_time, last_review_time)
+    SELECT project_id, skeleton_id, reviewer_id, COUNT(DISTINCT treenode_id),
+        MIN(review_time), MAX(review_time)
+    FROM review
+    GROUP BY project_id, skeleton_id, reviewer_id;
+
+    INSERT INTO catmaid_skeleton_review_summary (project_id, skeleton_id,
+        n_reviewed_nodes, last_review_time)
+    SELECT project_id, skeleton_id, COUNT(DISTINCT treenode_id),
+        MAX(review_time)
+    FROM review
+    GROUP BY project_id, skeleton_id;
+"""
+
+backward = """
+    DROP TRIGGER on_insert_review_update_summary ON review;
+    DROP TRIGGER on_edit_review_update_summary ON review;
+    DROP TRIGGER on_delete_review_update_summary ON review;
+    DROP TRIGGER on_truncate_review_update_summary ON review;
+
+    DROP FUNCTION on_insert_review_update_summary();
+    DROP FUNCTION on_edit_review_update_summary();
+    DROP FUNCTION on_delete_review_update_summary();
+    DROP FUNCTION on_truncate_review_update_summary();
+
+    DROP TABLE catmaid_skeleton_review_summary;
+    DROP TABLE catmaid_skeleton_reviewer_summary;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add summary tables of the number of reviewed nodes per skeleton and
+    reviewer and per skeleton, which review status queries can use instead
+    of counting reviews.
+    """
+
+    dependencies = [
+        ('catmaid', '0112_add_stats_summary_watermarks'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
@@ -0,0 +1,64 @@
+from django.db import migrations, models
+
+
+forward = """
+    SELECT disable_history_tracking_for_table('pointcloud'::regclass,
+            get_history_table_name('pointcloud'::regclass));
+    SELECT drop_history_view_for_table('pointcloud'::regclass);
+
+    -- Points of a point cloud can alternatively be stored as packed array of
+    -- little-endian float32 X, Y and Z values, i.e. 12 bytes per point.
+    ALTER TABLE pointcloud
+    ADD COLUMN point_data bytea;
+
+    ALTER TABLE pointcloud
+    ADD CONSTRAINT pointcloud_point_data_length_check
+    CHECK (octet_length(point_data) % 12 = 0);
+
+    -- Keep point data uncompressed, so that samples of it can be read without
+    -- reading the whole array.
+    ALTER TABLE pointcloud
+    ALTER COLUMN point_data SET STORAGE EXTERNAL;
+
+    ALTER TABLE pointcloud__history
+    ADD COLUMN point_data bytea;
+
+    SELECT create_history_view_for_table('pointcloud'::regclass);
+    SELECT enable_history_tracking_for_table('pointcloud'::regclass,
+            get_history_table_name('pointcloud'::regclass), FALSE);
+"""
+
+backward = """
+    SELECT disable_history_tracking_for_table('pointcloud'::regclass,
+            get_history_table_name('pointcloud'::regclass));
+    SELECT drop_history_view_for_table('pointcloud'::regclass);
+
+    ALTER TABLE pointcloud
+    DROP COLUMN point_data;
+
+    ALTER TABLE pointcloud__history
+    DROP COLUMN point_data;
+
+    SELECT create_history_view_for_table('pointcloud'::regclass);
+    SELECT enable_history_tracking_for_table('pointcloud'::regclass,
+            get_history_table_name('pointcloud'::regclass), FALSE);
+"""
+
+
+class Migration(migrations.Migration):
+    """Add an optional packed binary representation of point cloud points.
+    """
+
+    dependencies = [
+        ('catmaid', '0113_add_skeleton_review_summary'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='pointcloud',
+                name='point_data',
+                field=models.BinaryField(null=True),
+            ),
+        ]),
+    ]
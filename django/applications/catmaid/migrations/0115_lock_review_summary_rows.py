@@ -0,0 +1,238 @@
+from django.db import migrations
+
+
+# Statement level triggers of concurrent transactions don't see each other's
+# reviews. If two transactions review the same node at the same time, both
+# count it as newly reviewed. To prevent this, the skeleton summary rows of
+# all changed skeletons are created if needed and locked first, in the order
+# of their skeleton IDs to avoid deadlocks. Concurrent review changes of the
+# same skeleton therefore wait for each other and, because each statement of
+# a trigger function sees all changes committed before it starts, the
+# following delta computation sees the reviews of the other transaction.
+lock_summary = """
+        INSERT INTO catmaid_skeleton_review_summary (project_id, skeleton_id,
+            n_reviewed_nodes, last_review_time)
+        SELECT project_id, skeleton_id, 0, MAX(review_time)
+        FROM (
+            SELECT project_id, skeleton_id, review_time FROM {added}
+            UNION ALL
+            SELECT project_id, skeleton_id, review_time FROM {removed}
+        ) changed
+        GROUP BY project_id, skeleton_id
+        ORDER BY skeleton_id
+        ON CONFLICT (skeleton_id) DO NOTHING;
+
+        PERFORM 1
+        FROM catmaid_skeleton_review_summary s
+        WHERE s.skeleton_id IN (
+            SELECT skeleton_id FROM {added}
+            UNION
+            SELECT skeleton_id FROM {removed}
+        )
+        ORDER BY s.skeleton_id
+        FOR UPDATE;
+"""
+
+changed_skeletons = """
+            SELECT skeleton_id FROM {added}
+            UNION
+            SELECT skeleton_id FROM {removed}
+        """
+
+update_summary_template = """
+    CREATE OR REPLACE FUNCTION {name}() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN{lock_summary}
+        WITH added AS (
+            SELECT id, project_id, skeleton_id, reviewer_id, treenode_id, review_time
+            FROM {added}
+        ),
+        removed AS (
+            SELECT id, project_id, skeleton_id, reviewer_id, treenode_id, review_time
+            FROM {removed}
+        ),
+        changed AS (
+            SELECT project_id, skeleton_id, reviewer_id, treenode_id FROM added
+            UNION
+            SELECT project_id, skeleton_id, reviewer_id, treenode_id FROM removed
+        ),
+        reviewed_after AS (
+            SELECT DISTINCT c.skeleton_id, c.reviewer_id, c.treenode_id
+            FROM changed c
+            JOIN review r
+                ON r.treenode_id = c.treenode_id
+                AND r.skeleton_id = c.skeleton_id
+                AND r.reviewer_id = c.reviewer_id
+        ),
+        reviewed_before AS (
+            SELECT c.skeleton_id, c.reviewer_id, c.treenode_id
+            FROM changed c
+            JOIN review r
+                ON r.treenode_id = c.treenode_id
+                AND r.skeleton_id = c.skeleton_id
+                AND r.reviewer_id = c.reviewer_id
+            LEFT JOIN added a
+                ON a.id = r.id
+            WHERE a.id IS NULL
+            UNION
+            SELECT skeleton_id, reviewer_id, treenode_id FROM removed
+        ),
+        reviewer_delta AS (
+            SELECT c.project_id, c.skeleton_id, c.reviewer_id,
+                COUNT(ra.treenode_id) - COUNT(rb.treenode_id) AS n_reviewed_nodes,
+                MIN(t.first_review_time) AS first_review_time,
+                MAX(t.last_review_time) AS last_review_time
+            FROM changed c
+            LEFT JOIN reviewed_after ra
+                USING (skeleton_id, reviewer_id, treenode_id)
+            LEFT JOIN reviewed_before rb
+                USING (skeleton_id, reviewer_id, treenode_id)
+            LEFT JOIN (
+                SELECT skeleton_id, reviewer_id,
+                    MIN(review_time) AS first_review_time,
+                    MAX(review_time) AS last_review_time
+                FROM added
+                GROUP BY skeleton_id, reviewer_id
+            ) t
+                USING (skeleton_id, reviewer_id)
+            GROUP BY c.project_id, c.skeleton_id, c.reviewer_id
+        ),
+        changed_node AS (
+            SELECT DISTINCT project_id, skeleton_id, treenode_id
+            FROM changed
+        ),
+        node_reviewed_after AS (
+            SELECT DISTINCT c.skeleton_id, c.treenode_id
+            FROM changed_node c
+            JOIN review r
+                ON r.treenode_id = c.treenode_id
+                AND r.skeleton_id = c.skeleton_id
+        ),
+        node_reviewed_before AS (
+            SELECT c.skeleton_id, c.treenode_id
+            FROM changed_node c
+            JOIN review r
+                ON r.treenode_id = c.treenode_id
+                AND r.skeleton_id = c.skeleton_id
+            LEFT JOIN added a
+                ON a.id = r.id
+            WHERE a.id IS NULL
+            UNION
+            SELECT skeleton_id, treenode_id FROM removed
+        ),
+        skeleton_delta AS (
+            SELECT c.project_id, c.skeleton_id,
+                COUNT(ra.treenode_id) - COUNT(rb.treenode_id) AS n_reviewed_nodes,
+                MAX(t.last_review_time) AS last_review_time
+            FROM changed_node c
+            LEFT JOIN node_reviewed_after ra
+                USING (skeleton_id, treenode_id)
+            LEFT JOIN node_reviewed_before rb
+                USING (skeleton_id, treenode_id)
+            LEFT JOIN (
+                SELECT skeleton_id, MAX(review_time) AS last_review_time
+                FROM added
+                GROUP BY skeleton_id
+            ) t
+                USING (skeleton_id)
+            GROUP BY c.project_id, c.skeleton_id
+        ),
+        -- Only combinations with added reviews can be new, all others are
+        -- updated in place.
+        upserted_reviewer_summary AS (
+            INSERT INTO catmaid_skeleton_reviewer_summary AS s (project_id,
+                skeleton_id, reviewer_id, n_reviewed_nodes, first_review_time,
+                last_review_time)
+            SELECT project_id, skeleton_id, reviewer_id, n_reviewed_nodes,
+                first_review_time, last_review_time
+            FROM reviewer_delta
+            WHERE first_review_time IS NOT NULL
+            ON CONFLICT (skeleton_id, reviewer_id) DO UPDATE
+            SET n_reviewed_nodes = s.n_reviewed_nodes + EXCLUDED.n_reviewed_nodes,
+                first_review_time = LEAST(s.first_review_time, EXCLUDED.first_review_time),
+                last_review_time = GREATEST(s.last_review_time, EXCLUDED.last_review_time)
+        ),
+        updated_reviewer_summary AS (
+            UPDATE catmaid_skeleton_reviewer_summary s
+            SET n_reviewed_nodes = s.n_reviewed_nodes + d.n_reviewed_nodes
+            FROM reviewer_delta d
+            WHERE d.first_review_time IS NULL
+                AND d.n_reviewed_nodes <> 0
+                AND s.skeleton_id = d.skeleton_id
+                AND s.reviewer_id = d.reviewer_id
+        ),
+        upserted_skeleton_summary AS (
+            INSERT INTO catmaid_skeleton_review_summary AS s (project_id,
+                skeleton_id, n_reviewed_nodes, last_review_time)
+            SELECT project_id, skeleton_id, n_reviewed_nodes, last_review_time
+            FROM skeleton_delta
+            WHERE last_review_time IS NOT NULL
+            ON CONFLICT (skeleton_id) DO UPDATE
+            SET n_reviewed_nodes = s.n_reviewed_nodes + EXCLUDED.n_reviewed_nodes,
+                last_review_time = GREATEST(s.last_review_time, EXCLUDED.last_review_time)
+        )
+        UPDATE catmaid_skeleton_review_summary s
+        SET n_reviewed_nodes = s.n_reviewed_nodes + d.n_reviewed_nodes
+        FROM skeleton_delta d
+        WHERE d.last_review_time IS NULL
+            AND d.n_reviewed_nodes <> 0
+            AND s.skeleton_id = d.skeleton_id;
+
+        -- Remove entries without reviewed nodes. They are the result of
+        -- removed reviews or of locked rows that weren't needed.
+        DELETE FROM catmaid_skeleton_reviewer_summary s
+        USING (SELECT DISTINCT skeleton_id, reviewer_id FROM {removed}) r
+        WHERE s.skeleton_id = r.skeleton_id
+            AND s.reviewer_id = r.reviewer_id
+            AND s.n_reviewed_nodes <= 0;
+
+        DELETE FROM catmaid_skeleton_review_summary s
+        USING ({cleanup_skeletons}) r
+        WHERE s.skeleton_id = r.skeleton_id
+            AND s.n_reviewed_nodes <= 0;
+
+        RETURN NULL;
+    END;
+    $$;
+"""
+
+
+def make_update_functions(lock) -> str:
+    """Create the insert, update and delete trigger functions of the review
+    summary, optionally with locking of the changed summary rows.
+    """
+    functions = []
+    for name, added, removed in (
+            ('on_insert_review_update_summary', 'inserted_review', 'inserted_review WHERE FALSE'),
+            ('on_edit_review_update_summary', 'new_review', 'old_review'),
+            ('on_delete_review_update_summary', 'deleted_review WHERE FALSE', 'deleted_review')):
+        if lock:
+            lock_sql = lock_summary.format(added=added, removed=removed)
+            cleanup_skeletons = changed_skeletons.format(added=added, removed=removed)
+        else:
+            lock_sql = ''
+            cleanup_skeletons = f'SELECT DISTINCT skeleton_id FROM {removed}'
+        functions.append(update_summary_template.format(name=name,
+                added=added, removed=removed, lock_summary=lock_sql,
+                cleanup_skeletons=cleanup_skeletons))
+    return ''.join(functions)
+
+
+forward = make_update_functions(lock=True)
+
+backward = make_update_functions(lock=False)
+
+
+class Migration(migrations.Migration):
+    """Lock the review summary rows of changed skeletons in the review
+    triggers, so that concurrent reviews of the same node are counted once.
+    """
+
+    dependencies = [
+        ('catmaid', '0114_add_pointcloud_point_data'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+
+forward = """
+    -- Chunks of chunked edge table rebuilds that are materialized already.
+    -- Each chunk is recorded in the same transaction that materializes it,
+    -- along with the transaction ID horizon of its snapshot.
+    CREATE TABLE catmaid_edge_rebuild_progress (
+        edge_table text NOT NULL,
+        scope text NOT NULL,
+        chunk_start bigint NOT NULL,
+        chunk_end bigint NOT NULL,
+        n_rows bigint NOT NULL,
+        snapshot_xmin bigint NOT NULL,
+        PRIMARY KEY (edge_table, scope, chunk_start)
+    );
+"""
+
+backward = """
+    DROP TABLE catmaid_edge_rebuild_progress;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a table to keep track of the progress of chunked edge table
+    rebuilds, so that interrupted rebuilds can be resumed.
+    """
+
+    dependencies = [
+        ('catmaid', '0115_lock_review_summary_rows'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
@@ -1006,6 +1006,7 @@ class StackGroupClassInstance(models.Model):
 NblastConfigDefaultDotBreaks = list(n/10 for n in range(11))
 NblastConfigDefaultDistanceBreaks = (0, 0.75, 1.5, 2, 2.5, 3, 3.5, 4, 5, 6, 7,
         8, 9, 10, 12, 14, 16, 20, 25, 30, 40, 500)
+NblastEngineChoices = [('r', 'R (nat.nblast)'), ('native', 'NumPy/SciPy')]
 
 
 class PointSet(NonCascadingUserFocusedModel):
@@ -1062,6 +1063,9 @@ class NblastConfig(NonCascadingUserFocusedModel):
     scoring = ArrayField(ArrayField(models.FloatField()))
     resample_step = models.FloatField(default=1000)
     tangent_neighbors = models.IntegerField(default=5)
+    # Whether similarities are computed with R or the NumPy/SciPy
+    # implementation.
+    engine = models.TextField(default='r', choices=NblastEngineChoices)
 
 
     class Meta:
@@ -1127,9 +1131,11 @@ class PointCloud(NonCascadingUserFocusedModel):
     description = models.TextField(default="")
     source_path = models.TextField(default="")
     images = models.ManyToManyField("ImageData", through='PointCloudImageData')
-    # Points are stored in an array of the format [X, Y, Z, X, Y, Z, …]. A
+    # Points are either linked individually or stored in a packed array of
+    # little-endian float32 values in the format [X, Y, Z, X, Y, Z, …]. A
     # length divisible by three is enforced by the database.
     points = models.ManyToManyField("Point", through='PointCloudPoint')
+    point_data = models.BinaryField(null=True)
 
     def num_permissions(self) -> int:
         n_user_perms = PointCloudUserObjectPermission.objects.filter(content_object=self).count()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from catmaid.control.project import validate_project_setup
+from catmaid.models import (ClassInstance, ClassInstanceClassInstance,
+        PointClassInstance, Treenode)
+
+from .common import CatmaidApiTestCase
+
+
+class LandmarksApiTests(CatmaidApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        validate_project_setup(self.test_project_id, self.test_user_id, fix=True)
+
+    def get_group_locations(self, group_id):
+        return sorted(PointClassInstance.objects.filter(
+                class_instance_id=group_id).values_list('point__location_x',
+                'point__location_y', 'point__location_z'))
+
+    def test_materialize_landmark_groups(self):
+        self.fake_authentication()
+        landmarks = [
+            ['L1', 1, 2, 3, 10, 20, 30],
+            ['L2', 4, 5, 6, 40, 50, 60],
+            # Only the first definition of a landmark is used
+            ['L1', 7, 8, 9, 70, 80, 90],
+        ]
+        data = {
+            'group_a_name': 'Group A',
+            'group_b_name': 'Group B',
+        }
+        for i, landmark in enumerate(landmarks):
+            for j, value in enumerate(landmark):
+                data[f'landmarks[{i}][{j}]'] = value
+        response = self.client.post(f'/{self.test_project_id}/landmarks/groups/materialize',
+                data)
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(parsed_response['created_landmarks'], 2)
+        self.assertEqual(parsed_response['created_locations'], 4)
+        self.assertIn('landmarks_per_second', parsed_response)
+
+        landmark_ids = parsed_response['landmarks']
+        self.assertEqual(sorted(landmark_ids.keys()), ['L1', 'L2'])
+        for group_id in (parsed_response['group_a_id'], parsed_response['group_b_id']):
+            members = ClassInstanceClassInstance.objects.filter(
+                    class_instance_b_id=group_id).values_list(
+                    'class_instance_a_id', flat=True)
+            self.assertEqual(sorted(members), sorted(landmark_ids.values()))
+        self.assertEqual(self.get_group_locations(parsed_response['group_a_id']),
+                [(1, 2, 3), (4, 5, 6)])
+        self.assertEqual(self.get_group_locations(parsed_response['group_b_id']),
+                [(10, 20, 30), (40, 50, 60)])
+        self.assertEqual(self.get_group_locations(landmark_ids['L1']),
+                [(1, 2, 3), (10, 20, 30)])
+
+        # Existing landmarks can only be used if this is requested
+        data['group_a_name'], data['group_b_name'] = 'Group C', 'Group D'
+        response = self.client.post(f'/{self.test_project_id}/landmarks/groups/materialize',
+                data)
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_landmark_groups(self):
+        self.fake_authentication()
+        data = [
+            ['Group A', [['L1', 1, 2, 3], ['L2', 4, 5, 6]]],
+            ['Group B', [['l1', 10, 20, 30], ['L3', 70, 80, 90]]],
+        ]
+        response = self.client.post(f'/{self.test_project_id}/landmarks/groups/import', {
+            'data': json.dumps(data),
+            'with_stats': 'true',
+        })
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        stats = parsed_response['stats']
+        self.assertEqual(stats['created_groups'], 2)
+        self.assertEqual(stats['created_landmarks'], 3)
+        self.assertEqual(stats['created_locations'], 4)
+
+        groups = parsed_response['groups']
+        self.assertEqual([g['name'] for g in groups], ['Group A', 'Group B'])
+        # Landmark names are matched case-insensitively
+        l1_id = groups[0]['members'][0]['id']
+        self.assertEqual(groups[1]['members'][0]['id'], l1_id)
+        self.assertEqual(ClassInstance.objects.get(pk=l1_id).name, 'L1')
+        self.assertEqual(self.get_group_locations(l1_id), [(1, 2, 3), (10, 20, 30)])
+        self.assertEqual(self.get_group_locations(groups[1]['id']),
+                [(10, 20, 30), (70, 80, 90)])
+        self.assertEqual(ClassInstanceClassInstance.objects.filter(
+                class_instance_a_id=l1_id).count(), 2)
+
+    def test_transform_landmark_groups(self):
+        self.fake_authentication()
+        # Group B is group A, scaled by two and moved by (10, 20, 30).
+        sources = [[0, 0, 0], [10000, 0, 0], [0, 10000, 0], [0, 0, 10000],
+                [10000, 10000, 10000]]
+        data = {
+            'group_a_name': 'Group A',
+            'group_b_name': 'Group B',
+        }
+        for i, (x, y, z) in enumerate(sources):
+            landmark = [f'L{i}', x, y, z, 2 * x + 10, 2 * y + 20, 2 * z + 30]
+            for j, value in enumerate(landmark):
+                data[f'landmarks[{i}][{j}]'] = value
+        response = self.client.post(f'/{self.test_project_id}/landmarks/groups/materialize',
+                data)
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        group_a_id = parsed_response['group_a_id']
+        group_b_id = parsed_response['group_b_id']
+
+        response = self.client.post(f'/{self.test_project_id}/landmarks/groups/transform', {
+            'source_group_id': group_a_id,
+            'target_group_id': group_b_id,
+            'skeleton_ids[0]': 235,
+            'points[0][0]': 1, 'points[0][1]': 2, 'points[0][2]': 3,
+        })
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(parsed_response['n_matches'], 5)
+        for actual, expected in zip(parsed_response['points'][0], [12, 24, 36]):
+            self.assertAlmostEqual(actual, expected, places=3)
+
+        nodes = parsed_response['skeletons']['235'][0]
+        treenodes = Treenode.objects.filter(skeleton_id=235).in_bulk()
+        self.assertEqual(len(nodes), len(treenodes))
+        for node in nodes:
+            treenode = treenodes[node[0]]
+            self.assertAlmostEqual(node[3], 2 * treenode.location_x + 10, places=2)
+            self.assertAlmostEqual(node[4], 2 * treenode.location_y + 20, places=2)
+            self.assertAlmostEqual(node[5], 2 * treenode.location_z + 30, places=2)
+
+        # Less than four shared landmarks can't define a transform.
+        response = self.client.post(f'/{self.test_project_id}/landmarks/groups/transform', {
+            'source_group_id': group_a_id,
+            'target_group_id': group_a_id + group_b_id,
+            'points[0][0]': 1, 'points[0][1]': 2, 'points[0][2]': 3,
+        })
+        self.assertEqual(response.status_code, 400)
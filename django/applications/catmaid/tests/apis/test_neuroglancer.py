@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+
+import numpy as np
+
+from django.db import connection
+
+from catmaid.control.neuroglancer import (encode_shard, encode_skeleton,
+        get_shard_locations, get_sharding_spec, skeleton_node_dtype)
+from catmaid.models import Treenode
+from catmaid.state import make_nocheck_state
+
+from .common import CatmaidApiTestCase
+
+
+def decode_skeleton(data):
+    n_vertices, n_edges = np.frombuffer(data[:8], dtype='<u4')
+    offset = 8
+    positions = np.frombuffer(data[offset:offset + 12 * n_vertices], dtype='<f4').reshape(-1, 3)
+    offset += 12 * n_vertices
+    edges = np.frombuffer(data[offset:offset + 8 * n_edges], dtype='<u4').reshape(-1, 2)
+    offset += 8 * n_edges
+    radii = np.frombuffer(data[offset:offset + 4 * n_vertices], dtype='<f4')
+    offset += 4 * n_vertices
+    confidences = np.frombuffer(data[offset:], dtype=np.uint8)
+    return positions, edges, radii, confidences
+
+
+def read_shard_chunk(shard_data, skeleton_id, sharding):
+    def decode(data):
+        return gzip.decompress(data) if sharding['data_encoding'] == 'gzip' else data
+    _, minishards = get_shard_locations([skeleton_id], sharding)
+    minishard = int(minishards[0])
+    index_end = 16 * 2**sharding['minishard_bits']
+    start, end = np.frombuffer(shard_data[16 * minishard:16 * (minishard + 1)], dtype='<u8')
+    index = np.frombuffer(decode(shard_data[index_end + start:index_end + end]),
+            dtype='<u8').reshape(3, -1)
+    chunk_end = 0
+    for chunk_id, offset, size in zip(np.cumsum(index[0]), index[1], index[2]):
+        chunk_start = chunk_end + int(offset)
+        chunk_end = chunk_start + int(size)
+        if chunk_id == skeleton_id:
+            return decode(shard_data[index_end + chunk_start:index_end + chunk_end])
+    return None
+
+
+class NeuroglancerApiTests(CatmaidApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cursor = connection.cursor()
+        cursor.execute("SELECT refresh_skeleton_summary_table_for_project(%s)",
+                [self.test_project_id])
+
+    def test_encode_skeleton(self):
+        nodes = np.array([
+            (1, 1, -1, 0, 0, 0, -1, 5),
+            (1, 2, 1, 10, 0, 0, 2.5, 5),
+            (1, 3, 1, 0, 10, 0, 5, 1),
+            # A parent that isn't part of the skeleton
+            (1, 5, 99, 0, 0, 10, 7, 0),
+        ], dtype=skeleton_node_dtype)
+        positions, edges, radii, confidences = decode_skeleton(encode_skeleton(nodes))
+        np.testing.assert_array_equal(positions,
+                [[0, 0, 0], [10, 0, 0], [0, 10, 0], [0, 0, 10]])
+        np.testing.assert_array_equal(edges, [[1, 0], [2, 0]])
+        np.testing.assert_array_equal(radii, [-1, 2.5, 5, 7])
+        np.testing.assert_array_equal(confidences, [5, 5, 1, 0])
+
+    def test_encode_shard(self):
+        chunks = dict((skeleton_id, f'skeleton {skeleton_id}'.encode())
+                for skeleton_id in (3, 7, 8, 130, 1027))
+        for compress in (False, True):
+            sharding = get_sharding_spec(0, 2, compress=compress)
+            shard_data = encode_shard(chunks, sharding)
+            for skeleton_id, data in chunks.items():
+                self.assertEqual(read_shard_chunk(shard_data, skeleton_id, sharding), data)
+            self.assertIsNone(read_shard_chunk(shard_data, 4, sharding))
+
+        shards, minishards = get_shard_locations([3, 7, 130], get_sharding_spec(2, 2))
+        self.assertEqual(shards.tolist(), [0, 1, 0])
+        self.assertEqual(minishards.tolist(), [3, 3, 2])
+
+    def test_skeleton_source(self):
+        self.fake_authentication()
+        base_url = f'/{self.test_project_id}/skeletons/neuroglancer'
+
+        response = self.client.get(f'{base_url}/info')
+        self.assertStatus(response)
+        info = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(info['@type'], 'neuroglancer_skeletons')
+        self.assertEqual([a['id'] for a in info['vertex_attributes']],
+                ['radius', 'confidence'])
+
+        response = self.client.get(f'{base_url}/segment_properties/info')
+        self.assertStatus(response)
+        properties = json.loads(response.content.decode('utf-8'))['inline']
+        self.assertIn('235', properties['ids'])
+        for prop in properties['properties']:
+            self.assertEqual(len(prop['values']), len(properties['ids']))
+
+        response = self.client.get(f'{base_url}/235')
+        self.assertStatus(response)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        positions, edges, radii, confidences = decode_skeleton(response.content)
+        n_nodes = Treenode.objects.filter(skeleton_id=235).count()
+        self.assertEqual(len(positions), n_nodes)
+        self.assertEqual(len(edges), n_nodes - 1)
+
+        # Unchanged skeletons don't need to be sent again.
+        etag = response['ETag']
+        response = self.client.get(f'{base_url}/235', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # The old URL returns the same data
+        response = self.client.get(f'/{self.test_project_id}/skeletons/235/neuroglancer')
+        self.assertStatus(response)
+        self.assertEqual(decode_skeleton(response.content)[0].tolist(), positions.tolist())
+
+        response = self.client.get(f'{base_url}/1')
+        self.assertEqual(response.status_code, 404)
+
+    def test_skeleton_source_radius_update(self):
+        self.fake_authentication()
+        url = f'/{self.test_project_id}/skeletons/neuroglancer/235'
+        response = self.client.get(url)
+        self.assertStatus(response)
+        etag = response['ETag']
+
+        # Radius changes don't change the skeleton summary, but need to
+        # invalidate cached skeletons and their ETag.
+        response = self.client.post(f'/{self.test_project_id}/treenode/257/radius',
+                {'radius': 5, 'option': 0, 'state': make_nocheck_state()})
+        self.assertStatus(response)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        _, _, radii, _ = decode_skeleton(response.content)
+        node_ids = list(Treenode.objects.filter(skeleton_id=235)
+                .order_by('id').values_list('id', flat=True))
+        self.assertEqual(radii[node_ids.index(257)], 5)
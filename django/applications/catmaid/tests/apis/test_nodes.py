@@ -520,3 +520,75 @@ class NodesApiTests(CatmaidApiTestCase):
         self.assertEqual({}, parsed_response[2])
         self.assertEqual(False, parsed_response[3])
         self.assertEqual(expected_rel_response, parsed_response[4])
+
+    def test_node_list_delta(self):
+        self.fake_authentication()
+        query = {
+            'z1': 0,
+            'top': 2280,
+            'left': 4430,
+            'right': 12430,
+            'bottom': 5730,
+            'z2': 9,
+            'labels': False,
+            'with_delta_token': True,
+        }
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), query)
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(5, len(parsed_response))
+        token = response['X-CATMAID-Node-Delta-Token']
+        self.assertTrue(token)
+
+        # Move a node and ask for changes
+        response = self.client.post(
+                '/%d/node/update' % self.test_project_id, {
+                    'state': make_nocheck_state(),
+                    't[0][0]': 289,
+                    't[0][1]': 5690,
+                    't[0][2]': 3340,
+                    't[0][3]': 0})
+        self.assertStatus(response)
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(query, delta_token=token))
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(parsed_response['delta_token'],
+                response['X-CATMAID-Node-Delta-Token'])
+        for key in ('treenodes', 'connectors', 'labels', 'relation_map',
+                'deleted_treenode_ids', 'deleted_connector_ids'):
+            self.assertIn(key, parsed_response)
+        moved_node = [t for t in parsed_response['treenodes'] if t[0] == 289]
+        self.assertEqual(1, len(moved_node))
+        self.assertEqual([5690.0, 3340.0, 0.0], moved_node[0][2:5])
+
+        # Nodes moved out of the view box are returned as deleted, along with
+        # their former parents. Changes outside of the view box are ignored.
+        token = response['X-CATMAID-Node-Delta-Token']
+        response = self.client.post(
+                '/%d/node/update' % self.test_project_id, {
+                    'state': make_nocheck_state(),
+                    't[0][0]': 2419,
+                    't[0][1]': 2000,
+                    't[0][2]': 6000,
+                    't[0][3]': 0,
+                    't[1][0]': 7,
+                    't[1][1]': 3000,
+                    't[1][2]': 3000,
+                    't[1][3]': 0})
+        self.assertStatus(response)
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(query, delta_token=token))
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertCountEqual([2417, 2419], parsed_response['deleted_treenode_ids'])
+
+        # A token for a different view box isn't accepted
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(query, delta_token=token, right=12431))
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(5, len(parsed_response))
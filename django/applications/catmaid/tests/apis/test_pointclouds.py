@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import json
+from urllib.parse import urlencode
+
+import numpy as np
+
+from catmaid.control.pointcloud import (get_pointcloud_points,
+        get_sample_indices, pack_points, unpack_points)
+from catmaid.models import PointCloudPoint
+
+from .common import CatmaidApiTestCase
+
+
+class PointCloudsApiTests(CatmaidApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.points = [[float(i), 2.0 * i, 3.0 * i] for i in range(100)]
+
+    def create_pointcloud(self, binary):
+        response = self.client.put(f'/{self.test_project_id}/pointclouds/',
+                urlencode({
+                    'name': 'Test point cloud',
+                    'points': json.dumps(self.points),
+                    'binary': 'true' if binary else 'false',
+                }), content_type='application/x-www-form-urlencoded')
+        self.assertStatus(response)
+        return json.loads(response.content.decode('utf-8'))['id']
+
+    def get_points(self, pointcloud_id, sample_ratio=1.0):
+        response = self.client.get(f'/{self.test_project_id}/pointclouds/{pointcloud_id}/', {
+            'with_points': 'true',
+            'sample_ratio': sample_ratio,
+        })
+        self.assertStatus(response)
+        return json.loads(response.content.decode('utf-8'))['points']
+
+    def test_pack_points(self):
+        point_data = pack_points(self.points)
+        self.assertEqual(len(point_data), 12 * len(self.points))
+        points = unpack_points(point_data)
+        self.assertEqual(points.shape, (100, 3))
+        self.assertFalse(points.flags.writeable)
+        np.testing.assert_array_equal(points, self.points)
+
+        with self.assertRaises(ValueError):
+            unpack_points(point_data[:-1])
+        with self.assertRaises(ValueError):
+            pack_points([[1.0, float('nan'), 2.0]])
+
+    def test_binary_storage(self):
+        self.fake_authentication()
+        linked_id = self.create_pointcloud(False)
+        packed_id = self.create_pointcloud(True)
+        self.assertEqual(PointCloudPoint.objects.filter(pointcloud_id=linked_id).count(), 100)
+        self.assertEqual(PointCloudPoint.objects.filter(pointcloud_id=packed_id).count(), 0)
+
+        # Points of packed point data use their index as ID.
+        self.assertEqual(self.get_points(packed_id),
+                [[i] + p for i, p in enumerate(self.points)])
+        self.assertEqual([p[1:] for p in self.get_points(linked_id)], self.points)
+
+        points = get_pointcloud_points([linked_id, packed_id])
+        for pointcloud_id in (linked_id, packed_id):
+            np.testing.assert_array_equal(points[pointcloud_id][1], self.points)
+
+    def test_sample_ratio(self):
+        self.fake_authentication()
+        linked_id = self.create_pointcloud(False)
+        packed_id = self.create_pointcloud(True)
+
+        # Small samples are read from the database, larger ones are sampled
+        # after reading all points. Both return the same points.
+        for sample_ratio in (0.05, 0.5):
+            sample = self.get_points(packed_id, sample_ratio)
+            self.assertEqual([p[0] for p in sample],
+                    get_sample_indices(100, sample_ratio).tolist())
+            for point in sample:
+                self.assertEqual(point[1:], self.points[point[0]])
+
+        sample = self.get_points(linked_id, 0.5)
+        self.assertEqual(len(sample), 50)
+        for point in sample:
+            self.assertIn(point[1:], self.points)
+        self.assertEqual(sample, self.get_points(linked_id, 0.5))
+
+    def test_upload(self):
+        self.fake_authentication()
+        url = f'/{self.test_project_id}/pointclouds/upload?' + urlencode({
+            'name': 'Uploaded point cloud',
+        })
+        response = self.client.post(url, data=pack_points(self.points),
+                content_type='application/octet-stream')
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(parsed_response['name'], 'Uploaded point cloud')
+        self.assertEqual(parsed_response['n_points'], 100)
+        self.assertEqual([p[1:] for p in self.get_points(parsed_response['id'])],
+                self.points)
+
+        # Point data needs to consist of complete points.
+        response = self.client.post(url, data=pack_points(self.points)[:-4],
+                content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 400)
@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import io
 from io import StringIO
 import json
+import numpy as np
 import platform
 import re
 from typing import Any, Dict
 from unittest import skipIf
+from scipy.sparse import load_npz
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 from django.db import connection, transaction
 from django.shortcuts import get_object_or_404
 from guardian.shortcuts import assign_perm
 
 from catmaid.control.annotation import _annotate_entities, annotations_for_skeleton
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.connectivity import get_synapse_counts
+from catmaid.control.review import get_review_status
 from catmaid.control.skeleton import _get_neuronname_from_skeletonid
 from catmaid.models import (
     ClassInstance, ClassInstanceClassInstance, Log, Review, TreenodeConnector,
@@ -176,6 +187,48 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(parsed_response, expected_response)
 
 
+    def test_compact_skeleton_detail_many(self):
+        self.fake_authentication()
+
+        skeleton_ids = [235, 373, 2364]
+        params = {
+            'with_connectors': 'true',
+            'with_tags': 'true',
+            'with_reviews': 'true',
+            'with_annotations': 'true',
+            'ordered': 'true',
+        }
+
+        response = self.client.post(
+            f'/{self.test_project_id}/skeletons/compact-detail',
+            dict(params, skeleton_ids=skeleton_ids + [235]))
+        self.assertStatus(response)
+        parsed_response = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(list(parsed_response['skeletons'].keys()),
+                [str(skid) for skid in skeleton_ids])
+
+        # The batched result is expected to match the individual results.
+        # Connectors, reviews and annotations have no defined order.
+        def normalize(result):
+            nodes, connectors, tags, reviews, annotations = result
+            return [nodes, sorted(connectors), tags, sorted(reviews),
+                    sorted(annotations)]
+
+        for skeleton_id in skeleton_ids:
+            response = self.client.get(
+                f'/{self.test_project_id}/skeletons/{skeleton_id}/compact-detail',
+                params)
+            self.assertStatus(response)
+            expected_result = json.loads(response.content.decode('utf-8'))
+            self.assertEqual(normalize(parsed_response['skeletons'][str(skeleton_id)]),
+                    normalize(expected_result))
+
+        response = self.client.post(
+            f'/{self.test_project_id}/skeletons/compact-detail',
+            dict(params, skeleton_ids=[235, 99999999]))
+        self.assertStatus(response, 404)
+
+
     def test_split_skeleton(self):
         self.fake_authentication()
 
@@ -610,6 +663,75 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_skeleton_connectivity_matrix_export(self):
+        self.fake_authentication()
+
+        # Rows and columns can contain duplicates and keep their order.
+        rows = [235, 2388, 235]
+        cols = [361, 373, 2364]
+        params:Dict[str, Any] = {}
+        for i, k in enumerate(rows):
+            params['rows[%d]' % i] = k
+        for i, k in enumerate(cols):
+            params['columns[%d]' % i] = k
+
+        url = '/%d/skeletons/connectivity_matrix/export' % (self.test_project_id,)
+        response = self.client.post(url, params)
+        self.assertStatus(response)
+        csv_data = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(csv_data.splitlines(), [
+            '"",361,373,2364',
+            '235,1,2,0',
+            '2388,0,0,1',
+            '235,1,2,0',
+        ])
+
+        params['format'] = 'npz'
+        response = self.client.post(url, params)
+        self.assertStatus(response)
+        npz_data = io.BytesIO(response.content)
+        self.assertEqual(load_npz(npz_data).toarray().tolist(),
+                [[1, 2, 0], [0, 0, 1], [1, 2, 0]])
+        npz_data.seek(0)
+        self.assertEqual(np.load(npz_data)['row_skeleton_ids'].tolist(), rows)
+
+        params['format'] = 'xml'
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 400)
+
+
+    @skipIf(pyarrow is None, "Arrow export test requires pyarrow")
+    def test_skeleton_connectivity_matrix_arrow_export(self):
+        self.fake_authentication()
+
+        rows = [235, 2388, 235]
+        cols = [361, 373, 2364]
+        params:Dict[str, Any] = {'format': 'arrow'}
+        for i, k in enumerate(rows):
+            params['rows[%d]' % i] = k
+        for i, k in enumerate(cols):
+            params['columns[%d]' % i] = k
+
+        url = '/%d/skeletons/connectivity_matrix/export' % (self.test_project_id,)
+        response = self.client.post(url, params)
+        self.assertStatus(response)
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.arrow.stream')
+        arrow_data = b''.join(response.streaming_content)
+        table = pyarrow.ipc.open_stream(arrow_data).read_all()
+        self.assertEqual(table.schema.names,
+                ['row_skeleton_id', 'column_skeleton_id', 'count'])
+        self.assertEqual(sorted(zip(*[c.to_pylist() for c in table.columns])), [
+            (235, 361, 1), (235, 361, 1), (235, 373, 2), (235, 373, 2),
+            (2388, 2364, 1),
+        ])
+
+        # Duplicate skeleton IDs don't change synapse counts.
+        relations = get_relation_to_id_map(self.test_project_id)
+        counts = get_synapse_counts(self.test_project_id, rows, cols,
+                relations['presynaptic_to'], relations['postsynaptic_to'])
+        self.assertEqual(sorted(counts), [(235, 361, 1), (235, 373, 2), (2388, 2364, 1)])
+
+
     def test_skeleton_list(self):
         self.fake_authentication()
 
@@ -1076,6 +1198,69 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertJSONEqual(response.content.decode('utf-8'), expected_result)
 
 
+    def test_review_status_summary(self):
+        skeleton_id = 2388
+        review_time = "2014-03-17T00:00:00Z"
+        later_review_time = "2014-03-18T00:00:00Z"
+        cursor = connection.cursor()
+
+        def add_review(reviewer_id, treenode_id, time=review_time):
+            return Review.objects.create(project_id=self.test_project_id,
+                    reviewer_id=reviewer_id, review_time=time,
+                    skeleton_id=skeleton_id, treenode_id=treenode_id)
+
+        def reviewer_summary(skeleton_id=skeleton_id):
+            cursor.execute("""
+                SELECT reviewer_id, n_reviewed_nodes
+                FROM catmaid_skeleton_reviewer_summary
+                WHERE skeleton_id = %s
+                ORDER BY reviewer_id
+            """, (skeleton_id,))
+            return cursor.fetchall()
+
+        def review_status(**kwargs):
+            return get_review_status([skeleton_id],
+                    project_id=self.test_project_id, **kwargs)[skeleton_id][1]
+
+        add_review(3, 2396)
+        add_review(2, 2396)
+        add_review(3, 2394)
+        duplicate_review = add_review(3, 2394, later_review_time)
+        add_review(2, 2392, later_review_time)
+        self.assertEqual(reviewer_summary(), [(2, 2), (3, 2)])
+
+        self.assertEqual(review_status(), 3)
+        self.assertEqual(review_status(user_ids=[3]), 2)
+        self.assertEqual(review_status(user_ids=[2, 3]), 3)
+        self.assertEqual(review_status(excluding_user_ids=[2]), 2)
+        self.assertEqual(review_status(excluding_user_ids=[4]), 3)
+
+        # Only one review of reviewer 2 is accepted
+        ReviewerWhitelist.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, reviewer_id=2,
+                accept_after="2014-03-17T12:00:00Z")
+        self.assertEqual(review_status(whitelist_id=self.test_user_id), 1)
+        ReviewerWhitelist.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, reviewer_id=3,
+                accept_after=review_time)
+        self.assertEqual(review_status(whitelist_id=self.test_user_id), 3)
+
+        # Removing a repeated review doesn't change the summary, removing the
+        # only review of a reviewer does.
+        duplicate_review.delete()
+        self.assertEqual(reviewer_summary(), [(2, 2), (3, 2)])
+        Review.objects.filter(reviewer_id=2, treenode_id=2396).delete()
+        self.assertEqual(reviewer_summary(), [(2, 1), (3, 2)])
+        self.assertEqual(review_status(), 3)
+
+        # Reviews move with their nodes to other skeletons
+        Review.objects.filter(treenode_id=2392).update(skeleton_id=373)
+        self.assertEqual(reviewer_summary(), [(3, 2)])
+        self.assertEqual(reviewer_summary(373), [(2, 1)])
+        self.assertEqual(review_status(), 2)
+        self.assertEqual(review_status(user_ids=[2]), 0)
+
+
     def test_export_review_skeleton(self):
         self.fake_authentication()
 
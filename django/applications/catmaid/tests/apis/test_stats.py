@@ -1185,3 +1185,41 @@ class StatsApiTests(CatmaidApiTestCase):
         node_stats = stats.select_node_stats(cursor,
                 self.test_project_id, start_date_utc, end_date_utc, time_zone)
         self.assertEqual(node_stats, expected_stats)
+
+    def test_stats_summary_refresh(self):
+        cursor = connection.cursor()
+
+        # Remove existing treenodes to make results easier to predict
+        cursor.execute("""TRUNCATE treenode CASCADE""")
+        self.add_test_treenodes()
+        self.assert_empty_summary_table(cursor)
+
+        def refresh():
+            report = stats.refresh_project_stats_summary(self.test_project_id)
+            self.assertEqual([e['statistic'] for e in report],
+                    list(stats.STATS_SUMMARY_STATISTICS.keys()))
+            return set(e['mode'] for e in report)
+
+        def non_empty_summary_table():
+            return set(row for row in self.get_summary_table(cursor)
+                    if any(row[1:9]))
+
+        # Without watermarks, statistics are updated from the last entry on,
+        # afterwards only touched hours are recomputed.
+        self.assertEqual(refresh(), {'incremental'})
+        self.assertEqual(refresh(), {'hours'})
+
+        # Give a node of user 3 to user 1 and expect the same summary as a
+        # complete recomputation.
+        cursor.execute("""
+            UPDATE treenode SET user_id = 1, edition_time = now()
+            WHERE creation_time = '2017-07-01T22:55:16.301Z'::timestamptz
+        """)
+        self.assertEqual(refresh(), {'hours'})
+        refreshed_summary = non_empty_summary_table()
+        self.assertIn((datetime.datetime(2017, 7, 1, 22, 0, tzinfo=pytz.utc),
+                0, 0, 1, 0, 0, 0, 0, 2.0, self.test_project_id, 1), refreshed_summary)
+
+        stats.populate_stats_summary(self.test_project_id, delete=True,
+                incremental=False)
+        self.assertEqual(refreshed_summary, non_empty_summary_table())
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import base64
+from io import BytesIO
+import json
+
+import mock
+import numpy as np
+from PIL import Image
+
+from catmaid.control.tile import CloudVolumePool, get_cloudvolume_tile
+
+from .common import CatmaidApiTestCase
+
+
+class FakeCloudVolume(object):
+    """A CloudVolume replacement, which keeps track of created handles and of
+    the cutouts read from them. The value of each voxel depends on its
+    position and the mip level.
+    """
+    instances:list = []
+    available_mips = [0, 1]
+    voxel_offset = (0, 0, 0)
+
+    def __init__(self, basename, mip=0, **kwargs):
+        self.basename = basename
+        self.mip = mip
+        self.n_cutouts = 0
+        FakeCloudVolume.instances.append(self)
+
+    def __getitem__(self, key):
+        xs, ys, z = key
+        self.n_cutouts += 1
+        x, y = np.meshgrid(np.arange(xs.start, xs.stop),
+                np.arange(ys.start, ys.stop), indexing='ij')
+        return get_voxel_values(x, y, self.mip)[:, :, np.newaxis, np.newaxis]
+
+
+def get_voxel_values(x, y, mip=0):
+    return ((x + 3 * y + 50 * mip) % 256).astype(np.uint8)
+
+
+def decode_image(data):
+    image = Image.open(BytesIO(data))
+    return np.array(image.convert('L'))
+
+
+class TileApiTests(CatmaidApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        FakeCloudVolume.instances = []
+        patcher = mock.patch.multiple('catmaid.control.tile', create=True,
+                cloudvolume=mock.Mock(CloudVolume=FakeCloudVolume),
+                cv_tile_loading_enabled=True, _cloudvolume_pool=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cloudvolume_pool(self):
+        pool = CloudVolumePool(ttl=60, max_size=2)
+        a0 = pool.get('a', 0)
+        self.assertIs(pool.get('a', 0), a0)
+        self.assertIsNot(pool.get('a', 0, fill_missing=True), a0)
+        self.assertEqual(len(FakeCloudVolume.instances), 2)
+
+        # The least recently used handle is dropped.
+        pool.get('a', 0)
+        pool.get('b', 0)
+        self.assertIs(pool.get('a', 0), a0)
+        self.assertEqual(len(FakeCloudVolume.instances), 3)
+        self.assertNotIn(('a', 0, True, True), pool.handles)
+
+        # Mip levels are cached and missing ones fall back to the closest one.
+        self.assertEqual(pool.get_available_mips('a'), [0, 1])
+        cv, mip = pool.get_closest('a', 3)
+        self.assertEqual(mip, 1)
+        self.assertEqual(cv.mip, 1)
+
+        # Expired handles are recreated.
+        n_instances = len(FakeCloudVolume.instances)
+        with mock.patch('catmaid.control.tile.time') as time_mock:
+            a0_time = pool.handles[('a', 0, False, True)][0]
+            time_mock.time.return_value = a0_time
+            self.assertIs(pool.get('a', 0), a0)
+            time_mock.time.return_value = a0_time + 61
+            a0_new = pool.get('a', 0)
+        self.assertIsNot(a0_new, a0)
+        self.assertEqual(len(FakeCloudVolume.instances), n_instances + 1)
+
+    def test_batch_tiles(self):
+        self.fake_authentication()
+        url = f'/{self.test_project_id}/stack/3/tiles'
+        tiles = [(0, 0), (4, 0), (8, 12)]
+        params = {'scale': 1, 'width': 4, 'height': 4, 'z': 0,
+                'basename': 'volume', 'format': 'cloudvolume'}
+        for i, (x, y) in enumerate(tiles):
+            params[f'tiles[{i}][0]'] = x
+            params[f'tiles[{i}][1]'] = y
+        response = self.client.get(url, params)
+        self.assertStatus(response)
+        result = json.loads(response.content.decode('utf-8'))
+
+        # All tiles are read with a single cutout of a single handle.
+        self.assertEqual(len(FakeCloudVolume.instances), 1)
+        self.assertEqual(FakeCloudVolume.instances[0].n_cutouts, 1)
+
+        self.assertEqual([(t['x'], t['y']) for t in result], tiles)
+        for t in result:
+            data = decode_image(base64.b64decode(t['image']))
+            x, y = np.meshgrid(np.arange(t['x'], t['x'] + 4),
+                    np.arange(t['y'], t['y'] + 4))
+            np.testing.assert_array_equal(data, get_voxel_values(x, y))
+            single_tile = get_cloudvolume_tile(self.test_project_id, 3, 1,
+                    4, 4, t['x'], t['y'], 0, 'y', 'x', 'png', 'volume')
+            np.testing.assert_array_equal(decode_image(single_tile.content), data)
+
+        # Handles are reused by later requests. Scales without mip level are
+        # read from the closest one and scaled to the tile size.
+        params['scale'] = 0.25
+        response = self.client.get(url, params)
+        self.assertStatus(response)
+        result = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(FakeCloudVolume.instances), 2)
+        self.assertEqual(FakeCloudVolume.instances[1].mip, 1)
+        for t in result:
+            self.assertEqual(decode_image(base64.b64decode(t['image'])).shape, (4, 4))
+
+    def test_batch_tiles_errors(self):
+        self.fake_authentication()
+        url = f'/{self.test_project_id}/stack/3/tiles'
+        params = {'scale': 1, 'width': 4, 'height': 4, 'z': 0}
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.content.decode('utf-8')))
+
+        # Tiles must not span too large an area
+        params.update({'tiles[0][0]': 0, 'tiles[0][1]': 0,
+                'tiles[1][0]': 4000, 'tiles[1][1]': 4000})
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.content.decode('utf-8')))
+        self.assertEqual(FakeCloudVolume.instances, [])
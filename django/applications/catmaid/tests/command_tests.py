@@ -1,16 +1,39 @@
 # -*- coding: utf-8 -*-
 
 from io import StringIO
+import json
+import os
+import tempfile
 
 import mock
+import numpy as np
+from unittest import skipIf
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from rest_framework.authtoken.models import Token
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import connection
 from django.test import TestCase
 from django.test.client import Client
 from guardian.shortcuts import assign_perm
-from catmaid.models import Class, ClassInstance, Project, User, Treenode
+from catmaid.control.neuroglancer import (get_encoded_skeletons,
+        get_shard_file_name, get_shard_locations)
+from catmaid.control.review import check_review_summary, get_review_status
+from catmaid.models import (Class, ClassInstance, ClassInstanceClassInstance,
+        Connector, Project, Review, User, Treenode, TreenodeClassInstance,
+        TreenodeConnector)
+from catmaid.management.commands.catmaid_check_db_integrity import find_tree_problems
+from catmaid.management.commands.catmaid_import_data import (BulkImportIds,
+        BULK_LOAD_TRIGGERS)
+from catmaid.management.commands.common import (iter_export_records,
+        iter_json_array, open_export_file)
+from catmaid.tests.apis.common import (CatmaidApiTestMixin,
+        CatmaidApiTransactionTestCase)
 
 
 class PruneSkeletonsTest(TestCase):
@@ -143,3 +166,383 @@ class GetTokenTest(TestCase):
         self.user.save()
         with self.assertRaisesMessage(CommandError, 'account is disabled'):
             self.attempt_command(self.username, '--password', self.password)
+
+
+class StreamingImportTest(TestCase):
+    """
+    Test the helpers of the streaming export and import modes.
+    """
+
+    def test_iter_json_array(self):
+        data = [{'model': 'catmaid.treenode', 'pk': i, 'fields': {'radius': -1,
+                'name': 'a, [b]'}} for i in range(100)] + [1.5, 12345678]
+        stream = StringIO(json.dumps(data, indent=2))
+        self.assertEqual(list(iter_json_array(stream, chunk_size=7)), data)
+        self.assertEqual(list(iter_json_array(StringIO(' [ ] '))), [])
+        with self.assertRaises(ValueError):
+            list(iter_json_array(StringIO('[{"a": 1}, {"b"')))
+
+    def test_bulk_import_ids(self):
+        ids = BulkImportIds([30, 10, 20], first_id=100)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids.map([20, None, 30, 5]), [101, None, 102, 5])
+        self.assertEqual(ids.get(10).id, 100)
+        self.assertIsNone(ids.get(15))
+        self.assertEqual(ids.new_ids.tolist(), [100, 101, 102])
+
+        preserved = BulkImportIds([30, 10, 20])
+        self.assertEqual(preserved.map([20, None]), [20, None])
+        self.assertEqual(preserved.get(30).id, 30)
+
+    def test_iter_export_records(self):
+        records = [
+            {'model': 'catmaid.class', 'pk': 1, 'fields': {'class_name': 'skeleton'}},
+            {'model': 'catmaid.treenode', 'columns': {'pk': [2, 3],
+                    'parent': [None, 2], 'radius': [-1.0, 5.0]}},
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'export.json.gz')
+            with open_export_file(path, 'w', 'gzip') as f:
+                json.dump(records, f)
+            with open_export_file(path) as f:
+                read_records = list(iter_export_records(f))
+
+        self.assertEqual(read_records, [
+            records[0],
+            {'model': 'catmaid.treenode', 'pk': 2, 'fields': {'parent': None, 'radius': -1.0}},
+            {'model': 'catmaid.treenode', 'pk': 3, 'fields': {'parent': 2, 'radius': 5.0}},
+        ])
+
+
+class BulkImportTest(CatmaidApiTestMixin, TestCase):
+    """
+    Test importing a small export file with catmaid_import_data --bulk-load.
+    """
+
+    def get_import_records(self):
+        common = {'user': self.test_user_id, 'project': 1,
+                'creation_time': '2020-01-01T00:00:00Z',
+                'edition_time': '2020-01-01T00:00:00Z'}
+        return [
+            {'model': 'catmaid.class', 'pk': 10, 'fields': dict(common,
+                    class_name='skeleton', description='')},
+            {'model': 'catmaid.relation', 'pk': 11, 'fields': dict(common,
+                    relation_name='presynaptic_to', uri='', description='',
+                    isreciprocal=False)},
+            {'model': 'catmaid.classinstance', 'pk': 12, 'fields': dict(common,
+                    class_column=10, name='Imported skeleton')},
+            {'model': 'catmaid.treenode', 'columns': {
+                    'pk': [20, 21, 22],
+                    'user': [self.test_user_id] * 3,
+                    'editor': [self.test_user_id] * 3,
+                    'location_x': [0.0, 10.0, 20.0],
+                    'location_y': [0.0, 0.0, 5.0],
+                    'location_z': [0.0, 0.0, 0.0],
+                    'parent': [None, 20, 21],
+                    'radius': [-1.0, -1.0, 2.0],
+                    'confidence': [5, 5, 5],
+                    'skeleton': [12] * 3}},
+            {'model': 'catmaid.connector', 'pk': 30, 'fields': dict(common,
+                    editor=self.test_user_id, location_x=25.0, location_y=5.0,
+                    location_z=0.0, confidence=5)},
+            {'model': 'catmaid.treenodeconnector', 'pk': 40, 'fields': dict(common,
+                    relation=11, treenode=22, connector=30, skeleton=12,
+                    confidence=5)},
+        ]
+
+    def test_bulk_import(self):
+        target = Project.objects.create(title="Bulk import target")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'export.json')
+            with open(path, 'w') as f:
+                json.dump(self.get_import_records(), f)
+            call_command('catmaid_import_data', source=path, target=target.id,
+                    map_users=False, map_user_ids=True, bulk_load=True,
+                    bulk_batch_size=2, analyze_db=False, verbosity=0,
+                    stdout=StringIO())
+
+        # All rows are stored with new IDs and consistent references.
+        skeleton = ClassInstance.objects.get(project=target)
+        self.assertEqual(skeleton.name, 'Imported skeleton')
+        self.assertEqual(skeleton.class_column.class_name, 'skeleton')
+        nodes = dict((n.location_x, n) for n in
+                Treenode.objects.filter(project=target))
+        self.assertEqual(sorted(nodes.keys()), [0.0, 10.0, 20.0])
+        self.assertIsNone(nodes[0.0].parent_id)
+        self.assertEqual(nodes[10.0].parent_id, nodes[0.0].id)
+        self.assertEqual(nodes[20.0].parent_id, nodes[10.0].id)
+        self.assertEqual(nodes[20.0].radius, 2.0)
+        for node in nodes.values():
+            self.assertEqual(node.skeleton_id, skeleton.id)
+            self.assertEqual(node.user_id, self.test_user_id)
+            self.assertNotIn(node.id, (20, 21, 22))
+        connector = Connector.objects.get(project=target)
+        self.assertEqual(connector.location_x, 25.0)
+        link = TreenodeConnector.objects.get(project=target)
+        self.assertEqual(link.treenode_id, nodes[20.0].id)
+        self.assertEqual(link.connector_id, connector.id)
+        self.assertEqual(link.skeleton_id, skeleton.id)
+        self.assertEqual(link.relation.relation_name, 'presynaptic_to')
+
+        # Sequences are past all imported IDs, new objects don't collide.
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT (SELECT last_value FROM location_id_seq),
+                (SELECT max(id) FROM location),
+                (SELECT last_value FROM concept_id_seq),
+                (SELECT max(id) FROM concept)
+        """)
+        last_location_id, max_location_id, last_concept_id, max_concept_id = cursor.fetchone()
+        self.assertGreaterEqual(last_location_id, max_location_id)
+        self.assertGreaterEqual(last_concept_id, max_concept_id)
+        new_node = Treenode.objects.create(project=target, user_id=self.test_user_id,
+                editor_id=self.test_user_id, location_x=30, location_y=0,
+                location_z=0, parent=nodes[20.0], radius=-1, skeleton=skeleton)
+        self.assertGreater(new_node.id, max_location_id)
+
+        # The disabled insert triggers are enabled again and the summary
+        # triggers are restored.
+        cursor.execute("""
+            SELECT c.relname, t.tgname, t.tgenabled
+            FROM pg_trigger t
+            JOIN pg_class c
+                ON c.oid = t.tgrelid
+            WHERE c.relname = ANY(%(tables)s)
+            AND NOT t.tgisinternal
+        """, {
+            'tables': list(BULK_LOAD_TRIGGERS.keys()) + ['treenode'],
+        })
+        triggers = dict(((table, name), enabled) for table, name, enabled in cursor.fetchall())
+        for table, names in BULK_LOAD_TRIGGERS.items():
+            for name in names:
+                self.assertEqual(triggers.get((table, name)), 'O', name)
+        for name in ('on_insert_treenode_update_summary_and_edges',
+                'on_edit_treenode_update_summary_and_edges',
+                'on_delete_treenode_update_summary_and_edges'):
+            self.assertEqual(triggers.get(('treenode', name)), 'O', name)
+
+        # Materializations of the imported data are available.
+        cursor.execute("""
+            SELECT
+                (SELECT count(*) FROM treenode_edge WHERE project_id = %(project_id)s),
+                (SELECT count(*) FROM connector_geom WHERE project_id = %(project_id)s),
+                (SELECT num_nodes FROM catmaid_skeleton_summary
+                 WHERE skeleton_id = %(skeleton_id)s)
+        """, {
+            'project_id': target.id,
+            'skeleton_id': skeleton.id,
+        })
+        self.assertEqual(cursor.fetchone(), (4, 1, 4))
+
+class ExportImportRoundTripTest(CatmaidApiTransactionTestCase):
+    """
+    Test that a streaming export of a project imports into a new project with
+    the same data. Chunks are read by parallel connections, which only see
+    committed data.
+    """
+
+    def get_project_data(self, project_id):
+        nodes = Treenode.objects.filter(project_id=project_id)
+        return {
+            'treenodes': sorted(nodes.values_list('location_x', 'location_y',
+                    'location_z', 'radius', 'confidence')),
+            'n_roots': nodes.filter(parent__isnull=True).count(),
+            'n_skeletons': nodes.values('skeleton_id').distinct().count(),
+            'connectors': sorted(Connector.objects.filter(project_id=project_id)
+                    .values_list('location_x', 'location_y', 'location_z')),
+            'links': sorted(TreenodeConnector.objects.filter(project_id=project_id)
+                    .values_list('relation__relation_name', 'treenode__location_x',
+                    'treenode__location_y', 'connector__location_x')),
+            # Only tracing data, tags and annotations are exported.
+            'class_instances': sorted(ClassInstance.objects.filter(project_id=project_id,
+                    class_column__class_name__in=('neuron', 'skeleton', 'label', 'annotation'))
+                    .values_list('class_column__class_name', 'name')),
+            'n_class_instance_links': ClassInstanceClassInstance.objects.filter(
+                    project_id=project_id,
+                    relation__relation_name__in=('model_of', 'annotated_with')).count(),
+            'n_treenode_tags': TreenodeClassInstance.objects.filter(
+                    project_id=project_id, relation__relation_name='labeled_as').count(),
+        }
+
+    def export(self, path, **options):
+        with mock.patch('catmaid.management.commands.catmaid_export_data.ask_to_continue',
+                return_value=True):
+            call_command('catmaid_export_data', source=self.test_project_id,
+                    file=path, streaming=True, chunk_size=3, verbosity=0,
+                    stdout=StringIO(), **options)
+
+    def round_trip(self, **export_options):
+        expected = self.get_project_data(self.test_project_id)
+        self.assertTrue(expected['treenodes'])
+        self.assertTrue(expected['links'])
+
+        for bulk_load in (False, True):
+            target = Project.objects.create(title=f"Import of {export_options}")
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'export.json')
+                self.export(path, **export_options)
+                # Users of the export map to the existing users.
+                with mock.patch('catmaid.management.commands.catmaid_import_data.ask_yes_no',
+                        return_value=True):
+                    call_command('catmaid_import_data', source=path,
+                            target=target.id, bulk_load=bulk_load,
+                            bulk_batch_size=5, analyze_db=False, verbosity=0,
+                            stdout=StringIO())
+            self.assertEqual(self.get_project_data(target.id), expected,
+                    f'bulk_load={bulk_load}')
+
+    def test_records_round_trip(self):
+        self.round_trip(workers=1)
+
+    def test_columnar_round_trip(self):
+        self.round_trip(workers=2, layout='columnar', compression='gzip')
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd_round_trip(self):
+        self.round_trip(workers=2, layout='columnar', compression='zstd')
+
+    def test_zstd_without_zstandard(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'export.json')
+            with mock.patch('catmaid.management.commands.common.zstandard', None):
+                with self.assertRaises(CommandError):
+                    self.export(path, compression='zstd')
+
+
+class IntegrityCheckTest(TestCase):
+    """
+    Test the set-based tracing data check of catmaid_check_db_integrity.
+    """
+
+    def test_find_tree_problems(self):
+        nodes = np.array([
+            # A valid skeleton
+            (1, -1, 1), (2, 1, 1), (3, 2, 1),
+            # A cycle without root
+            (10, 11, 2), (11, 10, 2),
+            # Two roots
+            (20, -1, 3), (21, 20, 3), (22, -1, 3),
+            # Parents in other skeletons
+            (30, -1, 4), (31, 3, 4), (32, 99, 4),
+            # A node that is its own parent
+            (40, 40, 5),
+        ], dtype=np.int64)
+        problems = find_tree_problems(nodes[:, 0], nodes[:, 1], nodes[:, 2])
+        self.assertEqual([(p['skeleton_id'], p['errors']) for p in problems], [
+            (2, ['no_root', 'cycle', 'unreachable_nodes']),
+            (3, ['multiple_roots']),
+            (4, ['cross_skeleton_parent', 'unreachable_nodes']),
+            (5, ['no_root', 'cycle', 'unreachable_nodes']),
+        ])
+        self.assertEqual(problems[1]['root_ids'], [20, 22])
+        self.assertEqual(problems[2]['cross_skeleton_parents'], [[31, 3], [32, 99]])
+        self.assertEqual(problems[2]['unreachable_node_ids'], [31, 32])
+
+    def test_check_tracing_data(self):
+        user = User.objects.create(username="test", password="test")
+        p = TestProject(user)
+        skeleton = p.create_neuron()
+        root = p.create_node(0, 0, 0, None, skeleton)
+        child = p.create_node(1, 0, 0, root.id, skeleton)
+        p.create_node(2, 0, 0, child.id, skeleton)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'report.json')
+            call_command('catmaid_check_db_integrity', volumes=False,
+                    workers=1, report=path, stdout=StringIO())
+            with open(path) as f:
+                report = json.load(f)
+
+        self.assertTrue(report['passed'])
+        self.assertEqual(report['tracing']['n_nodes'], 3)
+        self.assertEqual(report['tracing']['n_skeletons'], 1)
+        self.assertEqual(report['tracing']['problems'], [])
+
+
+class ExportNeuroglancerSkeletonsTest(CatmaidApiTestMixin, TestCase):
+    """
+    Test writing a project's skeletons as Neuroglancer precomputed skeleton
+    source.
+    """
+
+    def setUp(self):
+        super().setUp()
+        cursor = connection.cursor()
+        cursor.execute("SELECT refresh_skeleton_summary_table_for_project(%s)",
+                [self.test_project_id])
+
+    def export(self, output, **options):
+        call_command('catmaid_export_neuroglancer_skeletons',
+                project_id=self.test_project_id, output=output,
+                stdout=StringIO(), **options)
+        with open(os.path.join(output, 'info')) as f:
+            info = json.load(f)
+        with open(os.path.join(output, 'segment_properties', 'info')) as f:
+            segment_properties = json.load(f)
+        return info, segment_properties
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            info, segment_properties = self.export(tmp)
+            self.assertNotIn('sharding', info)
+            ids = segment_properties['inline']['ids']
+            self.assertIn('235', ids)
+            properties = dict((p['id'], p) for p in segment_properties['inline']['properties'])
+            self.assertIn('min_x', properties)
+            skeleton_ids = list(map(int, ids))
+            encoded = get_encoded_skeletons(self.test_project_id, skeleton_ids)
+            for skeleton_id in skeleton_ids:
+                with open(os.path.join(tmp, str(skeleton_id)), 'rb') as f:
+                    self.assertEqual(f.read(), encoded[skeleton_id])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            info, _ = self.export(tmp, sharded=True, shard_bits=1,
+                    minishard_bits=1, gzip=True)
+            sharding = info['sharding']
+            self.assertEqual(sharding['data_encoding'], 'gzip')
+            shards, _ = get_shard_locations(skeleton_ids, sharding)
+            for shard in set(shards.tolist()):
+                self.assertTrue(os.path.exists(os.path.join(tmp,
+                        get_shard_file_name(shard, sharding))))
+            self.assertFalse(os.path.exists(os.path.join(tmp, '235')))
+
+
+class UpdateReviewSummaryTest(CatmaidApiTestMixin, TestCase):
+    """
+    Test checking and rebuilding the review summary tables.
+    """
+
+    def setUp(self):
+        super().setUp()
+        for reviewer_id, treenode_id in ((3, 237), (3, 237), (3, 239), (2, 239)):
+            Review.objects.create(project_id=self.test_project_id,
+                    reviewer_id=reviewer_id, skeleton_id=235, treenode_id=treenode_id)
+
+    def test_check_and_rebuild(self):
+        self.assertEqual(check_review_summary(self.test_project_id), [])
+        self.assertEqual(get_review_status([235])[235][1], 2)
+
+        # Changes without triggers are found and fixed.
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE catmaid_skeleton_review_summary
+            SET n_reviewed_nodes = 5
+            WHERE skeleton_id = 235;
+            DELETE FROM catmaid_skeleton_reviewer_summary
+            WHERE skeleton_id = 235 AND reviewer_id = 2;
+        """)
+        self.assertEqual(check_review_summary(self.test_project_id),
+                [(235, 2, 0, 1), (235, None, 5, 2)])
+
+        out = StringIO()
+        call_command('catmaid_update_review_summary', check=True,
+                project_id=[self.test_project_id], stdout=out)
+        self.assertIn('Found 2 mismatches', out.getvalue())
+        self.assertEqual(check_review_summary(self.test_project_id), [])
+        self.assertEqual(get_review_status([235])[235][1], 2)
+        self.assertEqual(get_review_status([235], user_ids=[2])[235][1], 1)
+
+        cursor.execute("TRUNCATE catmaid_skeleton_review_summary")
+        call_command('catmaid_update_review_summary', rebuild=True,
+                project_id=[self.test_project_id], stdout=StringIO())
+        self.assertEqual(check_review_summary(self.test_project_id), [])
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import networkx as nx
+import numpy as np
+
+from django.db import connection
+from django.test import TestCase
+
+from catmaid.control.tree_util import (ArrayTree, edge_count_to_root,
+        load_array_trees, partition, simplify)
+
+
+class ArrayTreeTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        # Node 2 is a branch node with the children 3 and 4, node 4 is a branch
+        # node with the children 5 and 6. Nodes are intentionally unordered.
+        self.rows = [
+            (5, 4, 20.0, 10.0, 0.0),
+            (1, None, 0.0, 0.0, 0.0),
+            (2, 1, 10.0, 0.0, 0.0),
+            (3, 2, 20.0, 0.0, 0.0),
+            (4, 2, 10.0, 10.0, 0.0),
+            (6, 4, 10.0, 20.0, 0.0),
+            (7, 6, 10.0, 30.0, 0.0),
+        ]
+        self.tree = ArrayTree.from_rows(self.rows, with_locations=True)
+        self.nx_tree = nx.DiGraph()
+        for row in self.rows:
+            self.nx_tree.add_node(row[0])
+            if row[1]:
+                self.nx_tree.add_edge(row[1], row[0])
+
+    def ids(self, indices):
+        return self.tree.node_ids[indices].tolist()
+
+    def by_id(self, values):
+        return dict(zip(self.tree.node_ids.tolist(), np.asarray(values).tolist()))
+
+    def test_structure(self):
+        tree = self.tree
+        self.assertEqual(len(tree), 7)
+        self.assertIn(7, tree)
+        self.assertNotIn(8, tree)
+        self.assertRaises(ValueError, tree.index, 8)
+        self.assertEqual(self.ids(tree.roots), [1])
+        self.assertEqual(self.ids(tree.children(tree.index(2))), [3, 4])
+        self.assertEqual(sorted(self.ids(np.flatnonzero(tree.is_end()))), [3, 5, 7])
+        self.assertEqual(sorted(self.ids(np.flatnonzero(tree.is_branch()))), [2, 4])
+        self.assertEqual(self.by_id(tree.depths),
+                {k: v - 1 for k, v in edge_count_to_root(self.nx_tree).items()})
+
+    def test_lengths(self):
+        tree = self.tree
+        self.assertAlmostEqual(tree.cable_length(), 60.0)
+        self.assertEqual(self.by_id(tree.root_distances()),
+                {1: 0.0, 2: 10.0, 3: 20.0, 4: 20.0, 5: 30.0, 6: 30.0, 7: 40.0})
+        self.assertAlmostEqual(tree.cable_length(tree.subtree_mask(tree.index(4))), 30.0)
+
+    def test_strahler(self):
+        self.assertEqual(self.by_id(self.tree.strahler()),
+                {1: 2, 2: 2, 3: 1, 4: 2, 5: 1, 6: 1, 7: 1})
+
+    def test_paths_and_subtrees(self):
+        tree = self.tree
+        self.assertEqual(self.ids(tree.path_to_root(tree.index(7))), [7, 6, 4, 2, 1])
+        self.assertEqual(sorted(self.ids(tree.subtree_mask(tree.index(4)))), [4, 5, 6, 7])
+        self.assertEqual(self.ids(tree.common_ancestor(tree.indices([5, 7]))), 4)
+        self.assertEqual(self.ids(tree.common_ancestor(tree.indices([3, 7]))), 2)
+        self.assertEqual(sorted(self.ids(tree.spanning_mask(tree.indices([3, 5])))),
+                [2, 3, 4, 5])
+
+        subtree = tree.extract(tree.subtree_mask(tree.index(4)))
+        self.assertEqual(subtree.node_ids[subtree.roots].tolist(), [4])
+        self.assertAlmostEqual(subtree.cable_length(), 30.0)
+
+    def test_reroot(self):
+        tree = self.tree.reroot(self.tree.index(7))
+        self.assertEqual(self.ids(tree.roots), [7])
+        self.assertEqual(self.ids(tree.path_to_root(tree.index(3))), [3, 2, 4, 6, 7])
+        self.assertAlmostEqual(tree.cable_length(), 60.0)
+        # The original tree is unchanged
+        self.assertEqual(self.ids(self.tree.roots), [1])
+
+    def test_partition(self):
+        expected = list(partition(self.nx_tree))
+        self.assertEqual([self.ids(s) for s in self.tree.partition()], expected)
+
+    def test_simplify(self):
+        tree, edges = self.tree.simplify(self.tree.indices([1, 5, 7]))
+        expected = simplify(self.nx_tree.copy(), [1, 5, 7])
+        self.assertEqual(sorted(tuple(sorted(self.ids(list(e)))) for e in edges),
+                sorted(tuple(sorted(e)) for e in expected.edges))
+
+    def test_from_digraph(self):
+        locations = dict((r[0], r[2:5]) for r in self.rows)
+        tree = ArrayTree.from_digraph(self.nx_tree, locations)
+        self.assertEqual(sorted(tree.node_ids.tolist()), list(range(1, 8)))
+        self.assertEqual(tree.node_ids[tree.roots].tolist(), [1])
+        self.assertEqual(tree.node_ids[tree.children(tree.index(2))].tolist(), [3, 4])
+        self.assertAlmostEqual(tree.cable_length(), 60.0)
+
+    def test_load_array_trees(self):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT id, parent_id, location_x, location_y, location_z
+            FROM treenode
+            WHERE skeleton_id = 235
+        """)
+        rows = cursor.fetchall()
+        trees = dict(load_array_trees([235, 373], with_locations=True))
+        self.assertEqual(sorted(trees.keys()), [235, 373])
+        tree = trees[235]
+        self.assertEqual(tree.node_ids.dtype, np.int64)
+        self.assertEqual(sorted(tree.node_ids.tolist()), sorted(r[0] for r in rows))
+        for node_id, parent_id, x, y, z in rows:
+            i = tree.index(node_id)
+            self.assertEqual(tree.node_ids[tree.parents[i]] if tree.parents[i] >= 0 else None,
+                    parent_id)
+            np.testing.assert_allclose(tree.locations[i], [x, y, z])
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import os
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+from catmaid.control.cropping import (CropJob, ImagePart, TileFetcher,
+        process_crop_job)
+from catmaid.fields import Double3D, Integer3D
+from catmaid.models import ProjectStack, Stack, StackMirror
+from catmaid.tests.common import CatmaidTestCase
+
+
+class TileRequestHandler(SimpleHTTPRequestHandler):
+    """Serve tiles from a folder, slowly enough to let requests overlap, and
+    keep track of the maximum number of concurrent requests.
+    """
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            time.sleep(0.05)
+            super().do_GET()
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class CroppingTests(CatmaidTestCase):
+    """Test cropping with tiles of a small stack, which are served over HTTP
+    from a temporary folder.
+    """
+
+    tile_size = 4
+    n_tiles = 2
+    n_slices = 2
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tile_dir = os.path.join(tmp.name, 'tiles')
+        self.output_dir = os.path.join(tmp.name, 'output')
+        os.mkdir(self.output_dir)
+
+        for z in range(self.n_slices):
+            os.makedirs(os.path.join(self.tile_dir, str(z)))
+            for row in range(self.n_tiles):
+                for col in range(self.n_tiles):
+                    image = Image.new('RGB', (self.tile_size, self.tile_size),
+                            (self.get_tile_value(z, row, col), 0, 0))
+                    image.save(self.get_tile_path(z, row, col))
+
+        TileRequestHandler.max_in_flight = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                partial(TileRequestHandler, directory=self.tile_dir))
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.image_base = f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+        size = self.tile_size * self.n_tiles
+        self.stack = Stack.objects.create(title='Crop test stack',
+                dimension=Integer3D(size, size, self.n_slices),
+                resolution=Double3D(1, 1, 1))
+        self.mirror = StackMirror.objects.create(stack=self.stack,
+                title='Local tiles', image_base=self.image_base,
+                file_extension='png', tile_width=self.tile_size,
+                tile_height=self.tile_size, tile_source_type=1)
+        ProjectStack.objects.create(project_id=self.test_project_id,
+                stack=self.stack)
+
+    def get_tile_value(self, z, row, col):
+        return 10 * (z + 1) + 2 * row + col
+
+    def get_tile_path(self, z, row, col):
+        return os.path.join(self.tile_dir, str(z), f'{row}_{col}_0.png')
+
+    def crop(self):
+        size = self.tile_size * self.n_tiles - 1
+        job = CropJob(self.user, self.test_project_id, [self.mirror.id],
+                0, size, 0, size, 0, self.n_slices - 1, 0, 0,
+                single_channel=True,
+                output_path=os.path.join(self.output_dir, 'crop.tiff'))
+        return job, process_crop_job(job, create_message=False)
+
+    def test_tile_fetcher(self):
+        parts = [ImagePart(f'{self.image_base}{z}/{row}_{col}_0.png',
+                0, 1, 0, 1, 0, 0) for z in range(self.n_slices)
+                for row in range(self.n_tiles) for col in range(self.n_tiles)]
+        with TileFetcher(n_threads=4) as fetcher:
+            futures = fetcher.fetch(parts)
+            images = [f.result() for f in futures]
+            fetcher.done(futures)
+
+        # Results are returned in order, cropped to their part.
+        expected = [self.get_tile_value(z, row, col) for z in range(self.n_slices)
+                for row in range(self.n_tiles) for col in range(self.n_tiles)]
+        self.assertEqual([image.getpixel((0, 0))[0] for image in images], expected)
+        self.assertEqual(set(image.size for image in images), {(2, 2)})
+        self.assertGreater(parts[0].bytes_read, 0)
+        self.assertGreater(TileRequestHandler.max_in_flight, 1)
+
+        # Tasks that didn't start yet are cancelled when closing.
+        fetcher = TileFetcher(n_threads=1)
+        futures = fetcher.fetch(parts)
+        fetcher.close()
+        self.assertTrue(any(f.cancelled() for f in futures))
+
+    def test_crop(self):
+        job, result = self.crop()
+        self.assertEqual(result, job.output_path)
+
+        image = Image.open(job.output_path)
+        self.assertEqual(image.n_frames, self.n_slices)
+        last = self.tile_size * self.n_tiles - 2
+        for z in range(self.n_slices):
+            image.seek(z)
+            self.assertEqual(image.mode, 'L')
+            self.assertEqual(image.getpixel((0, 0)), self.get_tile_value(z, 0, 0))
+            self.assertEqual(image.getpixel((last, 0)), self.get_tile_value(z, 0, 1))
+            self.assertEqual(image.getpixel((0, last)), self.get_tile_value(z, 1, 0))
+            self.assertEqual(image.getpixel((last, last)), self.get_tile_value(z, 1, 1))
+        image.close()
+
+    def test_crop_missing_tile(self):
+        os.remove(self.get_tile_path(1, 1, 0))
+        job, result = self.crop()
+        self.assertNotEqual(result, job.output_path)
+        self.assertIn('1/1_0_0.png', result)
+        self.assertFalse(os.path.exists(job.output_path))
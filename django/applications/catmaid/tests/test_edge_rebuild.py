@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from django.db import connection
+
+from catmaid.control.edge import (edge_table_sources, get_table_schema,
+        rebuild_edge_tables_chunked, SHADOW_SUFFIX)
+from catmaid.tests.common import CatmaidTestCase
+
+
+class EdgeRebuildTests(CatmaidTestCase):
+    """Test chunked edge table rebuilds, both in place and with shadow
+    tables that replace the edge tables.
+    """
+
+    def get_edges(self):
+        cursor = connection.cursor()
+        edges = {}
+        for edge_table in edge_table_sources:
+            geometry = 'geom' if edge_table == 'connector_geom' else 'edge'
+            cursor.execute(f"""
+                SELECT id, project_id, ST_AsText({geometry})
+                FROM {edge_table}
+                ORDER BY id
+            """)
+            edges[edge_table] = cursor.fetchall()
+        return edges
+
+    def get_schema(self):
+        cursor = connection.cursor()
+        schema = {}
+        for edge_table in edge_table_sources:
+            table_schema = get_table_schema(cursor, edge_table)
+            schema[edge_table] = {
+                'indices': sorted(table_schema['indices']),
+                'constraints': sorted(table_schema['constraints']),
+                'triggers': sorted(table_schema['triggers']),
+            }
+        return schema
+
+    def assertRebuildProgressEmpty(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM catmaid_edge_rebuild_progress")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_chunked_rebuild(self):
+        expected = self.get_edges()
+        self.assertTrue(expected['treenode_edge'])
+
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM treenode_edge WHERE id % 2 = 0")
+        n_rows = rebuild_edge_tables_chunked(chunk_size=100)
+        self.assertEqual(n_rows, dict((t, len(e)) for t, e in expected.items()))
+        self.assertEqual(self.get_edges(), expected)
+        self.assertRebuildProgressEmpty()
+
+    def test_shadow_rebuild(self):
+        expected = self.get_edges()
+        schema = self.get_schema()
+        for edge_table in edge_table_sources:
+            self.assertTrue(schema[edge_table]['indices'],
+                    f'{edge_table} has no indices')
+
+        rebuild_edge_tables_chunked(chunk_size=100, shadow=True)
+
+        # The shadow tables replaced the edge tables, with the same indices,
+        # constraints and triggers.
+        cursor = connection.cursor()
+        for edge_table in edge_table_sources:
+            cursor.execute("SELECT to_regclass(%(table)s)", {
+                'table': f'{edge_table}{SHADOW_SUFFIX}',
+            })
+            self.assertIsNone(cursor.fetchone()[0])
+        self.assertEqual(self.get_schema(), schema)
+        self.assertEqual(self.get_edges(), expected)
+        self.assertRebuildProgressEmpty()
+
+        # The triggers of the source tables update the new edge tables.
+        cursor.execute("""
+            UPDATE treenode
+            SET location_x = location_x + 10
+            WHERE id = 237
+        """)
+        cursor.execute("""
+            SELECT ST_X(ST_StartPoint(e.edge)), t.location_x
+            FROM treenode_edge e
+            JOIN treenode t
+                ON t.id = e.id
+            WHERE e.id = 237
+        """)
+        edge_x, location_x = cursor.fetchone()
+        self.assertEqual(edge_x, location_x)
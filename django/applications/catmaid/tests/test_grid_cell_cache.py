@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from django.test import TestCase
+
+from catmaid.control.gridcache import EMPTY_CELL, GridCellCache
+
+
+class GridCellCacheTests(TestCase):
+
+    def test_hit_and_miss(self):
+        cache = GridCellCache(1000, listen=False)
+        self.assertTrue(cache.is_available())
+
+        variant = ('msgpack', 1, 2)
+        self.assertEqual(cache.get((1, 0, 0, 0), variant), (False, None))
+
+        cache.put((1, 0, 0, 0), variant, [b'\x95abc', None])
+        cache.put((1, 1, 0, 0), variant, EMPTY_CELL)
+        self.assertEqual(cache.get((1, 0, 0, 0), variant), (True, [b'\x95abc', None]))
+        self.assertEqual(cache.get((1, 1, 0, 0), variant), (True, EMPTY_CELL))
+        self.assertEqual(cache.get((1, 0, 0, 0), ('msgpack', 1, 1)), (False, None))
+
+        self.assertEqual(cache.get_many([(1, 0, 0, 0), (1, 1, 0, 0)], variant),
+                [[b'\x95abc', None], EMPTY_CELL])
+        self.assertIsNone(cache.get_many([(1, 0, 0, 0), (1, 2, 0, 0)], variant))
+
+    def test_size_bound(self):
+        cache = GridCellCache(25, listen=False)
+        variant = ('json_text', 1, 1)
+        cache.put((1, 0, 0, 0), variant, ['a' * 10])
+        cache.put((1, 1, 0, 0), variant, ['b' * 10])
+        # Make first cell the most recently used one
+        cache.get((1, 0, 0, 0), variant)
+        cache.put((1, 2, 0, 0), variant, ['c' * 10])
+
+        self.assertTrue(cache.get((1, 0, 0, 0), variant)[0])
+        self.assertFalse(cache.get((1, 1, 0, 0), variant)[0])
+        self.assertTrue(cache.get((1, 2, 0, 0), variant)[0])
+        self.assertEqual(cache.size, 22)
+
+        # Values larger than the cache aren't stored
+        self.assertFalse(cache.put((1, 3, 0, 0), variant, ['d' * 30]))
+
+    def test_invalidation(self):
+        cache = GridCellCache(1000, listen=False)
+        cache.put((1, 0, 0, 0), ('msgpack', 1, 1), [b'abc'])
+        cache.put((1, 0, 0, 0), ('msgpack', 1, 2), [b'abc', b'def'])
+        cache.put((1, 0, 1, 0), ('msgpack', 1, 1), [b'ghi'])
+
+        generation = cache.generation
+        cache.handle_notification('{"grid_id": 1, "x": 0, "y": 0, "z": 0}')
+        self.assertFalse(cache.get((1, 0, 0, 0), ('msgpack', 1, 1))[0])
+        self.assertFalse(cache.get((1, 0, 0, 0), ('msgpack', 1, 2))[0])
+        self.assertTrue(cache.get((1, 0, 1, 0), ('msgpack', 1, 1))[0])
+        self.assertEqual(cache.size, 4)
+
+        # Data read before an invalidation isn't stored.
+        self.assertFalse(cache.put((1, 0, 0, 0), ('msgpack', 1, 1), [b'abc'], generation))
+        self.assertTrue(cache.put((1, 0, 0, 0), ('msgpack', 1, 1), [b'abc'], cache.generation))
+
+    def test_ttl(self):
+        cache = GridCellCache(1000, ttl=-1, listen=False)
+        cache.put((1, 0, 0, 0), ('msgpack', 1, 1), [b'abc'])
+        self.assertFalse(cache.get((1, 0, 0, 0), ('msgpack', 1, 1))[0])
+        self.assertEqual(cache.size, 0)
+
+
+class GridCacheResultSpliceTests(TestCase):
+
+    def test_msgpack_splice(self):
+        import msgpack
+        from catmaid.control.node import splice_msgpack_result
+
+        target = [[[1, None, 1.0, 2.0, 3.0]], [], {}, False, {}]
+        cell = [[[2, 1, 1.0, 2.0, 3.0]], [], {}, False, {}]
+        extra = [[[3, None, 4.0, 5.0, 6.0]], [], {}, False, {}]
+
+        result = splice_msgpack_result(msgpack.packb(target),
+                [memoryview(msgpack.packb(cell)), None], [extra])
+        self.assertEqual(msgpack.unpackb(result), target + [[cell, extra]])
+
+        result = splice_msgpack_result(msgpack.packb(target), [], [])
+        self.assertEqual(msgpack.unpackb(result), target + [[]])
+
+    def test_json_text_splice(self):
+        import ujson
+        from catmaid.control.node import splice_json_text_result
+
+        target = [[[1, None, 1.0, 2.0, 3.0]], [], {}, False, {}]
+        cell = [[[2, 1, 1.0, 2.0, 3.0]], [], {}, False, {}]
+        extra = [[[3, None, 4.0, 5.0, 6.0]], [], {}, False, {}]
+
+        result = splice_json_text_result(ujson.dumps(target),
+                [ujson.dumps(cell), None], [extra])
+        self.assertEqual(ujson.loads(result), target + [[cell, extra]])
+
+        result = splice_json_text_result(result, [ujson.dumps(cell)], [])
+        self.assertEqual(ujson.loads(result), target + [[cell, extra, cell]])
+
+        self.assertEqual(splice_json_text_result(ujson.dumps(target), [], []),
+                ujson.dumps(target))
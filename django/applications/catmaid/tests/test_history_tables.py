@@ -275,13 +275,19 @@ class HistoryTableTests(TransactionTestCase):
         'treenode_edge',
         'catmaid_history_table',
         'treenode_connector_edge',
+        'catmaid_edge_rebuild_progress',
         'connector_geom',
         'nblast_skeleton_source_type',
         'node_grid_cache_cell',
         'node_grid_cache',
         'catmaid_transaction_info',
         'catmaid_stats_summary',
+        'catmaid_stats_summary_watermark',
         'catmaid_skeleton_summary',
+        'catmaid_skeleton_reviewer_summary',
+        'catmaid_skeleton_review_summary',
+        'catmaid_skeleton_connectivity',
+        'catmaid_skeleton_connectivity_dirty',
 
         # Regular unversioned non-CATMAID tables
         'djkombu_queue',
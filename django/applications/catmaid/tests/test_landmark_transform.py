@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from django.test import TestCase
+
+from catmaid.control import landmarktransform
+from catmaid.control.landmarktransform import MovingLeastSquaresTransform
+
+
+class MovingLeastSquaresTransformTests(TestCase):
+
+    def setUp(self):
+        self.sources = np.array([
+            [0.0, 0.0, 0.0],
+            [1000.0, 0.0, 0.0],
+            [0.0, 1000.0, 0.0],
+            [0.0, 0.0, 1000.0],
+            [1000.0, 1000.0, 1000.0],
+        ])
+        # A rotation around the Z axis, a scaling and a translation.
+        self.matrix = np.array([
+            [0.0, -2.0, 0.0],
+            [2.0, 0.0, 0.0],
+            [0.0, 0.0, 0.5],
+        ])
+        self.offset = np.array([10.0, -20.0, 30.0])
+        self.targets = self.sources @ self.matrix.T + self.offset
+
+    def test_affine_mapping(self):
+        # An affine mapping of all point matches is reproduced everywhere.
+        transform = MovingLeastSquaresTransform(self.sources, self.targets)
+        self.assertEqual(len(transform), 5)
+        points = np.array([
+            [500.0, 500.0, 500.0],
+            [-300.0, 2000.0, 10.0],
+            [123.0, 456.0, 789.0],
+        ])
+        expected = points @ self.matrix.T + self.offset
+        np.testing.assert_allclose(transform.apply(points), expected, atol=1e-6)
+
+    def test_exact_hits_and_batches(self):
+        targets = self.targets.copy()
+        targets[4] += [100.0, 0.0, 0.0]
+        transform = MovingLeastSquaresTransform(self.sources, targets)
+        np.testing.assert_allclose(transform.apply(self.sources), targets)
+
+        # Results don't depend on the batch size.
+        points = np.random.RandomState(0).uniform(-500, 1500, (50, 3))
+        expected = transform.apply(points)
+        batch_distances = landmarktransform.MAX_BATCH_DISTANCES
+        try:
+            landmarktransform.MAX_BATCH_DISTANCES = 7 * len(self.sources)
+            np.testing.assert_allclose(transform.apply(points), expected)
+        finally:
+            landmarktransform.MAX_BATCH_DISTANCES = batch_distances
+
+    def test_ill_defined_matches(self):
+        with self.assertRaises(ValueError):
+            MovingLeastSquaresTransform(self.sources[:3], self.targets[:3])
+        planar = self.sources.copy()
+        planar[:, 2] = 0
+        with self.assertRaises(ValueError):
+            MovingLeastSquaresTransform(planar, self.targets)
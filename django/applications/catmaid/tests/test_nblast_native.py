@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import json
+import mock
+import numpy as np
+from unittest import skipIf
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from catmaid.control.nat import r as r_engine
+from catmaid.control.nat.native import (ScoringMatrix, make_dotprops, nblast,
+        resample_tree, score_matrix, simplify_tree)
+from catmaid.models import NblastConfig
+from catmaid.tests.common import CatmaidTestCase
+
+
+def r_nblast_available():
+    return r_engine.rnat_enaled and \
+            json.loads(r_engine.test_environment().content)['setup_ok']
+
+
+class NativeNblastTests(TestCase):
+
+    def test_scoring_matrix_lookup(self):
+        smat = ScoringMatrix([[1, 2], [3, 4]], [0, 1, 2], [0, 0.5, 1])
+        # Values outside of the breaks count towards the outer bins.
+        scores = smat.lookup(np.array([0.5, 1.5, 5, 0.0]),
+                np.array([0.2, 0.7, 1.0, 0.5]))
+        self.assertEqual(scores.tolist(), [1, 4, 4, 2])
+
+        with self.assertRaises(ValueError):
+            ScoringMatrix([[1, 2]], [0, 1, 2], [0, 0.5, 1])
+
+    def test_dotprops_of_line(self):
+        points = np.array([[x, 0.0, 0.0] for x in range(10)])
+        dps = make_dotprops(points, k=3)
+        self.assertEqual(len(dps), 10)
+        np.testing.assert_allclose(np.abs(dps.vect[:, 0]), 1.0)
+        np.testing.assert_allclose(dps.alpha, 1.0)
+
+        self.assertIsNone(make_dotprops(points[:2], k=3))
+        with self.assertRaises(ValueError):
+            make_dotprops(points[:2], k=3, omit_failures=False)
+
+    def test_simplify_tree(self):
+        # Node 1 is a branch with a long (2 -> 3) and a short (4) branch, node
+        # 5 is a short branch off of node 2.
+        parents = np.array([-1, 0, 1, 2, 1, 2])
+        positions = np.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [5, 0, 0],
+                [1, 1, 0], [2, 2, 0]], dtype=np.float64)
+        self.assertEqual(simplify_tree(parents, positions, 0).tolist(),
+                [True, True, True, True, False, False])
+        self.assertEqual(simplify_tree(parents, positions, 1).tolist(),
+                [True, True, True, True, False, True])
+        self.assertTrue(simplify_tree(parents, positions, 2).all())
+
+    def test_resample_tree(self):
+        parents = np.array([-1, 0, 1])
+        positions = np.array([[0, 0, 0], [1, 0, 0], [3, 0, 0]], dtype=np.float64)
+        points = resample_tree(parents, positions, 0.5)
+        self.assertEqual(sorted(points[:, 0].tolist()),
+                [0.0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0])
+
+    def test_normalized_self_score(self):
+        smat = ScoringMatrix([[2, 5], [-1, 0]], [0, 1, 10], [0, 0.5, 1])
+        a = make_dotprops(np.array([[x, 0.0, 0.0] for x in range(10)]), k=3)
+        b = make_dotprops(np.array([[0.0, y, 0.0] for y in range(10)]), k=3)
+
+        scores = score_matrix([a, b], [a, b], smat)
+        self.assertEqual(scores.tolist(), [[50, -7], [-7, 50]])
+
+        scores = score_matrix([a, b], [a, b], smat, normalized=True)
+        np.testing.assert_allclose(np.diag(scores), 1.0)
+
+    def get_reference_pair(self):
+        """Two parallel lines along the X axis, 1.5 apart, and a line along
+        the Y axis that starts next to the end of both.
+        """
+        smat = ScoringMatrix([[8, 4], [2, 6], [-3, -1]], [0, 1, 2, 5], [0, 0.5, 1])
+        dps = [make_dotprops(np.array(points, dtype=np.float64), k=3) for points in (
+                [[x, 0, 0] for x in range(10)],
+                [[x, 1.5, 0] for x in range(10)],
+                [[10, y, 0] for y in range(10)])]
+        return smat, dps
+
+    def test_reference_scores(self):
+        # The scores nat.nblast's NeuriteBlast() computes for these lines: each
+        # query point is scored by the distance to its nearest target point
+        # and the absolute dot product of both tangents. Like findInterval(),
+        # distances on a break belong to the bin that starts with it.
+        smat, dps = self.get_reference_pair()
+        np.testing.assert_allclose(score_matrix(dps, dps, smat), [
+            [40, 60, -25],
+            [60, 40, -25],
+            [-20, -10, 40],
+        ])
+
+    @override_settings(NBLAST_ALL_BY_ALL_MIN_SIZE=1)
+    def test_score_matrix_in_daemonic_process(self):
+        # Daemonic processes, like Celery workers, can't have a process pool.
+        smat, dps = self.get_reference_pair()
+        expected = score_matrix(dps, dps, smat)
+        with mock.patch('catmaid.control.nat.native.current_process') as current_process, \
+                mock.patch('catmaid.control.nat.native.Pool') as pool:
+            current_process.return_value.daemon = True
+            scores = score_matrix(dps, dps, smat, n_workers=2)
+            pool.assert_not_called()
+        np.testing.assert_array_equal(scores, expected)
+
+
+class NativeNblastSkeletonTests(CatmaidTestCase):
+    """Compute NBLAST scores for skeletons of the test project.
+    """
+
+    query_ids = [235, 361, 373]
+    target_ids = [2364, 2388, 2411]
+
+    def setUp(self):
+        super().setUp()
+        self.config = NblastConfig.objects.create(project_id=self.test_project_id,
+                user=self.user, name='Test config', status='complete',
+                distance_breaks=[0, 0.5, 1, 2, 5, 10, 50],
+                dot_breaks=[0, 0.25, 0.5, 0.75, 1],
+                scoring=[[8, 6, 4, 2], [6, 5, 3, 1], [4, 3, 2, 0],
+                        [1, 0, 0, -1], [-1, -1, -2, -2], [-3, -3, -3, -3]],
+                tangent_neighbors=3, engine='native')
+
+    def compute(self, engine=nblast, **kwargs):
+        params = {
+            'min_nodes': 0,
+            'simplify': False,
+            'use_cache': False,
+            'resample_by': 100,
+        }
+        params.update(kwargs)
+        result = engine(self.test_project_id, self.user.id, self.config.id,
+                self.query_ids, self.target_ids, **params)
+        self.assertEqual(result['errors'], [])
+        return result
+
+    def test_top_n(self):
+        full = self.compute()
+        full_scores = np.array(full['similarity'])
+        result = self.compute(top_n=1)
+        self.assertEqual(result['query_object_ids'], full['query_object_ids'])
+
+        # Each row only contains the best forward match of its query object.
+        for row, full_row in zip(result['similarity'], full_scores):
+            best_target = full['target_object_ids'][int(np.argmax(full_row))]
+            matches = [(target, score) for target, score in
+                    zip(result['target_object_ids'], row) if not np.isnan(score)]
+            self.assertEqual(matches, [(best_target, full_row.max())])
+
+        best_targets = set(full['target_object_ids'][i]
+                for i in np.argmax(full_scores, axis=1))
+        self.assertEqual(set(result['target_object_ids']), best_targets)
+
+    @skipIf(not r_nblast_available(), 'R NBLAST packages are not installed')
+    def test_r_engine_scores(self):
+        # Both engines resample and compute tangents slightly differently,
+        # which is why scores are compared with a tolerance.
+        for normalized in ('raw', 'normalized', 'mean'):
+            native_result = self.compute(normalized=normalized)
+            r_result = self.compute(r_engine.nblast, normalized=normalized)
+            self.assertEqual(native_result['query_object_ids'],
+                    r_result['query_object_ids'])
+            self.assertEqual(native_result['target_object_ids'],
+                    r_result['target_object_ids'])
+            np.testing.assert_allclose(native_result['similarity'],
+                    r_result['similarity'], rtol=0.1, atol=0.1)
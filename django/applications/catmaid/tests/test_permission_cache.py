@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from guardian.shortcuts import remove_perm
+
+from catmaid.control.permissioncache import (PermissionCache,
+        get_permission_cache, get_permission_cache_key)
+from catmaid.models import UserRole
+
+from .apis.common import CatmaidApiTestMixin
+
+
+class PermissionCacheTests(CatmaidApiTestMixin, TestCase):
+
+    def test_hit_miss_and_expiration(self):
+        cache = PermissionCache(ttl=10)
+        key = get_permission_cache_key(self.test_user, '3',
+                [UserRole.Browse, UserRole.Annotate])
+        self.assertEqual(key, get_permission_cache_key(self.test_user, 3,
+                [UserRole.Annotate, UserRole.Browse]))
+        self.assertNotEqual(key, get_permission_cache_key(self.test_user, 3,
+                [UserRole.Annotate, UserRole.Browse], True))
+
+        self.assertIsNone(cache.get(key))
+        self.assertTrue(cache.put(key, False))
+        self.assertEqual(cache.get(key), False)
+
+        # Results computed before an invalidation aren't stored.
+        generation = cache.generation
+        cache.clear()
+        self.assertFalse(cache.put(key, True, generation))
+        self.assertIsNone(cache.get(key))
+
+        cache.put(key, True)
+        cache.entries[key] = (time.time() - 11, True)
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+    @override_settings(PERMISSION_CACHE_TTL=60)
+    def test_requires_user_role(self):
+        cache = get_permission_cache()
+        self.client.force_login(self.test_user)
+        url = f'/{self.test_project_id}/skeletons/'
+
+        before = cache.stats()
+        self.assertStatus(self.client.get(url))
+        self.assertStatus(self.client.get(url))
+        after = cache.stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+        # Permission changes clear the cache
+        remove_perm('can_annotate', self.test_user, self.test_project)
+        self.assertEqual(cache.stats()['n_entries'], 0)
+        self.assertGreater(cache.stats()['generation'], after['generation'])
+        self.assertStatus(self.client.get(url))
+        self.assertEqual(cache.stats()['misses'] - after['misses'], 1)
+
+    @override_settings(PERMISSION_CACHE_TTL=0)
+    def test_disabled(self):
+        self.assertIsNone(get_permission_cache())
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.connectivity import (check_skeleton_connectivity,
+        get_summarized_links, update_dirty_skeleton_connectivity)
+from catmaid.control.connector import _many_to_many_synapses
+from catmaid.control.graph2 import basic_graph
+from catmaid.control.skeleton import get_connectivity_matrix
+from catmaid.models import TreenodeConnector
+
+from .apis.common import CatmaidApiTestMixin
+
+
+class SkeletonConnectivitySummaryTests(CatmaidApiTestMixin, TestCase):
+
+    skeleton_ids = [235, 361, 373, 2364, 2388, 2411]
+
+    def update_summary(self):
+        while update_dirty_skeleton_connectivity(cursor=connection.cursor()):
+            pass
+
+    def get_results(self):
+        matrix = get_connectivity_matrix(self.test_project_id,
+                self.skeleton_ids, self.skeleton_ids)
+        graph = basic_graph(self.test_project_id, self.skeleton_ids)
+        synapses = _many_to_many_synapses(self.skeleton_ids, self.skeleton_ids,
+                'presynaptic_to', self.test_project_id)
+        return (dict(matrix), sorted(graph['edges']), sorted(synapses))
+
+    def test_summary_matches_links(self):
+        with override_settings(SKELETON_CONNECTIVITY_SUMMARY=False):
+            expected = self.get_results()
+
+        # All skeletons of the fixture are marked dirty when their links are
+        # created.
+        relations = get_relation_to_id_map(self.test_project_id)
+        self.assertIsNone(get_summarized_links(self.test_project_id,
+                self.skeleton_ids, self.skeleton_ids,
+                relations['presynaptic_to'], relations['postsynaptic_to']))
+
+        self.update_summary()
+        self.assertEqual([], check_skeleton_connectivity(self.test_project_id))
+        self.assertEqual(expected, self.get_results())
+        self.assertEqual({
+                235: {361: 1, 373: 2},
+                2388: {2364: 1},
+                2411: {2364: 1},
+            }, expected[0])
+
+    def test_changed_skeletons_fall_back_to_links(self):
+        self.update_summary()
+
+        # A changed link marks its skeleton as dirty, the summary isn't used
+        # anymore until it is updated.
+        link = TreenodeConnector.objects.filter(skeleton_id=2411).first()
+        link.confidence = 1
+        link.save()
+        with override_settings(SKELETON_CONNECTIVITY_SUMMARY=False):
+            expected = self.get_results()
+        self.assertEqual(expected, self.get_results())
+
+        self.update_summary()
+        self.assertEqual(expected, self.get_results())
+
+        # Changes made without triggers are found by the consistency check.
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE catmaid_skeleton_connectivity
+            SET n_links = n_links + 1
+            WHERE source_skeleton_id = 235
+        """)
+        mismatches = check_skeleton_connectivity(self.test_project_id, [235])
+        self.assertTrue(mismatches)
+        self.assertTrue(all(235 in m[:2] for m in mismatches))
+
+    def test_duplicate_skeleton_ids(self):
+        self.update_summary()
+        expected = self.get_results()
+
+        # Repeated skeleton IDs don't count links more than once.
+        relations = get_relation_to_id_map(self.test_project_id)
+        links = get_summarized_links(self.test_project_id, self.skeleton_ids,
+                self.skeleton_ids, relations['presynaptic_to'],
+                relations['postsynaptic_to'])
+        self.skeleton_ids = self.skeleton_ids + self.skeleton_ids
+        self.assertEqual(sorted(links), sorted(get_summarized_links(
+                self.test_project_id, self.skeleton_ids, self.skeleton_ids,
+                relations['presynaptic_to'], relations['postsynaptic_to'])))
+        self.assertEqual(expected, self.get_results())
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from math import sqrt
+import numpy as np
+
+from django.test import TestCase
+
+from catmaid.control.skeletonexport import (arbor_node_dtype, get_path_sums,
+        measure_arbors)
+
+
+class SkeletonMeasurementTests(TestCase):
+
+    def test_path_sums(self):
+        parents = np.array([-1, 0, 1, 1, 3])
+        values = np.array([0, 1, 2, 3, 4])
+        self.assertEqual(get_path_sums(parents, values).tolist(), [0, 1, 3, 4, 8])
+
+    def test_measure_arbors(self):
+        nodes = np.array([
+            # Skeleton 10, node 2 is a branch, node 4 a slab node
+            (4, 2, 10, 10.0, 10.0, 0.0),
+            (1, -1, 10, 0.0, 0.0, 0.0),
+            (2, 1, 10, 10.0, 0.0, 0.0),
+            (3, 2, 10, 20.0, 0.0, 0.0),
+            (5, 4, 10, 20.0, 10.0, 0.0),
+            # Skeleton 20 has only a single node
+            (6, -1, 20, 5.0, 5.0, 5.0),
+        ], dtype=arbor_node_dtype)
+
+        measurements = measure_arbors(nodes)
+        self.assertEqual(sorted(measurements.keys()), [10, 20])
+
+        m = measurements[10]
+        self.assertEqual(m.n_nodes, 5)
+        self.assertEqual(m.n_ends, 3)
+        self.assertEqual(m.n_branch, 1)
+        self.assertAlmostEqual(m.raw_cable, 40.0)
+        # Node 4 moves to (13, 7, 0)
+        self.assertAlmostEqual(m.smooth_cable, 20.0 + 2 * sqrt(58))
+        self.assertAlmostEqual(m.principal_branch_cable, 10.0 + 2 * sqrt(58))
+
+        m = measurements[20]
+        self.assertEqual(m.get_morphology(), (1, 0.0, 0.0, 0.0, 0, 0))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import networkx as nx
+import numpy as np
+
+from django.test import TestCase
+
+from catmaid.control.synapseclustering import (TreeDensityField,
+        array_tree_max_density, tree_max_density)
+from catmaid.control.tree_util import ArrayTree
+
+
+class SynapseClusteringTests(TestCase):
+
+    def setUp(self):
+        # A path of ten nodes, 1000 nm apart, with a side branch of two nodes
+        # at node 5.
+        rows = [(i, i - 1 if i > 1 else None, (i - 1) * 1000.0, 0.0, 0.0)
+                for i in range(1, 11)]
+        rows.extend([(11, 5, 4000.0, 1000.0, 0.0), (12, 11, 4000.0, 2000.0, 0.0)])
+        self.tree = ArrayTree.from_rows(rows, with_locations=True)
+        # Two groups of synapses, centered on node 2 and node 8.
+        self.synapse_nodes = [1, 2, 2, 3, 7, 8, 9]
+        self.connector_ids = [101, 102, 103, 104, 107, 108, 109]
+        self.relations = [1, 1, 2, 1, 2, 2, 2]
+
+    def test_density(self):
+        tree = self.tree
+        syn_indices = tree.indices(self.synapse_nodes)
+        h = 2000.0
+        # Every synapse node counts once, distances are along the cable.
+        expected = np.zeros(len(tree))
+        for i in np.unique(syn_indices):
+            d = tree.reroot(i).root_distances()
+            expected += np.exp(-d * d / (h * h))
+
+        field = TreeDensityField(tree, syn_indices, cutoff=np.inf)
+        self.assertTrue(np.allclose(field.density(h), expected))
+
+        # With a cutoff, far away synapses don't contribute
+        field = TreeDensityField(tree, syn_indices, cutoff=1.0)
+        density = field.density(1000.0)
+        self.assertAlmostEqual(density[tree.index(5)], 0.0)
+        self.assertAlmostEqual(density[tree.index(1)], 1 + np.exp(-1))
+
+    def test_groups(self):
+        timings = {}
+        groups = array_tree_max_density(self.tree, self.synapse_nodes,
+                self.connector_ids, self.relations, [10000, 1000],
+                timings=timings)
+        self.assertEqual(list(groups.keys()), [10000, 1000])
+        self.assertEqual(sorted(timings.keys()), [1000, 10000])
+
+        small = sorted((sorted(g.connector_ids), g.local_max)
+                for g in groups[1000].values())
+        self.assertEqual(small, [([101, 102, 103, 104], 2), ([107, 108, 109], 8)])
+        # With a large bandwidth, all synapses climb to the center.
+        self.assertEqual([g.local_max for g in groups[10000].values()], [5])
+
+        # The networkx based interface returns the same groups.
+        graph = nx.Graph()
+        for child in np.flatnonzero(self.tree.parents >= 0):
+            graph.add_edge(int(self.tree.node_ids[self.tree.parents[child]]),
+                    int(self.tree.node_ids[child]),
+                    weight=self.tree.edge_lengths[child])
+        nx_groups = tree_max_density(graph, self.synapse_nodes,
+                self.connector_ids, self.relations, [1000])
+        self.assertEqual(sorted((sorted(g.connector_ids), g.local_max)
+                for g in nx_groups[1000].values()), small)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+from unittest import skipIf
+
+import numpy as np
+
+from django.test import TestCase, override_settings
+
+from catmaid.control.tile import (EncodedTileCache, HDF5FilePool,
+        get_hdf5_file_pool, get_hdf5_tile, get_hdf5_tile_cache,
+        tile_loading_enabled)
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def write_hdf5_file(path, data, scale=0, z=0):
+    with h5py.File(path, 'w') as hfile:
+        hfile.create_dataset(f'/{scale}/{z}/data', data=data)
+
+
+def replace_hdf5_file(path, data):
+    """Replace a HDF5 file with a new one, which gets a later modification
+    time, without writing to the old file, which might be open.
+    """
+    mtime = os.stat(path).st_mtime
+    write_hdf5_file(path + '.new', data)
+    os.replace(path + '.new', path)
+    os.utime(path, (mtime + 10, mtime + 10))
+
+
+@skipIf(not tile_loading_enabled, 'HDF5 tile loading is disabled')
+class HDF5TileTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        get_hdf5_file_pool().clear()
+        self.addCleanup(get_hdf5_file_pool().clear)
+        cache = get_hdf5_tile_cache()
+        if cache:
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    def get_path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_file_pool_reopens_changed_files(self):
+        path = self.get_path('a.hdf')
+        write_hdf5_file(path, np.full((4, 4), 1, dtype=np.uint8))
+        pool = HDF5FilePool(max_size=2)
+        self.addCleanup(pool.clear)
+
+        with pool.open(path) as hfile:
+            first_handle = hfile
+            self.assertEqual(hfile['/0/0/data'][0, 0], 1)
+        with pool.open(path) as hfile:
+            self.assertIs(hfile, first_handle)
+
+        replace_hdf5_file(path, np.full((4, 4), 2, dtype=np.uint8))
+        with pool.open(path) as hfile:
+            self.assertIsNot(hfile, first_handle)
+            self.assertEqual(hfile['/0/0/data'][0, 0], 2)
+        self.assertFalse(first_handle.id.valid)
+        self.assertEqual(len(pool.handles), 1)
+
+        with self.assertRaises(OSError):
+            with pool.open(self.get_path('missing.hdf')):
+                pass
+
+    def test_file_pool_eviction(self):
+        paths = []
+        for name in ('a', 'b', 'c'):
+            path = self.get_path(f'{name}.hdf')
+            write_hdf5_file(path, np.zeros((4, 4), dtype=np.uint8))
+            paths.append(path)
+        a, b, c = paths
+        pool = HDF5FilePool(max_size=2)
+        self.addCleanup(pool.clear)
+
+        handles = {}
+        for path in paths:
+            with pool.open(path) as hfile:
+                handles[path] = hfile
+        # The least recently used file is closed.
+        self.assertEqual(list(pool.handles.keys()), [b, c])
+        self.assertFalse(handles[a].id.valid)
+        self.assertTrue(handles[b].id.valid)
+
+        # Using a file makes it the most recently used one.
+        with pool.open(b):
+            pass
+        with pool.open(a):
+            pass
+        self.assertEqual(list(pool.handles.keys()), [b, a])
+        self.assertFalse(handles[c].id.valid)
+
+        pool.invalidate(b)
+        self.assertEqual(list(pool.handles.keys()), [a])
+        self.assertFalse(handles[b].id.valid)
+
+    def test_tile_cache_eviction(self):
+        cache = EncodedTileCache(10)
+        cache.put('a', b'1234')
+        cache.put('b', b'5678')
+        self.assertEqual(cache.get('a'), b'1234')
+        cache.put('c', b'90ab')
+        # "b" is the least recently used entry
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1234')
+        self.assertEqual(cache.size, 8)
+        # Values larger than the cache aren't stored
+        cache.put('d', b'0123456789abc')
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.size, 8)
+
+    def test_get_tile_invalidation(self):
+        data = np.arange(64, dtype=np.uint8).reshape(8, 8)
+        path = self.get_path('1_2_raw.hdf')
+        write_hdf5_file(path, data)
+
+        def get_tile(x, y):
+            response = get_hdf5_tile(1, 2, 0, 4, 4, x, y, 0, 'y', 'x', 'raw', 'raw')
+            self.assertEqual(response['Content-Type'], 'application/octet-stream')
+            return np.frombuffer(response.content, dtype=np.uint8).reshape(4, 4)
+
+        with override_settings(HDF5_STORAGE_PATH=self.tmp.name):
+            np.testing.assert_array_equal(get_tile(0, 0), data[:4, :4])
+            # Parts outside of the data set are zero
+            expected = np.zeros((4, 4), dtype=np.uint8)
+            expected[:2, :2] = data[6:, 6:]
+            np.testing.assert_array_equal(get_tile(6, 6), expected)
+
+            # A changed file invalidates both its pooled handle and its
+            # cached tiles.
+            replace_hdf5_file(path, data + 1)
+            np.testing.assert_array_equal(get_tile(0, 0), data[:4, :4] + 1)
+
+            # Missing files result in empty tiles
+            os.remove(path)
+            np.testing.assert_array_equal(get_tile(0, 0), np.zeros((4, 4)))
@@ -17,7 +17,8 @@ from catmaid.control import (authentication, user, group, log, message, client,
         classification, notifications, roi, clustering, volume, noop,
         useranalytics, user_evaluation, search, graphexport, transaction,
         graph2, circles, analytics, review, wiringdiagram, object, sampler,
-        similarity, nat, origin, point, landmarks, pointcloud, pointset, painting)
+        similarity, nat, origin, point, landmarks, pointcloud, pointset, painting,
+        neuroglancer)
 
 from catmaid.history import record_request_action as record_view
 from catmaid.views import CatmaidView
@@ -138,6 +139,7 @@ urlpatterns += [
 # Tile access
 urlpatterns += [
     url(r'^(?P<project_id>\d+)/stack/(?P<stack_id>\d+)/tile$', tile.get_tile),
+    url(r'^(?P<project_id>\d+)/stack/(?P<stack_id>\d+)/tiles$', tile.get_tiles),
     url(r'^(?P<project_id>\d+)/stack/(?P<stack_id>\d+)/put_tile$', tile.put_tile),
 ]
 
@@ -314,6 +316,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeletons/in-bounding-box$', skeleton.skeletons_in_bounding_box),
     url(r'^(?P<project_id>\d+)/skeleton/connectivity_matrix$', skeleton.connectivity_matrix),
     url(r'^(?P<project_id>\d+)/skeletons/connectivity_matrix/csv$', skeleton.connectivity_matrix_csv),
+    url(r'^(?P<project_id>\d+)/skeletons/connectivity_matrix/export$', skeleton.connectivity_matrix_export),
     url(r'^(?P<project_id>\d+)/skeletons/review-status$', skeleton.review_status),
     url(r'^(?P<project_id>\d+)/skeletons/from-origin$', skeleton.from_origin),
     url(r'^(?P<project_id>\d+)/skeletons/origin$', skeleton.origin_info),
@@ -364,7 +367,10 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeletons/partners-by-connector$', skeletonexport.partners_by_connector),
     url(r'^(?P<project_id>\d+)/skeletons/connector-polyadicity$', skeletonexport.connector_polyadicity),
     url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/compact-detail$', skeletonexport.compact_skeleton_detail),
-    url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/neuroglancer$', skeletonexport.neuroglancer_skeleton),
+    url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/neuroglancer$', neuroglancer.skeleton_data),
+    url(r'^(?P<project_id>\d+)/skeletons/neuroglancer/info$', neuroglancer.skeleton_info),
+    url(r'^(?P<project_id>\d+)/skeletons/neuroglancer/segment_properties/info$', neuroglancer.segment_properties_info),
+    url(r'^(?P<project_id>\d+)/skeletons/neuroglancer/(?P<skeleton_id>\d+)$', neuroglancer.skeleton_data),
     url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/node-overview$', skeletonexport.treenode_overview),
     url(r'^(?P<project_id>\d+)/skeletons/compact-detail$', skeletonexport.compact_skeleton_detail_many),
     # Marked as deprecated, but kept for backwards compatibility
@@ -380,6 +386,7 @@ urlpatterns += [
 # Pointclouds
 urlpatterns += [
     url(r'^(?P<project_id>\d+)/pointclouds/$', pointcloud.PointCloudList.as_view()),
+    url(r'^(?P<project_id>\d+)/pointclouds/upload$', pointcloud.PointCloudUpload.as_view()),
     url(r'^(?P<project_id>\d+)/pointclouds/(?P<pointcloud_id>\d+)/$', pointcloud.PointCloudDetail.as_view()),
     url(r'^(?P<project_id>\d+)/pointclouds/(?P<pointcloud_id>\d+)/images/(?P<image_id>\d+)/$', pointcloud.PointCloudImageDetail.as_view()),
 ]
@@ -527,6 +534,7 @@ urlpatterns += [
     url(rf'^(?P<project_id>{integer})/landmarks/groups/$', landmarks.LandmarkGroupList.as_view()),
     url(rf'^(?P<project_id>{integer})/landmarks/groups/import$', landmarks.LandmarkGroupImport.as_view()),
     url(rf'^(?P<project_id>{integer})/landmarks/groups/materialize$', landmarks.LandmarkGroupMaterializer.as_view()),
+    url(rf'^(?P<project_id>{integer})/landmarks/groups/transform$', landmarks.LandmarkGroupTransformation.as_view()),
     url(rf'^(?P<project_id>{integer})/landmarks/groups/links/$', landmarks.LandmarkGroupLinks.as_view()),
     url(rf'^(?P<project_id>{integer})/landmarks/groups/links/(?P<link_id>[0-9]+)/$',
             landmarks.LandmarkGroupLinkDetail.as_view()),
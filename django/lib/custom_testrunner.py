@@ -11,7 +11,10 @@ class TestSuiteRunner(DiscoverRunner):
         super(TestSuiteRunner, self).__init__(*args, **kwargs)
 
     def setup_test_environment(self, **kwargs):
-        '''Override STATICFILES_STORAGE and pipeline DEBUG.'''
+        '''Override STATICFILES_STORAGE, pipeline DEBUG and the permission cache.'''
         super().setup_test_environment(**kwargs)
         settings.STATICFILES_STORAGE = 'pipeline.storage.NonPackagingPipelineStorage'
         pipeline_settings.DEBUG = True
+        # Permission changes are rolled back between tests without any signal,
+        # cached permission checks could outlive them.
+        settings.PERMISSION_CACHE_TTL = 0
@@ -180,6 +180,12 @@ AUTHENTICATION_BACKENDS = (
 # for admin accounts.
 REQUIRE_EXTRA_TOKEN_PERMISSIONS = True
 
+# Results of the permission checks of API endpoints are kept in a process local
+# cache for this many seconds, 0 disables the cache. Permission changes made in
+# a process clear its cache immediately, other processes pick them up once their
+# entries expire.
+PERMISSION_CACHE_TTL = 10
+
 # Main ASGI router for CATMAID
 ASGI_APPLICATION = "mysite.routing.application"
 
@@ -262,6 +268,23 @@ MEDIA_CACHE_SUBDIRECTORY = 'cache'
 CROPPING_OUTPUT_FILE_EXTENSION = "tiff"
 CROPPING_OUTPUT_FILE_PREFIX = "crop_"
 CROPPING_VERIFY_CERTIFICATES = True
+# The number of threads that fetch image tiles of a single cropping job in
+# parallel. They share a single HTTP session.
+CROPPING_TILE_FETCH_THREADS = 8
+
+# Back-end CloudVolume tiles use a process wide pool of CloudVolume handles.
+# Handles and the cached list of available scale levels expire after the
+# following number of seconds. At most CLOUDVOLUME_HANDLE_POOL_SIZE handles are
+# kept per process.
+CLOUDVOLUME_HANDLE_TTL = 300
+CLOUDVOLUME_HANDLE_POOL_SIZE = 32
+
+# HDF5 tiles are read from a per process pool of open HDF5 files, which holds
+# at most HDF5_FILE_POOL_SIZE files. Encoded HDF5 tiles are cached in a LRU
+# cache of HDF5_TILE_CACHE_SIZE bytes per process, 0 disables it. Both are
+# invalidated if a file's modification time changes.
+HDF5_FILE_POOL_SIZE = 16
+HDF5_TILE_CACHE_SIZE = 33554432
 
 # The maximum allowed size in Bytes for generated files. The cropping tool, for
 # instance, uses this to cancel a request if the generated file grows larger
@@ -275,6 +298,10 @@ IMPORTED_SKELETON_FILE_MAXIMUM_SIZE = 5242880
 # The maximum allowed image size for imported images. The default is 3MB.
 IMPORTED_IMAGE_FILE_MAXIMUM_SIZE = 3145728
 
+# The maximum allowed size in bytes of packed point data uploaded as point
+# cloud. The default is 256 MB, which is about 22 million points.
+POINTCLOUD_UPLOAD_MAXIMUM_SIZE = 268435456
+
 # The maximum allowd body data size, default is 10 MB.
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 8 * 1024**2
 
@@ -363,9 +390,11 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'catmaid.tasks.cleanup_cropped_stacks',
         'schedule': crontab(hour=23, minute=30)
     },
-    # Update project statistics every night at 23:45.
+    # Update project statistics every night at 23:45. Only changes since the
+    # last update are processed. The update_project_statistics_from_scratch
+    # task rebuilds all statistics and is meant for manual use only.
     'daily-project-stats-summary-update': {
-        'task': 'catmaid.tasks.update_project_statistics_from_scratch',
+        'task': 'catmaid.tasks.update_project_statistics',
         'schedule': crontab(hour=23, minute=45)
     },
     'daily-inactive-user-update': {
@@ -512,11 +541,27 @@ DEFAULT_CACHE_GRID_CELL_WIDTH = 25000
 DEFAULT_CACHE_GRID_CELL_HEIGHT = 25000
 DEFAULT_CACHE_GRID_CELL_DEPTH = 40
 
+# Web server processes can keep recently used node grid cache cells in a
+# process local LRU cache, which avoids database queries for cells that were
+# served before. This defines the maximum size of this cache in bytes of
+# encoded cell data, 0 disables it (e.g. 256 * 1024**2 for 256 MiB). Cached
+# cells are invalidated through the "catmaid.dirty-cache" event and expire
+# after NODE_GRID_CACHE_LRU_TTL seconds.
+NODE_GRID_CACHE_LRU_SIZE = 0
+NODE_GRID_CACHE_LRU_TTL = 300
+
 # Whether Postgres should emit "catmaid.spatial-update" events on changes of
 # spatial data (e.g. inserts, updates and deletions of treenodes, connectors and
 # connector links).
 SPATIAL_UPDATE_NOTIFICATIONS = False
 
+# Connectivity queries between skeletons (e.g. the connectivity matrix and the
+# graph widget) can read link counts from a summary table instead of joining
+# connector links. Skeletons that have been changed since the summary was last
+# updated by the "catmaid_update_skeleton_connectivity" management command are
+# always read from the connector link table.
+SKELETON_CONNECTIVITY_SUMMARY = True
+
 # On statup, the default client instance settings can be populated based on a
 # JSON string, representing a list of objects with a "key" field and a "value"
 # field. These settings will only be applied if they exist already.